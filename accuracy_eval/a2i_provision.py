@@ -12,6 +12,8 @@ from aws_cdk import (
     Environment,
     Duration,
     aws_s3_notifications,
+    aws_sqs as _sqs,
+    aws_lambda_event_sources as _lambda_event_sources,
     aws_stepfunctions as _aws_stepfunctions,
     RemovalPolicy,
     custom_resources as cr,
@@ -31,15 +33,19 @@ from accuracy_eval.constant import *
 from iam_role.lambda_provision_role import create_role as lambda_provision_role
 from iam_role.lambda_custom_resource_lambda_role import create_role as lambda_custom_res_role
 from iam_role.lambda_s3_trigger_role import create_role as create_lambda_s3_trigger_role
+from iam_role.lambda_upload_index_role import create_role as create_lambda_upload_index_role
+from accuracy_eval.layer_provision import create_common_layer
+from helper.static_site import StaticSiteSignedCookies
 
 class A2iProvision(NestedStack):
     instance_hash = None
     region = None
     account_id = None
     ouput_cognito_user_pool_id = None
+    output_image_cdn_key_pair_id = ""
     user_emails = None
 
-    def __init__(self, scope: Construct, construct_id: str, instance_hash_code, user_emails, **kwargs) -> None:
+    def __init__(self, scope: Construct, construct_id: str, instance_hash_code, user_emails, image_cdn=None, image_normalization=IMAGE_NORMALIZATION, **kwargs) -> None:
         super().__init__(scope, construct_id, **kwargs)
         self.instance_hash = instance_hash_code #str(uuid.uuid4())[0:5]
         self.user_emails = user_emails
@@ -63,6 +69,24 @@ class A2iProvision(NestedStack):
                 allowed_origins=["*"])
             ])
             
+        # Optional CloudFront distribution for the task images (input/), accessed with signed cookies
+        if image_cdn is not None:
+            with open(image_cdn["imageCdnPublicKeyFile"]) as f:
+                public_key_pem = f.read()
+            image_site = StaticSiteSignedCookies(self, "image-cdn",
+                bucket=s3_bucket,
+                public_key_pem=public_key_pem,
+                path_pattern=S3_INPUT_PREFIX + "*",
+                site_domain_name=image_cdn["imageCdnDomainName"],
+                hosted_zone_id=image_cdn["imageCdnHostedZoneId"],
+                hosted_zone_name=image_cdn["imageCdnHostedZoneName"],
+                domain_certificate_arn=image_cdn.get("imageCdnCertificateArn"))
+            self.output_image_cdn_key_pair_id = image_site.public_key.public_key_id
+            CfnOutput(self, id="ImageCdnDomainName", value=image_cdn["imageCdnDomainName"], export_name="ImageCdnDomainName")
+
+        # Create Lambda layer: shared library
+        common_layer = create_common_layer(self)
+
         # Create Lambdas
         # Lambda: cm-accuracy-eval-task-s3-a2i-etl
         lambda_s3_trigger = _lambda.Function(self, 
@@ -71,23 +95,101 @@ class A2iProvision(NestedStack):
             runtime=_lambda.Runtime.PYTHON_3_9,
             handler='cm-accuracy-eval-task-s3-a2i-etl.lambda_handler',
             code=_lambda.Code.from_asset(os.path.join("./", "lambda/task/s3-trigger")),
-            timeout=Duration.seconds(30),
+            timeout=Duration.seconds(A2I_ETL_LAMBDA_TIMEOUT_S),
             role=create_lambda_s3_trigger_role(self,bucket_name, self.region, self.account_id),
             memory_size=5120,
             environment={
              'DYNAMODB_TABLE_PREFIX': f'{DYNAMOBD_DETAIL_TABLE_PREFIX}-{self.instance_hash}',
              'DYNAMODB_TASK_TABLE': DYNAMOBD_TASK_TABLE_PREFIX + f"-{self.instance_hash}",
              'DYNAMODB_INDEX_NAME': DYNAMOBD_DETAIL_TABLE_LABELED_INDEX_NAME,
-            }
+             'S3_DERIVED_PREFIX': S3_DERIVED_PREFIX,
+            },
+            layers=[common_layer]
+        )
+        # SQS queue buffering the A2I output notifications, with a dead-letter queue for outputs failing repeatedly
+        a2i_output_dlq = _sqs.Queue(self,
+            id='a2i-output-dlq',
+            queue_name=f"{A2I_OUTPUT_QUEUE_PREFIX}-dlq-{self.instance_hash}",
+            retention_period=Duration.days(14),
+            removal_policy=RemovalPolicy.DESTROY
         )
-        # create s3 notification for lambda function
+        a2i_output_queue = _sqs.Queue(self,
+            id='a2i-output-queue',
+            queue_name=f"{A2I_OUTPUT_QUEUE_PREFIX}-{self.instance_hash}",
+            # AWS recommends 6 times the function timeout for Lambda event sources
+            visibility_timeout=Duration.seconds(A2I_ETL_LAMBDA_TIMEOUT_S * 6),
+            dead_letter_queue=_sqs.DeadLetterQueue(max_receive_count=A2I_OUTPUT_MAX_RECEIVE_COUNT, queue=a2i_output_dlq),
+            removal_policy=RemovalPolicy.DESTROY
+        )
+        # create s3 notification for the queue
         s3_bucket.add_event_notification(
                 _s3.EventType.OBJECT_CREATED, 
-                aws_s3_notifications.LambdaDestination(lambda_s3_trigger), 
+                aws_s3_notifications.SqsDestination(a2i_output_queue), 
                 _s3.NotificationKeyFilter(
                     prefix=S3_A2I_PREFIX,
                     suffix=".json",
                 ))
+        lambda_s3_trigger.add_event_source(_lambda_event_sources.SqsEventSource(a2i_output_queue,
+            batch_size=A2I_OUTPUT_BATCH_SIZE,
+            max_batching_window=Duration.seconds(A2I_OUTPUT_BATCH_WINDOW_S),
+            report_batch_item_failures=True
+        ))
+
+        # Upload index: one item per uploaded object, with the task's running counts
+        upload_index_table = _dynamodb.Table(self, 
+            id='upload-index-table', 
+            table_name=f'{DYNAMOBD_UPLOAD_INDEX_TABLE_PREFIX}-{self.instance_hash}', 
+            partition_key=_dynamodb.Attribute(name='task_id', type=_dynamodb.AttributeType.STRING),
+            sort_key=_dynamodb.Attribute(name='key', type=_dynamodb.AttributeType.STRING),
+            billing_mode=_dynamodb.BillingMode.PAY_PER_REQUEST,
+            time_to_live_attribute='ttl',
+            removal_policy=RemovalPolicy.DESTROY
+        ) 
+        # Lambda: cm-accuracy-eval-task-upload-index
+        lambda_upload_index = _lambda.Function(self, 
+            id='upload-index', 
+            function_name=f"cm-accuracy-eval-task-upload-index-{self.instance_hash}", 
+            runtime=_lambda.Runtime.PYTHON_3_9,
+            handler='cm-accuracy-eval-task-upload-index.lambda_handler',
+            code=_lambda.Code.from_asset(os.path.join("./", "lambda/task/upload-index")),
+            timeout=Duration.seconds(UPLOAD_INDEX_LAMBDA_TIMEOUT_S),
+            role=create_lambda_upload_index_role(self,bucket_name, self.region, self.account_id),
+            memory_size=512,
+            environment={
+             'DYNAMODB_TASK_TABLE': DYNAMOBD_TASK_TABLE_PREFIX + f"-{self.instance_hash}",
+             'DYNAMODB_UPLOAD_INDEX_TABLE': upload_index_table.table_name,
+             'S3_INPUT_PREFIX': S3_INPUT_PREFIX,
+             'SUPPORTED_FILE_TYPES': moderated_file_types(image_normalization),
+             'SUPPORTED_FORMATS': moderated_formats(image_normalization),
+             'MAX_IMAGE_BYTES': str(moderated_max_image_bytes(image_normalization)),
+            },
+            layers=[common_layer]
+        )
+        # SQS queue buffering the put and delete notifications of the input folder, with a dead-letter queue
+        upload_index_dlq = _sqs.Queue(self,
+            id='upload-index-dlq',
+            queue_name=f"{UPLOAD_INDEX_QUEUE_PREFIX}-dlq-{self.instance_hash}",
+            retention_period=Duration.days(14),
+            removal_policy=RemovalPolicy.DESTROY
+        )
+        upload_index_queue = _sqs.Queue(self,
+            id='upload-index-queue',
+            queue_name=f"{UPLOAD_INDEX_QUEUE_PREFIX}-{self.instance_hash}",
+            # AWS recommends 6 times the function timeout for Lambda event sources
+            visibility_timeout=Duration.seconds(UPLOAD_INDEX_LAMBDA_TIMEOUT_S * 6),
+            dead_letter_queue=_sqs.DeadLetterQueue(max_receive_count=UPLOAD_INDEX_MAX_RECEIVE_COUNT, queue=upload_index_dlq),
+            removal_policy=RemovalPolicy.DESTROY
+        )
+        for event_type in [_s3.EventType.OBJECT_CREATED, _s3.EventType.OBJECT_REMOVED]:
+            s3_bucket.add_event_notification(
+                    event_type, 
+                    aws_s3_notifications.SqsDestination(upload_index_queue), 
+                    _s3.NotificationKeyFilter(prefix=S3_INPUT_PREFIX))
+        lambda_upload_index.add_event_source(_lambda_event_sources.SqsEventSource(upload_index_queue,
+            batch_size=UPLOAD_INDEX_BATCH_SIZE,
+            max_batching_window=Duration.seconds(UPLOAD_INDEX_BATCH_WINDOW_S),
+            report_batch_item_failures=True
+        ))
             
         # Custom Resource Lambda: cm-accuracy-eval-provision-custom-resource
         lambda_provision = _lambda.Function(self, 
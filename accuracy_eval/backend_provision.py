@@ -8,6 +8,7 @@ from aws_cdk import (
     aws_lambda as _lambda,
     aws_apigateway as _apigw,
     aws_iam as _iam,
+    aws_sqs as _sqs,
     Environment,
     Duration,
     aws_s3_notifications,
@@ -39,6 +40,11 @@ from iam_role.lambda_start_moderation_role import create_role as lambda_start_mo
 from iam_role.lambda_get_task_with_count_role import create_role as lambda_get_task_with_count_role
 from iam_role.lambda_provision_role import create_role as lambda_provision_role
 from iam_role.lambda_export_csv_role import create_role as create_lambda_export_csv_role
+from iam_role.lambda_report_cube_role import create_role as create_lambda_report_cube_role
+from iam_role.lambda_prepare_manifest_role import create_role as create_lambda_prepare_manifest_role
+from iam_role.lambda_thumbnails_role import create_role as create_lambda_thumbnails_role
+from iam_role.lambda_export_job_role import create_role as create_lambda_export_job_role
+from accuracy_eval.layer_provision import create_common_layer, create_report_layer, create_imaging_layer, create_crypto_layer
 
 
 class BackendProvision(NestedStack):
@@ -47,7 +53,7 @@ class BackendProvision(NestedStack):
     instance_hash = None
     api_gw_base_url = None
     
-    def __init__(self, scope: Construct, construct_id: str, instance_hash_code, cognito_user_pool_id, **kwargs) -> None:
+    def __init__(self, scope: Construct, construct_id: str, instance_hash_code, cognito_user_pool_id, image_cdn=None, image_cdn_key_pair_id="", image_normalization=IMAGE_NORMALIZATION, **kwargs) -> None:
         super().__init__(scope, construct_id, **kwargs)
         
         self.account_id=os.environ.get("CDK_DEPLOY_ACCOUNT", os.environ["CDK_DEFAULT_ACCOUNT"])
@@ -82,7 +88,81 @@ class BackendProvision(NestedStack):
             partition_key=_dynamodb.Attribute(name='id', type=_dynamodb.AttributeType.STRING),
             removal_policy=RemovalPolicy.DESTROY
         ) 
+
+        # Rekognition rate limiter state, shared by all moderation workers
+        rate_limit_table = _dynamodb.Table(self, 
+            id='rate-limit-table', 
+            table_name=f'{DYNAMOBD_RATE_LIMIT_TABLE_PREFIX}-{self.instance_hash}', 
+            partition_key=_dynamodb.Attribute(name='id', type=_dynamodb.AttributeType.STRING),
+            billing_mode=_dynamodb.BillingMode.PAY_PER_REQUEST,
+            removal_policy=RemovalPolicy.DESTROY
+        ) 
+        
+        # Moderation result cache, shared by all tasks
+        moderation_cache_table = _dynamodb.Table(self, 
+            id='moderation-cache-table', 
+            table_name=f'{DYNAMOBD_MODERATION_CACHE_TABLE_PREFIX}-{self.instance_hash}', 
+            partition_key=_dynamodb.Attribute(name='content_hash', type=_dynamodb.AttributeType.STRING),
+            billing_mode=_dynamodb.BillingMode.PAY_PER_REQUEST,
+            time_to_live_attribute='ttl',
+            removal_policy=RemovalPolicy.DESTROY
+        ) 
         
+        # Report cube: report aggregates per task, maintained from the result table streams
+        report_cube_table = _dynamodb.Table(self, 
+            id='report-cube-table', 
+            table_name=f'{DYNAMOBD_REPORT_CUBE_TABLE_PREFIX}-{self.instance_hash}', 
+            partition_key=_dynamodb.Attribute(name='task_id', type=_dynamodb.AttributeType.STRING),
+            billing_mode=_dynamodb.BillingMode.PAY_PER_REQUEST,
+            # Markers of the applied stream record slices expire
+            time_to_live_attribute='ttl',
+            removal_policy=RemovalPolicy.DESTROY
+        ) 
+        # SQS queue receiving the stream batches the report cube failed to apply (rebuild the cube of the task to recover)
+        report_cube_failure_queue = _sqs.Queue(self,
+            id='report-cube-failure-queue',
+            queue_name=f"{REPORT_CUBE_FAILURE_QUEUE_PREFIX}-{self.instance_hash}",
+            retention_period=Duration.days(14),
+            removal_policy=RemovalPolicy.DESTROY
+        )
+        
+        # Export jobs: progress of the asynchronous exports, expired after a week
+        export_job_table = _dynamodb.Table(self, 
+            id='export-job-table', 
+            table_name=f'{DYNAMOBD_EXPORT_JOB_TABLE_PREFIX}-{self.instance_hash}', 
+            partition_key=_dynamodb.Attribute(name='job_id', type=_dynamodb.AttributeType.STRING),
+            billing_mode=_dynamodb.BillingMode.PAY_PER_REQUEST,
+            time_to_live_attribute='ttl',
+            removal_policy=RemovalPolicy.DESTROY
+        ) 
+        
+        # Moderation claims: idempotency guard of the moderation workers, expired after a week
+        moderation_claim_table = _dynamodb.Table(self, 
+            id='moderation-claim-table', 
+            table_name=f'{DYNAMOBD_MODERATION_CLAIM_TABLE_PREFIX}-{self.instance_hash}', 
+            partition_key=_dynamodb.Attribute(name='claim_id', type=_dynamodb.AttributeType.STRING),
+            billing_mode=_dynamodb.BillingMode.PAY_PER_REQUEST,
+            time_to_live_attribute='ttl',
+            removal_policy=RemovalPolicy.DESTROY
+        ) 
+        
+        # Failure ledger: images whose moderation failed, per task
+        moderation_failure_table = _dynamodb.Table(self, 
+            id='moderation-failure-table', 
+            table_name=f'{DYNAMOBD_MODERATION_FAILURE_TABLE_PREFIX}-{self.instance_hash}', 
+            partition_key=_dynamodb.Attribute(name='task_id', type=_dynamodb.AttributeType.STRING),
+            sort_key=_dynamodb.Attribute(name='file_path', type=_dynamodb.AttributeType.STRING),
+            billing_mode=_dynamodb.BillingMode.PAY_PER_REQUEST,
+            removal_policy=RemovalPolicy.DESTROY
+        ) 
+        
+        # Create Lambda layers: shared library, third party packages by need. cryptography only signs the cookies of the
+        # image distribution: its layer is only built when the distribution is deployed.
+        common_layer = create_common_layer(self)
+        report_layer = create_report_layer(self)
+        imaging_layer = create_imaging_layer(self)
+        gallery_layers = [common_layer] if image_cdn is None else [common_layer, create_crypto_layer(self)]
+
         # Step Function - start
         # Lambda: cm-accuracy-eval-task-moderate-image 
         lambda_moderate_image = _lambda.Function(self, 
@@ -91,8 +171,31 @@ class BackendProvision(NestedStack):
             runtime=_lambda.Runtime.PYTHON_3_9,
             handler='cm-accuracy-eval-task-moderate-image.lambda_handler',
             code=_lambda.Code.from_asset(os.path.join("./", "lambda/task/moderate-image")),
-            timeout=Duration.seconds(30),
+            timeout=Duration.seconds(MODERATION_LAMBDA_TIMEOUT_S),
+            memory_size=NORMALIZATION_LAMBDA_MEMORY_M if image_normalization else MODERATION_LAMBDA_MEMORY_M,
             role=create_lambda_moderate_image_role(self,bucket_name, self.region, self.account_id),
+            environment={
+             'MODERATION_THREAD_POOL_SIZE': str(MODERATION_THREAD_POOL_SIZE),
+             'MODERATION_BATCH_RESERVED_S': str(MODERATION_BATCH_RESERVED_S),
+             'DYNAMODB_RATE_LIMIT_TABLE': rate_limit_table.table_name,
+             'REKOGNITION_TPS_INITIAL': str(REKOGNITION_TPS_INITIAL),
+             'REKOGNITION_TPS_MAX': str(REKOGNITION_TPS_MAX),
+             'REKOGNITION_THROTTLE_MAX_RETRIES': str(REKOGNITION_THROTTLE_MAX_RETRIES),
+             'DYNAMODB_TASK_TABLE': DYNAMOBD_TASK_TABLE_PREFIX + f"-{self.instance_hash}",
+             'DYNAMODB_MODERATION_CACHE_TABLE': moderation_cache_table.table_name,
+             'MODERATION_CACHE_HASH_MODE': MODERATION_CACHE_HASH_MODE,
+             'DYNAMODB_MODERATION_CLAIM_TABLE': moderation_claim_table.table_name,
+             'MODERATION_CLAIM_LEASE_S': str(MODERATION_CLAIM_LEASE_S),
+             'DYNAMODB_MODERATION_FAILURE_TABLE': moderation_failure_table.table_name,
+             'IMAGE_NORMALIZATION': "true" if image_normalization else "false",
+             'S3_BUCKET_NAME': bucket_name,
+             'S3_DERIVED_PREFIX': S3_DERIVED_PREFIX,
+             'NORMALIZATION_SIZE_THRESHOLD_BYTES': str(NORMALIZATION_SIZE_THRESHOLD_BYTES),
+             'NORMALIZATION_MAX_DIMENSION': str(NORMALIZATION_MAX_DIMENSION),
+             'NORMALIZATION_MAX_SOURCE_BYTES': str(NORMALIZATION_MAX_SOURCE_BYTES),
+             'NORMALIZATION_CONCURRENCY': str(NORMALIZATION_CONCURRENCY),
+            },
+            layers=[common_layer, imaging_layer] if image_normalization else [common_layer]
         )
         # Lambda: cm-accuracy-eval-task-update-status 
         lambda_update_status = _lambda.Function(self, 
@@ -106,6 +209,56 @@ class BackendProvision(NestedStack):
              'DYNAMODB_TASK_TABLE': DYNAMOBD_TASK_TABLE_PREFIX + f"-{self.instance_hash}",
             }
         )
+        # Lambda: cm-accuracy-eval-task-prepare-manifest
+        lambda_prepare_manifest = _lambda.Function(self, 
+            id='prepare-manifest', 
+            function_name=f"cm-accuracy-eval-task-prepare-manifest-{self.instance_hash}", 
+            runtime=_lambda.Runtime.PYTHON_3_9,
+            handler='cm-accuracy-eval-task-prepare-manifest.lambda_handler',
+            code=_lambda.Code.from_asset(os.path.join("./", "lambda/task/prepare-manifest")),
+            timeout=Duration.seconds(900),
+            memory_size=2048,
+            role=create_lambda_prepare_manifest_role(self,bucket_name, self.region, self.account_id),
+            environment={
+             'DYNAMODB_TASK_TABLE': DYNAMOBD_TASK_TABLE_PREFIX + f"-{self.instance_hash}",
+             'DYNAMODB_UPLOAD_INDEX_TABLE': f'{DYNAMOBD_UPLOAD_INDEX_TABLE_PREFIX}-{self.instance_hash}',
+             'S3_MANIFEST_PREFIX': S3_MANIFEST_PREFIX,
+             'SUPPORTED_FILE_TYPES': moderated_file_types(image_normalization),
+             'MAX_IMAGE_BYTES': str(moderated_max_image_bytes(image_normalization)),
+             'DEDUP_MAX_DISTANCE': str(DEDUP_MAX_DISTANCE),
+             'DYNAMODB_MODERATION_FAILURE_TABLE': moderation_failure_table.table_name,
+             'MODERATION_RETRY_WAIT_S': str(MODERATION_RETRY_WAIT_S),
+            },
+            layers=[common_layer, imaging_layer, report_layer]
+        )
+        # Lambda: cm-accuracy-eval-task-report-cube, triggered by the result table streams (mapped by start-moderation)
+        lambda_report_cube = _lambda.Function(self, 
+            id='report-cube', 
+            function_name=f"cm-accuracy-eval-task-report-cube-{self.instance_hash}", 
+            runtime=_lambda.Runtime.PYTHON_3_9,
+            handler='cm-accuracy-eval-task-report-cube.lambda_handler',
+            code=_lambda.Code.from_asset(os.path.join("./", "lambda/task/report-cube")),
+            timeout=Duration.seconds(60),
+            memory_size=512,
+            role=create_lambda_report_cube_role(self,bucket_name, self.region, self.account_id, report_cube_failure_queue.queue_arn),
+            environment={
+             'DYNAMODB_TABLE_PREFIX': f'{DYNAMOBD_DETAIL_TABLE_PREFIX}-{self.instance_hash}',
+             'DYNAMODB_REPORT_CUBE_TABLE': report_cube_table.table_name,
+            },
+            layers=[common_layer]
+        )
+        # Lambda: cm-accuracy-eval-task-thumbnails, invoked asynchronously by the images APIs
+        lambda_thumbnails = _lambda.Function(self, 
+            id='thumbnails', 
+            function_name=f"cm-accuracy-eval-task-thumbnails-{self.instance_hash}", 
+            runtime=_lambda.Runtime.PYTHON_3_9,
+            handler='cm-accuracy-eval-task-thumbnails.lambda_handler',
+            code=_lambda.Code.from_asset(os.path.join("./", "lambda/task/thumbnails")),
+            timeout=Duration.seconds(300),
+            memory_size=1024,
+            role=create_lambda_thumbnails_role(self,bucket_name, self.region, self.account_id),
+            layers=[common_layer, imaging_layer]
+        )
         # StepFunctions StateMachine
         sm_json = None
         with open('./stepfunctions/cm-accuracy-eval-image-bulk.json', "r") as f:
@@ -114,6 +267,12 @@ class BackendProvision(NestedStack):
         if sm_json is not None:
             sm_json = sm_json.replace("##LAMBDA_MODERATE_IMAGE##", f"arn:aws:lambda:{self.region}:{self.account_id}:function:cm-accuracy-eval-task-moderate-image-{self.instance_hash}")
             sm_json = sm_json.replace("##LAMBDA_UPDATE_STATUS##", f"arn:aws:lambda:{self.region}:{self.account_id}:function:cm-accuracy-eval-task-update-status-{self.instance_hash}")
+            sm_json = sm_json.replace("##LAMBDA_PREPARE_MANIFEST##", lambda_prepare_manifest.function_arn)
+            sm_json = sm_json.replace('"##MODERATION_BATCH_SIZE##"', str(MODERATION_BATCH_SIZE))
+            sm_json = sm_json.replace('"##MODERATION_BATCH_MAX_ATTEMPTS##"', str(MODERATION_BATCH_MAX_ATTEMPTS))
+            sm_json = sm_json.replace('"##MODERATION_BATCH_RETRY_WAIT_S##"', str(MODERATION_BATCH_RETRY_WAIT_S))
+            sm_json = sm_json.replace('"##MODERATION_TOLERATED_FAILURE_PERCENTAGE##"', str(MODERATION_TOLERATED_FAILURE_PERCENTAGE))
+            sm_json = sm_json.replace('"##MODERATION_RETRY_ROUNDS##"', str(MODERATION_RETRY_ROUNDS))
             
         cfn_state_machine = _aws_stepfunctions.CfnStateMachine(self, f'{STEP_FUNCTION_STATE_MACHINE_NAME_PREFIX}-{self.instance_hash}',
             state_machine_name=f'{STEP_FUNCTION_STATE_MACHINE_NAME_PREFIX}-{self.instance_hash}', 
@@ -142,13 +301,26 @@ class BackendProvision(NestedStack):
                                      
         # POST /v1/report/images
         # Lambda: cm-accuracy-eval-report-get-images 
-        get_images_role = create_lambda_get_images_role(self,bucket_name, self.region, self.account_id)
+        get_images_role = create_lambda_get_images_role(self,bucket_name, self.region, self.account_id,
+            None if image_cdn is None else image_cdn["imageCdnPrivateKeySecretArn"])
+        # Signed cookie delivery through the image distribution, if deployed. Presigned URLs otherwise
+        image_cdn_envs = {
+             'IMAGE_CDN_DOMAIN': "" if image_cdn is None else image_cdn["imageCdnDomainName"],
+             'IMAGE_CDN_KEY_PAIR_ID': image_cdn_key_pair_id,
+             'IMAGE_CDN_PRIVATE_KEY_SECRET_ARN': "" if image_cdn is None else image_cdn["imageCdnPrivateKeySecretArn"],
+             'IMAGE_CDN_COOKIE_EXPIRATION_IN_S': IMAGE_CDN_COOKIE_EXPIRATION_IN_S,
+            }
         self.create_api_endpoint('get-images', report, "report", "images", "POST", auth, get_images_role, "cm-accuracy-eval-report-get-images", self.instance_hash, 10240, 30, 
             evns={
              'DYNAMODB_INDEX_NAME': DYNAMOBD_DETAIL_TABLE_LABELED_INDEX_NAME,
+             'DYNAMODB_CONFIDENCE_INDEX_NAME': DYNAMOBD_DETAIL_TABLE_CONFIDENCE_INDEX_NAME,
              'DYNAMODB_TASK_TABLE': DYNAMOBD_TASK_TABLE_PREFIX + f"-{self.instance_hash}",
              'EXPIRATION_IN_S': S3_PRE_SIGNED_URL_EXPIRATION_IN_S,
-            })
+             'URL_CACHE_SIZE': S3_PRE_SIGNED_URL_CACHE_SIZE,
+             'URL_CACHE_MIN_LIFETIME_S': S3_PRE_SIGNED_URL_MIN_LIFETIME_S,
+             'THUMBNAILS_FUNCTION_NAME': lambda_thumbnails.function_name,
+             **image_cdn_envs,
+            }, layers=gallery_layers)
  
         # POST /v1/report/images-unflag
         # Lambda: cm-accuracy-eval-task-get-images-unflaged 
@@ -157,7 +329,11 @@ class BackendProvision(NestedStack):
              'DYNAMODB_INDEX_NAME': DYNAMOBD_DETAIL_TABLE_LABELED_INDEX_NAME,
              'DYNAMODB_TASK_TABLE': DYNAMOBD_TASK_TABLE_PREFIX + f"-{self.instance_hash}",
              'EXPIRATION_IN_S': S3_PRE_SIGNED_URL_EXPIRATION_IN_S,
-            })        
+             'URL_CACHE_SIZE': S3_PRE_SIGNED_URL_CACHE_SIZE,
+             'URL_CACHE_MIN_LIFETIME_S': S3_PRE_SIGNED_URL_MIN_LIFETIME_S,
+             'THUMBNAILS_FUNCTION_NAME': lambda_thumbnails.function_name,
+             **image_cdn_envs,
+            }, layers=gallery_layers)        
  
         # POST /v1/report/export
         # Lambda: cm-accuracy-eval-report-export-flagged
@@ -169,8 +345,53 @@ class BackendProvision(NestedStack):
              'S3_BUCKET_NAME': bucket_name,
              'S3_REPORT_PREFIX': S3_REPORT_PREFIX,
              'EXPIRATION_IN_S': S3_PRE_SIGNED_URL_EXPIRATION_IN_S,
-            })      
+            }, layers=[common_layer, report_layer])      
             
+        # Export jobs, for tasks too large to export within a request
+        # Lambda: cm-accuracy-eval-report-export-worker, invoked asynchronously by export-start and by itself
+        export_job_role = create_lambda_export_job_role(self,bucket_name, self.region, self.account_id)
+        lambda_export_worker = _lambda.Function(self, 
+            id='export-worker', 
+            function_name=f"cm-accuracy-eval-report-export-worker-{self.instance_hash}", 
+            runtime=_lambda.Runtime.PYTHON_3_9,
+            handler='cm-accuracy-eval-report-export-worker.lambda_handler',
+            code=_lambda.Code.from_asset(os.path.join("./", "lambda/report/export-worker")),
+            timeout=Duration.seconds(EXPORT_WORKER_LAMBDA_TIMEOUT_S),
+            memory_size=EXPORT_WORKER_LAMBDA_MEMORY_M,
+            role=export_job_role,
+            environment={
+             'DYNAMODB_EXPORT_JOB_TABLE': export_job_table.table_name,
+             'S3_BUCKET_NAME': bucket_name,
+             'S3_REPORT_PREFIX': S3_REPORT_PREFIX,
+            },
+            layers=[common_layer, report_layer]
+        )
+
+        # POST /v1/report/export-start
+        # Lambda: cm-accuracy-eval-report-export-start
+        self.create_api_endpoint('export-start', report, "report", "export-start", "POST", auth, export_job_role, "cm-accuracy-eval-report-export-start", self.instance_hash, 256, 30, 
+            evns={
+             'DYNAMODB_TASK_TABLE': DYNAMOBD_TASK_TABLE_PREFIX + f"-{self.instance_hash}",
+             'DYNAMODB_EXPORT_JOB_TABLE': export_job_table.table_name,
+             'EXPORT_WORKER_FUNCTION_NAME': lambda_export_worker.function_name,
+            }, layers=[common_layer])
+
+        # POST /v1/report/export-status
+        # Lambda: cm-accuracy-eval-report-export-status
+        self.create_api_endpoint('export-status', report, "report", "export-status", "POST", auth, export_job_role, "cm-accuracy-eval-report-export-status", self.instance_hash, 128, 10, 
+            evns={
+             'DYNAMODB_EXPORT_JOB_TABLE': export_job_table.table_name,
+            }, layers=[common_layer])
+
+        # POST /v1/report/export-download
+        # Lambda: cm-accuracy-eval-report-export-download
+        self.create_api_endpoint('export-download', report, "report", "export-download", "POST", auth, export_job_role, "cm-accuracy-eval-report-export-download", self.instance_hash, 128, 10, 
+            evns={
+             'DYNAMODB_EXPORT_JOB_TABLE': export_job_table.table_name,
+             'S3_BUCKET_NAME': bucket_name,
+             'EXPIRATION_IN_S': S3_PRE_SIGNED_URL_EXPIRATION_IN_S,
+            }, layers=[common_layer])
+
         # POST /v1/report/report
         # Lambda: cm-accuracy-eval-report-get-report 
         get_report_role = create_lambda_get_report_role(self,bucket_name, self.region, self.account_id)
@@ -178,7 +399,9 @@ class BackendProvision(NestedStack):
             evns={
              'DYNAMODB_INDEX_NAME': DYNAMOBD_DETAIL_TABLE_LABELED_INDEX_NAME,
              'DYNAMODB_TASK_TABLE': DYNAMOBD_TASK_TABLE_PREFIX + f"-{self.instance_hash}",
-            })
+             'DYNAMODB_REPORT_CUBE_TABLE': report_cube_table.table_name,
+             'DYNAMODB_MODERATION_FAILURE_TABLE': moderation_failure_table.table_name,
+            }, layers=[common_layer, report_layer])
             
         # POST /v1/task/tasks
         # Lambda: cm-accuracy-eval-task-get-tasks
@@ -194,12 +417,13 @@ class BackendProvision(NestedStack):
         self.create_api_endpoint('create-task', task, "task", "create-task", "POST", auth, create_task_role, "cm-accuracy-eval-task-create-task", self.instance_hash, 128, 30, 
             evns={
              'DYNAMODB_INDEX_NAME': DYNAMOBD_DETAIL_TABLE_LABELED_INDEX_NAME,
+             'DYNAMODB_CONFIDENCE_INDEX_NAME': DYNAMOBD_DETAIL_TABLE_CONFIDENCE_INDEX_NAME,
              'DYNAMODB_TASK_TABLE': DYNAMOBD_TASK_TABLE_PREFIX + f"-{self.instance_hash}",
              "DYNAMODB_RESULT_TABLE_PREFIX": f'{DYNAMOBD_DETAIL_TABLE_PREFIX}-{self.instance_hash}',
              'S3_BUCKET': bucket_name,
              'S3_KEY_PREFIX': S3_INPUT_PREFIX,
              'EXPIRATION_IN_S': S3_PRE_SIGNED_URL_EXPIRATION_IN_S
-            })
+            }, layers=[common_layer])
         
         # POST /v1/task/task-with-count
         # Lamabd: cm-accuracy-eval-task-get-task-with-s3-object-count
@@ -208,8 +432,8 @@ class BackendProvision(NestedStack):
             evns={
              'DYNAMODB_INDEX_NAME': DYNAMOBD_DETAIL_TABLE_LABELED_INDEX_NAME,
              'DYNAMODB_TASK_TABLE': DYNAMOBD_TASK_TABLE_PREFIX + f"-{self.instance_hash}",
-             'SUPPORTED_FILE_TYPES': '.jpg,.png,.jpeg',
-            }, layer=layer)
+             'SUPPORTED_FILE_TYPES': moderated_file_types(image_normalization),
+            }, layers=[common_layer])
         
         # POST /v1/task/delete-task
         # Lambda: cm-accuracy-eval-task-delete-task
@@ -217,7 +441,13 @@ class BackendProvision(NestedStack):
         self.create_api_endpoint('delete-task', task, "task", "delete-task", "POST", auth, delete_task_with_count_role, "cm-accuracy-eval-task-delete-task", self.instance_hash, 2560, 30, 
             evns={
              'DYNAMODB_TASK_TABLE': DYNAMOBD_TASK_TABLE_PREFIX + f"-{self.instance_hash}",
-            }, layer=layer)
+             'DYNAMODB_REPORT_CUBE_TABLE': report_cube_table.table_name,
+             'DYNAMODB_MODERATION_FAILURE_TABLE': moderation_failure_table.table_name,
+             'DYNAMODB_EXPORT_JOB_TABLE': export_job_table.table_name,
+             'S3_DERIVED_PREFIX': S3_DERIVED_PREFIX,
+             'S3_MANIFEST_PREFIX': S3_MANIFEST_PREFIX,
+             'S3_REPORT_PREFIX': S3_REPORT_PREFIX,
+            }, layers=[layer, common_layer])
         
         # POST /v1/task/start-moderation
         # Lambda: cm-accuracy-eval-task-start-moderation   
@@ -228,16 +458,19 @@ class BackendProvision(NestedStack):
                 "DYNAMODB_RESULT_TABLE_PREFIX": f'{DYNAMOBD_DETAIL_TABLE_PREFIX}-{self.instance_hash}',
                 "WORK_FLOW_NAME_PREFIX": A2I_WORKFLOW_NAME_PREFIX + f"-{self.instance_hash}",
                 "HUMAN_TASK_UI_NAME": f'arn:aws:sagemaker:{self.region}:{self.account_id}:human-task-ui/{A2I_UI_TEMPLATE_NAME}-{self.instance_hash}',
-                "STEP_FUNCTION_STATE_MACHINE_ARN": f"arn:aws:states:{self.region}:{self.account_id}:stateMachine:{STEP_FUNCTION_STATE_MACHINE_NAME_PREFIX}-{self.instance_hash}"
-            }, layer=layer)
+                "STEP_FUNCTION_STATE_MACHINE_ARN": f"arn:aws:states:{self.region}:{self.account_id}:stateMachine:{STEP_FUNCTION_STATE_MACHINE_NAME_PREFIX}-{self.instance_hash}",
+                "REPORT_CUBE_FUNCTION_NAME": lambda_report_cube.function_name,
+                "REPORT_CUBE_MAX_RETRY_ATTEMPTS": str(REPORT_CUBE_MAX_RETRY_ATTEMPTS),
+                "REPORT_CUBE_FAILURE_DESTINATION_ARN": report_cube_failure_queue.queue_arn,
+                "SUPPORTED_FILE_TYPES": moderated_file_types(image_normalization),
+            }, layers=[common_layer])
             
             
-    def create_api_endpoint(self, id, root, path1, path2, method, auth, role, lambda_file_name, instance_hash, memory_m, timeout_s, evns, layer=None):
+    def create_api_endpoint(self, id, root, path1, path2, method, auth, role, lambda_file_name, instance_hash, memory_m, timeout_s, evns, layers=None):
     # POST /v1/task/tasks
         # Lambda: cm-accuracy-eval-task-get-tasks
-        layers = []
-        if layer is not None:
-            layers = [layer]
+        if layers is None:
+            layers = []
         lambda_funcation = _lambda.Function(self, 
             id=id, 
             function_name=f"{lambda_file_name}-{self.instance_hash}", 
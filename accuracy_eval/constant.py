@@ -1,6 +1,16 @@
 DYNAMOBD_TASK_TABLE_PREFIX = "cm-accuracy-eval-task"
 DYNAMOBD_DETAIL_TABLE_PREFIX = "cm-accuracy"
 DYNAMOBD_DETAIL_TABLE_LABELED_INDEX_NAME = "issue_flag-index"
+DYNAMOBD_DETAIL_TABLE_CONFIDENCE_INDEX_NAME = "issue_flag-max_confidence-index"
+DYNAMOBD_RATE_LIMIT_TABLE_PREFIX = "cm-accuracy-eval-rate-limit"
+DYNAMOBD_MODERATION_CACHE_TABLE_PREFIX = "cm-accuracy-eval-moderation-cache"
+DYNAMOBD_REPORT_CUBE_TABLE_PREFIX = "cm-accuracy-eval-report-cube"
+# Report cube stream mappings: retries of a failing batch before its records go to the on-failure queue
+REPORT_CUBE_FAILURE_QUEUE_PREFIX = "cm-accuracy-eval-report-cube-failure"
+REPORT_CUBE_MAX_RETRY_ATTEMPTS = 5
+DYNAMOBD_EXPORT_JOB_TABLE_PREFIX = "cm-accuracy-eval-export-job"
+DYNAMOBD_MODERATION_CLAIM_TABLE_PREFIX = "cm-accuracy-eval-moderation-claim"
+DYNAMOBD_MODERATION_FAILURE_TABLE_PREFIX = "cm-accuracy-eval-moderation-failure"
 
 COGNITO_NAME_PREFIX = 'cm-accuracy-eval-user-pool'
 COGNITO_USER_POOL_NAME = 'cm-accuracy-eval-user-pool'
@@ -14,7 +24,13 @@ S3_A2I_PREFIX = "a2i/"
 S3_BUCKET_TEMP_FILE_KEY = ".cfn_temp/a2i.json"
 S3_INPUT_PREFIX = "input/"
 S3_REPORT_PREFIX = "report/"
+S3_MANIFEST_PREFIX = "manifest/"
 S3_PRE_SIGNED_URL_EXPIRATION_IN_S = "300"
+# Presigned URLs cached by the image handlers across warm invocations; served while they have the min lifetime left
+S3_PRE_SIGNED_URL_CACHE_SIZE = "20000"
+S3_PRE_SIGNED_URL_MIN_LIFETIME_S = "120"
+# Signed cookie image delivery (optional image CloudFront distribution)
+IMAGE_CDN_COOKIE_EXPIRATION_IN_S = "3600"
 S3_WEB_BUCKET_NAME_PREFIX = "cm-website-console"
 
 A2I_WORKFLOW_NAME_PREFIX = "cm-accuracy"
@@ -23,4 +39,85 @@ A2I_WORK_FORCE_NAME = 'cm-accuracy-eval-workforce'
 A2I_WORK_TEAM_NAME = 'cm-accuracy-eval-workteam'
 
 API_NAME_PREFIX = "cm-accuracy-eval-srv"
-STEP_FUNCTION_STATE_MACHINE_NAME_PREFIX = "cm-accuracy-eval-image-sm"
\ No newline at end of file
+STEP_FUNCTION_STATE_MACHINE_NAME_PREFIX = "cm-accuracy-eval-image-sm"
+
+MODERATION_BATCH_SIZE = 50
+MODERATION_BATCH_MAX_ATTEMPTS = 3
+MODERATION_BATCH_RETRY_WAIT_S = 5
+MODERATION_THREAD_POOL_SIZE = 10
+# The Map children are EXPRESS workflows, stopped after 5 minutes without running their Catch: the attempts of a batch and the
+# waits between them fit in it, with time reserved for the Lambda invoke retries and the recording of a failed batch
+EXPRESS_WORKFLOW_MAX_S = 300
+MODERATION_CHILD_RESERVED_S = 40
+MODERATION_LAMBDA_TIMEOUT_S = (EXPRESS_WORKFLOW_MAX_S - MODERATION_CHILD_RESERVED_S
+    - (MODERATION_BATCH_MAX_ATTEMPTS - 1) * MODERATION_BATCH_RETRY_WAIT_S) // MODERATION_BATCH_MAX_ATTEMPTS
+# Time kept by a batch attempt to save its results: images not started by then are returned for the next attempt
+MODERATION_BATCH_RESERVED_S = 10
+MODERATION_LAMBDA_MEMORY_M = 512
+# Idempotency claims of the moderation workers: a claim outlives the worker holding it by the lease
+MODERATION_CLAIM_LEASE_S = MODERATION_LAMBDA_TIMEOUT_S + 60
+# Failed batches tolerated by the moderation Map runs, in percent, and the retry pass of the failure ledger: rounds and the
+# backoff before the first round, doubled each round
+MODERATION_TOLERATED_FAILURE_PERCENTAGE = 5
+MODERATION_RETRY_ROUNDS = 2
+MODERATION_RETRY_WAIT_S = 30
+
+# Shared Rekognition DetectModerationLabels throttle: start rate, account TPS quota and retries on throttling
+REKOGNITION_TPS_INITIAL = 20
+REKOGNITION_TPS_MAX = 50
+REKOGNITION_THROTTLE_MAX_RETRIES = 10
+
+# Moderation result cache across tasks. Key mode: "etag" (S3 ETag + size) or "sha256" (reads the image)
+MODERATION_CACHE_HASH_MODE = "etag"
+
+# Near-duplicate collapsing: max Hamming distance between 64-bit perceptual hashes of duplicates
+DEDUP_MAX_DISTANCE = 6
+SUPPORTED_FILE_TYPES = '.jpg,.png,.jpeg'
+
+# Image normalization before moderation (cm_accuracy_eval.normalization): images in the formats Rekognition doesn't read, or
+# larger than the size threshold, are moderated through a downscaled JPEG copy under the derived prefix of the task bucket.
+# Off: only JPEG and PNG images within the Rekognition 15 MB limit are moderated. Default of the "imageNormalization" context
+# flag (cdk deploy -c imageNormalization=true)
+IMAGE_NORMALIZATION = False
+S3_DERIVED_PREFIX = "derived/"
+NORMALIZED_FILE_TYPES = '.webp,.gif,.bmp,.tif,.tiff,.heic,.heif'
+NORMALIZED_FORMATS = 'jpeg,png,webp,gif,bmp,tiff,heic,heif'
+NORMALIZATION_SIZE_THRESHOLD_BYTES = 5 * 1024 * 1024
+NORMALIZATION_MAX_DIMENSION = 2048
+NORMALIZATION_MAX_SOURCE_BYTES = 50 * 1024 * 1024
+NORMALIZATION_CONCURRENCY = 2
+NORMALIZATION_LAMBDA_MEMORY_M = 1536
+# File types, formats and sizes accepted for moderation: the Rekognition ones, extended with normalization on
+REKOGNITION_MAX_IMAGE_BYTES = 15 * 1024 * 1024
+REKOGNITION_FORMATS = 'jpeg,png'
+
+
+def moderated_file_types(image_normalization):
+    return f'{SUPPORTED_FILE_TYPES},{NORMALIZED_FILE_TYPES}' if image_normalization else SUPPORTED_FILE_TYPES
+
+
+def moderated_formats(image_normalization):
+    return NORMALIZED_FORMATS if image_normalization else REKOGNITION_FORMATS
+
+
+def moderated_max_image_bytes(image_normalization):
+    return NORMALIZATION_MAX_SOURCE_BYTES if image_normalization else REKOGNITION_MAX_IMAGE_BYTES
+
+# A2I output ingestion: S3 notifications buffered in SQS, processed in batches
+A2I_OUTPUT_QUEUE_PREFIX = "cm-accuracy-eval-a2i-output"
+A2I_OUTPUT_BATCH_SIZE = 100
+A2I_OUTPUT_BATCH_WINDOW_S = 10
+A2I_OUTPUT_MAX_RECEIVE_COUNT = 5
+A2I_ETL_LAMBDA_TIMEOUT_S = 120
+
+# Export jobs: one worker per scan segment, continued in a new invocation before the timeout
+EXPORT_WORKER_LAMBDA_TIMEOUT_S = 900
+EXPORT_WORKER_LAMBDA_MEMORY_M = 2048
+
+# Upload index: S3 put and delete notifications of the input folder buffered in SQS, indexed in batches
+DYNAMOBD_UPLOAD_INDEX_TABLE_PREFIX = "cm-accuracy-eval-upload-index"
+UPLOAD_INDEX_QUEUE_PREFIX = "cm-accuracy-eval-upload-index"
+UPLOAD_INDEX_BATCH_SIZE = 100
+UPLOAD_INDEX_BATCH_WINDOW_S = 5
+UPLOAD_INDEX_MAX_RECEIVE_COUNT = 5
+UPLOAD_INDEX_LAMBDA_TIMEOUT_S = 60
@@ -0,0 +1,69 @@
+from aws_cdk import (
+    aws_lambda as _lambda,
+    BundlingOptions,
+    ILocalBundling,
+    RemovalPolicy,
+)
+import jsii
+import os
+import subprocess
+import sys
+
+
+def create_common_layer(self):
+    # Shared Python package (cm_accuracy_eval) used by the Lambda functions. Lambda adds /opt/python to sys.path.
+    return _lambda.LayerVersion(self, 'common_layer',
+        code=_lambda.Code.from_asset(os.path.join("./", "lambda/layer-common")),
+        description='Shared cm_accuracy_eval library',
+        compatible_runtimes=[_lambda.Runtime.PYTHON_3_9],
+        removal_policy=RemovalPolicy.DESTROY
+    )
+
+
+def create_report_layer(self):
+    # pyarrow and NumPy: Parquet exports, inventory manifests and report aggregation
+    return create_deps_layer(self, 'report_layer', "lambda/layer-report", 'pyarrow and NumPy')
+
+
+def create_imaging_layer(self):
+    # Pillow and pillow-heif: thumbnails, near-duplicate hashes and image normalization
+    return create_deps_layer(self, 'imaging_layer', "lambda/layer-imaging", 'Pillow and pillow-heif')
+
+
+def create_crypto_layer(self):
+    # cryptography: CloudFront signed cookies of the image distribution
+    return create_deps_layer(self, 'crypto_layer', "lambda/layer-crypto", 'cryptography')
+
+
+def create_deps_layer(self, id, path, description):
+    # Third party packages with native code (<path>/requirements.txt), installed at synth. The Lambda platform wheels are
+    # installed with the local pip, the Lambda build image (Docker) is only used when they can't be.
+    return _lambda.LayerVersion(self, id,
+        code=_lambda.Code.from_asset(os.path.join("./", path),
+            bundling=BundlingOptions(
+                image=_lambda.Runtime.PYTHON_3_9.bundling_image,
+                command=["bash", "-c", "pip install -r requirements.txt -t /asset-output/python"],
+                local=PipLocalBundling(os.path.join("./", path))
+            )
+        ),
+        description=description,
+        compatible_runtimes=[_lambda.Runtime.PYTHON_3_9],
+        removal_policy=RemovalPolicy.DESTROY
+    )
+
+
+@jsii.implements(ILocalBundling)
+class PipLocalBundling:
+    '''Installs requirements.txt from the manylinux wheels for the Lambda Python 3.9 x86_64 runtime with the local pip.'''
+    def __init__(self, path):
+        self.path = path
+
+    def try_bundle(self, output_dir, *args, **kwargs):
+        try:
+            subprocess.run([sys.executable, "-m", "pip", "install", "-r", os.path.join(self.path, "requirements.txt"),
+                "-t", os.path.join(output_dir, "python"), "--platform", "manylinux2014_x86_64", "--implementation", "cp",
+                "--python-version", "3.9", "--only-binary=:all:"], check=True)
+        except (OSError, subprocess.CalledProcessError) as ex:
+            print(f"Local install of {self.path}/requirements.txt failed, using the build image: {ex}")
+            return False
+        return True
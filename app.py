@@ -6,6 +6,12 @@ import uuid
 from accuracy_eval.backend_provision import BackendProvision
 from accuracy_eval.frontend_provision import FrontendProvision
 from accuracy_eval.a2i_provision import A2iProvision
+from accuracy_eval.constant import IMAGE_NORMALIZATION
+
+# cdk deploy -c imageCdnDomainName=images.example.com -c imageCdnHostedZoneId=... -c imageCdnHostedZoneName=example.com
+#   -c imageCdnPublicKeyFile=public_key.pem -c imageCdnPrivateKeySecretArn=arn:aws:secretsmanager:... [-c imageCdnCertificateArn=...]
+IMAGE_CDN_CONTEXT_KEYS = ["imageCdnDomainName", "imageCdnHostedZoneId", "imageCdnHostedZoneName", "imageCdnCertificateArn",
+    "imageCdnPublicKeyFile", "imageCdnPrivateKeySecretArn"]
 
 
 #env = cdk.Environment(account="TARGET_ACCOUNT_ID", region="TARGET_REGION")
@@ -22,14 +28,27 @@ class RootProvision(Stack):
                                 description="The emails for users to log in to the website and A2I. Split by a comma if multiple. You can always add new users after the system is deployed.")
     
     
+        # Optional: serve task images through CloudFront with signed cookies. Presigned S3 URLs are used otherwise.
+        image_cdn = None
+        if self.node.try_get_context("imageCdnDomainName"):
+            image_cdn = {k: self.node.try_get_context(k) for k in IMAGE_CDN_CONTEXT_KEYS}
+
+        # Optional: moderate more formats and larger images through a downscaled JPEG copy (cdk deploy -c imageNormalization=true)
+        image_normalization = str(self.node.try_get_context("imageNormalization") or IMAGE_NORMALIZATION).lower() == "true"
+    
         a2i_stack = A2iProvision(self, "A2iProvisionStack", description="AWS Content Moderation accuracy evaluation - A2I deployment statck.",
             instance_hash_code=self.instance_hash,
-            user_emails=user_emails
+            user_emails=user_emails,
+            image_cdn=image_cdn,
+            image_normalization=image_normalization
         )
         
         backend_stack = BackendProvision(self, "BackendProvisionStack", description="AWS Content Moderation accuracy evaluation - Backend deployment statck.",
             instance_hash_code=self.instance_hash,
-            cognito_user_pool_id = a2i_stack.ouput_cognito_user_pool_id
+            cognito_user_pool_id = a2i_stack.ouput_cognito_user_pool_id,
+            image_cdn=image_cdn,
+            image_cdn_key_pair_id=a2i_stack.output_image_cdn_key_pair_id,
+            image_normalization=image_normalization
         )
     
         frontend_stack = FrontendProvision(self, "FrontProvisionStack", description="AWS Content Moderation accuracy evaluation - Frontend deployment statck.",
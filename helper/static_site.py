@@ -5,6 +5,9 @@ an origin in cloudfront and Origin Access Identity (OAI) to access the s3 object
 StaticSitePublicS3 creates a public S3 bucket with website enabled and
 uses Origin Custom Header (referer) to limit the access of s3 objects to the
 CloudFront only.
+StaticSiteSignedCookies serves a prefix of an existing private bucket through
+Origin Access Control (OAC). Viewers need CloudFront signed cookies (or signed
+URLs) from a trusted key group.
 """
 from aws_cdk import (
     aws_s3 as s3,
@@ -15,7 +18,8 @@ from aws_cdk import (
     aws_route53_targets as targets,
     aws_iam as iam,
     aws_ssm as ssm,
-    RemovalPolicy
+    RemovalPolicy,
+    Stack
 )
 from constructs import Construct
 
@@ -223,4 +227,91 @@ class StaticSitePublicS3(StaticSite):
             ],
             viewer_protocol_policy=cloudfront.ViewerProtocolPolicy.REDIRECT_TO_HTTPS,
             price_class=cloudfront.PriceClass.PRICE_CLASS_ALL,
-        )
\ No newline at end of file
+        )
+
+
+class StaticSiteSignedCookies(StaticSite):
+    def __init__(
+        self,
+        scope,
+        construct_id,
+        bucket,
+        public_key_pem,
+        path_pattern="*",
+        **kwargs,
+    ):
+        super().__init__(scope, construct_id, **kwargs)
+
+        # Public variables
+        self.public_key = None
+        self.key_group = None
+
+        # Instance Variables
+        self.__origin_bucket = bucket
+        self.__public_key_pem = public_key_pem
+        self.__path_pattern = path_pattern
+
+        self._build_site()
+
+    def _create_site_bucket(self):
+        """Uses the existing bucket: only the objects under path_pattern are readable by the distribution"""
+        self.bucket = self.__origin_bucket
+
+    def _create_cloudfront_distribution(self):
+        """Create a cloudfront distribution with OAC to a private bucket, restricted to a trusted key group"""
+        self.public_key = cloudfront.PublicKey(
+            self,
+            "public_key",
+            encoded_key=self.__public_key_pem,
+        )
+        self.key_group = cloudfront.KeyGroup(
+            self,
+            "key_group",
+            items=[self.public_key],
+        )
+        origin_access_control = cloudfront.CfnOriginAccessControl(
+            self,
+            "origin_access_control",
+            origin_access_control_config=cloudfront.CfnOriginAccessControl.OriginAccessControlConfigProperty(
+                name=self._site_domain_name,
+                origin_access_control_origin_type="s3",
+                signing_behavior="always",
+                signing_protocol="sigv4",
+            ),
+        )
+
+        # The origin is built from an imported bucket, so no Origin Access Identity is granted in the bucket policy
+        origin_bucket = s3.Bucket.from_bucket_name(self, "origin_bucket", self.bucket.bucket_name)
+        self.distribution = cloudfront.Distribution(
+            self,
+            "cloudfront_distribution",
+            default_behavior=cloudfront.BehaviorOptions(
+                origin=origins.S3Origin(origin_bucket),
+                viewer_protocol_policy=cloudfront.ViewerProtocolPolicy.REDIRECT_TO_HTTPS,
+                cache_policy=cloudfront.CachePolicy.CACHING_OPTIMIZED,
+                trusted_key_groups=[self.key_group],
+            ),
+            domain_names=[self._site_domain_name],
+            certificate=self.certificate,
+        )
+        # Switch the origin from Origin Access Identity to Origin Access Control
+        cfn_distribution = self.distribution.node.default_child
+        cfn_distribution.add_property_override(
+            "DistributionConfig.Origins.0.S3OriginConfig.OriginAccessIdentity", ""
+        )
+        cfn_distribution.add_property_override(
+            "DistributionConfig.Origins.0.OriginAccessControlId", origin_access_control.attr_id
+        )
+
+        self.bucket.add_to_resource_policy(
+            iam.PolicyStatement(
+                actions=["s3:GetObject"],
+                resources=[self.bucket.arn_for_objects(self.__path_pattern)],
+                principals=[iam.ServicePrincipal("cloudfront.amazonaws.com")],
+                conditions={
+                    "StringEquals": {
+                        "AWS:SourceArn": f"arn:aws:cloudfront::{Stack.of(self).account}:distribution/{self.distribution.distribution_id}"
+                    }
+                },
+            )
+        )
@@ -27,6 +27,10 @@ def create_role(self, bucket_name, region, account_id):
         # A2I
         policy.create_policy_a2i(self, bucket_name, region, account_id)
     )
+    new_role.add_to_policy(
+        # Lambda event source mapping: result table stream to the report cube
+        policy.create_policy_lambda_event_source_mapping(self, bucket_name, region, account_id)
+    )
     new_role.add_to_policy(
         # CloudWatch log
         policy.create_policy_lambda_log(self, bucket_name, region, account_id)
@@ -6,7 +6,7 @@ from constructs import Construct
 from iam_role import policy
 
 
-def create_role(self, bucket_name, region, account_id):
+def create_role(self, bucket_name, region, account_id, image_cdn_secret_arn=None):
     # IAM role
     new_role = _iam.Role(self, "lambda-get-images-role",
         assumed_by=_iam.ServicePrincipal("lambda.amazonaws.com"),
@@ -19,6 +19,15 @@ def create_role(self, bucket_name, region, account_id):
         # DynamoDB access
         policy.create_policy_dynamodb(self, bucket_name, region, account_id)
     )
+    if image_cdn_secret_arn:
+        new_role.add_to_policy(
+            # CloudFront signed cookie private key, when the image distribution is deployed
+            policy.create_policy_secrets_manager(self, image_cdn_secret_arn)
+        )
+    new_role.add_to_policy(
+        # Asynchronous thumbnail builds
+        policy.create_policy_lambda_invoke(self, bucket_name, region, account_id)
+    )
     new_role.add_to_policy(
         # CloudWatch log
         policy.create_policy_lambda_log(self, bucket_name, region, account_id)
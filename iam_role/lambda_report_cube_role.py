@@ -0,0 +1,26 @@
+from aws_cdk import (
+    Stack,
+    aws_iam as _iam,
+)
+from constructs import Construct
+from iam_role import policy
+
+
+def create_role(self, bucket_name, region, account_id, failure_queue_arn):
+    # IAM role
+    new_role = _iam.Role(self, "lambda-report-cube-role",
+        assumed_by=_iam.ServicePrincipal("lambda.amazonaws.com"),
+    )
+    new_role.add_to_policy(
+        # DynamoDB access: result table streams, report cube table
+        policy.create_policy_dynamodb(self, bucket_name, region, account_id)
+    )
+    new_role.add_to_policy(
+        # SQS: on-failure destination of the stream mappings
+        policy.create_policy_sqs_send(self, failure_queue_arn)
+    )
+    new_role.add_to_policy(
+        # CloudWatch log
+        policy.create_policy_lambda_log(self, bucket_name, region, account_id)
+    )
+    return new_role
\ No newline at end of file
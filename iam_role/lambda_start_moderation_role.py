@@ -37,6 +37,10 @@ def create_role(self, bucket_name, region, account_id):
     new_role.add_to_policy(
         policy.create_policy_dynamodb(self, bucket_name, region, account_id)
     )
+    # Lambda event source mapping: result table stream to the report cube
+    new_role.add_to_policy(
+        policy.create_policy_lambda_event_source_mapping(self, bucket_name, region, account_id)
+    )
     # Log groups
     new_role.add_to_policy(
         policy.create_policy_lambda_log(self, bucket_name, region, account_id)
@@ -60,4 +60,29 @@ def create_policy_lambda_log(self, bucket_name, region, account_id):
     return  _iam.PolicyStatement(
             actions=["logs:CreateLogGroup","logs:CreateLogStream","logs:PutLogEvents"],
             resources=[f"arn:aws:logs:{region}:{account_id}:*"]
-        )
\ No newline at end of file
+        )
+
+def create_policy_lambda_event_source_mapping(self, bucket_name, region, account_id):
+    return  _iam.PolicyStatement(
+            actions=["lambda:CreateEventSourceMapping", "lambda:DeleteEventSourceMapping", "lambda:GetEventSourceMapping", "lambda:UpdateEventSourceMapping"],
+            resources=["*"]
+        )
+
+def create_policy_sqs_send(self, queue_arn):
+    return  _iam.PolicyStatement(
+            actions=["sqs:SendMessage"],
+            resources=[queue_arn]
+        )
+
+def create_policy_secrets_manager(self, secret_arn):
+    # A secret ARN without its random suffix (partial ARN) matches the secret with the suffix
+    return  _iam.PolicyStatement(
+            actions=["secretsmanager:GetSecretValue"],
+            resources=[secret_arn, f"{secret_arn}-??????"]
+        )
+
+def create_policy_lambda_invoke(self, bucket_name, region, account_id):
+    return  _iam.PolicyStatement(
+            actions=["lambda:InvokeFunction"],
+            resources=[f"arn:aws:lambda:{region}:{account_id}:function:cm-accuracy-eval-*"]
+        )
@@ -0,0 +1,4 @@
+'''
+Shared library for the content moderation accuracy evaluation Lambda functions.
+Shipped in the common Lambda layer: import as `from cm_accuracy_eval import ...`.
+'''
@@ -0,0 +1,35 @@
+'''
+DynamoDB BatchGetItem reader.
+Keys are read 100 per request. UnprocessedKeys are resent with full-jitter exponential backoff, the same way
+BatchResultWriter resends UnprocessedItems. Keys still unprocessed after the last attempt are returned to the caller.
+
+    items, unprocessed_keys = batch_get_items(dynamodb, table_name, [{"file_path": {"S": path}}])
+'''
+import random
+import time
+
+MAX_BATCH_SIZE = 100
+
+
+def batch_get_items(dynamodb, table_name, keys, projection=None, max_attempts=8, base_delay_s=0.05, max_delay_s=5.0):
+    items, unprocessed = [], []
+    for i in range(0, len(keys), MAX_BATCH_SIZE):
+        request = {"Keys": keys[i:i + MAX_BATCH_SIZE]}
+        if projection is not None:
+            request["ProjectionExpression"] = projection
+        attempt = 0
+        while len(request["Keys"]) > 0:
+            try:
+                response = dynamodb.batch_get_item(RequestItems={table_name: request})
+                items.extend(response.get("Responses", {}).get(table_name, []))
+                request = response.get("UnprocessedKeys", {}).get(table_name, {"Keys": []})
+            except Exception as ex:
+                print(f"BatchGetItem failed on {table_name}: ", ex)
+            attempt += 1
+            if len(request["Keys"]) > 0:
+                if attempt >= max_attempts:
+                    unprocessed.extend(request["Keys"])
+                    print(f"Failed to read {len(request['Keys'])} items from {table_name} after {attempt} attempts")
+                    break
+                time.sleep(random.uniform(0, min(max_delay_s, base_delay_s * (2 ** attempt))))
+    return items, unprocessed
@@ -0,0 +1,66 @@
+'''
+CloudFront signed cookies for the image distribution (helper/static_site.py StaticSiteSignedCookies).
+
+One set of cookies grants access to every object under a URL prefix until it expires, so the images of a task are served
+without a signature per image and can be cached at the edge for every reviewer. The custom policy is signed with RSA-SHA1
+(PKCS#1 v1.5), as CloudFront requires, with the private key of the key group's public key.
+
+The cryptography package is required by CookieSigner (crypto layer, deployed with the image distribution).
+
+    signer = CookieSigner(key_pair_id, private_key_pem)
+    cookies = signer.signed_cookies("https://images.example.com/input/<task id>/*", expires_at)
+
+delivery() returns what a client needs to load the images of a prefix: the base URL, the cookie path, the expiry and the cookies.
+The image URLs are then plain paths (object_path()) under the base URL.
+'''
+import base64
+import json
+import time
+from urllib.parse import quote
+
+
+class CookieSigner:
+    def __init__(self, key_pair_id, private_key_pem):
+        from cryptography.hazmat.primitives import serialization
+        self.key_pair_id = key_pair_id
+        self.private_key = serialization.load_pem_private_key(private_key_pem.encode("utf-8"), password=None)
+
+    def signed_cookies(self, resource, expires_at):
+        '''{"CloudFront-Policy", "CloudFront-Signature", "CloudFront-Key-Pair-Id"} for a resource URL (wildcards allowed).'''
+        policy = json.dumps(
+            {"Statement": [{"Resource": resource, "Condition": {"DateLessThan": {"AWS:EpochTime": int(expires_at)}}}]},
+            separators=(",", ":")
+        ).encode("utf-8")
+        from cryptography.hazmat.primitives import hashes
+        from cryptography.hazmat.primitives.asymmetric import padding
+        signature = self.private_key.sign(policy, padding.PKCS1v15(), hashes.SHA1())
+        return {
+            "CloudFront-Policy": _encode(policy),
+            "CloudFront-Signature": _encode(signature),
+            "CloudFront-Key-Pair-Id": self.key_pair_id,
+        }
+
+
+def delivery(signer, domain, key_prefix, expires_in, now=None):
+    '''Signed cookies for the objects under key_prefix, e.g. "input/<task id>/".'''
+    expires_at = int(time.time() if now is None else now) + int(expires_in)
+    path = object_path(key_prefix)
+    return {
+        "mode": "cookie",
+        "base_url": f"https://{domain}",
+        "path": path,
+        "expires": expires_at,
+        "cookies": signer.signed_cookies(f"https://{domain}{path}*", expires_at),
+    }
+
+
+def object_path(key):
+    '''URL path of an S3 key, or of the key of an "s3://bucket/key" URI.'''
+    if key.startswith("s3://"):
+        key = key[len("s3://"):].split("/", 1)[1]
+    return "/" + quote(key, safe="/~")
+
+
+def _encode(data):
+    # Base64 with the characters that are invalid in cookies and query strings replaced, as CloudFront expects
+    return base64.b64encode(data).decode("ascii").replace("+", "-").replace("=", "_").replace("/", "~")
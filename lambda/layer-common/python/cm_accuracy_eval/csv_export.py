@@ -0,0 +1,30 @@
+'''
+CSV export of the moderation and review results: one row per label, built with data_access.flatten_labels like the Parquet
+export (parquet_export), so both formats hold the same rows. Fields are quoted by csv.writer when needed.
+
+    with S3MultipartWriter(s3, bucket, key, gzip=True) as f:
+        rows = write_labels(f, data_access.labeled_items(dynamodb, result_table, index_name, parallel=True))
+'''
+import csv
+
+from cm_accuracy_eval import data_access
+
+HEADER = ['file_path', 'top_category', 'sub_category', 'confidence', 'reivew_result']
+
+
+def write_labels(f, db_items, top_category=None, sub_category=None, type=None, confidence_threshold=None, header=True, counts=None):
+    '''
+    Write the labels of moderation results (DynamoDB JSON) matching the filters to a file object. Returns the row count.
+    counts: dict whose "rows" is kept up to date while writing, for progress reports.
+    '''
+    rows = 0
+    writer = csv.writer(f, lineterminator='\n')
+    if header:
+        writer.writerow(HEADER)
+    for db_item in db_items:
+        for i in data_access.flatten_labels(db_item, top_category, sub_category, type, confidence_threshold):
+            writer.writerow([i["file_path"], i["top_category"], i["sub_category"], i["confidence"], i["type"]])
+            rows += 1
+        if counts is not None:
+            counts["rows"] = rows
+    return rows
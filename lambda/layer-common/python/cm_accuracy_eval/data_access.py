@@ -0,0 +1,134 @@
+'''
+Shared DynamoDB data access for the task and report handlers.
+
+- pages() / items(): generators over Query and Scan results. While the caller processes a page, the next page is
+  fetched on a background thread. Pass ProjectionExpression to read only the attributes needed.
+- count(): item count with a parallel segmented scan (cm_accuracy_eval.parallel_scan)
+- flatten_labels() / flat_items(): the labels of the moderation results, one dict per label, with optional filters
+- unmarshal(): DynamoDB JSON to plain values (S and N as strings, M as dict, L as list)
+
+    for fi in flat_items(dynamodb, result_table, index_name, type="false-positive"):
+        ...
+'''
+from concurrent.futures import ThreadPoolExecutor
+
+from cm_accuracy_eval.parallel_scan import ParallelScan
+
+# Attributes of a moderation result needed to flatten its labels
+LABEL_PROJECTION = "file_path, rek_results"
+
+
+def pages(dynamodb, operation, prefetch=True, **kwargs):
+    '''Yield the responses of a paginated "query" or "scan" call.'''
+    call = getattr(dynamodb, operation)
+    if not prefetch:
+        while True:
+            response = call(**kwargs)
+            yield response
+            if response.get("LastEvaluatedKey") is None:
+                return
+            kwargs = dict(kwargs, ExclusiveStartKey=response["LastEvaluatedKey"])
+
+    executor = ThreadPoolExecutor(max_workers=1)
+    try:
+        future = executor.submit(call, **kwargs)
+        while future is not None:
+            response = future.result()
+            future = None
+            if response.get("LastEvaluatedKey") is not None:
+                kwargs = dict(kwargs, ExclusiveStartKey=response["LastEvaluatedKey"])
+                future = executor.submit(call, **kwargs)
+            yield response
+    finally:
+        executor.shutdown(wait=False)
+
+
+def items(dynamodb, operation, prefetch=True, **kwargs):
+    '''Yield the items of a paginated "query" or "scan" call.'''
+    for page in pages(dynamodb, operation, prefetch, **kwargs):
+        for item in page.get("Items", []):
+            yield item
+
+
+def count(dynamodb, table_name, **kwargs):
+    '''Count the items of a table (Select=COUNT parallel scan). Pass FilterExpression etc. in kwargs.'''
+    return sum([page["Count"] for page in ParallelScan(dynamodb, table_name, Select="COUNT", **kwargs).pages()])
+
+
+def labeled_items(dynamodb, result_table, index_name, projection=LABEL_PROJECTION, parallel=False):
+    '''Moderation results with labels: a query of the issue_flag index, or a parallel scan of the table for whole-table reads.'''
+    if parallel:
+        kwargs = {"FilterExpression": 'issue_flag = :i', "ExpressionAttributeValues": {':i': {'N': '1'}}}
+        if projection is not None:
+            kwargs["ProjectionExpression"] = projection
+        return ParallelScan(dynamodb, result_table, **kwargs).items()
+    kwargs = {
+        "TableName": result_table,
+        "IndexName": index_name,
+        "KeyConditionExpression": 'issue_flag = :i',
+        "ExpressionAttributeValues": {':i': {'N': '1'}},
+    }
+    if projection is not None:
+        kwargs["ProjectionExpression"] = projection
+    return items(dynamodb, "query", **kwargs)
+
+
+def flat_items(dynamodb, result_table, index_name, top_category=None, sub_category=None, type=None, confidence_threshold=None, parallel=False):
+    '''Yield the flattened labels of the moderation results matching the filters.'''
+    for db_item in labeled_items(dynamodb, result_table, index_name, parallel=parallel):
+        for fi in flatten_labels(db_item, top_category, sub_category, type, confidence_threshold):
+            yield fi
+
+
+def flatten_labels(db_item, top_category=None, sub_category=None, type=None, confidence_threshold=None):
+    '''Labels of a moderation result: [{"file_path", "top_category", "sub_category", "confidence", "type"}]'''
+    flat_items = []
+    if db_item is None or "rek_results" not in db_item or len(db_item["rek_results"]["L"]) == 0:
+        return flat_items
+
+    for i in db_item["rek_results"]["L"]:
+        if "M" not in i or i["M"] is None:
+            continue
+
+        # masage data to fix the data schema mis alignment.
+        # For top category, Rek return parent_category="" and put the top category name into "category" field
+        db_top_category = i["M"]["parent_category"]["S"]
+        db_sub_category = i["M"]["category"]["S"]
+        db_confidence = 0
+        db_type = None
+        if (db_top_category is None or len(db_top_category) == 0) and (db_sub_category is not None and len(db_sub_category) > 0):
+            db_top_category = db_sub_category
+            db_sub_category = ""
+        if ("confidence" in i["M"] and i["M"]["confidence"]["N"] is not None):
+            db_confidence = float(i["M"]["confidence"]["N"])
+        if ("review_result" in i["M"] and "S" in i["M"]["review_result"] and len(i["M"]["review_result"]["S"]) > 0):
+            db_type = i["M"]["review_result"]["S"]
+
+        if ((top_category is None or db_top_category == top_category) \
+            and (sub_category is None or db_sub_category == sub_category) \
+            and (type is None or db_type == type) \
+            and (confidence_threshold is None or db_confidence >= confidence_threshold)):
+                flat_items.append({
+                    "file_path": db_item["file_path"]["S"],
+                    "top_category": db_top_category,
+                    "sub_category": db_sub_category,
+                    "confidence": db_confidence,
+                    "type": i["M"].get("review_result", {}).get("S")
+                })
+
+    return flat_items
+
+
+def unmarshal(item):
+    '''DynamoDB JSON item to plain values. S and N are kept as strings, other types are None.'''
+    return _unmarshal_value({"M": item})
+
+
+def _unmarshal_value(node):
+    for key, value in node.items():
+        if key == "S" or key == "N":
+            return value
+        if key == "M":
+            return {k: _unmarshal_value(v) for k, v in value.items()}
+        if key == "L":
+            return [_unmarshal_value(v) for v in value]
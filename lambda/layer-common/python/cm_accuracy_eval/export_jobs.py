@@ -0,0 +1,223 @@
+'''
+Asynchronous export jobs, for tasks too large to export within an API request (export endpoint):
+1. export-start creates the job item and invokes the export worker once per scan segment of the moderation result table.
+2. A worker scans its segment and writes the labels to a shard (csv_export or parquet_export, S3MultipartWriter) under
+   report/jobs/<job id>/shards/. Before its Lambda times out, it ends the shard and invokes itself to continue from the scan
+   checkpoint with a new shard. The progress of the segment is saved on the job item every PROGRESS_INTERVAL_S.
+3. The worker that completes the last segment invokes the finalizer. CSV: the shards are concatenated into one object, copied
+   by S3 but for their first bytes (S3MultipartWriter.append_object). Before its Lambda times out, the finalizer suspends the
+   upload and invokes itself to continue from the next shard. Parquet: the shards are the files of the export.
+4. export-status returns summary(): progress, rows per second and ETA. export-download returns URLs of the output files.
+
+Job item: job_id, task_id, result_table, status (RUNNING, FINALIZING, COMPLETED, FAILED), format, gzip, filters,
+total_segments, estimated_items (task "processed" counter), created_at, finished_at, progress ({segment: {rows, scanned,
+bytes, shards, done}}), done_segments, output_keys, output_bytes, error, ttl.
+'''
+import json
+import time
+import uuid
+
+from cm_accuracy_eval import data_access
+from cm_accuracy_eval.parallel_scan import ParallelScan
+
+STATUS_RUNNING = "RUNNING"
+STATUS_FINALIZING = "FINALIZING"
+STATUS_COMPLETED = "COMPLETED"
+STATUS_FAILED = "FAILED"
+FORMATS = ("csv", "parquet")
+FILTERS = ("top_category", "sub_category", "type", "confidence_threshold")
+PROGRESS_INTERVAL_S = 10
+JOB_TTL_S = 7 * 24 * 3600
+
+
+class JobStopped(Exception):
+    '''The job isn't running anymore (failed or finalized): the worker stops.'''
+
+
+def new_job(task_id, result_table, format, gzip, filters, total_segments, estimated_items=None, now=None):
+    '''Job item in DynamoDB JSON. filters: {"top_category", "sub_category", "type", "confidence_threshold"}, None if not set.'''
+    now = int(time.time() if now is None else now)
+    item = {
+        "job_id": {"S": str(uuid.uuid4())},
+        "task_id": {"S": task_id},
+        "result_table": {"S": result_table},
+        "status": {"S": STATUS_RUNNING},
+        "format": {"S": format},
+        "gzip": {"BOOL": gzip},
+        "filters": {"S": json.dumps({k: filters.get(k) for k in FILTERS})},
+        "total_segments": {"N": str(total_segments)},
+        "created_at": {"N": str(now)},
+        "progress": {"M": {}},
+        "ttl": {"N": str(now + JOB_TTL_S)},
+    }
+    if estimated_items is not None:
+        item["estimated_items"] = {"N": str(estimated_items)}
+    return item
+
+
+def read_job(item):
+    '''Job item in DynamoDB JSON to plain values.'''
+    job = {
+        "job_id": item["job_id"]["S"],
+        "task_id": item["task_id"]["S"],
+        "result_table": item["result_table"]["S"],
+        "status": item["status"]["S"],
+        "format": item["format"]["S"],
+        "gzip": item["gzip"]["BOOL"],
+        "filters": json.loads(item["filters"]["S"]),
+        "total_segments": int(item["total_segments"]["N"]),
+        "estimated_items": int(item["estimated_items"]["N"]) if "estimated_items" in item else None,
+        "created_at": int(item["created_at"]["N"]),
+        "finished_at": int(item["finished_at"]["N"]) if "finished_at" in item else None,
+        "progress": {int(k): json.loads(v["S"]) for k, v in item.get("progress", {}).get("M", {}).items()},
+        "done_segments": len(item.get("done_segments", {}).get("SS", [])),
+        "output_keys": [k["S"] for k in item.get("output_keys", {}).get("L", [])],
+        "output_bytes": int(item["output_bytes"]["N"]) if "output_bytes" in item else None,
+        "error": item.get("error", {}).get("S"),
+    }
+    return job
+
+
+def get_job(dynamodb, job_table, job_id):
+    '''Job in plain values, None if it doesn't exist.'''
+    item = dynamodb.get_item(TableName=job_table, Key={"job_id": {"S": job_id}}, ConsistentRead=True).get("Item")
+    return None if item is None else read_job(item)
+
+
+def summary(job, now=None):
+    '''Job status for the status API: progress, rows per second and ETA (seconds, None until it can be estimated).'''
+    now = time.time() if now is None else now
+    rows = sum([p["rows"] for p in job["progress"].values()])
+    scanned = sum([p["scanned"] for p in job["progress"].values()])
+    elapsed = max((job["finished_at"] or now) - job["created_at"], 1)
+    eta = None
+    if job["status"] in (STATUS_COMPLETED, STATUS_FAILED):
+        eta = 0
+    elif job["estimated_items"] is not None and scanned > 0:
+        eta = round(max(job["estimated_items"] - scanned, 0) / (scanned / elapsed))
+    return {
+        "job_id": job["job_id"],
+        "task_id": job["task_id"],
+        "status": job["status"],
+        "format": job["format"],
+        "gzip": job["gzip"],
+        "segments": job["total_segments"],
+        "segments_done": job["done_segments"],
+        "rows": rows,
+        "items_scanned": scanned,
+        "estimated_items": job["estimated_items"],
+        "elapsed_s": round(elapsed),
+        "rows_per_s": round(rows / elapsed, 1),
+        "eta_s": eta,
+        "output_bytes": job["output_bytes"],
+        "error": job["error"],
+    }
+
+
+def task_job_ids(dynamodb, job_table, task_id):
+    '''Ids of the export jobs of a task: the job table only holds the jobs of the last JOB_TTL_S, it is scanned.'''
+    paginator = dynamodb.get_paginator("scan")
+    for page in paginator.paginate(TableName=job_table, FilterExpression="task_id = :t", ProjectionExpression="job_id",
+            ExpressionAttributeValues={":t": {"S": task_id}}):
+        for item in page.get("Items", []):
+            yield item["job_id"]["S"]
+
+
+def job_prefix(report_prefix, job_id):
+    return f"{report_prefix}jobs/{job_id}/"
+
+
+def shard_key(report_prefix, job, segment, chunk):
+    extension = ".parquet" if job["format"] == "parquet" else ".csv.gz" if job["gzip"] else ".csv"
+    return f"{job_prefix(report_prefix, job['job_id'])}shards/{segment:05}-{chunk:05}{extension}"
+
+
+def carry_key(report_prefix, job, shard):
+    '''Bytes buffered by the finalizer when it hands over, before the shard.'''
+    return f"{job_prefix(report_prefix, job['job_id'])}finalize/{shard:05}"
+
+
+def output_key(report_prefix, job):
+    extension = ".csv.gz" if job["gzip"] else ".csv"
+    return f"{job_prefix(report_prefix, job['job_id'])}{job['task_id']}{extension}"
+
+
+def segment_scan(dynamodb, job, segment, checkpoint=None, projection=data_access.LABEL_PROJECTION):
+    '''Scan of the labeled results of one segment: the other segments are marked done.'''
+    if checkpoint is None:
+        checkpoint = {"segments": [{} if n == segment else {"done": True} for n in range(job["total_segments"])]}
+    return ParallelScan(dynamodb, job["result_table"], checkpoint=checkpoint,
+        FilterExpression='issue_flag = :i', ExpressionAttributeValues={':i': {'N': '1'}}, ProjectionExpression=projection)
+
+
+def save_progress(dynamodb, job_table, job_id, segment, progress):
+    '''Save the progress of a segment. Raises JobStopped if the job isn't running.'''
+    try:
+        dynamodb.update_item(
+            TableName=job_table,
+            Key={"job_id": {"S": job_id}},
+            UpdateExpression="SET progress.#s = :p",
+            ConditionExpression="#st = :running",
+            ExpressionAttributeNames={"#s": str(segment), "#st": "status"},
+            ExpressionAttributeValues={":p": {"S": json.dumps(progress)}, ":running": {"S": STATUS_RUNNING}}
+        )
+    except dynamodb.exceptions.ConditionalCheckFailedException:
+        raise JobStopped(job_id)
+
+
+def complete_segment(dynamodb, job_table, job_id, segment):
+    '''
+    Mark a segment done. Returns True for the call that completes the last segment, which moves the job to FINALIZING: only
+    one worker finalizes, even when a segment is completed twice.
+    '''
+    response = dynamodb.update_item(
+        TableName=job_table,
+        Key={"job_id": {"S": job_id}},
+        UpdateExpression="ADD done_segments :s",
+        ExpressionAttributeValues={":s": {"SS": [str(segment)]}},
+        ReturnValues="ALL_NEW"
+    )
+    item = response["Attributes"]
+    if len(item["done_segments"]["SS"]) < int(item["total_segments"]["N"]):
+        return False
+    try:
+        dynamodb.update_item(
+            TableName=job_table,
+            Key={"job_id": {"S": job_id}},
+            UpdateExpression="SET #st = :finalizing",
+            ConditionExpression="#st = :running",
+            ExpressionAttributeNames={"#st": "status"},
+            ExpressionAttributeValues={":finalizing": {"S": STATUS_FINALIZING}, ":running": {"S": STATUS_RUNNING}}
+        )
+    except dynamodb.exceptions.ConditionalCheckFailedException:
+        return False
+    return True
+
+
+def complete(dynamodb, job_table, job_id, output_keys, output_bytes, now=None):
+    dynamodb.update_item(
+        TableName=job_table,
+        Key={"job_id": {"S": job_id}},
+        UpdateExpression="SET #st = :completed, output_keys = :k, output_bytes = :b, finished_at = :t",
+        ExpressionAttributeNames={"#st": "status"},
+        ExpressionAttributeValues={
+            ":completed": {"S": STATUS_COMPLETED},
+            ":k": {"L": [{"S": k} for k in output_keys]},
+            ":b": {"N": str(output_bytes)},
+            ":t": {"N": str(int(time.time() if now is None else now))},
+        }
+    )
+
+
+def fail(dynamodb, job_table, job_id, error, now=None):
+    dynamodb.update_item(
+        TableName=job_table,
+        Key={"job_id": {"S": job_id}},
+        UpdateExpression="SET #st = :failed, #e = :e, finished_at = :t",
+        ExpressionAttributeNames={"#st": "status", "#e": "error"},
+        ExpressionAttributeValues={
+            ":failed": {"S": STATUS_FAILED},
+            ":e": {"S": str(error)[:1000]},
+            ":t": {"N": str(int(time.time() if now is None else now))},
+        }
+    )
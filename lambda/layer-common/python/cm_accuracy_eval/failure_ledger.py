@@ -0,0 +1,135 @@
+'''
+Failure ledger: one item per image of a task whose moderation failed, so that failed images are retried and reported instead
+of vanishing from the evaluation.
+
+Ledger item: task_id (partition key), file_path (sort key: s3://bucket/key), bucket, s3_key, duplicates (JSON list of the
+near-duplicates moderated through the image), error_class, error_code, error_message, attempts, first_failed_at and
+last_failed_at.
+
+Error classes (classify):
+- THROTTLE: throttled by Rekognition, S3 or DynamoDB - retried
+- TRANSIENT: service errors, timeouts, image claimed by another worker, batch out of time, results not saved - retried
+- INVALID_IMAGE: format, size or dimensions rejected by Rekognition - not retried
+- ACCESS: object missing or not readable - not retried
+- UNKNOWN: any other error - retried
+
+The moderation workers record every failed attempt, and delete the entries of the images moderated by a retry (resolve).
+After the moderation, the retry pass of the state machine moderates the retryable entries again with backoff. The entries left
+are the images never moderated, summarized by class and error code in the report.
+'''
+import random
+import time
+
+THROTTLE = "THROTTLE"
+TRANSIENT = "TRANSIENT"
+INVALID_IMAGE = "INVALID_IMAGE"
+ACCESS = "ACCESS"
+UNKNOWN = "UNKNOWN"
+RETRYABLE_CLASSES = (THROTTLE, TRANSIENT, UNKNOWN)
+
+_ERROR_CLASSES = {
+    THROTTLE: ["ThrottlingException", "ProvisionedThroughputExceededException", "LimitExceededException",
+        "RequestLimitExceeded", "TooManyRequestsException", "SlowDown"],
+    INVALID_IMAGE: ["InvalidImageFormatException", "ImageTooLargeException", "InvalidParameterException", "NormalizationError"],
+    ACCESS: ["AccessDeniedException", "AccessDenied", "InvalidS3ObjectException", "NoSuchKey", "NoSuchBucket"],
+    TRANSIENT: ["InternalServerError", "ServiceUnavailable", "ServiceUnavailableException", "ClaimHeld", "DeadlineExceeded", "UnprocessedItems",
+        "ReadTimeoutError", "ConnectTimeoutError", "EndpointConnectionError", "States.Timeout", "States.TaskFailed",
+        "Lambda.Unknown"],
+}
+_CLASS_BY_CODE = {code: c for c, codes in _ERROR_CLASSES.items() for code in codes}
+MAX_MESSAGE_LENGTH = 500
+MAX_DELETE_ATTEMPTS = 5
+
+
+def error_code(ex):
+    '''AWS error code of an exception, or its class name.'''
+    # The timeouts of botocore have a response attribute set to None
+    return (getattr(ex, "response", None) or {}).get("Error", {}).get("Code") or type(ex).__name__
+
+
+def classify(code):
+    return _CLASS_BY_CODE.get(code, UNKNOWN)
+
+
+def is_retryable(code):
+    return classify(code) in RETRYABLE_CLASSES
+
+
+def file_path(bucket, key):
+    return f"s3://{bucket}/{key}"
+
+
+def record(dynamodb, ledger_table, task_id, bucket, key, code, message, duplicates=None, now=None):
+    '''Record a failed attempt of an image: the entry keeps the last error and counts the attempts.'''
+    now = int(time.time() if now is None else now)
+    dynamodb.update_item(
+        TableName=ledger_table,
+        Key={"task_id": {"S": task_id}, "file_path": {"S": file_path(bucket, key)}},
+        UpdateExpression="SET #b = :b, s3_key = :k, duplicates = :d, error_class = :c, error_code = :e, error_message = :m, "
+            "last_failed_at = :now, first_failed_at = if_not_exists(first_failed_at, :now) ADD attempts :one",
+        ExpressionAttributeNames={"#b": "bucket"},
+        ExpressionAttributeValues={
+            ":b": {"S": bucket},
+            ":k": {"S": key},
+            ":d": {"L": [{"S": d} for d in (duplicates or [])]},
+            ":c": {"S": classify(code)},
+            ":e": {"S": code},
+            ":m": {"S": str(message)[:MAX_MESSAGE_LENGTH] or code},
+            ":now": {"N": str(now)},
+            ":one": {"N": "1"},
+        }
+    )
+
+
+def resolve(dynamodb, ledger_table, task_id, file_paths):
+    '''Delete the entries of images moderated since they failed. Entries that don't exist are ignored.'''
+    _delete(dynamodb, ledger_table, [{"task_id": {"S": task_id}, "file_path": {"S": p}} for p in file_paths])
+
+
+def entries(dynamodb, ledger_table, task_id, retryable_only=False):
+    '''Ledger entries of a task in DynamoDB JSON, in file path order.'''
+    kwargs, values = {}, {":t": {"S": task_id}}
+    if retryable_only:
+        kwargs["FilterExpression"] = "error_class IN (" + ", ".join([f":c{i}" for i in range(len(RETRYABLE_CLASSES))]) + ")"
+        values.update({f":c{i}": {"S": c} for i, c in enumerate(RETRYABLE_CLASSES)})
+    paginator = dynamodb.get_paginator("query")
+    for page in paginator.paginate(
+        TableName=ledger_table,
+        KeyConditionExpression="task_id = :t",
+        ExpressionAttributeValues=values,
+        **kwargs
+    ):
+        for item in page.get("Items", []):
+            yield item
+
+
+def clear(dynamodb, ledger_table, task_id):
+    '''Delete the ledger of a task. Returns the number of entries deleted.'''
+    keys = [{"task_id": i["task_id"], "file_path": i["file_path"]} for i in entries(dynamodb, ledger_table, task_id)]
+    _delete(dynamodb, ledger_table, keys)
+    return len(keys)
+
+
+def summary(dynamodb, ledger_table, task_id):
+    '''Images never moderated: {"total", "retryable", "by_class": {class: count}, "by_error": {error code: count}}.'''
+    result = {"total": 0, "retryable": 0, "by_class": {}, "by_error": {}}
+    for item in entries(dynamodb, ledger_table, task_id):
+        result["total"] += 1
+        error_class, code = item["error_class"]["S"], item["error_code"]["S"]
+        if error_class in RETRYABLE_CLASSES:
+            result["retryable"] += 1
+        result["by_class"][error_class] = result["by_class"].get(error_class, 0) + 1
+        result["by_error"][code] = result["by_error"].get(code, 0) + 1
+    return result
+
+
+def _delete(dynamodb, table_name, keys):
+    for start in range(0, len(keys), 25):
+        requests = [{"DeleteRequest": {"Key": k}} for k in keys[start:start + 25]]
+        for attempt in range(MAX_DELETE_ATTEMPTS):
+            requests = dynamodb.batch_write_item(RequestItems={table_name: requests}).get("UnprocessedItems", {}).get(table_name, [])
+            if len(requests) == 0:
+                break
+            time.sleep(random.uniform(0, 0.05 * (2 ** attempt)))
+        if len(requests) > 0:
+            print(f"Failed to delete {len(requests)} items from {table_name}")
@@ -0,0 +1,90 @@
+'''
+Image URLs and thumbnails of the images APIs (get-images, images-unflag).
+
+- add_image_urls(): presigned S3 URLs from a PresignedUrlCache, or with "cookie" delivery (image distribution deployed) plain
+  paths under the distribution and one set of signed cookies for the task folder (cm_accuracy_eval.cloudfront_cookies).
+- add_thumbnails(): presigned URLs of the thumbnail and of its sprite sheet, and its box in the sheet. The thumbnails not
+  built yet are requested from the thumbnails Lambda, asynchronously, for a later request (cm_accuracy_eval.thumbnails).
+
+The cookie signer reads the distribution's private key from Secrets Manager once per container.
+
+    image_delivery = ImageDelivery(dynamodb, lambda_client, secretsmanager, url_cache, expires_in, thumbnails_function_name,
+        cdn_domain, cdn_key_pair_id, cdn_private_key_secret_arn, cdn_cookie_expires_in)
+    image_delivery.add_thumbnails(images, task_item)
+    delivery = image_delivery.add_image_urls(images, task_item, event.get("delivery"))
+'''
+import json
+
+from cm_accuracy_eval import cloudfront_cookies, thumbnails
+
+
+class ImageDelivery:
+    def __init__(self, dynamodb, lambda_client, secretsmanager, url_cache, expires_in, thumbnails_function_name="",
+            cdn_domain="", cdn_key_pair_id="", cdn_private_key_secret_arn="", cdn_cookie_expires_in=3600):
+        self.dynamodb = dynamodb
+        self.lambda_client = lambda_client
+        self.secretsmanager = secretsmanager
+        self.url_cache = url_cache
+        self.expires_in = expires_in
+        self.thumbnails_function_name = thumbnails_function_name
+        self.cdn_domain = cdn_domain
+        self.cdn_key_pair_id = cdn_key_pair_id
+        self.cdn_private_key_secret_arn = cdn_private_key_secret_arn
+        self.cdn_cookie_expires_in = cdn_cookie_expires_in
+        self.cookie_signer = None
+
+    def add_image_urls(self, images, task_item, delivery):
+        '''
+        Set the image URLs. "cookie" delivery (when the image distribution is deployed): URL paths under the distribution and
+        one set of signed cookies for the task folder, returned. Otherwise presigned S3 URLs, and None is returned.
+        '''
+        # The images of an input manifest aren't in the task folder served by the distribution
+        if delivery == "cookie" and len(self.cdn_domain) > 0 and "input_manifest" not in task_item:
+            for i in images:
+                i["url"] = cloudfront_cookies.object_path(i["file_path"])
+            return cloudfront_cookies.delivery(self.get_cookie_signer(), self.cdn_domain, task_item["s3_key_prefix"]["S"], self.cdn_cookie_expires_in)
+
+        # Generate S3 presigned URLs
+        for i, url in zip(images, self.url_cache.get_urls([i["file_path"] for i in images], self.expires_in)):
+            i["url"] = url
+        print("Presigned URL cache: ", self.url_cache.pop_stats())
+        return None
+
+    def add_thumbnails(self, images, task_item):
+        '''
+        Set the thumbnail of the images: presigned URLs of the thumbnail and of its sprite sheet, and its box in the sheet.
+        None for the images without one yet: their thumbnails are built asynchronously for a later request.
+        '''
+        result_table = task_item["moderation_result_table"]["S"]
+        missing = [i["file_path"] for i in images if i.get("thumbnail") is None]
+        if len(missing) > 0:
+            # Built since the index was read, or not projected by the index of a table created before thumbnails
+            built = thumbnails.load(self.dynamodb, result_table, missing)
+            for i in images:
+                if i.get("thumbnail") is None:
+                    i["thumbnail"] = built.get(i["file_path"])
+            missing = [f for f in missing if f not in built]
+        if len(missing) > 0 and len(self.thumbnails_function_name) > 0:
+            try:
+                self.lambda_client.invoke(FunctionName=self.thumbnails_function_name, InvocationType="Event",
+                    Payload=json.dumps({"TaskId": task_item["id"]["S"], "ResultTable": result_table, "FilePaths": missing, "Bucket": task_item["s3_bucket"]["S"]}))
+            except Exception as ex:
+                print("Failed to request thumbnails: ", ex)
+
+        # Thumbnails are served from the bucket: presigned, cached with the image URLs
+        ready = [i for i in images if i.get("thumbnail") is not None and "error" not in i["thumbnail"]]
+        urls = self.url_cache.get_urls([u for i in ready for u in (i["thumbnail"]["thumbnail"], i["thumbnail"]["sprite"])], self.expires_in)
+        for n, i in enumerate(ready):
+            t = i["thumbnail"]
+            i["thumbnail"] = {"url": urls[2 * n], "sprite": {"url": urls[2 * n + 1], "x": t["x"], "y": t["y"], "w": t["w"], "h": t["h"]}}
+        for i in images:
+            if i["thumbnail"] is not None and "url" not in i["thumbnail"]:
+                i["thumbnail"] = None
+        print(f"Thumbnails: {len(ready)}, requested: {len(missing)}")
+
+    def get_cookie_signer(self):
+        # The private key of the distribution's key group, read once per container
+        if self.cookie_signer is None:
+            private_key = self.secretsmanager.get_secret_value(SecretId=self.cdn_private_key_secret_arn)["SecretString"]
+            self.cookie_signer = cloudfront_cookies.CookieSigner(self.cdn_key_pair_id, private_key)
+        return self.cookie_signer
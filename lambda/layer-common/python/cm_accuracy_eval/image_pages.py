@@ -0,0 +1,151 @@
+'''
+Cursor pagination of the report images (get-images and get-images-unflag).
+
+A page is read from DynamoDB only as far as it needs and the cursor returned with it is an opaque token (URL safe base64 JSON)
+to pass back for the next page; None when there are no more images. A filtered page stops after MAX_READ_PER_PAGE result items
+even if it isn't full, so every call has a bounded cost: keep paging while the cursor isn't None.
+
+Flagged images are sorted by max_confidence descending, the highest label confidence of the image:
+- "index" mode: a query of the confidence index (issue_flag, max_confidence) in descending order. The cursor is the key of the
+  last image returned.
+- "sort" mode, for tables created before the index existed: the labeled images are streamed and the next page_size images after
+  the cursor (max_confidence, file_path) are kept in a heap. Memory is bounded by the page size, but every page reads the labeled
+  images again.
+
+    images, cursor = flagged_page(dynamodb, result_table, confidence_index, labeled_index, 100, decode_cursor(token))
+
+Every image of a page has its "thumbnail" (cm_accuracy_eval.thumbnails.from_item), None when it wasn't built yet. Indexes of
+tables created before thumbnails existed don't project it: None as well.
+'''
+import base64
+import heapq
+import json
+
+from cm_accuracy_eval import data_access, thumbnails
+
+MAX_PAGE_SIZE = 500
+MAX_READ_PER_PAGE = 5000
+INDEX_PROJECTION = "file_path, issue_flag, max_confidence, rek_results, thumbnail"
+SORT_PROJECTION = "file_path, rek_results, thumbnail"
+
+
+def encode_cursor(cursor):
+    if cursor is None:
+        return None
+    return base64.urlsafe_b64encode(json.dumps(cursor, separators=(",", ":")).encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(token):
+    '''Cursor from a token. Raises ValueError if the token is invalid.'''
+    if token is None or len(token) == 0:
+        return None
+    try:
+        cursor = json.loads(base64.urlsafe_b64decode(token.encode("ascii")))
+    except Exception:
+        raise ValueError("Invalid cursor")
+    if not isinstance(cursor, dict) or cursor.get("m") not in ("index", "sort", "key"):
+        raise ValueError("Invalid cursor")
+    return cursor
+
+
+def max_confidence(db_item):
+    '''Highest label confidence of a moderation result, 0 without labels.'''
+    return max([float(l["M"]["confidence"]["N"]) for l in db_item.get("rek_results", {}).get("L", []) if "confidence" in l.get("M", {})], default=0)
+
+
+def flagged_page(dynamodb, result_table, confidence_index, labeled_index, page_size, cursor=None,
+        top_category=None, sub_category=None, type=None, confidence_threshold=None):
+    '''
+    A page of flagged images matching the filters: the first matching label of each image.
+    Returns (labels, cursor). Raises ValueError if the cursor is invalid.
+    '''
+    filters = (top_category, sub_category, type, confidence_threshold)
+    if cursor is None or cursor["m"] == "index":
+        try:
+            return _index_page(dynamodb, result_table, confidence_index, page_size, cursor, filters)
+        except Exception as ex:
+            if getattr(ex, "response", {}).get("Error", {}).get("Code") != "ValidationException":
+                raise
+            if cursor is not None:
+                raise ValueError("Invalid cursor")
+            print("No confidence index, sorting the labeled images:", result_table)
+    if cursor is not None and cursor["m"] != "sort":
+        raise ValueError("Invalid cursor")
+    return _sorted_page(dynamodb, result_table, labeled_index, page_size, cursor, filters)
+
+
+def unflagged_page(dynamodb, result_table, labeled_index, page_size, cursor=None):
+    '''
+    A page of the images without labels, in index order: [{"file_path", "thumbnail"}]. Returns (images, cursor).
+    Without page_size, the page is one DynamoDB response (up to 1 MB).
+    '''
+    if cursor is not None and cursor["m"] != "key":
+        raise ValueError("Invalid cursor")
+    kwargs = {
+        "TableName": result_table,
+        "IndexName": labeled_index,
+        "KeyConditionExpression": 'issue_flag = :i',
+        "ExpressionAttributeValues": {':i': {'N': '0'}},
+        "ProjectionExpression": "file_path, thumbnail",
+    }
+    if page_size is not None:
+        kwargs["Limit"] = page_size
+    if cursor is not None:
+        kwargs["ExclusiveStartKey"] = cursor["k"]
+    response = next(data_access.pages(dynamodb, "query", prefetch=False, **kwargs))
+    last_key = response.get("LastEvaluatedKey")
+    images = [{"file_path": i["file_path"]["S"], "thumbnail": thumbnails.from_item(i)} for i in response["Items"]]
+    return images, None if last_key is None else {"m": "key", "k": last_key}
+
+
+def _index_page(dynamodb, result_table, confidence_index, page_size, cursor, filters):
+    filtered = any([f is not None for f in filters])
+    kwargs = {
+        "TableName": result_table,
+        "IndexName": confidence_index,
+        "KeyConditionExpression": 'issue_flag = :i',
+        "ExpressionAttributeValues": {':i': {'N': '1'}},
+        "ScanIndexForward": False,
+        "ProjectionExpression": INDEX_PROJECTION,
+    }
+    if not filtered:
+        kwargs["Limit"] = page_size
+    if cursor is not None:
+        kwargs["ExclusiveStartKey"] = cursor["k"]
+
+    result, read = [], 0
+    # Prefetch the next page only when a filter may skip images
+    for page in data_access.pages(dynamodb, "query", prefetch=filtered, **kwargs):
+        items = page.get("Items", [])
+        for n, db_item in enumerate(items):
+            read += 1
+            labels = data_access.flatten_labels(db_item, *filters)
+            if len(labels) > 0:
+                labels[0]["thumbnail"] = thumbnails.from_item(db_item)
+                result.append(labels[0])
+            if len(result) >= page_size or read >= MAX_READ_PER_PAGE:
+                more = n < len(items) - 1 or page.get("LastEvaluatedKey") is not None
+                key = {k: db_item[k] for k in ("file_path", "issue_flag", "max_confidence")}
+                return result, {"m": "index", "k": key} if more else None
+    return result, None
+
+
+def _sorted_page(dynamodb, result_table, labeled_index, page_size, cursor, filters):
+    after = None if cursor is None else (-float(cursor["c"]), cursor["f"])
+
+    def candidates():
+        for db_item in data_access.labeled_items(dynamodb, result_table, labeled_index, projection=SORT_PROJECTION):
+            labels = data_access.flatten_labels(db_item, *filters)
+            if len(labels) == 0:
+                continue
+            labels[0]["thumbnail"] = thumbnails.from_item(db_item)
+            sort_key = (-max_confidence(db_item), db_item["file_path"]["S"])
+            if after is None or sort_key > after:
+                yield sort_key, labels[0]
+
+    page = heapq.nsmallest(page_size + 1, candidates(), key=lambda c: c[0])
+    next_cursor = None
+    if len(page) > page_size:
+        page = page[:page_size]
+        next_cursor = {"m": "sort", "c": -page[-1][0][0], "f": page[-1][0][1]}
+    return [label for _, label in page], next_cursor
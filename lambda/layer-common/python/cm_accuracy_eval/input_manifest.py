@@ -0,0 +1,225 @@
+'''
+Input manifests: the list of images to moderate for a task, instead of the objects under its input prefix. The images stay
+where they are: a curated subset of a bucket is moderated without copying it.
+
+Formats (FORMATS), optionally gzip compressed (".gz"):
+- csv: one image per row, "s3://bucket/key", or "bucket,key" with the key URL-encoded (S3 Batch Operations manifest). A
+  header row is skipped.
+- jsonl: one JSON object per line, {"s3_uri": "s3://bucket/key"} ("file_path" is accepted too), or {"bucket", "key"}, with
+  an optional "size".
+- s3_inventory: the manifest.json of an S3 Inventory report, with CSV, ORC or Parquet data files. Delete markers and older
+  versions are skipped.
+
+check() validates a manifest within an API request: the object exists and its first rows are valid. normalize() reads the whole
+manifest up front, before any image is moderated: rows are validated (file type, size when the manifest has it) and exact
+duplicates are dropped, keeping the first. The accepted keys are written to the moderation manifest read by the distributed
+Map. The images must be in one bucket: the Map moderates the keys of one bucket.
+
+Memory: duplicates are found with a set of 16-byte digests of the keys, about 100 bytes per image (500 MB for 5M images),
+whatever the key length.
+'''
+import codecs
+import csv
+import gzip
+import hashlib
+import io
+import json
+import os
+import urllib.parse
+import zlib
+
+FORMATS = ("csv", "jsonl", "s3_inventory")
+INVENTORY_FORMATS = ("CSV", "ORC", "Parquet")
+# First cells of a CSV header row
+CSV_HEADERS = ("bucket", "key", "s3_uri", "uri", "file_path")
+# Bytes read by check(): the first rows of a CSV or JSONL manifest
+CHECK_BYTES = 64 * 1024
+CHECK_ROWS = 10
+
+
+class ManifestError(Exception):
+    '''The manifest can't be read, or has no valid image.'''
+
+
+def parse_s3_uri(uri):
+    '''(bucket, key) of "s3://bucket/key". Raises ManifestError.'''
+    if not isinstance(uri, str) or not uri.startswith("s3://") or "/" not in uri[len("s3://"):]:
+        raise ManifestError(f"Invalid S3 URI: {uri}")
+    bucket, key = uri[len("s3://"):].split("/", 1)
+    if len(bucket) == 0 or len(key) == 0:
+        raise ManifestError(f"Invalid S3 URI: {uri}")
+    return bucket, key
+
+
+def source(format, s3_uri):
+    '''Manifest source {"Format", "Bucket", "Key"} from the API parameters. Raises ManifestError.'''
+    if format not in FORMATS:
+        raise ManifestError(f'Invalid manifest format: {format}. Supported formats: {", ".join(FORMATS)}')
+    bucket, key = parse_s3_uri(s3_uri)
+    return {"Format": format, "Bucket": bucket, "Key": key}
+
+
+def csv_entries(lines):
+    '''(bucket, key, size) per CSV row, None for an invalid row.'''
+    for n, row in enumerate(csv.reader(lines)):
+        if len(row) == 0 or (len(row) == 1 and len(row[0].strip()) == 0):
+            continue
+        first = row[0].strip()
+        if n == 0 and first.lower() in CSV_HEADERS:
+            continue
+        if first.startswith("s3://"):
+            try:
+                yield parse_s3_uri(first) + (None,)
+            except ManifestError:
+                yield None
+        elif len(row) >= 2 and len(first) > 0 and len(row[1]) > 0:
+            yield first, urllib.parse.unquote_plus(row[1]), None
+        else:
+            yield None
+
+
+def jsonl_entries(lines):
+    '''(bucket, key, size) per JSON line, None for an invalid line.'''
+    for line in lines:
+        if len(line.strip()) == 0:
+            continue
+        try:
+            entry = json.loads(line)
+            uri = entry.get("s3_uri", entry.get("file_path"))
+            bucket, key = parse_s3_uri(uri) if uri is not None else (entry["bucket"], entry["key"])
+            size = entry.get("size")
+            yield bucket, key, None if size is None else int(size)
+        except Exception:
+            yield None
+
+
+def read_inventory(s3, bucket, key):
+    '''S3 Inventory manifest.json content. Raises ManifestError if it can't be read or its format isn't supported.'''
+    try:
+        inventory = json.loads(s3.get_object(Bucket=bucket, Key=key)["Body"].read())
+    except Exception as ex:
+        raise ManifestError(f"Failed to read the S3 Inventory manifest s3://{bucket}/{key}: {ex}")
+    file_format = inventory.get("fileFormat")
+    if file_format not in INVENTORY_FORMATS:
+        raise ManifestError(f'Unsupported S3 Inventory format: {file_format}. Supported formats: {", ".join(INVENTORY_FORMATS)}')
+    if len(inventory.get("files", [])) == 0 or "destinationBucket" not in inventory:
+        raise ManifestError(f"No data file in the S3 Inventory manifest s3://{bucket}/{key}")
+    return inventory
+
+
+def inventory_entries(s3, inventory):
+    '''(bucket, key, size) per object of an S3 Inventory report (manifest.json content).'''
+    file_format = inventory["fileFormat"]
+    data_bucket = inventory["destinationBucket"].split(":::")[-1]
+    schema = [c.strip() for c in inventory.get("fileSchema", "").split(",")]
+    for f in inventory["files"]:
+        body = s3.get_object(Bucket=data_bucket, Key=f["key"])["Body"]
+        if file_format == "CSV":
+            # Columns of fileSchema, keys URL-encoded, no header
+            columns = {c: i for i, c in enumerate(schema)}
+            for row in csv.reader(codecs.getreader("utf-8")(gzip.GzipFile(fileobj=body))):
+                if "IsDeleteMarker" in columns and row[columns["IsDeleteMarker"]] == "true":
+                    continue
+                if "IsLatest" in columns and row[columns["IsLatest"]] == "false":
+                    continue
+                size = row[columns["Size"]] if "Size" in columns else ""
+                yield row[columns["Bucket"]], urllib.parse.unquote_plus(row[columns["Key"]]), int(size) if size != "" else None
+        else:
+            yield from _columnar_entries(file_format, io.BytesIO(body.read()))
+
+
+def _columnar_entries(file_format, f):
+    # ORC and Parquet inventories: lower case columns, keys aren't encoded
+    if file_format == "Parquet":
+        import pyarrow.parquet as pq
+        batches = pq.ParquetFile(f).iter_batches()
+    else:
+        import pyarrow.orc as orc
+        orc_file = orc.ORCFile(f)
+        batches = (orc_file.read_stripe(n) for n in range(orc_file.nstripes))
+    for batch in batches:
+        columns = batch.to_pydict()
+        sizes, deleted, latest = columns.get("size"), columns.get("is_delete_marker"), columns.get("is_latest")
+        for i, key in enumerate(columns["key"]):
+            if (deleted is not None and deleted[i]) or (latest is not None and latest[i] is False):
+                continue
+            yield columns["bucket"][i], key, None if sizes is None else sizes[i]
+
+
+def entries(s3, manifest_source, limit_bytes=None):
+    '''
+    (bucket, key, size) per image of a manifest ({"Format", "Bucket", "Key"}), None for an invalid row.
+    limit_bytes: read the first bytes of a CSV or JSONL manifest only (check).
+    '''
+    format, bucket, key = manifest_source["Format"], manifest_source["Bucket"], manifest_source["Key"]
+    if format == "s3_inventory":
+        return inventory_entries(s3, read_inventory(s3, bucket, key))
+    try:
+        args = {} if limit_bytes is None else {"Range": f"bytes=0-{limit_bytes - 1}"}
+        body = s3.get_object(Bucket=bucket, Key=key, **args)["Body"]
+    except Exception as ex:
+        raise ManifestError(f"Failed to read the manifest s3://{bucket}/{key}: {ex}")
+    if key.endswith(".gz"):
+        if limit_bytes is not None:
+            # The first bytes of a gzip file are decompressed as far as they go. wbits 47: gzip or zlib header
+            body = io.BytesIO(zlib.decompressobj(47).decompress(body.read()))
+        else:
+            body = gzip.GzipFile(fileobj=body)
+    lines = codecs.getreader("utf-8")(body, errors="replace")
+    return csv_entries(lines) if format == "csv" else jsonl_entries(lines)
+
+
+def check(s3, manifest_source):
+    '''
+    Validate a manifest within an API request: the S3 Inventory manifest.json, or the first rows of a CSV or JSONL manifest.
+    Raises ManifestError.
+    '''
+    if manifest_source["Format"] == "s3_inventory":
+        read_inventory(s3, manifest_source["Bucket"], manifest_source["Key"])
+        return
+    rows = []
+    for entry in entries(s3, manifest_source, limit_bytes=CHECK_BYTES):
+        rows.append(entry)
+        if len(rows) >= CHECK_ROWS:
+            break
+    # The last row of a partial read may be cut: the first one is checked
+    if len(rows) == 0 or rows[0] is None:
+        raise ManifestError(f'No valid image in the first rows of the manifest s3://{manifest_source["Bucket"]}/{manifest_source["Key"]}')
+
+
+def key_digest(key):
+    '''16-byte digest of an S3 key or URI, for sets of millions of keys.'''
+    return hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+
+
+def normalize(rows, supported_file_types, max_bytes, stats):
+    '''
+    Validated and deduplicated keys of manifest rows, in the manifest order. stats (dict) is updated while reading: total,
+    accepted, duplicates, invalid, unsupported, too_large and bucket. Raises ManifestError for images of several buckets.
+    '''
+    for k in ("total", "accepted", "duplicates", "invalid", "unsupported", "too_large"):
+        stats.setdefault(k, 0)
+    seen = set()
+    for row in rows:
+        stats["total"] += 1
+        if row is None:
+            stats["invalid"] += 1
+            continue
+        bucket, key, size = row
+        if stats.get("bucket") is None:
+            stats["bucket"] = bucket
+        elif bucket != stats["bucket"]:
+            raise ManifestError(f'The images must be in one bucket: {stats["bucket"]}, {bucket}')
+        if os.path.splitext(key)[1].lower() not in supported_file_types:
+            stats["unsupported"] += 1
+            continue
+        if size is not None and (size == 0 or size > max_bytes):
+            stats["too_large" if size > 0 else "invalid"] += 1
+            continue
+        digest = key_digest(key)
+        if digest in seen:
+            stats["duplicates"] += 1
+            continue
+        seen.add(digest)
+        stats["accepted"] += 1
+        yield key
@@ -0,0 +1,118 @@
+'''
+Content-addressed cache of Rekognition moderation results, shared by all tasks.
+
+Entries are keyed by the image content hash:
+- "etag" mode (default): S3 ETag plus object size, from one HeadObject call
+- "sha256" mode: SHA-256 of the object bytes, streamed from S3
+
+Each entry keeps the Rekognition model version it was produced with. A sentinel item holds the latest model version
+seen from Rekognition; entries produced by another model version are treated as misses, so a model upgrade invalidates
+the whole cache.
+'''
+import hashlib
+import threading
+import time
+
+from cm_accuracy_eval.result_writer import BatchResultWriter
+
+MODEL_VERSION_KEY = "#model-version"
+MODEL_VERSION_REFRESH_S = 300
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+class ModerationCache:
+    def __init__(self, dynamodb, s3, table_name, min_confidence, hash_mode="etag", ttl_days=180):
+        self.dynamodb = dynamodb
+        self.s3 = s3
+        self.table_name = table_name
+        self.min_confidence = str(min_confidence)
+        self.hash_mode = hash_mode
+        self.ttl_days = ttl_days
+        self.writer = BatchResultWriter(dynamodb, table_name, key_attributes=("content_hash",))
+
+        self.hits = 0
+        self.misses = 0
+
+        self._model_version = None
+        self._model_version_ts = 0
+        self._lock = threading.Lock()
+
+    def content_hash(self, bucket, key):
+        if self.hash_mode == "sha256":
+            body = self.s3.get_object(Bucket=bucket, Key=key)["Body"]
+            digest = hashlib.sha256()
+            for chunk in iter(lambda: body.read(HASH_CHUNK_SIZE), b""):
+                digest.update(chunk)
+            return f'sha256:{digest.hexdigest()}'
+
+        response = self.s3.head_object(Bucket=bucket, Key=key)
+        return f'etag:{response["ETag"].strip(chr(34))}:{response["ContentLength"]}'
+
+    def get(self, content_hash):
+        '''Return the cached entry {"rek_results", "rek_moderation_model_version"} or None.'''
+        response = self.dynamodb.get_item(
+            TableName=self.table_name,
+            Key={"content_hash": {"S": content_hash}}
+        )
+        item = response.get("Item")
+        if item is None \
+            or item["rek_moderation_model_version"]["S"] != self.model_version() \
+            or item["moderation_min_confidence"]["N"] != self.min_confidence:
+            return None
+        return {
+            "rek_results": item.get("rek_results"),
+            "rek_moderation_model_version": item["rek_moderation_model_version"]
+        }
+
+    def put(self, content_hash, db_item):
+        '''Cache the Rekognition result of a moderation result item.'''
+        model_version = db_item["rek_moderation_model_version"]["S"]
+        if model_version != self.model_version():
+            self._set_model_version(model_version)
+
+        item = {
+            "content_hash": {"S": content_hash},
+            "rek_moderation_model_version": db_item["rek_moderation_model_version"],
+            "moderation_min_confidence": {"N": self.min_confidence},
+            "ttl": {"N": str(int(time.time()) + self.ttl_days * 24 * 3600)},
+        }
+        if "rek_results" in db_item:
+            item["rek_results"] = db_item["rek_results"]
+        self.writer.put(item)
+
+    def record(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def flush(self):
+        return self.writer.flush()
+
+    def model_version(self):
+        with self._lock:
+            if self._model_version_ts + MODEL_VERSION_REFRESH_S > time.time():
+                return self._model_version
+        response = self.dynamodb.get_item(
+            TableName=self.table_name,
+            Key={"content_hash": {"S": MODEL_VERSION_KEY}}
+        )
+        item = response.get("Item")
+        with self._lock:
+            self._model_version = None if item is None else item["rek_moderation_model_version"]["S"]
+            self._model_version_ts = time.time()
+            return self._model_version
+
+    def _set_model_version(self, model_version):
+        self.dynamodb.put_item(
+            TableName=self.table_name,
+            Item={
+                "content_hash": {"S": MODEL_VERSION_KEY},
+                "rek_moderation_model_version": {"S": model_version}
+            }
+        )
+        with self._lock:
+            self._model_version = model_version
+            self._model_version_ts = time.time()
+        print("Moderation model version changed, cache entries from other versions are invalidated:", model_version)
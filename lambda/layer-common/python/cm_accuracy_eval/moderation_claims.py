@@ -0,0 +1,82 @@
+'''
+Idempotency guard of the moderation workers: one claim item per task and image, written with a conditional put before
+Rekognition is called, so an image is moderated once even when its batch is run again (Lambda or Step Functions retries, a
+Map item retried after a timeout, a resumed run started while results were being saved).
+
+Claim item: claim_id (partition key: "<task id>#<file path>"), status (CLAIMED, DONE), expires_at, ttl.
+
+claim() returns:
+- CLAIMED: the worker moderates the image
+- DONE: the image was moderated and its results saved, the worker skips it
+- HELD: another worker holds an unexpired claim, the image is failed and retried later
+A claim expires after the lease (longer than the Lambda timeout), so the claim of a worker that died is taken over. The worker
+marks its claims DONE once the results are saved, and releases the claims of the images it failed so that they can be retried
+at once. Claims are expired by TTL after CLAIM_TTL_S.
+'''
+import time
+
+from cm_accuracy_eval.result_writer import BatchResultWriter
+
+CLAIMED = "CLAIMED"
+DONE = "DONE"
+HELD = "HELD"
+CLAIM_TTL_S = 7 * 24 * 3600
+
+
+class ClaimHeld(Exception):
+    '''The image is being moderated by another worker.'''
+
+
+class ModerationClaims:
+    def __init__(self, dynamodb, table_name, task_id, lease_s):
+        self.dynamodb = dynamodb
+        self.table_name = table_name
+        self.task_id = task_id
+        self.lease_s = lease_s
+        self.skipped = 0
+
+    def claim_id(self, file_path):
+        return f"{self.task_id}#{file_path}"
+
+    def claim(self, file_path, now=None):
+        now = int(time.time() if now is None else now)
+        try:
+            self.dynamodb.put_item(
+                TableName=self.table_name,
+                Item=self._item(file_path, CLAIMED, now + self.lease_s, now),
+                ConditionExpression="attribute_not_exists(claim_id) OR (#st = :claimed AND expires_at < :now)",
+                ExpressionAttributeNames={"#st": "status"},
+                ExpressionAttributeValues={":claimed": {"S": CLAIMED}, ":now": {"N": str(now)}}
+            )
+            return CLAIMED
+        except self.dynamodb.exceptions.ConditionalCheckFailedException:
+            pass
+        item = self.dynamodb.get_item(TableName=self.table_name, Key={"claim_id": {"S": self.claim_id(file_path)}}, ConsistentRead=True).get("Item")
+        if item is not None and item["status"]["S"] == DONE:
+            self.skipped += 1
+            return DONE
+        return HELD
+
+    def complete(self, file_paths):
+        '''Mark claims DONE. Returns the file paths whose claim couldn't be saved: they may be moderated again.'''
+        return self._write(file_paths, DONE, 0)
+
+    def release(self, file_paths):
+        '''Expire claims at once, for the images to retry.'''
+        return self._write(file_paths, CLAIMED, 0)
+
+    def _write(self, file_paths, status, expires_at):
+        now = int(time.time())
+        writer = BatchResultWriter(self.dynamodb, self.table_name, key_attributes=("claim_id",))
+        for p in file_paths:
+            writer.put(self._item(p, status, expires_at, now))
+        prefix = len(self.task_id) + 1
+        return [i["claim_id"]["S"][prefix:] for i in writer.flush()]
+
+    def _item(self, file_path, status, expires_at, now):
+        return {
+            "claim_id": {"S": self.claim_id(file_path)},
+            "status": {"S": status},
+            "expires_at": {"N": str(expires_at)},
+            "ttl": {"N": str(now + CLAIM_TTL_S)},
+        }
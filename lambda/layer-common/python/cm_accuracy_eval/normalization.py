@@ -0,0 +1,162 @@
+'''
+Image normalization before moderation: JPEG copies of the images Rekognition can't read from S3, or reads slowly.
+
+Rekognition DetectModerationLabels reads JPEG and PNG images of at most 15 MB from S3. An image is normalized when:
+- its format is another one (NORMALIZED_FILE_TYPES: WEBP, GIF, BMP, TIFF, HEIC/HEIF)
+- it is larger than the size threshold: camera originals are downscaled, smaller payloads are moderated faster
+- Rekognition rejected the original (InvalidImageFormatException, ImageTooLargeException: a misnamed or oversized file)
+
+The copy is decoded, oriented (EXIF), downscaled to MAX_DIMENSION on its longest side and saved as JPEG under the derived
+prefix of the task bucket: derived/<image bucket>/<key>.jpg. Rekognition moderates the copy, the result row keeps the
+file_path of the original (derived_path and the bytes saved are recorded on the row), and original_path() maps the copy back
+to the original for the A2I human review outputs.
+
+Memory: the original is streamed to a spooled temporary file, kept in memory up to SPOOL_BYTES and in /tmp beyond. JPEG
+originals are decoded at a reduced scale (draft mode); other formats are decoded at full size, up to MAX_IMAGE_PIXELS.
+
+Normalizer decides and normalizes for the moderation workers, with the number of concurrent decodes bounded, and counts the
+images normalized and the bytes saved (original size minus copy size).
+
+Pillow is required (imaging layer). HEIC/HEIF needs the pillow-heif plugin, registered when it is installed.
+'''
+import io
+import os
+import shutil
+import tempfile
+import threading
+
+DERIVED_PREFIX = "derived/"
+# Formats Rekognition reads from S3
+NATIVE_FILE_TYPES = (".jpg", ".jpeg", ".png")
+NORMALIZED_FILE_TYPES = (".webp", ".gif", ".bmp", ".tif", ".tiff", ".heic", ".heif")
+# Sniffed formats (upload_index.sniff_format) accepted for normalization
+NORMALIZED_FORMATS = ("webp", "gif", "bmp", "tiff", "heic", "heif")
+# Originals larger than this are downscaled; at most MAX_SOURCE_BYTES are accepted
+SIZE_THRESHOLD_BYTES = 5 * 1024 * 1024
+MAX_SOURCE_BYTES = 50 * 1024 * 1024
+MAX_DIMENSION = 2048
+JPEG_QUALITY = 90
+# Decompression bomb guard: larger images are not normalized
+MAX_IMAGE_PIXELS = 100_000_000
+SPOOL_BYTES = 16 * 1024 * 1024
+COPY_CHUNK_BYTES = 1024 * 1024
+# Rekognition errors on the original that a normalized copy fixes
+REKOGNITION_ERROR_CODES = ("InvalidImageFormatException", "ImageTooLargeException")
+
+
+class NormalizationError(Exception):
+    '''The image can't be decoded or is too large to normalize.'''
+
+
+def needs_normalization(key, size=None, size_threshold=SIZE_THRESHOLD_BYTES):
+    '''True for the formats Rekognition doesn't read, and for originals larger than the threshold (size, when known).'''
+    ext = os.path.splitext(key)[1].lower()
+    if ext in NORMALIZED_FILE_TYPES:
+        return True
+    return size is not None and size > size_threshold
+
+
+def derived_key(image_bucket, key, prefix=DERIVED_PREFIX):
+    return f"{prefix}{image_bucket}/{key}.jpg"
+
+
+def original_path(file_path, derived_bucket, prefix=DERIVED_PREFIX):
+    '''
+    s3://<image bucket>/<key> for the S3 URI of a derived copy (s3://<task bucket>/derived/<image bucket>/<key>.jpg). Other
+    URIs are returned unchanged.
+    '''
+    bucket, key = file_path[len("s3://"):].split("/", 1)
+    if bucket != derived_bucket or not key.startswith(prefix) or not key.endswith(".jpg") or "/" not in key[len(prefix):]:
+        return file_path
+    return "s3://" + key[len(prefix):-len(".jpg")]
+
+
+def register_heif():
+    try:
+        import pillow_heif
+        pillow_heif.register_heif_opener()
+        return True
+    except ImportError:
+        return False
+
+
+def normalize(fp, max_dimension=MAX_DIMENSION, quality=JPEG_QUALITY):
+    '''Returns (JPEG bytes, (width, height) of the original). Raises NormalizationError.'''
+    from PIL import Image, ImageOps
+
+    try:
+        with Image.open(fp) as img:
+            size = img.size
+            if img.width * img.height > MAX_IMAGE_PIXELS:
+                raise NormalizationError(f"Image too large: {img.width}x{img.height}")
+            # Animated images: the first frame
+            img.seek(0)
+            img.draft("RGB", (max_dimension, max_dimension))
+            img = ImageOps.exif_transpose(img)
+            if img.mode != "RGB":
+                # Transparent areas on white
+                rgba = img.convert("RGBA")
+                img = Image.new("RGB", rgba.size, (255, 255, 255))
+                img.paste(rgba, mask=rgba.getchannel("A"))
+            img.thumbnail((max_dimension, max_dimension), Image.LANCZOS, reducing_gap=3.0)
+            out = io.BytesIO()
+            img.save(out, format="JPEG", quality=quality, optimize=True)
+    except NormalizationError:
+        raise
+    except Exception as ex:
+        raise NormalizationError(f"{type(ex).__name__}: {ex}")
+    return out.getvalue(), size
+
+
+def normalize_object(s3, image_bucket, key, derived_bucket, prefix=DERIVED_PREFIX, max_dimension=MAX_DIMENSION, max_source_bytes=MAX_SOURCE_BYTES):
+    '''
+    Normalize an S3 image to its derived copy. Returns {"Bucket", "Key", "SourceBytes", "DerivedBytes"}.
+    Raises NormalizationError.
+    '''
+    response = s3.get_object(Bucket=image_bucket, Key=key)
+    source_bytes = response["ContentLength"]
+    if source_bytes > max_source_bytes:
+        response["Body"].close()
+        raise NormalizationError(f"Image too large to normalize: {source_bytes} bytes")
+    with tempfile.SpooledTemporaryFile(max_size=SPOOL_BYTES) as f:
+        shutil.copyfileobj(response["Body"], f, COPY_CHUNK_BYTES)
+        f.seek(0)
+        body, _ = normalize(f, max_dimension)
+    output_key = derived_key(image_bucket, key, prefix)
+    s3.put_object(Bucket=derived_bucket, Key=output_key, Body=body, ContentType="image/jpeg")
+    return {"Bucket": derived_bucket, "Key": output_key, "SourceBytes": source_bytes, "DerivedBytes": len(body)}
+
+
+class Normalizer:
+    def __init__(self, s3, derived_bucket, prefix=DERIVED_PREFIX, size_threshold=SIZE_THRESHOLD_BYTES, max_dimension=MAX_DIMENSION,
+            max_source_bytes=MAX_SOURCE_BYTES, concurrency=2):
+        self.s3 = s3
+        self.derived_bucket = derived_bucket
+        self.prefix = prefix
+        self.size_threshold = size_threshold
+        self.max_dimension = max_dimension
+        self.max_source_bytes = max_source_bytes
+
+        self.normalized = 0
+        self.bytes_saved = 0
+
+        self._decodes = threading.Semaphore(concurrency)
+        self._lock = threading.Lock()
+        register_heif()
+
+    def prepare(self, image_bucket, key):
+        '''The derived copy to moderate instead of the original, None to moderate the original.'''
+        size = None
+        if os.path.splitext(key)[1].lower() in NATIVE_FILE_TYPES:
+            size = self.s3.head_object(Bucket=image_bucket, Key=key)["ContentLength"]
+        if not needs_normalization(key, size, self.size_threshold):
+            return None
+        return self.normalize(image_bucket, key)
+
+    def normalize(self, image_bucket, key):
+        with self._decodes:
+            copy = normalize_object(self.s3, image_bucket, key, self.derived_bucket, self.prefix, self.max_dimension, self.max_source_bytes)
+        with self._lock:
+            self.normalized += 1
+            self.bytes_saved += max(0, copy["SourceBytes"] - copy["DerivedBytes"])
+        return copy
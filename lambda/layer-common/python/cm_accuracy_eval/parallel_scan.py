@@ -0,0 +1,135 @@
+'''
+Parallel segmented Scan for whole-table reads.
+
+The table is read as TotalSegments segments on a thread pool, one worker per segment. Pages are handed to the caller in the
+calling thread, so the caller doesn't need to be thread safe. The position of a segment (its LastEvaluatedKey) is checkpointed
+when its page is handed to the caller: when the deadline passes the scan stops, and checkpoint() returns the JSON serializable
+state to resume from, in a later invocation if needed. Pages read but not yet handed out are read again on resume, a page
+handed out is not: the caller processes every page it gets before it stops or checkpoints. With items(), checkpoint() raises
+when the caller stopped in the middle of a page, as its remaining items would be skipped.
+
+The segment count follows the table size reported by DescribeTable: one segment per SEGMENT_SIZE_BYTES, between 1 and
+MAX_SEGMENTS. DynamoDB updates the size about every six hours, so a new table reports 0 and gets MAX_SEGMENTS.
+
+    scan = ParallelScan(dynamodb, table_name, checkpoint=saved, Select="COUNT")
+    for page in scan.pages(deadline=time.time() + 20):
+        total += page["Count"]
+    saved = scan.checkpoint()  # None when the whole table was read
+'''
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+SEGMENT_SIZE_BYTES = 64 * 1024 * 1024
+MAX_SEGMENTS = 16
+# Pages buffered per segment before its worker waits for the caller
+PAGES_PER_SEGMENT = 2
+# How often the caller thread re-checks the deadline while waiting for a page
+POLL_INTERVAL_S = 0.5
+
+
+def segment_count(dynamodb, table_name, index_name=None):
+    '''Number of segments for the size of a table or of one of its global secondary indexes.'''
+    try:
+        table = dynamodb.describe_table(TableName=table_name)["Table"]
+        size = table.get("TableSizeBytes", 0)
+        if index_name is not None:
+            size = next((i.get("IndexSizeBytes", 0) for i in table.get("GlobalSecondaryIndexes", []) if i["IndexName"] == index_name), 0)
+    except Exception as ex:
+        print(f"Failed to describe table {table_name}: ", ex)
+        size = 0
+    if size == 0:
+        return MAX_SEGMENTS
+    return max(1, min(MAX_SEGMENTS, -(-size // SEGMENT_SIZE_BYTES)))
+
+
+class ParallelScan:
+    def __init__(self, dynamodb, table_name, total_segments=None, checkpoint=None, **kwargs):
+        '''kwargs are passed to every Scan request: IndexName, ProjectionExpression, FilterExpression, Select...'''
+        self.dynamodb = dynamodb
+        self.kwargs = dict(kwargs, TableName=table_name)
+        if checkpoint is not None:
+            self.segments = [dict(s) for s in checkpoint["segments"]]
+        else:
+            if total_segments is None:
+                total_segments = segment_count(dynamodb, table_name, kwargs.get("IndexName"))
+            self.segments = [{} for _ in range(total_segments)]
+        # Items of the page items() is handing out that the caller didn't get yet
+        self.items_left = 0
+
+    def done(self):
+        return all([s.get("done") for s in self.segments])
+
+    def checkpoint(self):
+        '''{"segments": [{"ExclusiveStartKey": ...} | {"done": True} | {}]}, or None when every segment was read.'''
+        if self.items_left > 0:
+            raise RuntimeError(f"Scan of {self.kwargs['TableName']} stopped with {self.items_left} items of a page left")
+        if self.done():
+            return None
+        return {"segments": [dict(s) for s in self.segments]}
+
+    def pages(self, deadline=None):
+        '''Yield the Scan responses of the remaining segments, until they are read or the deadline (epoch seconds) passes.'''
+        remaining = [i for i, s in enumerate(self.segments) if not s.get("done")]
+        if len(remaining) == 0:
+            return
+        results = queue.Queue(maxsize=PAGES_PER_SEGMENT * len(remaining))
+        stop = threading.Event()
+        executor = ThreadPoolExecutor(max_workers=len(remaining))
+        try:
+            for segment in remaining:
+                executor.submit(self._read_segment, segment, results, stop)
+            running = len(remaining)
+            while running > 0:
+                if deadline is not None and time.time() >= deadline:
+                    print(f"Scan of {self.kwargs['TableName']} stopped at the deadline, segments left: {running}")
+                    return
+                try:
+                    segment, response, error = results.get(timeout=POLL_INTERVAL_S)
+                except queue.Empty:
+                    continue
+                if error is not None:
+                    raise error
+                # Checkpointed before the page is handed out: a caller stopping right after it doesn't read it again
+                last_key = response.get("LastEvaluatedKey")
+                if last_key is None:
+                    self.segments[segment] = {"done": True}
+                    running -= 1
+                else:
+                    self.segments[segment] = {"ExclusiveStartKey": last_key}
+                yield response
+        finally:
+            stop.set()
+            executor.shutdown(wait=False)
+
+    def items(self, deadline=None):
+        for page in self.pages(deadline):
+            items = page.get("Items", [])
+            for n, item in enumerate(items):
+                self.items_left = len(items) - n - 1
+                yield item
+
+    def _read_segment(self, segment, results, stop):
+        kwargs = dict(self.kwargs, Segment=segment, TotalSegments=len(self.segments))
+        if "ExclusiveStartKey" in self.segments[segment]:
+            kwargs["ExclusiveStartKey"] = self.segments[segment]["ExclusiveStartKey"]
+        try:
+            while not stop.is_set():
+                response = self.dynamodb.scan(**kwargs)
+                if not _put(results, (segment, response, None), stop) or response.get("LastEvaluatedKey") is None:
+                    return
+                kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+        except Exception as ex:
+            _put(results, (segment, None, ex), stop)
+
+
+def _put(results, value, stop):
+    # Wait for room in the queue, unless the caller stopped reading
+    while not stop.is_set():
+        try:
+            results.put(value, timeout=POLL_INTERVAL_S)
+            return True
+        except queue.Full:
+            continue
+    return False
@@ -0,0 +1,76 @@
+'''
+Parquet export of the moderation and review results: one row per label, built with data_access.flatten_labels like the CSV
+export, so both formats hold the same rows.
+
+Columns (SCHEMA): file_path, top_category, sub_category, confidence (float32), review_result, model_version. The repeated
+string columns are dictionary encoded, and read back as categoricals by pandas. Rows are written in row groups of
+ROW_GROUP_SIZE, so memory is bounded by one row group whatever the task size.
+
+The export of a whole task is written to the task's partition, report/parquet/task_id=<task id>/ (Hive style), for Athena or
+pyarrow.dataset. pyarrow is required (report layer).
+
+    with S3MultipartWriter(s3, bucket, partition_key(S3_REPORT_PREFIX, task_id)) as f:
+        rows = write_labels(f, data_access.labeled_items(dynamodb, result_table, index_name, projection=PROJECTION))
+'''
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from cm_accuracy_eval import data_access
+
+PROJECTION = "file_path, rek_results, rek_moderation_model_version"
+ROW_GROUP_SIZE = 100_000
+COMPRESSION = "snappy"
+
+_category = pa.dictionary(pa.int32(), pa.string())
+SCHEMA = pa.schema([
+    ("file_path", pa.string()),
+    ("top_category", _category),
+    ("sub_category", _category),
+    ("confidence", pa.float32()),
+    ("review_result", _category),
+    ("model_version", _category),
+])
+
+
+def partition_key(report_prefix, task_id, file_name="labels.parquet"):
+    '''report/parquet/task_id=<task id>/labels.parquet: the export of a whole task replaces the previous one.'''
+    return f"{report_prefix}parquet/task_id={task_id}/{file_name}"
+
+
+def write_labels(f, db_items, top_category=None, sub_category=None, type=None, confidence_threshold=None, counts=None):
+    '''
+    Write the labels of moderation results (DynamoDB JSON) matching the filters to a file object. Returns the row count.
+    counts: dict whose "rows" is kept up to date while writing, for progress reports.
+    '''
+    rows = 0
+    columns = {name: [] for name in SCHEMA.names}
+    with pq.ParquetWriter(f, SCHEMA, compression=COMPRESSION) as writer:
+        for db_item in db_items:
+            model_version = db_item.get("rek_moderation_model_version", {}).get("S")
+            for label in data_access.flatten_labels(db_item, top_category, sub_category, type, confidence_threshold):
+                columns["file_path"].append(label["file_path"])
+                columns["top_category"].append(label["top_category"])
+                columns["sub_category"].append(label["sub_category"])
+                columns["confidence"].append(label["confidence"])
+                columns["review_result"].append(label["type"])
+                columns["model_version"].append(model_version)
+                rows += 1
+            if counts is not None:
+                counts["rows"] = rows
+            if len(columns["file_path"]) >= ROW_GROUP_SIZE:
+                _write_row_group(writer, columns)
+        if len(columns["file_path"]) > 0 or rows == 0:
+            _write_row_group(writer, columns)
+    return rows
+
+
+def _write_row_group(writer, columns):
+    arrays = []
+    for field in SCHEMA:
+        values = columns[field.name]
+        if pa.types.is_dictionary(field.type):
+            arrays.append(pa.array(values, type=pa.string()).dictionary_encode())
+        else:
+            arrays.append(pa.array(values, type=field.type))
+        values.clear()
+    writer.write_table(pa.Table.from_arrays(arrays, schema=SCHEMA))
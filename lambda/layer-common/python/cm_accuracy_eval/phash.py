@@ -0,0 +1,102 @@
+'''
+Perceptual hashing and near-duplicate clustering.
+
+- phash(): 64-bit DCT perceptual hash. The image is reduced to 32x32 grayscale, the top-left 8x8 DCT coefficients are
+  compared to their median. Resized and re-encoded copies of an image hash to the same or nearby values.
+- BKTree: metric tree over Hamming distance to find hashes within a distance without comparing against every hash.
+- cluster(): greedy clustering. Each image joins the closest representative within `max_distance`, or becomes a new
+  representative.
+
+Pillow is required for phash() (imaging layer).
+'''
+import math
+
+HASH_SIZE = 8
+IMAGE_SIZE = 32
+
+# DCT-II basis for the first HASH_SIZE coefficients, computed once
+_DCT = [[math.cos(math.pi * (2 * x + 1) * u / (2 * IMAGE_SIZE)) for x in range(IMAGE_SIZE)] for u in range(HASH_SIZE)]
+
+
+def phash(fp):
+    from PIL import Image
+
+    with Image.open(fp) as img:
+        # JPEG decoders can scale down while decoding: far less memory and CPU for large originals
+        img.draft("L", (IMAGE_SIZE * 2, IMAGE_SIZE * 2))
+        img = img.convert("L").resize((IMAGE_SIZE, IMAGE_SIZE), Image.LANCZOS)
+        pixels = list(img.getdata())
+
+    rows = [pixels[i * IMAGE_SIZE:(i + 1) * IMAGE_SIZE] for i in range(IMAGE_SIZE)]
+    # Separable 2D DCT, only the low frequencies are needed
+    row_dct = [[sum(b * p for b, p in zip(basis, row)) for basis in _DCT] for row in rows]
+    coefficients = []
+    for u in range(HASH_SIZE):
+        for v in range(HASH_SIZE):
+            coefficients.append(sum(_DCT[u][x] * row_dct[x][v] for x in range(IMAGE_SIZE)))
+
+    # Skip the DC term when computing the median: it only carries the average brightness
+    median = sorted(coefficients[1:])[len(coefficients[1:]) // 2]
+    value = 0
+    for c in coefficients:
+        value = (value << 1) | (1 if c > median else 0)
+    return value
+
+
+def hamming_distance(a, b):
+    return bin(a ^ b).count("1")
+
+
+class BKTree:
+    def __init__(self):
+        self._root = None
+        self.size = 0
+
+    def add(self, hash_value, item):
+        node = [hash_value, item, {}]
+        self.size += 1
+        if self._root is None:
+            self._root = node
+            return
+        current = self._root
+        while True:
+            distance = hamming_distance(hash_value, current[0])
+            child = current[2].get(distance)
+            if child is None:
+                current[2][distance] = node
+                return
+            current = child
+
+    def search(self, hash_value, max_distance):
+        '''Return [(distance, hash, item)] within max_distance, closest first.'''
+        result = []
+        if self._root is None:
+            return result
+        candidates = [self._root]
+        while candidates:
+            node = candidates.pop()
+            distance = hamming_distance(hash_value, node[0])
+            if distance <= max_distance:
+                result.append((distance, node[0], node[1]))
+            # Triangle inequality: only children in [d - max, d + max] can match
+            for child_distance, child in node[2].items():
+                if distance - max_distance <= child_distance <= distance + max_distance:
+                    candidates.append(child)
+        return sorted(result, key=lambda r: r[0])
+
+
+def cluster(hashes, max_distance):
+    '''
+    hashes: [(item, hash)] in a stable order.
+    Returns {representative item: [member items]}; the representative is not in its member list.
+    '''
+    tree = BKTree()
+    clusters = {}
+    for item, hash_value in hashes:
+        matches = tree.search(hash_value, max_distance)
+        if len(matches) > 0:
+            clusters[matches[0][2]].append(item)
+        else:
+            tree.add(hash_value, item)
+            clusters[item] = []
+    return clusters
@@ -0,0 +1,162 @@
+'''
+Bulk SigV4 presigner for S3 GetObject URLs.
+
+generate_presigned_url builds a request and derives the SigV4 signing key (four HMACs) for every URL. Here the signing key is
+derived once per credentials, date and region and cached, and the URLs of a call share one timestamp, so the query string is
+built once: each URL only hashes its canonical request and signs it with one HMAC.
+
+The URLs are the same as the ones of an S3 client with signature_version "s3v4" and endpoint_url https://s3.<region>.amazonaws.com
+(path style), for the same credentials and time.
+
+    presigner = S3Presigner(boto3.Session().get_credentials(), region)
+    urls = presigner.presign_get_objects(["s3://bucket/key.jpg", ...], expires_in=300)
+
+PresignedUrlCache keeps the URLs across warm invocations, in an LRU of max_size entries. A cached URL is served only while it
+has at least min_lifetime_s left before it expires; older entries are evicted. Hits, misses and evictions are counted until
+pop_stats().
+
+    url_cache = PresignedUrlCache(presigner, max_size=20000, min_lifetime_s=120)
+    urls = url_cache.get_urls(["s3://bucket/key.jpg", ...], expires_in=300)
+    print("URL cache: ", url_cache.pop_stats())
+'''
+import hashlib
+import hmac
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+from urllib.parse import quote
+
+ALGORITHM = "AWS4-HMAC-SHA256"
+SERVICE = "s3"
+
+
+class S3Presigner:
+    def __init__(self, credentials, region, endpoint_url=None):
+        '''credentials: botocore Credentials (refreshed before expiry by get_frozen_credentials)'''
+        self.credentials = credentials
+        self.region = region
+        self.endpoint_url = (endpoint_url or f"https://s3.{region}.amazonaws.com").rstrip("/")
+        self.host = self.endpoint_url.split("://", 1)[1]
+        self._lock = threading.Lock()
+        self._key_scope = None
+        self._signing_key = None
+
+    def presign_get_objects(self, s3_uris, expires_in, now=None):
+        '''Presigned GetObject URLs of "s3://bucket/key" URIs, in the same order.'''
+        now = datetime.now(timezone.utc) if now is None else now
+        amz_date = now.strftime("%Y%m%dT%H%M%SZ")
+        date = amz_date[:8]
+        credentials = self.credentials.get_frozen_credentials()
+        scope = f"{date}/{self.region}/{SERVICE}/aws4_request"
+        signing_key = self._get_signing_key(credentials.secret_key, date)
+
+        params = [
+            ("X-Amz-Algorithm", ALGORITHM),
+            ("X-Amz-Credential", f"{credentials.access_key}/{scope}"),
+            ("X-Amz-Date", amz_date),
+            ("X-Amz-Expires", str(int(expires_in))),
+            ("X-Amz-SignedHeaders", "host"),
+        ]
+        if credentials.token:
+            params.append(("X-Amz-Security-Token", credentials.token))
+        query = "&".join([f"{k}={_encode(v)}" for k, v in params])
+        canonical_query = "&".join([f"{k}={_encode(v)}" for k, v in sorted(params)])
+        canonical_suffix = f"\n{canonical_query}\nhost:{self.host}\n\nhost\nUNSIGNED-PAYLOAD"
+        string_to_sign_prefix = f"{ALGORITHM}\n{amz_date}\n{scope}\n"
+
+        urls = []
+        for uri in s3_uris:
+            bucket, key = uri[len("s3://"):].split("/", 1)
+            path = f"/{quote(bucket, safe='~')}/{quote(key, safe='/~')}"
+            canonical_request = "GET\n" + path + canonical_suffix
+            string_to_sign = string_to_sign_prefix + hashlib.sha256(canonical_request.encode("utf-8")).hexdigest()
+            signature = hmac.new(signing_key, string_to_sign.encode("utf-8"), hashlib.sha256).hexdigest()
+            urls.append(f"{self.endpoint_url}{path}?{query}&X-Amz-Signature={signature}")
+        return urls
+
+    def presign_get_object(self, s3_uri, expires_in):
+        return self.presign_get_objects([s3_uri], expires_in)[0]
+
+    def _get_signing_key(self, secret_key, date):
+        with self._lock:
+            if self._key_scope != (secret_key, date):
+                key = _sign(("AWS4" + secret_key).encode("utf-8"), date)
+                key = _sign(key, self.region)
+                key = _sign(key, SERVICE)
+                self._signing_key = _sign(key, "aws4_request")
+                self._key_scope = (secret_key, date)
+            return self._signing_key
+
+
+class PresignedUrlCache:
+    def __init__(self, presigner, max_size, min_lifetime_s):
+        self.presigner = presigner
+        self.max_size = max_size
+        self.min_lifetime_s = min_lifetime_s
+        self._lock = threading.Lock()
+        # (s3 uri, expires_in) -> (url, expires at epoch seconds), least recently used first
+        self._urls = OrderedDict()
+        self._access_key = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get_urls(self, s3_uris, expires_in, now=None):
+        '''Presigned GetObject URLs of "s3://bucket/key" URIs, in the same order: cached or presigned in one call.'''
+        now = time.time() if now is None else now
+        # URLs signed with other credentials stop working when their session expires
+        access_key = self.presigner.credentials.get_frozen_credentials().access_key
+        expires_in = int(expires_in)
+        urls, missing = [None] * len(s3_uris), {}
+        with self._lock:
+            if access_key != self._access_key:
+                self._urls.clear()
+                self._access_key = access_key
+            for n, uri in enumerate(s3_uris):
+                entry = self._urls.get((uri, expires_in))
+                if entry is not None and entry[1] - now >= self.min_lifetime_s:
+                    self._urls.move_to_end((uri, expires_in))
+                    urls[n] = entry[0]
+                    self.hits += 1
+                else:
+                    missing.setdefault(uri, []).append(n)
+                    self.misses += 1
+
+        if len(missing) > 0:
+            # X-Amz-Date has second resolution: the URL expires expires_in seconds after the truncated signing time
+            signed_at = int(now)
+            presigned = self.presigner.presign_get_objects(list(missing.keys()), expires_in, now=datetime.fromtimestamp(signed_at, timezone.utc))
+            with self._lock:
+                for (uri, positions), url in zip(missing.items(), presigned):
+                    for n in positions:
+                        urls[n] = url
+                    self._urls[(uri, expires_in)] = (url, signed_at + expires_in)
+                    self._urls.move_to_end((uri, expires_in))
+                self._evict(now)
+        return urls
+
+    def pop_stats(self):
+        '''Counters since the last call: hits, misses, evictions (size), expirations (age), size.'''
+        with self._lock:
+            stats = {"hits": self.hits, "misses": self.misses, "evictions": self.evictions, "expirations": self.expirations, "size": len(self._urls)}
+            self.hits, self.misses, self.evictions, self.expirations = 0, 0, 0, 0
+        return stats
+
+    def _evict(self, now):
+        # Age: entries too close to their expiry can't be served again. Size: least recently used first.
+        for k in [k for k, (url, expires_at) in self._urls.items() if expires_at - now < self.min_lifetime_s]:
+            del self._urls[k]
+            self.expirations += 1
+        while len(self._urls) > self.max_size:
+            self._urls.popitem(last=False)
+            self.evictions += 1
+
+
+def _sign(key, msg):
+    return hmac.new(key, msg.encode("utf-8"), hashlib.sha256).digest()
+
+
+def _encode(value):
+    return quote(value, safe="-_.~")
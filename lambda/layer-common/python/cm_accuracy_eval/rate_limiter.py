@@ -0,0 +1,213 @@
+'''
+Distributed token bucket with AIMD rate control, shared by all concurrent moderation workers.
+
+The bucket state (tokens, rate, timestamps, version) lives in one item of a backend:
+- DynamoDBBucketBackend: an item in a DynamoDB table, saved with a conditional write on the version (optimistic locking)
+- InMemoryBucketBackend: process local, for running the control loop offline
+
+Rate control:
+- Additive increase: while no throttling is seen, the rate grows by `increase_per_s` every second up to `max_rate`.
+- Multiplicative decrease: on throttling the rate is multiplied by `decrease_factor` (not below `min_rate`) and the
+  tokens are dropped. Decreases are applied at most once per `decrease_cooldown_s` so concurrent workers seeing the
+  same throttling burst don't collapse the rate.
+
+To keep the backend round trips low, a worker leases up to `lease_size` tokens per backend update and consumes them locally.
+Updates that lose the version race to another worker are retried after a full jitter exponential backoff, bounded by
+CONFLICT_MAX_BACKOFF_S; a decrease gives up after CONFLICT_MAX_RETRIES conflicts (another worker decreased the rate).
+
+    limiter = TokenBucket(DynamoDBBucketBackend(dynamodb, table_name, "rekognition-detect-moderation-labels"), initial_rate=20, max_rate=50)
+    limiter.acquire()
+    try:
+        call()
+        limiter.on_success()
+    except ThrottlingException:
+        limiter.on_throttle()
+'''
+import copy
+import random
+import threading
+import time
+
+MIN_WAIT_S = 0.001
+CONFLICT_BASE_BACKOFF_S = 0.01
+CONFLICT_MAX_BACKOFF_S = 0.5
+CONFLICT_MAX_RETRIES = 8
+
+
+def conflict_backoff(conflicts):
+    '''Full jitter exponential backoff after a number of consecutive version conflicts.'''
+    return random.uniform(0, min(CONFLICT_MAX_BACKOFF_S, CONFLICT_BASE_BACKOFF_S * (2 ** conflicts)))
+
+
+class InMemoryBucketBackend:
+    def __init__(self):
+        self._state = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        with self._lock:
+            return copy.deepcopy(self._state)
+
+    def save(self, state, expected_version):
+        with self._lock:
+            current_version = None if self._state is None else self._state["version"]
+            if current_version != expected_version:
+                return False
+            self._state = copy.deepcopy(state)
+            return True
+
+
+class DynamoDBBucketBackend:
+    FIELDS = ["tokens", "rate", "updated_ts", "last_decrease_ts", "version"]
+
+    def __init__(self, dynamodb, table_name, bucket_id):
+        self.dynamodb = dynamodb
+        self.table_name = table_name
+        self.bucket_id = bucket_id
+
+    def load(self):
+        response = self.dynamodb.get_item(
+            TableName=self.table_name,
+            Key={"id": {"S": self.bucket_id}},
+            ConsistentRead=True
+        )
+        item = response.get("Item")
+        if item is None:
+            return None
+        state = {f: float(item[f]["N"]) for f in self.FIELDS}
+        state["version"] = int(state["version"])
+        return state
+
+    def save(self, state, expected_version):
+        item = {f: {"N": str(state[f])} for f in self.FIELDS}
+        item["id"] = {"S": self.bucket_id}
+        try:
+            if expected_version is None:
+                self.dynamodb.put_item(
+                    TableName=self.table_name,
+                    Item=item,
+                    ConditionExpression="attribute_not_exists(id)"
+                )
+            else:
+                self.dynamodb.put_item(
+                    TableName=self.table_name,
+                    Item=item,
+                    ConditionExpression="version = :v",
+                    ExpressionAttributeValues={":v": {"N": str(expected_version)}}
+                )
+            return True
+        except Exception as ex:
+            if getattr(ex, "response", {}).get("Error", {}).get("Code") == "ConditionalCheckFailedException":
+                return False
+            raise
+
+
+class TokenBucket:
+    def __init__(self, backend, initial_rate, max_rate, min_rate=1.0, increase_per_s=1.0, decrease_factor=0.7,
+                 decrease_cooldown_s=2.0, burst_s=1.0, lease_size=5, clock=time.time, sleep=time.sleep):
+        self.backend = backend
+        self.initial_rate = float(initial_rate)
+        self.max_rate = float(max_rate)
+        self.min_rate = float(min_rate)
+        self.increase_per_s = float(increase_per_s)
+        self.decrease_factor = float(decrease_factor)
+        self.decrease_cooldown_s = float(decrease_cooldown_s)
+        self.burst_s = float(burst_s)
+        self.lease_size = lease_size
+        self.clock = clock
+        self.sleep = sleep
+
+        self.throttled = 0
+        self.waited_s = 0.0
+        self.conflicts = 0
+
+        self._leased = 0
+        self._lease_conflicts = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        '''Block until a token is available.'''
+        while True:
+            with self._lock:
+                if self._leased > 0:
+                    self._leased -= 1
+                    return
+            wait_s = self._lease()
+            if wait_s > 0:
+                with self._lock:
+                    self.waited_s += wait_s
+                self.sleep(wait_s)
+
+    def on_success(self):
+        '''Nothing to do per call: the additive increase is applied by elapsed time on every bucket update.'''
+
+    def on_throttle(self):
+        '''Multiplicative decrease, shared with all workers.'''
+        with self._lock:
+            self.throttled += 1
+            # Leased tokens were granted at a rate the service just rejected
+            self._leased = 0
+        for conflicts in range(CONFLICT_MAX_RETRIES + 1):
+            if conflicts > 0:
+                self.sleep(conflict_backoff(conflicts))
+            state = self.backend.load()
+            version = None if state is None else state["version"]
+            now = self.clock()
+            state = self._refill(state, now)
+            if now - state["last_decrease_ts"] < self.decrease_cooldown_s:
+                return
+            state["rate"] = max(self.min_rate, state["rate"] * self.decrease_factor)
+            state["tokens"] = 0.0
+            state["last_decrease_ts"] = now
+            state["version"] = (version or 0) + 1
+            if self.backend.save(state, version):
+                print(f"Throttled: rate decreased to {round(state['rate'], 2)}/s")
+                return
+            with self._lock:
+                self.conflicts += 1
+        print("Throttled: rate not decreased, the bucket is updated by other workers")
+
+    def rate(self):
+        state = self.backend.load()
+        return self.initial_rate if state is None else state["rate"]
+
+    def _lease(self):
+        '''Take up to lease_size tokens from the shared bucket. Returns seconds to wait if no token is available.'''
+        state = self.backend.load()
+        version = None if state is None else state["version"]
+        state = self._refill(state, self.clock())
+        if state["tokens"] < 1 - 1e-9:
+            return max(MIN_WAIT_S, (1 - state["tokens"]) / state["rate"])
+
+        granted = max(1, int(min(self.lease_size, state["tokens"] + 1e-9)))
+        state["tokens"] -= granted
+        state["version"] = (version or 0) + 1
+        if not self.backend.save(state, version):
+            # Another worker updated the bucket first: retry after a backoff growing with the consecutive conflicts
+            with self._lock:
+                self.conflicts += 1
+                self._lease_conflicts += 1
+                conflicts = self._lease_conflicts
+            return max(MIN_WAIT_S, conflict_backoff(min(conflicts, CONFLICT_MAX_RETRIES)))
+        with self._lock:
+            self._leased += granted
+            self._lease_conflicts = 0
+        return 0
+
+    def _refill(self, state, now):
+        if state is None:
+            return {
+                "tokens": self.initial_rate * self.burst_s,
+                "rate": self.initial_rate,
+                "updated_ts": now,
+                "last_decrease_ts": 0.0,
+                "version": 0,
+            }
+        elapsed = max(0.0, now - state["updated_ts"])
+        # Additive increase while there is no recent throttling: from the end of the last decrease cooldown
+        increase_from = max(state["updated_ts"], state["last_decrease_ts"] + self.decrease_cooldown_s)
+        if now > increase_from:
+            state["rate"] = min(self.max_rate, state["rate"] + self.increase_per_s * (now - increase_from))
+        state["tokens"] = min(state["rate"] * self.burst_s, state["tokens"] + elapsed * state["rate"])
+        state["updated_ts"] = now
+        return state
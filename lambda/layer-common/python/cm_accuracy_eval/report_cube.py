@@ -0,0 +1,207 @@
+'''
+Report cube: the aggregates of the report (get-report without filters) kept as one item per task, maintained from the
+moderation result table streams.
+
+Every result row contributes a set of metric keys, each counted once per image:
+- "processed" for every row; "labeled", "reviewed", "tp", "fp" for flagged images
+- "<breakdown>#<title>", e.g. "by_top_category#Suggestive" or "by_confidence#85"
+- "<breakdown>_type#<review result>#<title>", e.g. "by_sub_category_type#false-positive#Revealing Clothes"
+A stream record changes the counts by the difference between the key sets of the old and the new image, so inserted rows and
+changed review results are applied as deltas with UpdateItem ADD.
+
+The records of a batch are applied in slices of consecutive records (slices()). A slice is applied at most once: its ADD runs
+in one transaction with the put of a marker item keyed by the slice id (a hash of its stream event ids), which expires after
+MARKER_TTL_S. A retried batch is sliced the same way, so the slices already applied are skipped instead of counted twice.
+
+    deltas = diff(metric_keys(old_image), metric_keys(new_image))
+    for start, slice_id, slice_deltas in slices([(task_id, event_id, deltas), ...]):
+        apply(dynamodb, cube_table, task_id, slice_id, slice_deltas)
+    report = document(dynamodb.get_item(...)["Item"])
+
+rebuild() recounts the cube of a task from its moderation result table, for a cube that drifted (records lost to the
+on-failure destination of the stream mapping, or applied twice when an invocation failed after a slice was saved). Run it
+while the task isn't moderated or reviewed: stream updates applied during the scan are overwritten. A rebuild that doesn't
+finish before the deadline saves its position on the cube item and continues in the next call.
+'''
+import hashlib
+import json
+import math
+import time
+
+from cm_accuracy_eval import data_access
+from cm_accuracy_eval.parallel_scan import ParallelScan
+
+TP_STR = "true-positive"
+FP_STR = "false-positive"
+BREAKDOWNS = ["by_top_category", "by_sub_category", "by_type", "by_confidence"]
+TYPE_BREAKDOWNS = ["by_top_category_type", "by_sub_category_type", "by_confidence_type"]
+METRICS = ["processed", "labeled", "reviewed", "tp", "fp"]
+# Keys per UpdateItem: keeps the update expression under the 4 KB limit
+MAX_KEYS_PER_UPDATE = 100
+# Slice markers outlive the 24 hour retention of the streams, so a batch can't be redelivered after its marker expired
+MARKER_TTL_S = 2 * 24 * 3600
+
+
+def metric_keys(db_item):
+    '''Metric keys a result item counts in.'''
+    keys = set()
+    if db_item is None:
+        return keys
+    keys.add("processed")
+    for label in data_access.flatten_labels(db_item):
+        top_category, sub_category, confidence, type = label["top_category"], label["sub_category"], label["confidence"], label["type"]
+        confidence_bucket = str(int(math.floor(confidence / 5) * 5))
+        keys.add("labeled")
+        for breakdown, title in [("by_top_category", top_category), ("by_sub_category", sub_category), ("by_type", type), ("by_confidence", confidence_bucket)]:
+            if title is not None and len(title) > 0:
+                keys.add(f"{breakdown}#{title}")
+        if type is None or len(type) == 0:
+            continue
+        keys.add("reviewed")
+        if type in (TP_STR, FP_STR):
+            keys.add("tp" if type == TP_STR else "fp")
+            for breakdown, title in [("by_top_category_type", top_category), ("by_sub_category_type", sub_category), ("by_confidence_type", confidence_bucket)]:
+                if len(title) > 0:
+                    keys.add(f"{breakdown}#{type}#{title}")
+    return keys
+
+
+def diff(old_keys, new_keys, deltas=None):
+    deltas = {} if deltas is None else deltas
+    for k in new_keys - old_keys:
+        deltas[k] = deltas.get(k, 0) + 1
+    for k in old_keys - new_keys:
+        deltas[k] = deltas.get(k, 0) - 1
+    return deltas
+
+
+def slices(changes, max_keys=None):
+    '''
+    Split the changes of consecutive stream records [(task_id, event_id, deltas)] into slices of one task, with at most
+    max_keys metric keys changed. Yields (index of the first record, slice id, summed deltas).
+    The slicing only depends on the records, so a batch delivered again is sliced into the same slices.
+    '''
+    max_keys = MAX_KEYS_PER_UPDATE if max_keys is None else max_keys
+    start, task_id, event_ids, deltas = 0, None, [], {}
+    for i, (record_task_id, event_id, record_deltas) in enumerate(changes):
+        keys = set(deltas.keys()) | set(record_deltas.keys())
+        if len(event_ids) > 0 and (record_task_id != task_id or len(keys) > max_keys):
+            yield start, _slice_id(task_id, event_ids), deltas
+            start, event_ids, deltas = i, [], {}
+        task_id = record_task_id
+        event_ids.append(event_id)
+        for k, v in record_deltas.items():
+            deltas[k] = deltas.get(k, 0) + v
+    if len(event_ids) > 0:
+        yield start, _slice_id(task_id, event_ids), deltas
+
+
+def _slice_id(task_id, event_ids):
+    return task_id + "#slice#" + hashlib.sha256("".join(event_ids).encode()).hexdigest()[:32]
+
+
+def apply(dynamodb, cube_table, task_id, slice_id, deltas):
+    '''
+    Add the deltas of a slice to the cube item, unless the slice was applied already.
+    Returns False when the marker of the slice exists: the deltas were counted by an earlier delivery of the records.
+    '''
+    deltas = [(k, v) for k, v in deltas.items() if v != 0]
+    if len(deltas) == 0:
+        return True
+    try:
+        dynamodb.transact_write_items(TransactItems=[
+            {"Put": {
+                "TableName": cube_table,
+                "Item": {"task_id": {"S": slice_id}, "ttl": {"N": str(int(time.time()) + MARKER_TTL_S)}},
+                "ConditionExpression": "attribute_not_exists(task_id)"
+            }},
+            {"Update": {
+                "TableName": cube_table,
+                "Key": {"task_id": {"S": task_id}},
+                "UpdateExpression": "ADD " + ", ".join([f"#k{j} :v{j}" for j in range(len(deltas))]),
+                "ExpressionAttributeNames": {f"#k{j}": k for j, (k, v) in enumerate(deltas)},
+                "ExpressionAttributeValues": {f":v{j}": {"N": str(v)} for j, (k, v) in enumerate(deltas)}
+            }}
+        ])
+    except Exception as ex:
+        reasons = getattr(ex, "response", {}).get("CancellationReasons", [])
+        if len(reasons) > 0 and reasons[0].get("Code") == "ConditionalCheckFailed":
+            print("Report cube slice already applied:", slice_id)
+            return False
+        raise
+    return True
+
+
+def count(dynamodb, result_table, state=None, deadline=None):
+    '''
+    Count the metric keys of the moderation result table in one parallel scan. Returns (counts, state): state is None when
+    the table was read, otherwise the scan stopped at the deadline (epoch seconds) and count() continues from the state.
+    '''
+    counts = {} if state is None else dict(state["counts"])
+    scan = ParallelScan(dynamodb, result_table,
+        checkpoint=None if state is None else state["scan"],
+        ProjectionExpression="file_path, rek_results"
+    )
+    for page in scan.pages(deadline):
+        for i in page.get("Items", []):
+            for k in metric_keys(i):
+                counts[k] = counts.get(k, 0) + 1
+    checkpoint = scan.checkpoint()
+    return counts, None if checkpoint is None else {"scan": checkpoint, "counts": counts}
+
+
+def rebuild_state(cube_item):
+    '''State of an unfinished rebuild saved on a cube item in DynamoDB JSON, or None.'''
+    if cube_item is None or "rebuild_state" not in cube_item:
+        return None
+    return json.loads(cube_item["rebuild_state"]["S"])
+
+
+def rebuild(dynamodb, cube_table, task_id, result_table, state=None, deadline=None):
+    '''
+    Replace the cube item of a task with the counts of its moderation result table. Returns the new cube item.
+    When the deadline passes first, the scan position and the partial counts are saved on the cube item ("rebuild_state")
+    and None is returned: call it again with rebuild_state(cube_item) to continue.
+    '''
+    counts, state = count(dynamodb, result_table, state, deadline)
+    if state is not None:
+        dynamodb.update_item(
+            TableName=cube_table,
+            Key={"task_id": {"S": task_id}},
+            UpdateExpression="SET rebuild_state = :s",
+            ExpressionAttributeValues={":s": {"S": json.dumps(state)}}
+        )
+        print("Rebuild of the report cube stopped at the deadline:", task_id, len(counts), "metrics counted")
+        return None
+    cube_item = {k: {"N": str(v)} for k, v in counts.items()}
+    cube_item["task_id"] = {"S": task_id}
+    dynamodb.put_item(TableName=cube_table, Item=cube_item)
+    print("Rebuilt report cube:", task_id, len(counts), "metrics")
+    return cube_item
+
+
+def document(cube_item):
+    '''The get-report response body from a cube item.'''
+    result = {m: int(cube_item[m]["N"]) if m in cube_item else 0 for m in METRICS}
+    counts = {b: {} for b in BREAKDOWNS}
+    counts.update({b: {FP_STR: {}, TP_STR: {}} for b in TYPE_BREAKDOWNS})
+    for key, value in cube_item.items():
+        if "#" not in key or int(value["N"]) <= 0:
+            continue
+        breakdown, title = key.split("#", 1)
+        if breakdown in TYPE_BREAKDOWNS:
+            type, title = title.split("#", 1)
+            counts[breakdown][type][title] = int(value["N"])
+        elif breakdown in BREAKDOWNS:
+            counts[breakdown][title] = int(value["N"])
+
+    for b in BREAKDOWNS:
+        result[b] = construct_list_with_count(counts[b], sort_key="title" if b == "by_confidence" else "value")
+    for b in TYPE_BREAKDOWNS:
+        result[b] = {t: construct_list_with_count(counts[b][t], sort_key="title" if b == "by_confidence_type" else "value") for t in (FP_STR, TP_STR)}
+    return result
+
+
+def construct_list_with_count(counts, sort_key="value", reverse=True):
+    result = [{"title": k, "value": v} for k, v in counts.items()]
+    return sorted(result, key=lambda d: d[sort_key], reverse=reverse)
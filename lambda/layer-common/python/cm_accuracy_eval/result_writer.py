@@ -0,0 +1,89 @@
+'''
+Buffered DynamoDB writer for moderation results.
+Items are collected and written with BatchWriteItem, 25 items per request. UnprocessedItems are resent with
+full-jitter exponential backoff. Items still unprocessed after the last attempt are kept in `failed_items` so
+the caller can report them instead of losing them.
+
+    writer = BatchResultWriter(dynamodb, table_name)
+    writer.put(db_item)
+    ...
+    writer.flush()  # always flush at the end of an invocation
+'''
+import random
+import threading
+import time
+
+MAX_BATCH_SIZE = 25
+
+
+class BatchResultWriter:
+    def __init__(self, dynamodb, table_name, key_attributes=("file_path",), max_attempts=8, base_delay_s=0.05, max_delay_s=5.0):
+        self.dynamodb = dynamodb
+        self.table_name = table_name
+        self.key_attributes = key_attributes
+        self.max_attempts = max_attempts
+        self.base_delay_s = base_delay_s
+        self.max_delay_s = max_delay_s
+
+        self.failed_items = []
+        self.written = 0
+        self.requests = 0
+
+        self._buffer = {}
+        self._lock = threading.Lock()
+
+    def put(self, item):
+        # BatchWriteItem rejects duplicate keys in one request: the last item for a key wins.
+        batch = None
+        with self._lock:
+            self._buffer[self._item_key(item)] = item
+            if len(self._buffer) >= MAX_BATCH_SIZE:
+                batch = self._take(MAX_BATCH_SIZE)
+        if batch:
+            self._write(batch)
+
+    def flush(self):
+        while True:
+            with self._lock:
+                batch = self._take(MAX_BATCH_SIZE)
+            if not batch:
+                break
+            self._write(batch)
+        return self.failed_items
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.flush()
+
+    def _item_key(self, item):
+        return tuple(str(item.get(k)) for k in self.key_attributes)
+
+    def _take(self, size):
+        keys = list(self._buffer.keys())[:size]
+        return [self._buffer.pop(k) for k in keys]
+
+    def _write(self, items):
+        requests = [{"PutRequest": {"Item": i}} for i in items]
+        attempt = 0
+        while len(requests) > 0:
+            try:
+                response = self.dynamodb.batch_write_item(RequestItems={self.table_name: requests})
+                self._count(len(requests) - len(response.get("UnprocessedItems", {}).get(self.table_name, [])))
+                requests = response.get("UnprocessedItems", {}).get(self.table_name, [])
+            except Exception as ex:
+                print(f"BatchWriteItem failed on {self.table_name}: ", ex)
+            attempt += 1
+            if len(requests) > 0:
+                if attempt >= self.max_attempts:
+                    with self._lock:
+                        self.failed_items.extend([r["PutRequest"]["Item"] for r in requests])
+                    print(f"Failed to write {len(requests)} items to {self.table_name} after {attempt} attempts")
+                    return
+                time.sleep(random.uniform(0, min(self.max_delay_s, self.base_delay_s * (2 ** attempt))))
+
+    def _count(self, written):
+        with self._lock:
+            self.written += written
+            self.requests += 1
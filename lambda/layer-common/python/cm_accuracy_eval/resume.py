@@ -0,0 +1,44 @@
+'''
+Resume of a moderation run: only the images without a row in the task's moderation result table are moderated again.
+
+A run that failed or was aborted halfway is resumed with a new execution (start-moderation "resume"). The images of the
+input (upload index, listing or input manifest) are compared with the file_path of the result rows: the moderated images are
+skipped, so they aren't billed twice by Rekognition and don't start a second human loop.
+
+The moderated images are read with a parallel scan projecting file_path only, and kept as a set of 16-byte digests
+(input_manifest.key_digest): about 100 bytes per image (500 MB for 5M images), whatever the key length. The difference is
+exact. A Bloom filter would use less memory, but its false positives would skip images that were never moderated, and a
+sorted-key merge would need the scan sorted first, as a scan returns the rows in hash order.
+
+Near-duplicate clusters are skipped when their representative was moderated: its result row was written with the rows of
+its duplicates.
+'''
+from cm_accuracy_eval.parallel_scan import ParallelScan
+from cm_accuracy_eval.input_manifest import key_digest
+
+
+def moderated(dynamodb, result_table):
+    '''Digests of the file_path of the result rows of a task.'''
+    digests = set()
+    for item in ParallelScan(dynamodb, result_table, ProjectionExpression="file_path").items():
+        digests.add(key_digest(item["file_path"]["S"]))
+    return digests
+
+
+def pending(bucket, key, moderated_digests, stats):
+    '''
+    True if an image has no result row. stats (dict) is updated: resume_total, resume_skipped and resume_remaining.
+    '''
+    for k in ("resume_total", "resume_skipped", "resume_remaining"):
+        stats.setdefault(k, 0)
+    stats["resume_total"] += 1
+    if key_digest(f"s3://{bucket}/{key}") in moderated_digests:
+        stats["resume_skipped"] += 1
+        return False
+    stats["resume_remaining"] += 1
+    return True
+
+
+def remaining(keys, bucket, moderated_digests, stats):
+    '''Keys of a bucket without a result row, in the input order. stats: see pending().'''
+    return [k for k in keys if pending(bucket, k, moderated_digests, stats)]
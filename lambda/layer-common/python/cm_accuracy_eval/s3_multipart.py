@@ -0,0 +1,232 @@
+'''
+Streaming S3 writer: data is written to an S3 object as it is produced, without a local file.
+Bytes are buffered up to part_size and uploaded as the parts of a multipart upload, at most max_in_flight parts at a time on
+background threads, so memory is bounded by (max_in_flight + 1) x part_size whatever the object size. An object smaller than
+one part is written with a single PutObject. With gzip=True the data is compressed on the fly (gzip format).
+
+If the block raises, the multipart upload is aborted and no object is written.
+
+append_object() concatenates existing objects (e.g. export shards) without compression. The buffered data is topped up to
+MIN_PART_SIZE with a ranged GetObject of the first bytes of the object, and the rest of the object is copied as parts by S3
+(UploadPartCopy with CopySourceRange): at most MIN_PART_SIZE of an object is read, whatever its size. Objects too small to
+leave a part of MIN_PART_SIZE to copy are read and buffered.
+
+A long upload is handed over to another process with suspend(): the parts in flight are completed, and the upload id and the
+buffered bytes (less than one part) are returned. resume() continues it, with the uploaded parts listed from S3 (ListParts).
+
+    with S3MultipartWriter(s3, bucket, "report/export.csv.gz", gzip=True) as writer:
+        w = csv.writer(writer)
+        for row in rows:
+            w.writerow(row)
+    print(writer.bytes_written, writer.parts)
+'''
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+# S3 parts are at least 5 MB, except the last one
+MIN_PART_SIZE = 5 * 1024 * 1024
+MAX_PART_SIZE = 5 * 1024 * 1024 * 1024
+PART_SIZE = 8 * 1024 * 1024
+MAX_IN_FLIGHT = 2
+
+
+class S3MultipartWriter:
+    def __init__(self, s3, bucket, key, gzip=False, part_size=PART_SIZE, max_in_flight=MAX_IN_FLIGHT, content_type=None):
+        if part_size < MIN_PART_SIZE:
+            raise ValueError(f"part_size must be at least {MIN_PART_SIZE} bytes")
+        self.s3 = s3
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.max_in_flight = max_in_flight
+        self.content_type = content_type
+        # wbits 31: gzip header and trailer
+        self.compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if gzip else None
+
+        self.upload_id = None
+        self.parts = 0
+        self.bytes_in = 0
+        self.bytes_written = 0
+        self._buffer = bytearray()
+        self._in_flight = []
+        self._etags = {}
+        self._executor = None
+        self._closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
+
+    def write(self, data):
+        '''Write str (UTF-8) or bytes. Returns the length written, as a file object does (csv.writer accepts this writer).'''
+        if self._closed:
+            raise ValueError("Writer is closed")
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        length = len(data)
+        self.bytes_in += length
+        if self.compressor is not None:
+            data = self.compressor.compress(data)
+        self._buffer += data
+        while len(self._buffer) >= self.part_size:
+            self._upload_part(bytes(self._buffer[:self.part_size]))
+            del self._buffer[:self.part_size]
+        return length
+
+    def append_object(self, bucket, key, size):
+        '''Append the content of an existing object as is.'''
+        if self._closed:
+            raise ValueError("Writer is closed")
+        if self.compressor is not None:
+            raise ValueError("append_object requires gzip=False")
+        # Parts other than the last must be at least MIN_PART_SIZE: the buffered data is sent first, as a part of its own,
+        # topped up with the first bytes of the object
+        head = MIN_PART_SIZE - len(self._buffer) if 0 < len(self._buffer) < MIN_PART_SIZE else 0
+        if size - head < MIN_PART_SIZE:
+            self.write(self.s3.get_object(Bucket=bucket, Key=key)["Body"].read())
+            return
+        if head > 0:
+            self.write(self.s3.get_object(Bucket=bucket, Key=key, Range=f"bytes=0-{head - 1}")["Body"].read())
+        if len(self._buffer) > 0:
+            self._upload_part(bytes(self._buffer))
+            self._buffer = bytearray()
+        # The rest is copied in even byte ranges of at most MAX_PART_SIZE
+        ranges = -(-(size - head) // MAX_PART_SIZE)
+        for n in range(ranges):
+            start, end = head + (size - head) * n // ranges, head + (size - head) * (n + 1) // ranges
+            self._upload_part(None, copy_source={"Bucket": bucket, "Key": key}, size=end - start,
+                copy_range=None if start == 0 and end == size else f"bytes={start}-{end - 1}")
+        self.bytes_in += size - head
+
+    def suspend(self):
+        '''
+        Stop writing without completing the upload, for another process to resume it. Returns (upload id, buffered bytes): the
+        upload id is None when no part was uploaded. Raises the error of a failed part (the upload is aborted).
+        '''
+        if self._closed:
+            raise ValueError("Writer is closed")
+        if self.compressor is not None:
+            raise ValueError("suspend requires gzip=False")
+        try:
+            self._wait(0)
+        except Exception:
+            self.abort()
+            raise
+        self._closed = True
+        buffered, self._buffer = bytes(self._buffer), bytearray()
+        self._shutdown()
+        return self.upload_id, buffered
+
+    @classmethod
+    def resume(cls, s3, bucket, key, upload_id, **kwargs):
+        '''Writer continuing a suspended upload (upload_id None: a new upload). The parts uploaded are listed from S3.'''
+        writer = cls(s3, bucket, key, **kwargs)
+        if upload_id is None:
+            return writer
+        writer.upload_id = upload_id
+        writer._executor = ThreadPoolExecutor(max_workers=writer.max_in_flight)
+        paginator = s3.get_paginator("list_parts")
+        for page in paginator.paginate(Bucket=bucket, Key=key, UploadId=upload_id):
+            for part in page.get("Parts", []):
+                writer._etags[part["PartNumber"]] = part["ETag"]
+                writer.bytes_written += part["Size"]
+        writer.parts = max(writer._etags) if len(writer._etags) > 0 else 0
+        return writer
+
+    # File object protocol, for writers that expect one (pyarrow): write only, the position is the uncompressed length
+    @property
+    def closed(self):
+        return self._closed
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        return self.bytes_in
+
+    def flush(self):
+        pass
+
+    def close(self):
+        '''Upload the last part and complete the upload.'''
+        if self._closed:
+            return
+        if self.compressor is not None:
+            self._buffer += self.compressor.flush()
+        self._closed = True
+        try:
+            if self.upload_id is None:
+                # Smaller than one part
+                self.s3.put_object(Bucket=self.bucket, Key=self.key, Body=bytes(self._buffer), **self._object_args())
+                self.bytes_written += len(self._buffer)
+                return
+            if len(self._buffer) > 0:
+                self._upload_part(bytes(self._buffer))
+            self._wait(0)
+            self.s3.complete_multipart_upload(
+                Bucket=self.bucket,
+                Key=self.key,
+                UploadId=self.upload_id,
+                MultipartUpload={"Parts": [{"ETag": self._etags[n], "PartNumber": n} for n in sorted(self._etags)]}
+            )
+        except Exception:
+            self.abort()
+            raise
+        finally:
+            self._buffer = bytearray()
+            self._shutdown()
+
+    def abort(self):
+        '''Discard the parts uploaded so far.'''
+        self._closed = True
+        self._buffer = bytearray()
+        self._shutdown()
+        if self.upload_id is not None:
+            try:
+                self.s3.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+            except Exception as ex:
+                print(f"Failed to abort the upload of s3://{self.bucket}/{self.key}", ex)
+            self.upload_id = None
+
+    def _object_args(self):
+        return {} if self.content_type is None else {"ContentType": self.content_type}
+
+    def _upload_part(self, body, copy_source=None, size=None, copy_range=None):
+        if self.upload_id is None:
+            self.upload_id = self.s3.create_multipart_upload(Bucket=self.bucket, Key=self.key, **self._object_args())["UploadId"]
+            self._executor = ThreadPoolExecutor(max_workers=self.max_in_flight)
+        # Bounded memory: wait for a part to finish before buffering more
+        self._wait(self.max_in_flight - 1)
+        self.parts += 1
+        if copy_source is not None:
+            self.bytes_written += size
+            self._in_flight.append(self._executor.submit(self._copy_part, self.parts, copy_source, copy_range))
+        else:
+            self.bytes_written += len(body)
+            self._in_flight.append(self._executor.submit(self._put_part, self.parts, body))
+
+    def _put_part(self, part_number, body):
+        response = self.s3.upload_part(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id, PartNumber=part_number, Body=body)
+        self._etags[part_number] = response["ETag"]
+
+    def _copy_part(self, part_number, copy_source, copy_range):
+        kwargs = {} if copy_range is None else {"CopySourceRange": copy_range}
+        response = self.s3.upload_part_copy(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id, PartNumber=part_number, CopySource=copy_source, **kwargs)
+        self._etags[part_number] = response["CopyPartResult"]["ETag"]
+
+    def _wait(self, max_pending):
+        while len(self._in_flight) > max_pending:
+            # Raises the error of a failed part
+            self._in_flight.pop(0).result()
+
+    def _shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        self._in_flight = []
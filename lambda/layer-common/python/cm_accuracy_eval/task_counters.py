@@ -0,0 +1,240 @@
+'''
+Moderation and review counters kept on the task item.
+
+Writers add deltas with an atomic UpdateItem ADD, readers get every counter with the task item in one GetItem:
+- moderate-image: processed and labeled, once per batch for the results saved
+- A2I ETL: reviewed, true_positive and false_positive, as the difference between the old and new review flags. save_rows()
+  writes the reviewed rows and adds their changes in one transaction, so a redelivered review can't lose or repeat them
+
+reconcile() rebuilds the counters from the moderation result table with a parallel scan. Use it for tasks created before the
+counters existed, or when an invocation retried after saving its results counted them twice. The writers keep adding while
+the table is scanned: the correction is added, as the difference between the scanned counts and the counters read when the
+scan started. A reconcile that doesn't finish before the deadline saves its position on the task item and continues in the
+next call.
+'''
+
+import json
+import random
+import time
+
+from cm_accuracy_eval.parallel_scan import ParallelScan
+
+COUNTERS = ["processed", "labeled", "reviewed", "true_positive", "true_negative", "false_positive", "false_negative"]
+
+# Counter for each flag attribute of a moderation result item
+FLAG_COUNTERS = {
+    "issue_flag": "labeled",
+    "reviewed_flag": "reviewed",
+    "tp_flag": "true_positive",
+    "tn_flag": "true_negative",
+    "fp_flag": "false_positive",
+    "fn_flag": "false_negative",
+}
+
+# Rows saved per transaction: 100 actions at most, one is the counter update
+MAX_ROWS_PER_TRANSACTION = 99
+# Attempts of an update conflicting with a transaction on the same item
+MAX_CONFLICT_ATTEMPTS = 5
+CONFLICT_DELAY_S = 0.05
+
+
+def update_request(task_table, task_id, deltas):
+    '''UpdateItem parameters adding the non-zero deltas to the task counters, or None.'''
+    deltas = {k: v for k, v in deltas.items() if v != 0}
+    if len(deltas) == 0:
+        return None
+    return {
+        "TableName": task_table,
+        "Key": {"id": {"S": task_id}},
+        "UpdateExpression": "ADD " + ", ".join([f"#c{i} :c{i}" for i in range(len(deltas))]),
+        # Don't recreate a deleted task
+        "ConditionExpression": "attribute_exists(id)",
+        "ExpressionAttributeNames": {f"#c{i}": c for i, c in enumerate(deltas)},
+        "ExpressionAttributeValues": {f":c{i}": {"N": str(d)} for i, d in enumerate(deltas.values())},
+    }
+
+
+def add(dynamodb, task_table, task_id, deltas, return_values="NONE"):
+    '''Atomically add the non-zero deltas to the task counters. Returns the response attributes or None.'''
+    request = update_request(task_table, task_id, deltas)
+    if request is None:
+        return None
+    for attempt in range(1, MAX_CONFLICT_ATTEMPTS + 1):
+        try:
+            return dynamodb.update_item(**request, ReturnValues=return_values).get("Attributes")
+        except Exception as ex:
+            code = getattr(ex, "response", {}).get("Error", {}).get("Code")
+            if code == "ConditionalCheckFailedException":
+                print("Task doesn't exist, counters not updated:", task_id)
+                return None
+            # The task item is in a transaction of save_rows()
+            if code != "TransactionConflictException" or attempt == MAX_CONFLICT_ATTEMPTS:
+                raise
+            time.sleep(random.uniform(0, CONFLICT_DELAY_S * (2 ** attempt)))
+
+
+def unchanged_condition(db_item):
+    '''
+    Condition that a moderation result row still has the flags of db_item (None: the row doesn't exist).
+    Returns (ConditionExpression, ExpressionAttributeNames, ExpressionAttributeValues).
+    '''
+    if db_item is None:
+        return "attribute_not_exists(file_path)", {}, {}
+    conditions, names = [], {}
+    for i, flag in enumerate(FLAG_COUNTERS):
+        names[f"#f{i}"] = flag
+        if db_item.get(flag, {}).get("N") == "1":
+            conditions.append(f"#f{i} = :one")
+        else:
+            conditions.append(f"(attribute_not_exists(#f{i}) OR #f{i} <> :one)")
+    return "attribute_exists(file_path) AND " + " AND ".join(conditions), names, {":one": {"N": "1"}}
+
+
+def save_rows(dynamodb, task_table, task_id, result_table, rows):
+    '''
+    Write moderation result rows and add their counter changes to the task: rows [(new item, old item)], old as read before
+    the change (None for a new row). The rows and their changes are written together in one transaction per
+    MAX_ROWS_PER_TRANSACTION rows, and a row only when it is unchanged since it was read.
+    Returns False when a row changed since: nothing of its transaction is saved, read the rows again and retry. A repeated
+    change (the rows have it already) adds 0. The rows of a deleted task are dropped: True.
+    '''
+    for i in range(0, len(rows), MAX_ROWS_PER_TRANSACTION):
+        actions, deltas = [], {}
+        for new_item, old_item in rows[i:i + MAX_ROWS_PER_TRANSACTION]:
+            old_counts = {c: 0 for c in COUNTERS} if old_item is None else item_counts(old_item)
+            for c, v in item_counts(new_item).items():
+                deltas[c] = deltas.get(c, 0) + v - old_counts[c]
+            condition, names, values = unchanged_condition(old_item)
+            put = {"TableName": result_table, "Item": new_item, "ConditionExpression": condition}
+            if len(names) > 0:
+                put["ExpressionAttributeNames"] = names
+                put["ExpressionAttributeValues"] = values
+            actions.append({"Put": put})
+        update = update_request(task_table, task_id, deltas)
+        if update is not None:
+            actions.append({"Update": update})
+        codes = transact(dynamodb, actions)
+        if update is not None and codes[-1:] == ["ConditionalCheckFailed"]:
+            print("Task doesn't exist, rows not saved:", task_id)
+            return True
+        if "ConditionalCheckFailed" in codes:
+            return False
+    return True
+
+
+def transact(dynamodb, actions):
+    '''
+    TransactWriteItems, retried when it conflicts with another write of the same items. Returns the cancellation reason
+    codes, one per action, when a condition failed: nothing is written. [] when written.
+    '''
+    for attempt in range(1, MAX_CONFLICT_ATTEMPTS + 1):
+        try:
+            dynamodb.transact_write_items(TransactItems=actions)
+            return []
+        except Exception as ex:
+            codes = [r.get("Code") for r in getattr(ex, "response", {}).get("CancellationReasons", [])]
+            if "ConditionalCheckFailed" in codes:
+                return codes
+            if "TransactionConflict" not in codes or attempt == MAX_CONFLICT_ATTEMPTS:
+                raise
+            time.sleep(random.uniform(0, CONFLICT_DELAY_S * (2 ** attempt)))
+
+
+def read(item):
+    '''Counters from a task item in DynamoDB JSON. None if the item has no counters.'''
+    if "processed" not in item:
+        return None
+    return {c: int(item[c]["N"]) if c in item else 0 for c in COUNTERS}
+
+
+def item_counts(db_item):
+    '''Counter values contributed by one moderation result item.'''
+    counts = {"processed": 1}
+    for flag, counter in FLAG_COUNTERS.items():
+        counts[counter] = 1 if db_item.get(flag, {}).get("N") == "1" else 0
+    return counts
+
+
+def count(dynamodb, result_table, state=None, deadline=None):
+    '''
+    Count the counters from the moderation result table, in one parallel scan of the flag attributes.
+    Returns (counters, state): state is None when the table was read, otherwise the scan stopped at the deadline (epoch seconds)
+    and count() continues from the state it is passed.
+    '''
+    counters = {c: 0 for c in COUNTERS} if state is None else dict(state["counters"])
+    scan = ParallelScan(dynamodb, result_table,
+        checkpoint=None if state is None else state["scan"],
+        ProjectionExpression=", ".join(FLAG_COUNTERS.keys())
+    )
+    for page in scan.pages(deadline):
+        for i in page.get("Items", []):
+            for c, v in item_counts(i).items():
+                counters[c] += v
+    checkpoint = scan.checkpoint()
+    return counters, None if checkpoint is None else {"scan": checkpoint, "counters": counters}
+
+
+def reconcile_state(item):
+    '''State of an unfinished reconcile saved on a task item in DynamoDB JSON, or None.'''
+    if "reconcile_state" not in item:
+        return None
+    return json.loads(item["reconcile_state"]["S"])
+
+
+def reconcile(dynamodb, task_table, task_id, result_table, state=None, deadline=None):
+    '''
+    Rebuild the task counters from the moderation result table. Returns the counters.
+    When the deadline passes first, the scan position and the partial counts are saved on the task item ("reconcile_state")
+    and None is returned: call it again with reconcile_state(item) to continue. None is returned as well when a concurrent
+    reconcile of the task saved or finished first.
+    '''
+    if state is None:
+        # The counters when the scan starts: the changes added from now on are kept
+        item = dynamodb.get_item(
+            TableName=task_table,
+            Key={"id": {"S": task_id}},
+            ProjectionExpression=", ".join([f"#c{i}" for i in range(len(COUNTERS))]),
+            ExpressionAttributeNames={f"#c{i}": c for i, c in enumerate(COUNTERS)},
+            ConsistentRead=True
+        ).get("Item", {})
+        base = {c: int(item[c]["N"]) if c in item else 0 for c in COUNTERS}
+        # Only the reconcile that started first saves its state
+        condition = {"ConditionExpression": "attribute_exists(id) AND attribute_not_exists(reconcile_state)"}
+    else:
+        base = state["base"]
+        condition = {"ConditionExpression": "reconcile_state = :loaded",
+            "ExpressionAttributeValues": {":loaded": {"S": json.dumps(state)}}}
+    counters, scan_state = count(dynamodb, result_table, state, deadline)
+    try:
+        if scan_state is not None:
+            scan_state["base"] = base
+            values = dict(condition.get("ExpressionAttributeValues", {}), **{":s": {"S": json.dumps(scan_state)}})
+            dynamodb.update_item(
+                TableName=task_table,
+                Key={"id": {"S": task_id}},
+                UpdateExpression="SET reconcile_state = :s",
+                ConditionExpression=condition["ConditionExpression"],
+                ExpressionAttributeValues=values
+            )
+            print("Reconcile of the task counters stopped at the deadline:", task_id, scan_state["counters"])
+            return None
+        # Every counter is added, 0 included, so that the task has them all
+        values = dict(condition.get("ExpressionAttributeValues", {}),
+            **{f":c{i}": {"N": str(counters[c] - base[c])} for i, c in enumerate(COUNTERS)})
+        response = dynamodb.update_item(
+            TableName=task_table,
+            Key={"id": {"S": task_id}},
+            UpdateExpression="ADD " + ", ".join([f"#c{i} :c{i}" for i in range(len(COUNTERS))]) + " REMOVE reconcile_state",
+            ConditionExpression=condition["ConditionExpression"],
+            ExpressionAttributeNames={f"#c{i}": c for i, c in enumerate(COUNTERS)},
+            ExpressionAttributeValues=values,
+            ReturnValues="ALL_NEW"
+        )
+    except Exception as ex:
+        if getattr(ex, "response", {}).get("Error", {}).get("Code") == "ConditionalCheckFailedException":
+            print("Reconcile of the task counters continued by another call, or the task was deleted:", task_id)
+            return None
+        raise
+    counters = read(response["Attributes"])
+    print("Reconciled task counters:", task_id, counters)
+    return counters
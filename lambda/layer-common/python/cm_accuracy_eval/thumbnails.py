@@ -0,0 +1,167 @@
+'''
+Gallery thumbnails and sprite sheets.
+
+- make_thumbnail(): JPEG thumbnail that fits in THUMBNAIL_SIZE x THUMBNAIL_SIZE, aspect ratio kept. JPEG originals are
+  decoded at a reduced scale (draft mode), so a multi-MB original only needs a fraction of its full size in memory. Other
+  formats are decoded at full size: with a MemoryBudget, the decode waits until the decoded size fits in the budget.
+- MemoryBudget: bytes held by concurrent threads, up to a limit. The thumbnails Lambda bounds the originals downloaded and
+  the images decoded at once with a share of the Lambda memory each.
+- make_sprite(): one JPEG sheet of up to SPRITE_MAX_IMAGES thumbnails in a grid of SPRITE_COLUMNS columns, and the box of
+  each thumbnail. A gallery page loads a few sheets instead of one image per thumbnail.
+- thumbnail_uri() / sprite_uri(): objects under the thumbnails/ prefix of the image bucket. The sprite key is a hash of its
+  file paths, so building the same sheet twice writes the same object.
+- The thumbnail and its box in the sheet are saved on the moderation result item ("thumbnail" attribute: to_item(),
+  from_item(), load()). The builds started for an image are counted in its "thumbnail_attempts" attribute.
+
+Pillow is required for make_thumbnail() and make_sprite() (imaging layer).
+'''
+import contextlib
+import hashlib
+import io
+import math
+import threading
+
+from cm_accuracy_eval.batch_reader import batch_get_items
+
+THUMBNAIL_PREFIX = "thumbnails/"
+THUMBNAIL_SIZE = 160
+SPRITE_COLUMNS = 10
+SPRITE_MAX_IMAGES = 100
+JPEG_QUALITY = 80
+# Decompression bomb guard: larger images are not thumbnailed
+MAX_IMAGE_PIXELS = 100_000_000
+# Memory of a decode per pixel: the decoded image (up to 4 bytes per pixel) and its RGB copy
+DECODE_BYTES_PER_PIXEL = 8
+# Shares of the Lambda memory for the originals downloaded and for the images decoded at once
+ORIGINALS_MEMORY_FRACTION = 0.2
+DECODE_MEMORY_FRACTION = 0.4
+ATTEMPTS_ATTRIBUTE = "thumbnail_attempts"
+
+
+class MemoryBudget:
+    '''Bytes held by concurrent threads, up to a limit. A thread larger than the limit waits until it runs alone.'''
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.condition = threading.Condition()
+
+    @contextlib.contextmanager
+    def hold(self, size):
+        with self.condition:
+            while self.used > 0 and self.used + size > self.limit:
+                self.condition.wait()
+            self.used += size
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.used -= size
+                self.condition.notify_all()
+
+
+def thumbnail_uri(file_path, input_prefix="input/", bucket=None):
+    '''
+    s3://bucket/thumbnails/<task id>/<path>.jpg for s3://bucket/input/<task id>/<path>. Images of another bucket than the task
+    bucket (input manifest) are thumbnailed in the task bucket: s3://bucket/thumbnails/<image bucket>/<key>.jpg
+    '''
+    image_bucket, key = file_path[len("s3://"):].split("/", 1)
+    if bucket is not None and bucket != image_bucket:
+        return f"s3://{bucket}/{THUMBNAIL_PREFIX}{image_bucket}/{key}.jpg"
+    if key.startswith(input_prefix):
+        key = key[len(input_prefix):]
+    return f"s3://{image_bucket}/{THUMBNAIL_PREFIX}{key}.jpg"
+
+
+def sprite_uri(bucket, task_id, file_paths):
+    digest = hashlib.sha1("\n".join(sorted(file_paths)).encode("utf-8")).hexdigest()
+    return f"s3://{bucket}/{THUMBNAIL_PREFIX}{task_id}/sprites/{digest}.jpg"
+
+
+def make_thumbnail(fp, budget=None):
+    '''Returns (thumbnail image, JPEG bytes). With a MemoryBudget, the decode holds its decoded size in the budget.'''
+    from PIL import Image
+
+    with Image.open(fp) as img:
+        if img.width * img.height > MAX_IMAGE_PIXELS:
+            raise ValueError(f"Image too large: {img.width}x{img.height}")
+        # Sets the decoded size of a JPEG to the smallest scale larger than the thumbnail
+        img.draft("RGB", (THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+        with contextlib.nullcontext() if budget is None else budget.hold(img.width * img.height * DECODE_BYTES_PER_PIXEL):
+            img = img.convert("RGB")
+            img.thumbnail((THUMBNAIL_SIZE, THUMBNAIL_SIZE), Image.LANCZOS)
+    out = io.BytesIO()
+    img.save(out, format="JPEG", quality=JPEG_QUALITY, optimize=True)
+    return img, out.getvalue()
+
+
+def make_sprite(images):
+    '''Returns (JPEG bytes, [{"x", "y", "w", "h"}]) for a list of thumbnail images.'''
+    from PIL import Image
+
+    rows = max(1, math.ceil(len(images) / SPRITE_COLUMNS))
+    columns = min(SPRITE_COLUMNS, max(1, len(images)))
+    sheet = Image.new("RGB", (columns * THUMBNAIL_SIZE, rows * THUMBNAIL_SIZE), (255, 255, 255))
+    boxes = []
+    for n, img in enumerate(images):
+        x, y = (n % SPRITE_COLUMNS) * THUMBNAIL_SIZE, (n // SPRITE_COLUMNS) * THUMBNAIL_SIZE
+        sheet.paste(img, (x, y))
+        boxes.append({"x": x, "y": y, "w": img.width, "h": img.height})
+    out = io.BytesIO()
+    sheet.save(out, format="JPEG", quality=JPEG_QUALITY, optimize=True)
+    return out.getvalue(), boxes
+
+
+def to_item(thumbnail, sprite, box):
+    '''"thumbnail" attribute of a moderation result item: S3 URIs of the thumbnail and its sheet, box in the sheet.'''
+    return {"M": {
+        "thumbnail": {"S": thumbnail},
+        "sprite": {"S": sprite},
+        "x": {"N": str(box["x"])},
+        "y": {"N": str(box["y"])},
+        "w": {"N": str(box["w"])},
+        "h": {"N": str(box["h"])},
+    }}
+
+
+def error_item(error):
+    '''"thumbnail" attribute of an image that can't be thumbnailed: it isn't requested again.'''
+    return {"M": {"error": {"S": error}}}
+
+
+def from_item(db_item):
+    '''
+    Thumbnail of a moderation result item in DynamoDB JSON: {"thumbnail", "sprite", "x", "y", "w", "h"}, {"error"}, or None
+    when it wasn't built yet.
+    '''
+    thumbnail = db_item.get("thumbnail", {}).get("M")
+    if thumbnail is None:
+        return None
+    if "error" in thumbnail:
+        return {"error": thumbnail["error"]["S"]}
+    result = {"thumbnail": thumbnail["thumbnail"]["S"], "sprite": thumbnail["sprite"]["S"]}
+    result.update({k: int(thumbnail[k]["N"]) for k in ("x", "y", "w", "h")})
+    return result
+
+
+def attempts(db_item):
+    '''Number of thumbnail builds started for a moderation result item in DynamoDB JSON.'''
+    return int(db_item.get(ATTEMPTS_ATTRIBUTE, {}).get("N", "0"))
+
+
+def read(dynamodb, result_table, file_paths):
+    '''Thumbnail attributes of moderation results (BatchGetItem): [db_item]. Keys still unprocessed are left out.'''
+    items, unprocessed = batch_get_items(dynamodb, result_table, [{"file_path": {"S": f}} for f in dict.fromkeys(file_paths)],
+        projection=f"file_path, thumbnail, {ATTEMPTS_ATTRIBUTE}")
+    if len(unprocessed) > 0:
+        print(f"Thumbnails not read: {len(unprocessed)}")
+    return items
+
+
+def load(dynamodb, result_table, file_paths):
+    '''Thumbnails of moderation results read from the table (BatchGetItem): {file_path: thumbnail}, built ones only.'''
+    result = {}
+    for db_item in read(dynamodb, result_table, file_paths):
+        thumbnail = from_item(db_item)
+        if thumbnail is not None:
+            result[db_item["file_path"]["S"]] = thumbnail
+    return result
@@ -0,0 +1,241 @@
+'''
+Upload index: one item per object uploaded under a task's input prefix (input/<task id>/), maintained from the S3 put and
+delete notifications by the upload-index Lambda, with running counts on the task item.
+
+Index item: task_id (partition key), key (sort key: the S3 key), status (ACCEPTED, REJECTED, DELETED), size, etag, format
+(sniffed from the first SNIFF_BYTES bytes), reason (REJECTED), sequencer, indexed_at, ttl (DELETED).
+
+An object is accepted when its extension is a supported file type, its size is within MAX_IMAGE_BYTES (Rekognition limit for
+S3 images) and its header is a supported format (JPEG, PNG). With image normalization (cm_accuracy_eval.normalization), the
+formats and sizes it converts are accepted too: the upload-index Lambda gets the extended lists and limit. Rejected objects
+are never moderated: the index is the moderation manifest (accepted_keys), so they don't cost a moderation Lambda invocation
+or a Rekognition call.
+
+Counters on the task item: index_accepted, index_rejected and index_bytes (accepted bytes). apply() saves the index items
+and adds their change to the counters in one transaction, as the difference between the indexed and new items: a redelivered
+event (same S3 sequencer) or an overwritten object doesn't count twice, and a failed update doesn't lose the change. S3
+doesn't deliver events in order: an event older than the indexed one is ignored, and deletes are kept as DELETED items for
+TOMBSTONE_TTL_S so that a late put can't bring a deleted object back.
+
+Tasks created before the index have no counters on the task item (read_counts returns None): their objects are listed.
+'''
+import os
+import time
+
+from cm_accuracy_eval import task_counters
+from cm_accuracy_eval.batch_reader import batch_get_items
+
+STATUS_ACCEPTED = "ACCEPTED"
+STATUS_REJECTED = "REJECTED"
+STATUS_DELETED = "DELETED"
+
+REASON_FILE_TYPE = "unsupported file type"
+REASON_EMPTY = "empty file"
+REASON_TOO_LARGE = "file too large"
+REASON_FORMAT = "unsupported image format"
+
+# Rekognition DetectModerationLabels: JPEG or PNG, at most 15 MB for an image in S3
+SUPPORTED_FORMATS = ("jpeg", "png")
+MAX_IMAGE_BYTES = 15 * 1024 * 1024
+SNIFF_BYTES = 32
+TOMBSTONE_TTL_S = 7 * 24 * 3600
+# Marker object written by create-task, not an upload
+TEMP_FILE_NAME = ".temp"
+# Index items saved per transaction: 100 actions at most, one is the counter update
+MAX_ITEMS_PER_TRANSACTION = 99
+# Reads of the indexed items when another event of an object was indexed since
+MAX_APPLY_ATTEMPTS = 5
+
+COUNTERS = {STATUS_ACCEPTED: "index_accepted", STATUS_REJECTED: "index_rejected"}
+BYTES_COUNTER = "index_bytes"
+
+_SIGNATURES = [
+    (b"\xff\xd8\xff", "jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "png"),
+    (b"GIF87a", "gif"),
+    (b"GIF89a", "gif"),
+    (b"BM", "bmp"),
+    (b"II*\x00", "tiff"),
+    (b"MM\x00*", "tiff"),
+]
+# ISO base media files (HEIF, AVIF): "ftyp" box with the major brand
+_FTYP_BRANDS = {b"heic": "heic", b"heix": "heic", b"mif1": "heif", b"msf1": "heif", b"avif": "avif"}
+
+
+def sniff_format(header):
+    '''Image format from the first bytes of a file, None if it isn't recognized.'''
+    for signature, format in _SIGNATURES:
+        if header.startswith(signature):
+            return format
+    if header[0:4] == b"RIFF" and header[8:12] == b"WEBP":
+        return "webp"
+    if header[4:8] == b"ftyp":
+        return _FTYP_BRANDS.get(header[8:12])
+    return None
+
+
+def parse_key(key, input_prefix):
+    '''Task id of an uploaded object, None for the keys that aren't uploads (other prefixes, folders, the .temp marker).'''
+    if not key.startswith(input_prefix) or key.endswith("/"):
+        return None
+    parts = key[len(input_prefix):].split("/", 1)
+    if len(parts) < 2 or parts[1] == TEMP_FILE_NAME:
+        return None
+    return parts[0]
+
+
+def check(key, size, supported_file_types, max_bytes=MAX_IMAGE_BYTES):
+    '''Reason to reject an object from its key and size, None if its header needs to be sniffed.'''
+    if os.path.splitext(key)[1].lower() not in supported_file_types:
+        return REASON_FILE_TYPE
+    if size == 0:
+        return REASON_EMPTY
+    if size > max_bytes:
+        return REASON_TOO_LARGE
+    return None
+
+
+def check_format(format, supported_formats=SUPPORTED_FORMATS):
+    return None if format in supported_formats else REASON_FORMAT
+
+
+def sequencer(value):
+    '''S3 event sequencers are hexadecimal numbers of different lengths: padded so that they compare as strings.'''
+    return value.upper().rjust(32, "0")
+
+
+def new_item(task_id, key, seq, size=None, etag=None, format=None, reason=None, deleted=False, now=None):
+    '''Index item in DynamoDB JSON.'''
+    now = int(time.time() if now is None else now)
+    item = {
+        "task_id": {"S": task_id},
+        "key": {"S": key},
+        "sequencer": {"S": seq},
+        "indexed_at": {"N": str(now)},
+    }
+    if deleted:
+        item["status"] = {"S": STATUS_DELETED}
+        item["ttl"] = {"N": str(now + TOMBSTONE_TTL_S)}
+        return item
+    item["status"] = {"S": STATUS_ACCEPTED if reason is None else STATUS_REJECTED}
+    item["size"] = {"N": str(size)}
+    if etag is not None:
+        item["etag"] = {"S": etag}
+    if format is not None:
+        item["format"] = {"S": format}
+    if reason is not None:
+        item["reason"] = {"S": reason}
+    return item
+
+
+def item_counts(item):
+    '''Counter values contributed by one index item in DynamoDB JSON (None: no item).'''
+    counts = {c: 0 for c in COUNTERS.values()}
+    counts[BYTES_COUNTER] = 0
+    status = None if item is None else item["status"]["S"]
+    if status in COUNTERS:
+        counts[COUNTERS[status]] = 1
+    if status == STATUS_ACCEPTED:
+        counts[BYTES_COUNTER] = int(item["size"]["N"])
+    return counts
+
+
+def apply(dynamodb, index_table, task_table, task_id, items):
+    '''
+    Save the index items of a task's events and add their change to the task counters, in one transaction per
+    MAX_ITEMS_PER_TRANSACTION items. The event of an object indexed with a newer (out of order) or the same sequencer
+    (redelivered) isn't applied. Returns the change to the task counters.
+    '''
+    # The latest event of each object: a transaction can't write an item twice
+    latest = {}
+    for item in items:
+        key = item["key"]["S"]
+        if key not in latest or latest[key]["sequencer"]["S"] < item["sequencer"]["S"]:
+            latest[key] = item
+    items = list(latest.values())
+    total = {}
+    for i in range(0, len(items), MAX_ITEMS_PER_TRANSACTION):
+        for c, v in _apply_items(dynamodb, index_table, task_table, task_id, items[i:i + MAX_ITEMS_PER_TRANSACTION]).items():
+            total[c] = total.get(c, 0) + v
+    return total
+
+
+def _apply_items(dynamodb, index_table, task_table, task_id, items):
+    for attempt in range(1, MAX_APPLY_ATTEMPTS + 1):
+        indexed, unprocessed = batch_get_items(dynamodb, index_table, [{"task_id": i["task_id"], "key": i["key"]} for i in items])
+        if len(unprocessed) > 0:
+            raise Exception(f"Failed to read {len(unprocessed)} index items of task {task_id}")
+        indexed = {i["key"]["S"]: i for i in indexed}
+        actions, deltas = [], {}
+        for item in items:
+            old = indexed.get(item["key"]["S"])
+            if old is not None and old["sequencer"]["S"] >= item["sequencer"]["S"]:
+                continue
+            old_counts, new_counts = item_counts(old), item_counts(item)
+            for c in new_counts:
+                deltas[c] = deltas.get(c, 0) + new_counts[c] - old_counts[c]
+            # Written only over the item read: another event indexed since fails the transaction
+            if old is None:
+                condition = {"ConditionExpression": "attribute_not_exists(#k)", "ExpressionAttributeNames": {"#k": "key"}}
+            else:
+                condition = {"ConditionExpression": "#seq = :seq", "ExpressionAttributeNames": {"#seq": "sequencer"},
+                    "ExpressionAttributeValues": {":seq": old["sequencer"]}}
+            actions.append({"Put": dict(condition, TableName=index_table, Item=item)})
+        if len(actions) == 0:
+            return {}
+        update = task_counters.update_request(task_table, task_id, deltas)
+        if update is not None:
+            actions.append({"Update": update})
+        codes = task_counters.transact(dynamodb, actions)
+        if len(codes) == 0:
+            return deltas
+        if update is not None and codes[-1] == "ConditionalCheckFailed":
+            print("Task doesn't exist, index items not saved:", task_id)
+            return {}
+    raise Exception(f"Index items of task {task_id} changed by {MAX_APPLY_ATTEMPTS} concurrent events")
+
+
+def initial_counts():
+    '''Counters of a new task in DynamoDB JSON: a task with counters is indexed.'''
+    counts = {c: {"N": "0"} for c in COUNTERS.values()}
+    counts[BYTES_COUNTER] = {"N": "0"}
+    return counts
+
+
+def read_counts(item):
+    '''Index counts from a task item in DynamoDB JSON: {"accepted", "rejected", "bytes"}. None if the task isn't indexed.'''
+    if COUNTERS[STATUS_ACCEPTED] not in item:
+        return None
+    def value(counter):
+        return int(item[counter]["N"]) if counter in item else 0
+    return {
+        "accepted": value(COUNTERS[STATUS_ACCEPTED]),
+        "rejected": value(COUNTERS[STATUS_REJECTED]),
+        "bytes": value(BYTES_COUNTER),
+    }
+
+
+def accepted_keys(dynamodb, index_table, task_id):
+    '''S3 keys of the accepted objects of a task, in key order.'''
+    paginator = dynamodb.get_paginator("query")
+    for page in paginator.paginate(
+        TableName=index_table,
+        KeyConditionExpression="task_id = :t",
+        FilterExpression="#st = :accepted",
+        ProjectionExpression="#k",
+        ExpressionAttributeNames={"#k": "key", "#st": "status"},
+        ExpressionAttributeValues={":t": {"S": task_id}, ":accepted": {"S": STATUS_ACCEPTED}},
+    ):
+        for item in page.get("Items", []):
+            yield item["key"]["S"]
+
+
+def count_listed(s3, bucket, prefix, supported_file_types):
+    '''Count of the supported files under a task's input prefix, listed: for the tasks created before the index.'''
+    total = 0
+    paginator = s3.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get("Contents", []):
+            if os.path.splitext(obj["Key"])[1].lower() in supported_file_types:
+                total += 1
+    return total
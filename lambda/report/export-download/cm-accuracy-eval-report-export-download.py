@@ -0,0 +1,49 @@
+'''
+Download an export job: presigned URLs of the output files once the job completed. One file for CSV, the shards for Parquet.
+'''
+import json
+import boto3
+import os
+from cm_accuracy_eval import export_jobs
+
+DYNAMO_EXPORT_JOB_TABLE = os.environ["DYNAMODB_EXPORT_JOB_TABLE"]
+EXPIRATION_IN_S = os.environ["EXPIRATION_IN_S"] # 5 minutes
+S3_BUCKET_NAME = os.environ["S3_BUCKET_NAME"]
+
+region = os.environ['AWS_REGION']
+
+dynamodb = boto3.client('dynamodb')
+s3 = boto3.client('s3', region_name=region, endpoint_url=f'https://s3.{region}.amazonaws.com')
+
+def lambda_handler(event, context):
+    job_id = event.get("job_id")
+    if job_id is None:
+        return {
+            'statusCode': 400,
+            'body': "Job id is required."
+        }
+
+    job = export_jobs.get_job(dynamodb, DYNAMO_EXPORT_JOB_TABLE, job_id)
+    if job is None:
+        return {
+            'statusCode': 400,
+            'body': "Job id doesn't exist."
+        }
+    if job["status"] != export_jobs.STATUS_COMPLETED:
+        return {
+            'statusCode': 400,
+            'body': f'The export job is not completed. Job status: {job["status"]}'
+        }
+
+    # Generate S3 presigned URLs
+    urls = []
+    for key in job["output_keys"]:
+        urls.append(s3.generate_presigned_url('get_object',
+                        Params={'Bucket': S3_BUCKET_NAME,
+                                'Key': key},
+                        ExpiresIn=EXPIRATION_IN_S))
+
+    return {
+        'statusCode': 200,
+        'body': json.dumps({"format": job["format"], "urls": urls})
+    }
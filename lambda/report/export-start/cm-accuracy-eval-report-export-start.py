@@ -0,0 +1,77 @@
+'''
+Start an export job (cm_accuracy_eval.export_jobs):
+1. Read the task item
+2. Create the job item: one segment per scan segment of the moderation result table
+3. Invoke the export worker once per segment
+Returns the job id, for the status and download APIs.
+'''
+import json
+import boto3
+import os
+from cm_accuracy_eval import export_jobs, parallel_scan, task_counters
+
+DYNAMO_TASK_TABLE = os.environ["DYNAMODB_TASK_TABLE"]
+DYNAMO_EXPORT_JOB_TABLE = os.environ["DYNAMODB_EXPORT_JOB_TABLE"]
+EXPORT_WORKER_FUNCTION_NAME = os.environ["EXPORT_WORKER_FUNCTION_NAME"]
+
+dynamodb = boto3.client('dynamodb')
+lambda_client = boto3.client('lambda')
+
+def lambda_handler(event, context):
+    id = event.get("id")
+    format = event.get("format", "csv")
+    gzip = event.get("gzip") is True
+    top_category = event.get("top_category")
+    sub_category = event.get("sub_category")
+    type = event.get("type")
+    confidence_threshold = event.get("confidence_threshold")
+
+    if id is None:
+        return {
+            'statusCode': 400,
+            'body': "Task id is required."
+        }
+    if format not in export_jobs.FORMATS:
+        return {
+            'statusCode': 400,
+            'body': "format must be csv or parquet."
+        }
+    filters = {
+        "top_category": None if top_category is None or len(top_category) == 0 else top_category,
+        "sub_category": None if sub_category is None or len(sub_category) == 0 else sub_category,
+        "type": None if type is None or len(type) == 0 else type,
+        "confidence_threshold": None if confidence_threshold is None or confidence_threshold < 50 else confidence_threshold,
+    }
+
+    # Get task item from DB table
+    d_response = dynamodb.get_item(
+        TableName=DYNAMO_TASK_TABLE,
+        Key={"id" : { "S": id}}
+    )    
+    item = d_response.get("Item")
+    print("1. Get db item: ", item)
+    if item is None:
+       return {
+            'statusCode': 400,
+            'body': "Task id doesn't exist."
+        }   
+
+    # Create the job: the processed counter estimates the items to scan, for the ETA
+    result_table = item["moderation_result_table"]["S"]
+    counters = task_counters.read(item)
+    job_item = export_jobs.new_job(id, result_table, format, gzip and format == "csv", filters,
+        parallel_scan.segment_count(dynamodb, result_table), None if counters is None else counters.get("processed"))
+    dynamodb.put_item(TableName=DYNAMO_EXPORT_JOB_TABLE, Item=job_item)
+    job_id = job_item["job_id"]["S"]
+    print("2. Create job: ", job_id, job_item["total_segments"]["N"], "segments")
+
+    # Fan out
+    for segment in range(int(job_item["total_segments"]["N"])):
+        lambda_client.invoke(FunctionName=EXPORT_WORKER_FUNCTION_NAME, InvocationType="Event",
+            Payload=json.dumps({"JobId": job_id, "Segment": segment}))
+    print("3. Start workers: ", job_item["total_segments"]["N"])
+
+    return {
+        'statusCode': 200,
+        'body': json.dumps({"job_id": job_id})
+    }
@@ -0,0 +1,32 @@
+'''
+Status of an export job (cm_accuracy_eval.export_jobs.summary): status, segments done, rows written, items scanned, rows per
+second and ETA.
+'''
+import json
+import boto3
+import os
+from cm_accuracy_eval import export_jobs
+
+DYNAMO_EXPORT_JOB_TABLE = os.environ["DYNAMODB_EXPORT_JOB_TABLE"]
+
+dynamodb = boto3.client('dynamodb')
+
+def lambda_handler(event, context):
+    job_id = event.get("job_id")
+    if job_id is None:
+        return {
+            'statusCode': 400,
+            'body': "Job id is required."
+        }
+
+    job = export_jobs.get_job(dynamodb, DYNAMO_EXPORT_JOB_TABLE, job_id)
+    if job is None:
+        return {
+            'statusCode': 400,
+            'body': "Job id doesn't exist."
+        }
+
+    return {
+        'statusCode': 200,
+        'body': json.dumps(export_jobs.summary(job))
+    }
@@ -0,0 +1,145 @@
+'''
+Export job worker (cm_accuracy_eval.export_jobs), invoked asynchronously by export-start and by itself.
+
+Segment: {"JobId", "Segment", "Chunk", "Checkpoint", "Progress"}
+1. Read the job - exit if it isn't running
+2. Scan the segment from the checkpoint and write its labels to a new shard, until the segment is read or the Lambda is about
+   to time out. Progress is saved on the job item every PROGRESS_INTERVAL_S.
+3. Segment read: mark it done, and start the finalizer if it was the last one. Otherwise continue with the next chunk in a
+   new invocation.
+
+Finalize: {"JobId", "Finalize": true, "Upload"}
+1. Read the job and the shards of every segment
+2. CSV: concatenate the shards after the header into one object. Parquet: the shards are the output files. Before the Lambda
+   times out, the upload is suspended and continued in a new invocation: Upload {"UploadId", "Shard" (next shard),
+   "Carry" (S3 key of the bytes buffered and not uploaded, or None)}.
+3. Complete the job
+'''
+import json
+import boto3
+import os
+import io
+import gzip
+import time
+from cm_accuracy_eval import data_access, export_jobs, csv_export, parquet_export
+from cm_accuracy_eval.s3_multipart import S3MultipartWriter
+
+DYNAMO_EXPORT_JOB_TABLE = os.environ["DYNAMODB_EXPORT_JOB_TABLE"]
+S3_BUCKET_NAME = os.environ["S3_BUCKET_NAME"]
+S3_REPORT_PREFIX = os.environ["S3_REPORT_PREFIX"]
+# Time kept to end the shard and hand over before the Lambda times out
+RESERVED_S = int(os.environ.get("RESERVED_S", "60"))
+
+dynamodb = boto3.client('dynamodb')
+s3 = boto3.client('s3')
+lambda_client = boto3.client('lambda')
+
+def lambda_handler(event, context):
+    job_id = event["JobId"]
+    job = export_jobs.get_job(dynamodb, DYNAMO_EXPORT_JOB_TABLE, job_id)
+    print("1. Get job: ", None if job is None else export_jobs.summary(job))
+    if job is None:
+        return False
+
+    try:
+        if event.get("Finalize"):
+            if job["status"] == export_jobs.STATUS_FINALIZING:
+                finalize(job, event, context)
+        elif job["status"] == export_jobs.STATUS_RUNNING:
+            export_segment(job, event, context)
+    except export_jobs.JobStopped:
+        print("Job stopped: ", job_id)
+    except Exception as ex:
+        # Not retried: the job is failed and the error is returned by the status API
+        print("Export failed: ", ex)
+        export_jobs.fail(dynamodb, DYNAMO_EXPORT_JOB_TABLE, job_id, f"{type(ex).__name__}: {ex}")
+    return True
+
+def export_segment(job, event, context):
+    segment = event["Segment"]
+    chunk = event.get("Chunk", 0)
+    progress = event.get("Progress") or {"rows": 0, "scanned": 0, "bytes": 0, "shards": [], "done": False}
+    deadline = time.time() + context.get_remaining_time_in_millis() / 1000 - RESERVED_S
+    parquet = job["format"] == "parquet"
+    scan = export_jobs.segment_scan(dynamodb, job, segment, event.get("Checkpoint"),
+        projection=parquet_export.PROJECTION if parquet else data_access.LABEL_PROJECTION)
+
+    counts, scanned = {"rows": 0}, [0]
+    def current():
+        return dict(progress, rows=progress["rows"] + counts["rows"], scanned=progress["scanned"] + scanned[0])
+
+    def db_items():
+        saved_ts = time.time()
+        for page in scan.pages(deadline):
+            scanned[0] += page.get("ScannedCount", 0)
+            for db_item in page.get("Items", []):
+                yield db_item
+            if time.time() - saved_ts >= export_jobs.PROGRESS_INTERVAL_S:
+                export_jobs.save_progress(dynamodb, DYNAMO_EXPORT_JOB_TABLE, job["job_id"], segment, current())
+                saved_ts = time.time()
+
+    key = export_jobs.shard_key(S3_REPORT_PREFIX, job, segment, chunk)
+    filters = [job["filters"][k] for k in export_jobs.FILTERS]
+    with S3MultipartWriter(s3, S3_BUCKET_NAME, key, gzip=job["gzip"] and not parquet) as f:
+        if parquet:
+            rows = parquet_export.write_labels(f, db_items(), *filters, counts=counts)
+        else:
+            rows = csv_export.write_labels(f, db_items(), *filters, header=False, counts=counts)
+    progress = current()
+    progress["bytes"] += f.bytes_written
+    progress["shards"].append({"key": key, "size": f.bytes_written, "rows": rows})
+    progress["done"] = scan.done()
+    export_jobs.save_progress(dynamodb, DYNAMO_EXPORT_JOB_TABLE, job["job_id"], segment, progress)
+    print(f"2. Segment {segment} chunk {chunk}: {rows} rows, {scanned[0]} items scanned, s3://{S3_BUCKET_NAME}/{key}")
+
+    if not progress["done"]:
+        invoke(context, {"JobId": job["job_id"], "Segment": segment, "Chunk": chunk + 1, "Checkpoint": scan.checkpoint(), "Progress": progress})
+        print(f"3. Continue segment {segment} with chunk {chunk + 1}")
+    elif export_jobs.complete_segment(dynamodb, DYNAMO_EXPORT_JOB_TABLE, job["job_id"], segment):
+        invoke(context, {"JobId": job["job_id"], "Finalize": True})
+        print(f"3. Segment {segment} done, last segment: finalize")
+    else:
+        print(f"3. Segment {segment} done")
+
+def finalize(job, event, context):
+    shards = [s for n in sorted(job["progress"]) for s in job["progress"][n]["shards"] if s["rows"] > 0]
+    print("2. Shards: ", len(shards))
+    if job["format"] == "parquet":
+        output_keys, output_bytes = [s["key"] for s in shards], sum([s["size"] for s in shards])
+    else:
+        deadline = time.time() + context.get_remaining_time_in_millis() / 1000 - RESERVED_S
+        upload = event.get("Upload") or {"UploadId": None, "Shard": 0, "Carry": None}
+        key = export_jobs.output_key(S3_REPORT_PREFIX, job)
+        with S3MultipartWriter.resume(s3, S3_BUCKET_NAME, key, upload["UploadId"],
+            content_type="application/gzip" if job["gzip"] else "text/csv") as f:
+            if upload["Shard"] == 0 and upload["Carry"] is None:
+                header = io.StringIO()
+                csv_export.write_labels(header, [])
+                header = header.getvalue().encode("utf-8")
+                # A gzip file can hold several members: the header is compressed on its own, the shards are members
+                f.write(gzip.compress(header) if job["gzip"] else header)
+            if upload["Carry"] is not None:
+                f.write(s3.get_object(Bucket=S3_BUCKET_NAME, Key=upload["Carry"])["Body"].read())
+            for n in range(upload["Shard"], len(shards)):
+                # At least one shard per invocation
+                if n > upload["Shard"] and time.time() >= deadline:
+                    suspend(context, job, f, n)
+                    return
+                f.append_object(S3_BUCKET_NAME, shards[n]["key"], shards[n]["size"])
+        output_keys, output_bytes = [key], f.bytes_written
+        print(f"3. Concatenated {len(shards)} shards in {f.parts} parts: s3://{S3_BUCKET_NAME}/{key}")
+    export_jobs.complete(dynamodb, DYNAMO_EXPORT_JOB_TABLE, job["job_id"], output_keys, output_bytes)
+    print("4. Job completed: ", job["job_id"], output_bytes, "bytes")
+
+def suspend(context, job, writer, shard):
+    '''Hand the concatenation over to a new invocation, from the shard. The buffered bytes are saved to a carry object.'''
+    upload_id, buffered = writer.suspend()
+    carry = None
+    if len(buffered) > 0:
+        carry = export_jobs.carry_key(S3_REPORT_PREFIX, job, shard)
+        s3.put_object(Bucket=S3_BUCKET_NAME, Key=carry, Body=buffered)
+    invoke(context, {"JobId": job["job_id"], "Finalize": True, "Upload": {"UploadId": upload_id, "Shard": shard, "Carry": carry}})
+    print(f"3. Concatenated shards up to {shard} in {writer.parts} parts, continue in a new invocation")
+
+def invoke(context, payload):
+    lambda_client.invoke(FunctionName=context.function_name, InvocationType="Event", Payload=json.dumps(payload))
@@ -1,11 +1,22 @@
 import json
 import boto3
-import math
 import os
+from cm_accuracy_eval import image_pages
+from cm_accuracy_eval.image_delivery import ImageDelivery
+from cm_accuracy_eval.presigner import S3Presigner, PresignedUrlCache
 
 DYNAMO_TASK_TABLE = os.environ["DYNAMODB_TASK_TABLE"]
 DYNAMO_INDEX_NAME = os.environ["DYNAMODB_INDEX_NAME"]
 EXPIRATION_IN_S = os.environ["EXPIRATION_IN_S"] # 5 minutes
+URL_CACHE_SIZE = int(os.environ.get("URL_CACHE_SIZE", "20000"))
+URL_CACHE_MIN_LIFETIME_S = int(os.environ.get("URL_CACHE_MIN_LIFETIME_S", "120"))
+# Signed cookie delivery through the image CloudFront distribution, when deployed (empty domain otherwise)
+IMAGE_CDN_DOMAIN = os.environ.get("IMAGE_CDN_DOMAIN", "")
+IMAGE_CDN_KEY_PAIR_ID = os.environ.get("IMAGE_CDN_KEY_PAIR_ID", "")
+IMAGE_CDN_PRIVATE_KEY_SECRET_ARN = os.environ.get("IMAGE_CDN_PRIVATE_KEY_SECRET_ARN", "")
+IMAGE_CDN_COOKIE_EXPIRATION_IN_S = int(os.environ.get("IMAGE_CDN_COOKIE_EXPIRATION_IN_S", "3600"))
+# Builds the missing thumbnails of a page asynchronously
+THUMBNAILS_FUNCTION_NAME = os.environ.get("THUMBNAILS_FUNCTION_NAME", "")
 
 region = os.environ['AWS_REGION']
 
@@ -13,7 +24,14 @@ TP_STR = "true-positive"
 FP_STR = "false-positive"
 
 dynamodb = boto3.client('dynamodb')
-s3 = boto3.client('s3', region_name=region, endpoint_url=f'https://s3.{region}.amazonaws.com')
+# SigV4 URLs for the https://s3.<region>.amazonaws.com endpoint, signed in bulk with a cached signing key.
+# Kept across warm invocations while they have URL_CACHE_MIN_LIFETIME_S left.
+presigner = S3Presigner(boto3.Session().get_credentials(), region)
+url_cache = PresignedUrlCache(presigner, URL_CACHE_SIZE, URL_CACHE_MIN_LIFETIME_S)
+secretsmanager = boto3.client('secretsmanager')
+lambda_client = boto3.client('lambda')
+image_delivery = ImageDelivery(dynamodb, lambda_client, secretsmanager, url_cache, EXPIRATION_IN_S, THUMBNAILS_FUNCTION_NAME,
+    IMAGE_CDN_DOMAIN, IMAGE_CDN_KEY_PAIR_ID, IMAGE_CDN_PRIVATE_KEY_SECRET_ARN, IMAGE_CDN_COOKIE_EXPIRATION_IN_S)
 
 def lambda_handler(event, context):
     id = event.get("id")
@@ -21,12 +39,18 @@ def lambda_handler(event, context):
     sub_category = event.get("sub_category")
     type = event.get("type")
     confidence_threshold = event.get("confidence_threshold")
+    page_size = event.get("page_size")
     
     if id is None:
         return {
             'statusCode': 400,
             'body': "Task id is required."
         }
+    if page_size is not None and (not isinstance(page_size, int) or page_size < 1 or page_size > image_pages.MAX_PAGE_SIZE):
+        return {
+            'statusCode': 400,
+            'body': f"page_size must be between 1 and {image_pages.MAX_PAGE_SIZE}."
+        }
 
     # Get task item from DB table
     d_response = dynamodb.get_item(
@@ -41,39 +65,41 @@ def lambda_handler(event, context):
             'body': "Task id doesn't exist."
         }   
     
-    from boto3.dynamodb.conditions import Key
-    dynamo_res = boto3.resource('dynamodb')
-    table = dynamo_res.Table(item["moderation_result_table"]["S"])
-    response = table.query(
-        IndexName=DYNAMO_INDEX_NAME,
-        KeyConditionExpression=Key('issue_flag').eq(0)
-    )
-    last_key = response.get("LastEvaluatedKey")
+    # One page of the unflagged images: only the file path and thumbnail are needed.
+    # Without page_size, the first page DynamoDB returns and no cursor, as before.
+    try:
+        images, cursor = image_pages.unflagged_page(dynamodb, item["moderation_result_table"]["S"], DYNAMO_INDEX_NAME,
+            page_size, image_pages.decode_cursor(event.get("cursor")))
+    except ValueError as ex:
+        return {
+            'statusCode': 400,
+            'body': str(ex)
+        }
 
     result = []
-    for db_item in response["Items"]:
-        file_path = db_item["file_path"]
-        bucket = file_path.split("/")[2]
-        key = file_path.replace(f's3://{bucket}/', '')
-        
-        # Generate S3 presigned URL
-        s3_response = s3.generate_presigned_url(
-            'get_object',
-            Params={'Bucket': bucket,
-                    'Key': key},
-            ExpiresIn=EXPIRATION_IN_S)
-            
+    for image in images:
         result.append({
-                "file_path": file_path,
-                "url": s3_response,
+                "file_path": image["file_path"],
+                "url": None,
                 "top_category": None,
                 "sub_category": None,
                 "confidence": None,
                 "type": None,
                 "review_result": None,
             })
+    # Paginated: thumbnails and sprite sheets of the page
+    if page_size is not None:
+        for r, image in zip(result, images):
+            r["thumbnail"] = image["thumbnail"]
+        image_delivery.add_thumbnails(result, item)
+    delivery = image_delivery.add_image_urls(result, item, event.get("delivery"))
     
+    body = result
+    if page_size is not None or delivery is not None:
+        body = {"items": result, "cursor": image_pages.encode_cursor(cursor)}
+        if delivery is not None:
+            body["delivery"] = delivery
     return {
             'statusCode': 200,
-            'body': json.dumps(result)
-        } 
\ No newline at end of file
+            'body': json.dumps(body)
+        }
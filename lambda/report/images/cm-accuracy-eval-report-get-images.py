@@ -1,11 +1,23 @@
 import json
 import boto3
-import math
 import os
+from cm_accuracy_eval import data_access, image_pages
+from cm_accuracy_eval.image_delivery import ImageDelivery
+from cm_accuracy_eval.presigner import S3Presigner, PresignedUrlCache
 
 DYNAMO_TASK_TABLE = os.environ["DYNAMODB_TASK_TABLE"]
 DYNAMO_INDEX_NAME = os.environ["DYNAMODB_INDEX_NAME"]
+DYNAMO_CONFIDENCE_INDEX_NAME = os.environ["DYNAMODB_CONFIDENCE_INDEX_NAME"]
 EXPIRATION_IN_S = os.environ["EXPIRATION_IN_S"] # 5 minutes
+URL_CACHE_SIZE = int(os.environ.get("URL_CACHE_SIZE", "20000"))
+URL_CACHE_MIN_LIFETIME_S = int(os.environ.get("URL_CACHE_MIN_LIFETIME_S", "120"))
+# Signed cookie delivery through the image CloudFront distribution, when deployed (empty domain otherwise)
+IMAGE_CDN_DOMAIN = os.environ.get("IMAGE_CDN_DOMAIN", "")
+IMAGE_CDN_KEY_PAIR_ID = os.environ.get("IMAGE_CDN_KEY_PAIR_ID", "")
+IMAGE_CDN_PRIVATE_KEY_SECRET_ARN = os.environ.get("IMAGE_CDN_PRIVATE_KEY_SECRET_ARN", "")
+IMAGE_CDN_COOKIE_EXPIRATION_IN_S = int(os.environ.get("IMAGE_CDN_COOKIE_EXPIRATION_IN_S", "3600"))
+# Builds the missing thumbnails of a page asynchronously
+THUMBNAILS_FUNCTION_NAME = os.environ.get("THUMBNAILS_FUNCTION_NAME", "")
 
 region = os.environ['AWS_REGION']
 
@@ -13,7 +25,14 @@ TP_STR = "true-positive"
 FP_STR = "false-positive"
 
 dynamodb = boto3.client('dynamodb')
-s3 = boto3.client('s3', region_name=region, endpoint_url=f'https://s3.{region}.amazonaws.com')
+# SigV4 URLs for the https://s3.<region>.amazonaws.com endpoint, signed in bulk with a cached signing key.
+# Kept across warm invocations while they have URL_CACHE_MIN_LIFETIME_S left.
+presigner = S3Presigner(boto3.Session().get_credentials(), region)
+url_cache = PresignedUrlCache(presigner, URL_CACHE_SIZE, URL_CACHE_MIN_LIFETIME_S)
+secretsmanager = boto3.client('secretsmanager')
+lambda_client = boto3.client('lambda')
+image_delivery = ImageDelivery(dynamodb, lambda_client, secretsmanager, url_cache, EXPIRATION_IN_S, THUMBNAILS_FUNCTION_NAME,
+    IMAGE_CDN_DOMAIN, IMAGE_CDN_KEY_PAIR_ID, IMAGE_CDN_PRIVATE_KEY_SECRET_ARN, IMAGE_CDN_COOKIE_EXPIRATION_IN_S)
 
 def lambda_handler(event, context):
     id = event.get("id")
@@ -21,12 +40,18 @@ def lambda_handler(event, context):
     sub_category = event.get("sub_category")
     type = event.get("type")
     confidence_threshold = event.get("confidence_threshold")
+    page_size = event.get("page_size")
     
     if id is None:
         return {
             'statusCode': 400,
             'body': "Task id is required."
         }
+    if page_size is not None and (not isinstance(page_size, int) or page_size < 1 or page_size > image_pages.MAX_PAGE_SIZE):
+        return {
+            'statusCode': 400,
+            'body': f"page_size must be between 1 and {image_pages.MAX_PAGE_SIZE}."
+        }
     top_category = None if top_category is None or len(top_category) == 0 else top_category
     sub_category = None if sub_category is None or len(sub_category) == 0 else sub_category
     type = None if type is None or len(type) == 0 else type
@@ -45,104 +70,39 @@ def lambda_handler(event, context):
             'body': "Task id doesn't exist."
         }   
     
-    # Get flatten items
-    flat_items = get_flat_items(item["moderation_result_table"]["S"], top_category, sub_category, type, confidence_threshold)
+    # Paginated: one page sorted by confidence descending, and the cursor of the next page
+    if page_size is not None:
+        try:
+            images, cursor = image_pages.flagged_page(dynamodb, item["moderation_result_table"]["S"], DYNAMO_CONFIDENCE_INDEX_NAME, DYNAMO_INDEX_NAME,
+                page_size, image_pages.decode_cursor(event.get("cursor")), top_category, sub_category, type, confidence_threshold)
+        except ValueError as ex:
+            return {
+                'statusCode': 400,
+                'body': str(ex)
+            }
+        print("2. Get page of images: ", len(images))
+        image_delivery.add_thumbnails(images, item)
+        body = {"items": images, "cursor": image_pages.encode_cursor(cursor)}
+        delivery = image_delivery.add_image_urls(images, item, event.get("delivery"))
+        if delivery is not None:
+            body["delivery"] = delivery
+        return {
+            'statusCode': 200,
+            'body': json.dumps(body)
+        }
+
+    # Stream flatten items
+    flat_items = data_access.flat_items(dynamodb, item["moderation_result_table"]["S"], DYNAMO_INDEX_NAME, top_category, sub_category, type, confidence_threshold)
   
-    unique, result = [], []
+    unique, result = set(), []
     for i in flat_items:
         if i["file_path"] not in unique:
-            unique.append(i["file_path"])
-            
-            bucket = i["file_path"].split("/")[2]
-            key = i["file_path"].replace(f's3://{bucket}/', '')
-            
-            # Generate S3 presigned URL
-            response = s3.generate_presigned_url('get_object',
-                                                Params={'Bucket': bucket,
-                                                        'Key': key},
-                                                ExpiresIn=EXPIRATION_IN_S)
-            i["url"] = response
+            unique.add(i["file_path"])
             result.append(i)
-        
+
+    delivery = image_delivery.add_image_urls(result, item, event.get("delivery"))
     
     return {
         'statusCode': 200,
-        'body': json.dumps(result)
+        'body': json.dumps(result if delivery is None else {"items": result, "cursor": None, "delivery": delivery})
     }
-
-def get_flat_items(result_table, top_category, sub_category, type, confidence_threshold):
-    flat_items = []
-    # Scan result table: issued images
-    d_response = dynamodb.query(
-        TableName=result_table,
-        IndexName=DYNAMO_INDEX_NAME,
-        KeyConditionExpression='issue_flag = :i',
-        ExpressionAttributeValues={
-            ':i': {'N': '1'}
-        }
-    )
-    
-    for item in d_response["Items"]:
-        flat_items = flatten_labels(item, flat_items, top_category, sub_category, type, confidence_threshold)
-
-    last_key = d_response.get("LastEvaluatedKey")
-    if last_key is not None:
-        while last_key is not None:
-            d_response = dynamodb.query(
-                TableName=result_table,
-                IndexName=DYNAMO_INDEX_NAME,
-                KeyConditionExpression='issue_flag = :i',
-                ExpressionAttributeValues={
-                    ':i': {'N': '1'}
-                },
-                ExclusiveStartKey=last_key
-            )
-            last_key = d_response.get("LastEvaluatedKey")
-            for item in d_response["Items"]:
-                flat_items = flatten_labels(item, flat_items, top_category, sub_category, type, confidence_threshold)
-    #print("////", flat_items)
-
-    return flat_items
-
-def flatten_labels(db_item, flat_items, top_category=None, sub_category=None, type=None, confidence_threshold=None):
-    if db_item is None or "rek_results" not in db_item or len(db_item["rek_results"]["L"]) == 0:
-        return flat_items
-    
-    if flat_items is None:
-        flat_items = []
-        
-    for i in db_item["rek_results"]["L"]:
-        if "M" not in i or i["M"] is None:
-            continue
-        
-        # masage data to fix the data schema mis alignment.
-        # For top category, Rek return parent_category="" and put the top category name into "category" field
-        db_top_category = i["M"]["parent_category"]["S"]
-        db_sub_category = i["M"]["category"]["S"]
-        db_confidence = 0
-        db_type = None
-        if (db_top_category is None or len(db_top_category) == 0) and (db_sub_category is not None and len(db_sub_category) > 0):
-            db_top_category = db_sub_category
-            db_sub_category = ""
-        if ("confidence" in i["M"] and i["M"]["confidence"]["N"] is not None):
-            db_confidence = float(i["M"]["confidence"]["N"])
-        if ("review_result" in i["M"] and "S" in i["M"]["review_result"] and len(i["M"]["review_result"]["S"]) > 0):
-            db_type = i["M"]["review_result"]["S"]
-        
-        if ((top_category is None or db_top_category == top_category) \
-            and (sub_category is None or db_sub_category == sub_category) \
-            and (type is None or db_type == type) \
-            and (confidence_threshold is None or db_confidence >= confidence_threshold)):
-                fi = {
-                    "file_path": db_item["file_path"]["S"],
-                    "top_category": db_top_category,
-                    "sub_category": db_sub_category,
-                    "confidence": db_confidence,
-                    "type": None
-                }
-                if i["M"]["review_result"] != {"NULL": True}:
-                    fi["type"] = i["M"]["review_result"]["S"]
-                flat_items.append(fi)
-        
-    return flat_items
-        
\ No newline at end of file
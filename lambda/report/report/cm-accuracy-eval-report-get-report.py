@@ -1,10 +1,16 @@
 import json
 import boto3
-import math
 import os
+import time
+from cm_accuracy_eval import report_cube, data_access, failure_ledger, task_counters
+from cm_accuracy_eval.report_aggregation import aggregate
 
 DYNAMO_TASK_TABLE = os.environ["DYNAMODB_TASK_TABLE"]
 DYNAMO_INDEX_NAME = os.environ["DYNAMODB_INDEX_NAME"]
+DYNAMODB_REPORT_CUBE_TABLE = os.environ["DYNAMODB_REPORT_CUBE_TABLE"]
+DYNAMODB_MODERATION_FAILURE_TABLE = os.environ.get("DYNAMODB_MODERATION_FAILURE_TABLE")
+# Time kept to save the rebuild state and respond
+REBUILD_RESERVED_S = 5
 
 TP_STR = "true-positive"
 FP_STR = "false-positive"
@@ -40,6 +46,33 @@ def lambda_handler(event, context):
             'statusCode': 400,
             'body': "Task id doesn't exist."
         }   
+
+    # Unfiltered report: served from the report cube maintained from the result table stream
+    if top_category is None and sub_category is None and type is None and confidence_threshold is None \
+        and "report_cube_mapping_uuid" in item and len(item["report_cube_mapping_uuid"].get("S", "")) > 0:
+        cube_item = dynamodb.get_item(
+            TableName=DYNAMODB_REPORT_CUBE_TABLE,
+            Key={"task_id": {"S": id}}
+        ).get("Item")
+        print("2. Get report cube: ", cube_item is not None)
+        # Rebuild the cube from the result table when "reconcile" is set. A large table is scanned over several calls: the
+        # rebuild stops before the Lambda timeout and continues in the next call, the cube is served as it is meanwhile.
+        rebuild_state = report_cube.rebuild_state(cube_item)
+        reconciling = False
+        if rebuild_state is not None or event.get("reconcile") == True:
+            deadline = time.time() + context.get_remaining_time_in_millis() / 1000 - REBUILD_RESERVED_S
+            rebuilt = report_cube.rebuild(dynamodb, DYNAMODB_REPORT_CUBE_TABLE, id, item["moderation_result_table"]["S"], rebuild_state, deadline)
+            reconciling = rebuilt is None
+            if rebuilt is not None:
+                cube_item = rebuilt
+            print("3. Rebuild report cube: ", "in progress" if reconciling else "done")
+        result = report_cube.document({} if cube_item is None else cube_item)
+        result["reconciling"] = reconciling
+        result["never_moderated"] = never_moderated(id)
+        return {
+            'statusCode': 200,
+            'body': json.dumps(result)
+        }
     
     result = {
         "processed": 0,
@@ -55,30 +88,34 @@ def lambda_handler(event, context):
         "by_sub_category_type": {},
         "by_confidence_type": {},
     }
-    # Get total processed images
-    result["processed"] = get_total_processed(item["moderation_result_table"]["S"])
+    # Get total processed images: the task counters, counted from the result table for a task created before them
+    counters = task_counters.read(item)
+    if counters is not None:
+        result["processed"] = counters["processed"]
+    else:
+        result["processed"] = data_access.count(dynamodb, item["moderation_result_table"]["S"])
     
-    # Get flatten items
-    flat_items = get_flat_items(item["moderation_result_table"]["S"], top_category, sub_category, type, confidence_threshold)
+    # Stream flatten items into the aggregation
+    flat_items = data_access.flat_items(dynamodb, item["moderation_result_table"]["S"], DYNAMO_INDEX_NAME, top_category, sub_category, type, confidence_threshold)
 
     # Aggregate metrics
-    by_top_category, by_sub_category, by_type, by_confidence, labeled, reviewed, fp, tp, by_top_category_type, by_sub_category_type, by_confidence_type \
-        = aggregate_chart_data(flat_items)
-    result["by_top_category"] = construct_list_with_count(by_top_category)
-    result["by_sub_category"] = construct_list_with_count(by_sub_category)
-    result["by_type"] = construct_list_with_count(by_type)
-    result["by_confidence"] = construct_list_with_count(by_confidence, sort_key="title")
-    result["labeled"] = len(labeled)
-    result["reviewed"] = len(reviewed)
-    result["fp"] = len(fp)
-    result["tp"] = len(tp)
+    aggregated = aggregate(flat_items)
+    result["by_top_category"] = construct_list_with_count(aggregated["by_top_category"])
+    result["by_sub_category"] = construct_list_with_count(aggregated["by_sub_category"])
+    result["by_type"] = construct_list_with_count(aggregated["by_type"])
+    result["by_confidence"] = construct_list_with_count(aggregated["by_confidence"], sort_key="title")
+    result["labeled"] = aggregated["labeled"]
+    result["reviewed"] = aggregated["reviewed"]
+    result["fp"] = aggregated["fp"]
+    result["tp"] = aggregated["tp"]
     
-    result["by_top_category_type"][FP_STR] = construct_list_with_count(by_top_category_type[FP_STR])
-    result["by_top_category_type"][TP_STR] = construct_list_with_count(by_top_category_type[TP_STR])
-    result["by_sub_category_type"][FP_STR] = construct_list_with_count(by_sub_category_type[FP_STR])
-    result["by_sub_category_type"][TP_STR] = construct_list_with_count(by_sub_category_type[TP_STR])
-    result["by_confidence_type"][FP_STR] = construct_list_with_count(by_confidence_type[FP_STR], sort_key="title")
-    result["by_confidence_type"][TP_STR] = construct_list_with_count(by_confidence_type[TP_STR], sort_key="title")
+    result["by_top_category_type"][FP_STR] = construct_list_with_count(aggregated["by_top_category_type"][FP_STR])
+    result["by_top_category_type"][TP_STR] = construct_list_with_count(aggregated["by_top_category_type"][TP_STR])
+    result["by_sub_category_type"][FP_STR] = construct_list_with_count(aggregated["by_sub_category_type"][FP_STR])
+    result["by_sub_category_type"][TP_STR] = construct_list_with_count(aggregated["by_sub_category_type"][TP_STR])
+    result["by_confidence_type"][FP_STR] = construct_list_with_count(aggregated["by_confidence_type"][FP_STR], sort_key="title")
+    result["by_confidence_type"][TP_STR] = construct_list_with_count(aggregated["by_confidence_type"][TP_STR], sort_key="title")
+    result["never_moderated"] = never_moderated(id)
     
     
     return {
@@ -86,6 +123,15 @@ def lambda_handler(event, context):
         'body': json.dumps(result)
     }
 
+def never_moderated(task_id):
+    '''Images of the failure ledger: count, retryable count, and counts by error class and error code.'''
+    summary = {"total": 0, "retryable": 0, "by_class": {}, "by_error": {}}
+    if DYNAMODB_MODERATION_FAILURE_TABLE is not None:
+        summary = failure_ledger.summary(dynamodb, DYNAMODB_MODERATION_FAILURE_TABLE, task_id)
+    summary["by_class"] = construct_list_with_count(summary["by_class"])
+    summary["by_error"] = construct_list_with_count(summary["by_error"])
+    return summary
+
 def construct_list_with_count(dict, sort_key="value", reverse=True):
     result = []
     if dict is not None:
@@ -93,179 +139,8 @@ def construct_list_with_count(dict, sort_key="value", reverse=True):
             result.append(
                 {
                     "title": key,
-                    "value": len(value) if value is not None else None
+                    "value": value
                 }
             )
 
     return sorted(result, key=lambda d: d[sort_key], reverse=reverse)
-
-# Get total images, processed, labeled
-def get_total_processed(result_table):
-    # Scan result table with pagination: Total
-    processed = 0
-    d_response = dynamodb.scan(
-        Select="COUNT",
-        TableName=result_table,
-    )
-    processed = d_response["Count"]
-    last_key = d_response.get("LastEvaluatedKey")
-    if last_key is not None:
-        while last_key is not None:
-            d_response = dynamodb.scan(
-                Select="COUNT",
-                TableName=result_table,
-                ExclusiveStartKey=last_key
-            )
-            last_key = d_response.get("LastEvaluatedKey")
-            processed += d_response["Count"]
-    return processed
-
-def aggregate_chart_data(flat_items):
-    by_top_category, by_sub_category, by_type, by_confidence = {}, {}, {}, {}
-    
-    by_top_category_type, by_sub_category_type, by_confidence_type = {FP_STR: {}, TP_STR: {}}, {FP_STR: {}, TP_STR: {}}, {FP_STR: {}, TP_STR: {}}
-    labeled, reviewed, tp, fp = [], [], [], []
-    '''
-    {
-        "Suggestive": {
-            "true-positive": 
-        }
-        FP_STR: {
-            "Suggestive": 10,
-            "Nudity": 3
-        }
-    }
-    '''
-    
-    for item in flat_items:
-        by_top_category = format_helper(item, "top_category", by_top_category)
-        by_sub_category = format_helper(item, "sub_category", by_sub_category)
-        by_type = format_helper(item, "type", by_type)
-        
-        # Round confidence score to a bucket: 10,20,30,40...100
-        confidence_bucket = str(int((math.floor(item["confidence"] / 5))*5))
-        by_confidence = format_helper(item, "confidence", by_confidence, key_name=confidence_bucket)
-        
-        # by type collections
-        by_top_category_type = by_type_helper(item, "top_category", by_top_category_type)
-        by_sub_category_type = by_type_helper(item, "sub_category", by_sub_category_type)
-        by_confidence_type = by_type_helper(item, "confidence", by_confidence_type, key_name=confidence_bucket)
-
-        # metrics
-        if item["file_path"] not in labeled:
-            labeled.append(item["file_path"])
-        if item["type"] is not None and len(item["type"]) > 0 and item["file_path"] not in reviewed:
-            reviewed.append(item["file_path"])
-        if item["type"] == FP_STR and item["file_path"] not in fp:
-            fp.append(item["file_path"])
-        elif item["type"] == TP_STR and item["file_path"] not in tp:
-            tp.append(item["file_path"])
-    
-    #print("!!!", by_top_category, by_sub_category, by_type, by_confidence)
-    return by_top_category, by_sub_category, by_type, by_confidence, labeled, reviewed, fp, tp, by_top_category_type, by_sub_category_type, by_confidence_type
-
-def by_type_helper(item, key, by_type_dict, key_name=None):
-    if key_name is None:
-        key_name = item.get(key)
-    if key_name is None or len(key_name) == 0: 
-        return by_type_dict
-        
-    file_path = item["file_path"]
-    if item["type"] == FP_STR:
-        if key_name not in by_type_dict[FP_STR].keys():
-            by_type_dict[FP_STR][key_name] = [file_path]
-        elif file_path not in by_type_dict[FP_STR][key_name]:
-            by_type_dict[FP_STR][key_name].append(file_path)
-    if item["type"] == TP_STR:
-        if key_name not in by_type_dict[TP_STR].keys():
-            by_type_dict[TP_STR][key_name] = [file_path]
-        elif file_path not in by_type_dict[TP_STR][key_name]:
-            by_type_dict[TP_STR][key_name].append(file_path)
-    
-    return by_type_dict
-
-def format_helper(item, key, by_dict, key_name=None):
-    if key_name is None:
-        key_name = item.get(key)
-    if key_name is None or len(key_name) == 0: 
-        return by_dict
-        
-    if key_name not in by_dict.keys():
-        by_dict[key_name] = [item["file_path"]]
-    elif item["file_path"] not in by_dict[key_name]:
-        by_dict[key_name].append(item["file_path"])
-    return by_dict
-
-def get_flat_items(result_table, top_category, sub_category, type, confidence_threshold):
-    flat_items = []
-    # Scan result table: issued images
-    d_response = dynamodb.query(
-        TableName=result_table,
-        IndexName=DYNAMO_INDEX_NAME,
-        KeyConditionExpression='issue_flag = :i',
-        ExpressionAttributeValues={
-            ':i': {'N': '1'}
-        }
-    )
-    
-    for item in d_response["Items"]:
-        flat_items = flatten_labels(item, flat_items, top_category, sub_category, type, confidence_threshold)
-
-    last_key = d_response.get("LastEvaluatedKey")
-    if last_key is not None:
-        while last_key is not None:
-            d_response = dynamodb.query(
-                TableName=result_table,
-                IndexName=DYNAMO_INDEX_NAME,
-                KeyConditionExpression='issue_flag = :i',
-                ExpressionAttributeValues={
-                    ':i': {'N': '1'}
-                },
-                ExclusiveStartKey=last_key
-            )
-            last_key = d_response.get("LastEvaluatedKey")
-            for item in d_response["Items"]:
-                flat_items = flatten_labels(item, flat_items, top_category, sub_category, type, confidence_threshold)
-    #print("////", flat_items)
-
-    return flat_items
-
-def flatten_labels(db_item, flat_items, top_category=None, sub_category=None, type=None, confidence_threshold=None):
-    if db_item is None or "rek_results" not in db_item or len(db_item["rek_results"]["L"]) == 0:
-        return flat_items
-    
-    if flat_items is None:
-        flat_items = []
-        
-    for i in db_item["rek_results"]["L"]:
-        if "M" not in i or i["M"] is None:
-            continue
-
-        # masage data to fix the data schema mis alignment.
-        # For top category, Rek return parent_category="" and put the top category name into "category" field
-        db_top_category = i["M"]["parent_category"]["S"]
-        db_sub_category = i["M"]["category"]["S"]
-        db_confidence = 0
-        db_type = None
-        if (db_top_category is None or len(db_top_category) == 0) and (db_sub_category is not None and len(db_sub_category) > 0):
-            db_top_category = db_sub_category
-            db_sub_category = ""
-        if ("confidence" in i["M"] and i["M"]["confidence"]["N"] is not None):
-            db_confidence = float(i["M"]["confidence"]["N"])
-        if ("review_result" in i["M"] and "S" in i["M"]["review_result"] and len(i["M"]["review_result"]["S"]) > 0):
-            db_type = i["M"]["review_result"]["S"]
-
-        if ((top_category is None or db_top_category == top_category) \
-            and (sub_category is None or db_sub_category == sub_category) \
-            and (type is None or db_type == type) \
-            and (confidence_threshold is None or db_confidence >= confidence_threshold)):
-                flat_items.append({
-                    "file_path": db_item["file_path"]["S"],
-                    "top_category": db_top_category,
-                    "sub_category": db_sub_category,
-                    "confidence": db_confidence,
-                    "type": i["M"]["review_result"].get("S")
-                })
-
-    return flat_items
-        
\ No newline at end of file
@@ -3,11 +3,13 @@ import boto3
 import uuid
 from datetime import datetime
 import os
+from cm_accuracy_eval import upload_index
 
 S3_BUCKET = os.environ["S3_BUCKET"]
 S3_KEY_PREFIX = os.environ["S3_KEY_PREFIX"]
 DYNAMO_TASK_TABLE = os.environ["DYNAMODB_TASK_TABLE"]
 DYNAMO_RESULT_TABLE_PREFIX = os.environ["DYNAMODB_RESULT_TABLE_PREFIX"]
+DYNAMO_CONFIDENCE_INDEX_NAME = os.environ["DYNAMODB_CONFIDENCE_INDEX_NAME"]
 
 JOB_STATUS = "CREATED"
 
@@ -71,6 +73,10 @@ def lambda_handler(event, context):
                 {
                     'AttributeName': 'issue_flag',
                     'AttributeType': 'N'
+                },
+                {
+                    'AttributeName': 'max_confidence',
+                    'AttributeType': 'N'
                 }
             ],
             GlobalSecondaryIndexes=[
@@ -85,19 +91,44 @@ def lambda_handler(event, context):
                     'Projection': {
                         'ProjectionType': 'ALL'
                     }
+                },
+                {
+                    # Images sorted by confidence for the paginated images API
+                    'IndexName': DYNAMO_CONFIDENCE_INDEX_NAME,
+                    'KeySchema': [
+                        {
+                            'AttributeName': 'issue_flag',
+                            'KeyType': 'HASH'  #Partition key
+                        },
+                        {
+                            'AttributeName': 'max_confidence',
+                            'KeyType': 'RANGE'  #Sort key
+                        }
+                    ],
+                    'Projection': {
+                        'ProjectionType': 'INCLUDE',
+                        'NonKeyAttributes': ['rek_results', 'thumbnail']
+                    }
                 }
             ],
             BillingMode= "PAY_PER_REQUEST",
+            # Feeds the task's report cube
+            StreamSpecification={
+                'StreamEnabled': True,
+                'StreamViewType': 'NEW_AND_OLD_IMAGES'
+            },
         )
 
         print("Created moderation table: ", task["moderation_result_table"])
     except Exception as ex:
         print("Failed to create moderation table: ", ex)
 
-    # Create task in DB table
+    # Create task in DB table, with the upload index counters kept up to date by the upload-index Lambda
+    d_item = constructDynamoItem(task)
+    d_item.update(upload_index.initial_counts())
     d_response = dynamodb.put_item(
         TableName=DYNAMO_TASK_TABLE,
-        Item=constructDynamoItem(task),
+        Item=d_item,
     )
 
     # Get item from DB table
@@ -2,12 +2,20 @@ import json
 import boto3
 import subprocess
 import os
+from cm_accuracy_eval import failure_ledger, export_jobs, thumbnails
 
 DYNAMO_TASK_TABLE = os.environ["DYNAMODB_TASK_TABLE"] 
+DYNAMODB_REPORT_CUBE_TABLE = os.environ["DYNAMODB_REPORT_CUBE_TABLE"]
+DYNAMODB_MODERATION_FAILURE_TABLE = os.environ.get("DYNAMODB_MODERATION_FAILURE_TABLE")
+S3_DERIVED_PREFIX = os.environ.get("S3_DERIVED_PREFIX")
+S3_MANIFEST_PREFIX = os.environ.get("S3_MANIFEST_PREFIX")
+S3_REPORT_PREFIX = os.environ.get("S3_REPORT_PREFIX")
+DYNAMODB_EXPORT_JOB_TABLE = os.environ.get("DYNAMODB_EXPORT_JOB_TABLE")
 
 s3 = boto3.client("s3")
 dynamodb = boto3.client('dynamodb')
 sagemaker = boto3.client('sagemaker')
+lambda_client = boto3.client('lambda')
 
 def lambda_handler(event, context):
     id = event.get("id")
@@ -37,6 +45,32 @@ def lambda_handler(event, context):
     result = subprocess.Popen(cli,shell=True,stdout=subprocess.PIPE,stderr=subprocess.STDOUT)
     output = result.communicate()[0].decode('UTF-8')
 
+    # Delete S3 folder: the normalized copies of the uploaded files (cm_accuracy_eval.normalization.derived_key)
+    if S3_DERIVED_PREFIX is not None:
+        cli = f'/opt/aws s3 rm --recursive s3://{item["s3_bucket"]["S"]}/{S3_DERIVED_PREFIX}{item["s3_bucket"]["S"]}/{item["s3_key_prefix"]["S"]}'
+        result = subprocess.Popen(cli,shell=True,stdout=subprocess.PIPE,stderr=subprocess.STDOUT)
+        output = result.communicate()[0].decode('UTF-8')
+        print("2. Delete normalized copies: ", output)
+
+    # Delete S3 folders: thumbnails and sprite sheets (cm_accuracy_eval.thumbnails), moderation manifests and dedup hashes
+    bucket = item["s3_bucket"]["S"]
+    print("2. Delete thumbnails: ", s3_rm(f'{bucket}/{thumbnails.THUMBNAIL_PREFIX}{id}/'))
+    if S3_MANIFEST_PREFIX is not None:
+        print("2. Delete manifests: ", s3_rm(f'{bucket}/{S3_MANIFEST_PREFIX}{id}/'))
+
+    # Delete the reports: export jobs (shards and outputs), the Parquet partition and the exports of the report API
+    if S3_REPORT_PREFIX is not None:
+        try:
+            if DYNAMODB_EXPORT_JOB_TABLE is not None:
+                for job_id in list(export_jobs.task_job_ids(dynamodb, DYNAMODB_EXPORT_JOB_TABLE, id)):
+                    print("2. Delete export job: ", job_id, s3_rm(f'{bucket}/{export_jobs.job_prefix(S3_REPORT_PREFIX, job_id)}'))
+                    dynamodb.delete_item(TableName=DYNAMODB_EXPORT_JOB_TABLE, Key={"job_id": {"S": job_id}})
+        except Exception as ex:
+            print("2. Failed to delete export jobs:", ex)
+        # cm_accuracy_eval.parquet_export.partition_key (pyarrow isn't in this Lambda's layers)
+        print("2. Delete Parquet partition: ", s3_rm(f'{bucket}/{S3_REPORT_PREFIX}parquet/task_id={id}/'))
+        print("2. Delete reports: ", s3_rm(f'{bucket}/{S3_REPORT_PREFIX}{id}_'))
+
     # Delete A2I Workflow and the output S3 folder
     if "a2i_workflow_arn" in item and "S" in item["a2i_workflow_arn"] and len(item["a2i_workflow_arn"]["S"]) > 0:
         arr = item["a2i_workflow_arn"]["S"].split('/')
@@ -74,9 +108,33 @@ def lambda_handler(event, context):
             print("5. No moderation result table provisioned.")
     except Exception as ex:
         print("5. Failed to delete result table:", ex)
+
+    # Delete the report cube and its stream mapping
+    try:
+        if "report_cube_mapping_uuid" in item and "S" in item["report_cube_mapping_uuid"] and len(item["report_cube_mapping_uuid"]["S"]) > 0:
+            lambda_client.delete_event_source_mapping(UUID=item["report_cube_mapping_uuid"]["S"])
+        dynamodb.delete_item(
+            TableName=DYNAMODB_REPORT_CUBE_TABLE,
+            Key={"task_id": {"S": id}}
+        )
+        print("6. Delete report cube")
+    except Exception as ex:
+        print("6. Failed to delete report cube:", ex)
+
+    # Delete the failure ledger
+    try:
+        if DYNAMODB_MODERATION_FAILURE_TABLE is not None:
+            print("7. Delete failure ledger entries: ", failure_ledger.clear(dynamodb, DYNAMODB_MODERATION_FAILURE_TABLE, id))
+    except Exception as ex:
+        print("7. Failed to delete failure ledger:", ex)
     
     
     return {
         'statusCode': 200,
         'body': f'Task {id} deleted'
     }
+
+def s3_rm(uri):
+    '''Delete the objects under an S3 prefix (bucket/prefix) with the AWS CLI layer.'''
+    result = subprocess.Popen(f'/opt/aws s3 rm --recursive "s3://{uri}"',shell=True,stdout=subprocess.PIPE,stderr=subprocess.STDOUT)
+    return result.communicate()[0].decode('UTF-8')
@@ -1,13 +1,100 @@
+'''
+Moderate images with Rekognition and save the results to the task's moderation result table.
+Two event formats are supported:
+- Single image: {"S3Bucket", "S3Key", "DynamoDBTable", "A2IWorkFlowArn"}. A failed image raises ModerationFailed.
+- Batch (Step Functions distributed Map with ItemBatcher): {"Items": [{"S3Key", "Duplicates"}], "BatchInput": {"S3Bucket", "DynamoDBTable", "A2IWorkFlowArn"}}
+  Images in a batch are moderated concurrently on a bounded thread pool sharing one set of boto3 clients.
+  The response lists succeeded and failed keys; retryable failed items are returned as "Items" so the state machine can
+  retry them. Images rejected by Rekognition (invalid image) or not readable (access) aren't retried.
+  "Duplicates" (optional, JSON list from the near-duplicate manifest) are keys collapsed into the representative S3Key:
+  the representative's result is fanned out to a result row per duplicate, marked with duplicate_of.
+  A batch attempt stops starting images MODERATION_BATCH_RESERVED_S before the Lambda timeout: the images left are failed
+  with DeadlineExceeded and retried by the next attempt, within the 5 minutes of the EXPRESS child workflow.
+- Failed batch: {"FailedBatch": {"Items", "BatchInput", "Error"}}, sent by the state machine when a batch invocation failed
+  (timeout, out of memory): its images are recorded in the failure ledger.
+Failed images are recorded in the task's failure ledger (cm_accuracy_eval.failure_ledger) with their error class and attempt
+count, and their entries are deleted when a retry moderates them ("Attempt" > 0, or "Retry" in BatchInput for the retry pass).
+Results are buffered and saved with BatchWriteItem (cm_accuracy_eval.result_writer), flushed at the end of the invocation.
+Rekognition calls draw from a token bucket shared by all concurrent workers (cm_accuracy_eval.rate_limiter). Throttled calls
+decrease the shared rate and are retried instead of dropping the image.
+Results are cached by image content hash across tasks (cm_accuracy_eval.moderation_cache). A cached result without labels is
+copied to the task's result table without calling Rekognition. Labeled images still call Rekognition: the task's A2I human
+loop can only be started by DetectModerationLabels.
+Batch workers claim each image before moderating it (cm_accuracy_eval.moderation_claims): an image whose results were
+already saved by another run of the batch is skipped without calling Rekognition, so retries don't bill it twice or start a
+second human loop. An image claimed by a running worker is failed with ClaimHeld and retried by the state machine.
+Images Rekognition can't read from S3 (WEBP, GIF, BMP, TIFF, HEIC), or larger than the size threshold, are normalized first
+when IMAGE_NORMALIZATION is on (cm_accuracy_eval.normalization): Rekognition moderates a downscaled JPEG copy under the derived
+prefix, and the result row keeps the original file_path with derived_path and normalized_bytes_saved. An original rejected by
+Rekognition for its format or size is normalized and moderated again.
+The task's processed and labeled counters (cm_accuracy_eval.task_counters) and cache hits and misses are added to the task
+item with one atomic update per invocation, for the results saved, with the normalized images and bytes saved.
+'''
 import json
 import boto3
+import copy
 import uuid
 from datetime import datetime
 import time
+import random
+import os
+from concurrent.futures import ThreadPoolExecutor
+from botocore.config import Config
+from cm_accuracy_eval.result_writer import BatchResultWriter
+from cm_accuracy_eval.rate_limiter import TokenBucket, DynamoDBBucketBackend
+from cm_accuracy_eval.moderation_cache import ModerationCache
+from cm_accuracy_eval.moderation_claims import ModerationClaims, ClaimHeld, CLAIMED, DONE
+from cm_accuracy_eval.normalization import Normalizer
+from cm_accuracy_eval import task_counters, failure_ledger, normalization
 
 MIN_CONFIDENCE = 50.0
+THREAD_POOL_SIZE = int(os.environ.get("MODERATION_THREAD_POOL_SIZE", "10"))
+BATCH_RESERVED_S = int(os.environ.get("MODERATION_BATCH_RESERVED_S", "10"))
+DYNAMO_TASK_TABLE = os.environ.get("DYNAMODB_TASK_TABLE")
+CACHE_TABLE = os.environ.get("DYNAMODB_MODERATION_CACHE_TABLE")
+CLAIM_TABLE = os.environ.get("DYNAMODB_MODERATION_CLAIM_TABLE")
+FAILURE_TABLE = os.environ.get("DYNAMODB_MODERATION_FAILURE_TABLE")
+CLAIM_LEASE_S = int(os.environ.get("MODERATION_CLAIM_LEASE_S", "360"))
+CACHE_HASH_MODE = os.environ.get("MODERATION_CACHE_HASH_MODE", "etag")
+IMAGE_NORMALIZATION = os.environ.get("IMAGE_NORMALIZATION", "false") == "true"
+S3_BUCKET_NAME = os.environ.get("S3_BUCKET_NAME")
+S3_DERIVED_PREFIX = os.environ.get("S3_DERIVED_PREFIX", normalization.DERIVED_PREFIX)
+NORMALIZATION_SIZE_THRESHOLD_BYTES = int(os.environ.get("NORMALIZATION_SIZE_THRESHOLD_BYTES", str(normalization.SIZE_THRESHOLD_BYTES)))
+NORMALIZATION_MAX_DIMENSION = int(os.environ.get("NORMALIZATION_MAX_DIMENSION", str(normalization.MAX_DIMENSION)))
+NORMALIZATION_MAX_SOURCE_BYTES = int(os.environ.get("NORMALIZATION_MAX_SOURCE_BYTES", str(normalization.MAX_SOURCE_BYTES)))
+NORMALIZATION_CONCURRENCY = int(os.environ.get("NORMALIZATION_CONCURRENCY", "2"))
+RATE_LIMIT_TABLE = os.environ.get("DYNAMODB_RATE_LIMIT_TABLE")
+REKOGNITION_TPS_INITIAL = float(os.environ.get("REKOGNITION_TPS_INITIAL", "20"))
+REKOGNITION_TPS_MAX = float(os.environ.get("REKOGNITION_TPS_MAX", "50"))
+REKOGNITION_THROTTLE_MAX_RETRIES = int(os.environ.get("REKOGNITION_THROTTLE_MAX_RETRIES", "10"))
+# Attempts of a call failing with other transient errors (server errors, timeouts), as the SDK standard retry mode
+REKOGNITION_MAX_ATTEMPTS = 3
+THROTTLING_ERROR_CODES = ["ThrottlingException", "ProvisionedThroughputExceededException", "LimitExceededException"]
 
-rekognition = boto3.client('rekognition')
-dynamodb = boto3.client('dynamodb')
+# boto3 clients are thread safe. Size the connection pool to the thread pool so workers don't queue on connections.
+client_config = Config(max_pool_connections=THREAD_POOL_SIZE)
+# Standard SDK retries on Rekognition, but with the shared rate limiter: throttling must reach it, and detect_moderation_labels
+# retries the other transient errors itself.
+rekognition = boto3.client('rekognition', config=client_config.merge(Config(retries={
+    'mode': 'standard',
+    'max_attempts': 1 if RATE_LIMIT_TABLE is not None else REKOGNITION_MAX_ATTEMPTS
+})))
+dynamodb = boto3.client('dynamodb', config=client_config)
+s3 = boto3.client('s3', config=client_config)
+
+rate_limiter = None
+if RATE_LIMIT_TABLE is not None:
+    rate_limiter = TokenBucket(
+        DynamoDBBucketBackend(dynamodb, RATE_LIMIT_TABLE, "rekognition:DetectModerationLabels"),
+        initial_rate=REKOGNITION_TPS_INITIAL,
+        max_rate=REKOGNITION_TPS_MAX
+    )
+
+class ModerationFailed(Exception):
+    '''The image couldn't be moderated, or its result couldn't be saved.'''
+
+class DeadlineExceeded(Exception):
+    '''The batch attempt ran out of time before the image was started.'''
 
 def lambda_handler(event, context):
     if event is None:
@@ -15,42 +102,278 @@ def lambda_handler(event, context):
         'statusCode': 400,
         'body': 'Missing parameters'
     }
-    
+
+    if "FailedBatch" in event:
+        return record_failed_batch(event["FailedBatch"])
+    if "Items" in event:
+        deadline = None if context is None else time.time() + context.get_remaining_time_in_millis() / 1000 - BATCH_RESERVED_S
+        return moderate_batch(event["Items"], event.get("BatchInput", {}), event.get("Attempt", 0), deadline)
+
     bucket_name = event["S3Bucket"]
     s3_key = event["S3Key"]
 
     dyanmodb_table = event["DynamoDBTable"]
     a2i_workflow_arn = event["A2IWorkFlowArn"]
-    
 
-    # Call Rekognition image moderation
-    human_loop_name = f"rek-default-loop-{str(uuid.uuid4())}"
-    
+    writer = BatchResultWriter(dynamodb, dyanmodb_table)
+    cache = create_cache()
+    normalizer = create_normalizer(bucket_name)
+    try:
+        labels_count = moderate_image(bucket_name, s3_key, writer, a2i_workflow_arn, cache, normalizer=normalizer)
+        writer.flush()
+        if cache is not None:
+            cache.flush()
+    except Exception as ex:
+        record_failures(event.get("TaskId"), bucket_name, [{"S3Key": s3_key, "Error": failure_ledger.error_code(ex), "Message": str(ex)}])
+        raise ModerationFailed(f"Moderation failed s3://{bucket_name}/{s3_key}: {ex}")
+    if len(writer.failed_items) > 0:
+        record_failures(event.get("TaskId"), bucket_name, [{"S3Key": s3_key, "Error": "UnprocessedItems", "Message": "Result not saved"}])
+        raise ModerationFailed(f"Moderation result not saved s3://{bucket_name}/{s3_key}")
+    update_task_counters(event.get("TaskId"), {"processed": 1, "labeled": 1 if labels_count > 0 else 0}, cache, normalizer)
+
+    msg = 'No invalid information detected.'
+    if labels_count > 0:
+        msg = f'{labels_count} labels detected.'
+
+    return msg
+
+def moderate_batch(items, batch_input, attempt, deadline=None):
+    bucket_name = batch_input["S3Bucket"]
+    dyanmodb_table = batch_input["DynamoDBTable"]
+    a2i_workflow_arn = batch_input["A2IWorkFlowArn"]
+
+    start_ts = time.time()
+    s3_keys = [i["S3Key"] for i in items]
+    items_by_key = {i["S3Key"]: i for i in items}
+    succeeded, failed = [], []
+    labels_counts = {}
+    writer = BatchResultWriter(dynamodb, dyanmodb_table)
+    cache = create_cache()
+    normalizer = create_normalizer(bucket_name)
+    claims = create_claims(batch_input.get("TaskId"))
+    claimed = set()
+
+    def moderate(s3_key):
+        if deadline is not None and time.time() >= deadline:
+            raise DeadlineExceeded(s3_key)
+        if claims is not None:
+            state = claims.claim(f"s3://{bucket_name}/{s3_key}")
+            if state == DONE:
+                return None
+            if state != CLAIMED:
+                raise ClaimHeld(s3_key)
+            claimed.add(s3_key)
+        return moderate_image(bucket_name, s3_key, writer, a2i_workflow_arn, cache, get_duplicates(items_by_key[s3_key]), normalizer)
+
+    with ThreadPoolExecutor(max_workers=min(THREAD_POOL_SIZE, max(len(s3_keys), 1))) as executor:
+        futures = [(k, executor.submit(moderate, k)) for k in s3_keys]
+        for s3_key, future in futures:
+            try:
+                labels_counts[s3_key] = future.result()
+                succeeded.append(s3_key)
+            except Exception as ex:
+                print(f"Moderation failed: s3://{bucket_name}/{s3_key}", ex)
+                failed.append({"S3Key": s3_key, "Error": failure_ledger.error_code(ex), "Message": str(ex)})
+
+    # Flush buffered results. Keys whose results (or duplicates' results) couldn't be saved are failed too.
+    unsaved = set([i["file_path"]["S"] for i in writer.flush()])
+    if len(unsaved) > 0:
+        def is_unsaved(k):
+            return any([f"s3://{bucket_name}/{p}" in unsaved for p in [k] + get_duplicates(items_by_key[k])])
+        failed.extend([{"S3Key": k, "Error": "UnprocessedItems", "Message": "Result not saved"} for k in succeeded if is_unsaved(k)])
+        succeeded = [k for k in succeeded if not is_unsaved(k)]
+
+    if cache is not None:
+        cache.flush()
+
+    # Close the claims: DONE once the results are saved, released for the retries
+    if claims is not None:
+        claims.complete([f"s3://{bucket_name}/{k}" for k in succeeded if k in claimed])
+        claims.release([f"s3://{bucket_name}/{f['S3Key']}" for f in failed if f["S3Key"] in claimed])
+        print(f"Moderation claims: {len(claimed)} claimed, {claims.skipped} already moderated")
+
+    # Failure ledger: record the failed attempts, resolve the images moderated by a retry
+    task_id = batch_input.get("TaskId")
+    for f in failed:
+        f["ErrorClass"] = failure_ledger.classify(f["Error"])
+    record_failures(task_id, bucket_name, failed, items_by_key)
+    if (attempt > 0 or batch_input.get("Retry") == True) and len(succeeded) > 0:
+        resolve_failures(task_id, [failure_ledger.file_path(bucket_name, k) for k in succeeded])
+    retry = [f for f in failed if failure_ledger.is_retryable(f["Error"])]
+
+    # Count the saved result rows: the representative and its duplicates. Images already moderated were counted then.
+    counters = {"processed": 0, "labeled": 0}
+    for k in [k for k in succeeded if labels_counts[k] is not None]:
+        rows = 1 + len(get_duplicates(items_by_key[k]))
+        counters["processed"] += rows
+        if labels_counts[k] > 0:
+            counters["labeled"] += rows
+    update_task_counters(batch_input.get("TaskId"), counters, cache, normalizer)
+
+    duration = time.time() - start_ts
+    if rate_limiter is not None:
+        print(f"Rate limiter: {rate_limiter.throttled} throttled calls, {round(rate_limiter.waited_s, 2)}s waited")
+    print(f"Saved {writer.written} results with {writer.requests} BatchWriteItem requests")
+    print(f"Moderated batch: {len(succeeded)} succeeded, {len(failed)} failed in {round(duration, 2)}s. {round(len(s3_keys) / duration, 2) if duration > 0 else 0} images/s")
+
+    # FailedCount drives the retry loop of the state machine: the retryable failures only
+    return {
+        "BatchInput": batch_input,
+        "Items": [items_by_key[f["S3Key"]] for f in retry],
+        "Attempt": attempt + 1,
+        "Succeeded": succeeded,
+        "Failed": [{"S3Key": f["S3Key"], "Error": f["Error"], "ErrorClass": f["ErrorClass"]} for f in failed],
+        "FailedCount": len(retry)
+    }
+
+def record_failed_batch(failed_batch):
+    '''Record the images of a batch whose invocation failed, with the Step Functions error.'''
+    batch_input = failed_batch.get("BatchInput", {})
+    error = failed_batch.get("Error", {})
+    failures = [{"S3Key": i["S3Key"], "Error": error.get("Error", "States.TaskFailed"), "Message": error.get("Cause", "")} for i in failed_batch.get("Items", [])]
+    items_by_key = {i["S3Key"]: i for i in failed_batch.get("Items", [])}
+    record_failures(batch_input.get("TaskId"), batch_input.get("S3Bucket"), failures, items_by_key)
+    print(f"Recorded failed batch: {len(failures)} images, error {error.get('Error')}")
+    return {"FailedCount": len(failures)}
+
+def record_failures(task_id, bucket_name, failures, items_by_key=None):
+    if task_id is None or FAILURE_TABLE is None:
+        return
+    for f in failures:
+        duplicates = get_duplicates(items_by_key[f["S3Key"]]) if items_by_key is not None else []
+        try:
+            failure_ledger.record(dynamodb, FAILURE_TABLE, task_id, bucket_name, f["S3Key"], f["Error"], f.get("Message", ""), duplicates)
+        except Exception as ex:
+            print(f"Failed to record the failure of s3://{bucket_name}/{f['S3Key']}: ", ex)
+
+def resolve_failures(task_id, file_paths):
+    if task_id is None or FAILURE_TABLE is None:
+        return
+    try:
+        failure_ledger.resolve(dynamodb, FAILURE_TABLE, task_id, file_paths)
+    except Exception as ex:
+        # The entries stay in the ledger: retried by the retry pass, or cleared by a resume
+        print("Failed to resolve failure ledger entries: ", ex)
+
+def get_duplicates(item):
+    duplicates = item.get("Duplicates")
+    if duplicates is None or len(duplicates) == 0:
+        return []
+    return json.loads(duplicates) if isinstance(duplicates, str) else duplicates
+
+def create_cache():
+    if CACHE_TABLE is None:
+        return None
+    return ModerationCache(dynamodb, s3, CACHE_TABLE, MIN_CONFIDENCE, hash_mode=CACHE_HASH_MODE)
+
+def create_claims(task_id):
+    if CLAIM_TABLE is None or task_id is None:
+        return None
+    return ModerationClaims(dynamodb, CLAIM_TABLE, task_id, CLAIM_LEASE_S)
+
+def create_normalizer(bucket_name):
+    if not IMAGE_NORMALIZATION:
+        return None
+    # Copies are written to the task bucket: the bucket of the images, unless they are listed by an input manifest
+    return Normalizer(s3, S3_BUCKET_NAME or bucket_name, S3_DERIVED_PREFIX, NORMALIZATION_SIZE_THRESHOLD_BYTES,
+        NORMALIZATION_MAX_DIMENSION, NORMALIZATION_MAX_SOURCE_BYTES, NORMALIZATION_CONCURRENCY)
+
+def update_task_counters(task_id, counters, cache=None, normalizer=None):
+    if task_id is None or DYNAMO_TASK_TABLE is None:
+        return
+    counters = dict(counters)
+    if cache is not None:
+        counters["cache_hits"] = cache.hits
+        counters["cache_misses"] = cache.misses
+        print(f"Moderation cache: {cache.hits} hits, {cache.misses} misses")
+    if normalizer is not None:
+        counters["normalized"] = normalizer.normalized
+        counters["normalized_bytes_saved"] = normalizer.bytes_saved
+        print(f"Normalization: {normalizer.normalized} images, {normalizer.bytes_saved} bytes saved")
+    try:
+        task_counters.add(dynamodb, DYNAMO_TASK_TABLE, task_id, counters)
+    except Exception as ex:
+        # The results are saved: a missed update is fixed by reconciling the counters
+        print("Failed to update the task counters:", ex)
+
+def moderate_image(bucket_name, s3_key, writer, a2i_workflow_arn, cache=None, duplicates=None, normalizer=None):
     start_ts = datetime.now()
     img_start_ts = time.time()
 
-    try:
-     rek_response = rekognition.detect_moderation_labels(
-         Image={
+    # Reuse a cached result when no human review is needed
+    content_hash, cached = None, None
+    if cache is not None:
+        content_hash = cache.content_hash(bucket_name, s3_key)
+        cached = cache.get(content_hash)
+    cache_hit = cached is not None and cached["rek_results"] is None
+    derived = None
+    if cache_hit:
+        rek_response = {"ModerationLabels": [], "ModerationModelVersion": cached["rek_moderation_model_version"]["S"]}
+    elif normalizer is None:
+        rek_response = call_rekognition(bucket_name, s3_key, a2i_workflow_arn)
+    else:
+        rek_response, derived = call_rekognition_normalized(bucket_name, s3_key, a2i_workflow_arn, normalizer)
+
+    # Construct result
+    db_item = build_result_item(bucket_name, s3_key, rek_response, start_ts, img_start_ts)
+    if derived is not None:
+        db_item["derived_path"] = {"S": f's3://{derived["Bucket"]}/{derived["Key"]}'}
+        db_item["normalized_bytes_saved"] = {"N": str(max(0, derived["SourceBytes"] - derived["DerivedBytes"]))}
+
+    # Fan out to near-duplicates. The representative keeps the list so human reviews can be fanned out too.
+    if duplicates:
+        db_item["duplicates"] = {"L": [{"S": f"s3://{bucket_name}/{d}"} for d in duplicates]}
+        for d in duplicates:
+            dup_item = copy.deepcopy(db_item)
+            del dup_item["duplicates"]
+            dup_item["file_path"] = {"S": f"s3://{bucket_name}/{d}"}
+            dup_item["duplicate_of"] = {"S": f"s3://{bucket_name}/{s3_key}"}
+            writer.put(dup_item)
+
+    if cache is not None:
+        cache.record(cache_hit)
+        if not cache_hit:
+            cache.put(content_hash, db_item)
+
+    # Buffer result: saved to DynamoDB in batches
+    writer.put(db_item)
+
+    return len(rek_response["ModerationLabels"])
+
+def call_rekognition(bucket_name, s3_key, a2i_workflow_arn):
+    # Call Rekognition image moderation
+    human_loop_name = f"rek-default-loop-{str(uuid.uuid4())}"
+
+    return detect_moderation_labels(
+        Image={
             'S3Object': {
                 'Bucket': bucket_name,
                 'Name': s3_key,
             }
-         },
-         HumanLoopConfig={
+        },
+        HumanLoopConfig={
             "FlowDefinitionArn":a2i_workflow_arn,
             "HumanLoopName": human_loop_name,
             "DataAttributes":{"ContentClassifiers":["FreeOfPersonallyIdentifiableInformation"]}
-         },
-         MinConfidence = MIN_CONFIDENCE
-     )
+        },
+        MinConfidence = MIN_CONFIDENCE
+    )
+
+def call_rekognition_normalized(bucket_name, s3_key, a2i_workflow_arn, normalizer):
+    '''Moderate the normalized copy of an image when it needs one. Returns (Rekognition response, derived copy or None).'''
+    derived = normalizer.prepare(bucket_name, s3_key)
+    if derived is not None:
+        return call_rekognition(derived["Bucket"], derived["Key"], a2i_workflow_arn), derived
+    try:
+        return call_rekognition(bucket_name, s3_key, a2i_workflow_arn), None
     except Exception as ex:
-      return {
-         'statusCode': 500,
-         'body': 'Moderation failed ' + s3_key
-     }    
-     
-    # Construct result
+        if failure_ledger.error_code(ex) not in normalization.REKOGNITION_ERROR_CODES:
+            raise
+        print(f"Rekognition rejected s3://{bucket_name}/{s3_key}, normalized: ", ex)
+    derived = normalizer.normalize(bucket_name, s3_key)
+    return call_rekognition(derived["Bucket"], derived["Key"], a2i_workflow_arn), derived
+
+def build_result_item(bucket_name, s3_key, rek_response, start_ts, img_start_ts):
     db_item = {
      "file_path": {
       "S": f"s3://{bucket_name}/{s3_key}"
@@ -72,13 +395,16 @@ def lambda_handler(event, context):
      },
      "fn_flag": {
       "N": "0"
-     },     
+     },
      "moderation_duration_ms": {
       "N": str(time.time() - img_start_ts)
      },
      "moderation_min_confidence": {
       "N": str(MIN_CONFIDENCE)
      },
+     "max_confidence": {
+      "N": "0"
+     },
      "moderation_start_ts": {
       "S": start_ts.strftime('%Y/%m/%d %H:%M:%S UTC')
      },
@@ -86,9 +412,11 @@ def lambda_handler(event, context):
       "S": rek_response["ModerationModelVersion"]
      }
     }
-    
+
     db_item["issue_flag"]["N"] = "1" if len(rek_response["ModerationLabels"]) > 0 else "0"
     if len(rek_response["ModerationLabels"]) > 0:
+     # Sort key of the confidence index
+     db_item["max_confidence"]["N"] = str(max([l["Confidence"] for l in rek_response["ModerationLabels"]]))
      db_item["rek_results"] = {"L":[]}
      for l in rek_response["ModerationLabels"]:
          db_item["rek_results"]["L"].append(
@@ -109,16 +437,27 @@ def lambda_handler(event, context):
                          }
                      }
              )
-    print(dyanmodb_table, db_item)
+    return db_item
 
-    # Save result to DynamoDB
-    db_response = dynamodb.put_item(
-        TableName = dyanmodb_table,
-        Item = db_item
-    )
-    
-    msg = 'No invalid information detected.'
-    if len(rek_response["ModerationLabels"]) > 0:
-     msg = f'{len(rek_response["ModerationLabels"])} labels detected.'
-    
-    return msg
\ No newline at end of file
+def detect_moderation_labels(**kwargs):
+    if rate_limiter is None:
+        return rekognition.detect_moderation_labels(**kwargs)
+
+    throttles, errors = 0, 0
+    while True:
+        rate_limiter.acquire()
+        try:
+            response = rekognition.detect_moderation_labels(**kwargs)
+            rate_limiter.on_success()
+            return response
+        except Exception as ex:
+            code = failure_ledger.error_code(ex)
+            if code in THROTTLING_ERROR_CODES and throttles < REKOGNITION_THROTTLE_MAX_RETRIES:
+                throttles += 1
+                rate_limiter.on_throttle()
+            elif failure_ledger.classify(code) == failure_ledger.TRANSIENT and errors < REKOGNITION_MAX_ATTEMPTS - 1:
+                # Full jitter backoff, as the SDK standard retry mode
+                errors += 1
+                time.sleep(random.uniform(0, min(20, 2 ** errors)))
+            else:
+                raise
\ No newline at end of file
@@ -0,0 +1,276 @@
+'''
+Prepare the moderation manifest for a task: a CSV file read by the Step Functions distributed Map.
+Columns: Key, Duplicates (JSON list of S3 keys moderated through the representative image in Key)
+
+The images are the accepted objects of the upload index (UseIndex=true, cm_accuracy_eval.upload_index), or the objects listed
+under the task's input prefix for the tasks created before the index.
+
+Input manifest (InputManifest={"Format", "Bucket", "Key"}, cm_accuracy_eval.input_manifest): the images listed by a CSV, JSONL
+or S3 Inventory manifest, wherever they are stored. The manifest is read as a stream, validated and deduplicated, and the
+accepted keys are written to the moderation manifest with a multipart upload. The counts are saved to the task item. An
+invalid manifest is saved to the task item ("manifest_error") and fails the execution before any image is moderated.
+
+Resume (Resume=true, cm_accuracy_eval.resume): the images with a row in the task's result table (DynamoDBTable) are left out
+of the manifest, so a failed or aborted run continues with the images it didn't moderate. The counts are saved to the task
+item ("resume_stats"). The failure ledger of the task is cleared: the images still failing are recorded again.
+
+Retry pass (RetryFailures=true, Round): the retryable entries of the task's failure ledger (cm_accuracy_eval.failure_ledger),
+written to a retry manifest with their near-duplicates. The response has the next Round and the backoff to wait before
+moderating them (WaitSeconds, doubled each round).
+
+Near-duplicate collapsing (Dedup=true, the default):
+1. List the images
+2. Compute a perceptual hash for each image on a bounded thread pool. The hashes are saved next to the manifest and reused by
+   a later run of the task (resume, retried execution): only the images without one are read. The images not hashed before
+   the Lambda timeout are moderated on their own.
+3. Group near-duplicates with a BK-tree: one representative per cluster
+4. Write the manifest with one row per representative, listing the cluster members
+5. Save dedup stats to the task item
+Without it (Dedup=false), the manifest lists every image (steps 1 and 4).
+The files of a listing with an unsupported extension are left out: they would never get a result row.
+'''
+import json
+import boto3
+import os
+import csv
+import io
+import time
+from concurrent.futures import ThreadPoolExecutor
+from botocore.config import Config
+from cm_accuracy_eval.phash import phash, cluster
+from cm_accuracy_eval import upload_index, input_manifest, resume, failure_ledger, normalization
+from cm_accuracy_eval.s3_multipart import S3MultipartWriter
+
+DYNAMO_TASK_TABLE = os.environ["DYNAMODB_TASK_TABLE"]
+DYNAMO_UPLOAD_INDEX_TABLE = os.environ["DYNAMODB_UPLOAD_INDEX_TABLE"]
+S3_MANIFEST_PREFIX = os.environ["S3_MANIFEST_PREFIX"]
+SUPPORTED_FILE_TYPES = os.environ["SUPPORTED_FILE_TYPES"].split(',')
+MAX_IMAGE_BYTES = int(os.environ.get("MAX_IMAGE_BYTES", str(upload_index.MAX_IMAGE_BYTES)))
+THREAD_POOL_SIZE = int(os.environ.get("THREAD_POOL_SIZE", "16"))
+DEDUP_MAX_DISTANCE = int(os.environ.get("DEDUP_MAX_DISTANCE", "6"))
+DYNAMO_FAILURE_TABLE = os.environ.get("DYNAMODB_MODERATION_FAILURE_TABLE")
+RETRY_WAIT_S = int(os.environ.get("MODERATION_RETRY_WAIT_S", "30"))
+# Time kept to save the hashes, cluster them and write the manifest before the Lambda timeout
+HASH_RESERVED_S = 90
+
+client_config = Config(max_pool_connections=THREAD_POOL_SIZE)
+s3 = boto3.client('s3', config=client_config)
+dynamodb = boto3.client('dynamodb')
+# HEIC/HEIF images are hashed too when the plugin is installed
+normalization.register_heif()
+
+def lambda_handler(event, context):
+    task_id = event["TaskId"]
+    bucket = event["S3Bucket"]
+    prefix = event["S3Prefix"]
+    max_distance = int(event.get("DedupMaxDistance", DEDUP_MAX_DISTANCE))
+    dedup = event.get("Dedup", True) == True
+    manifest_key = f'{S3_MANIFEST_PREFIX}{task_id}/moderation-manifest.csv'
+    hashes_key = f'{S3_MANIFEST_PREFIX}{task_id}/dedup-hashes.json'
+    if event.get("RetryFailures") == True:
+        return prepare_retry_manifest(task_id, bucket, int(event.get("Round", 0)))
+    moderated = None
+    if event.get("Resume") == True:
+        start_ts = time.time()
+        moderated = resume.moderated(dynamodb, event["DynamoDBTable"])
+        print(f"0. Resume: {len(moderated)} result rows read in {round(time.time() - start_ts, 2)}s")
+        if DYNAMO_FAILURE_TABLE is not None:
+            print("0. Cleared the failure ledger: ", failure_ledger.clear(dynamodb, DYNAMO_FAILURE_TABLE, task_id))
+    if event.get("InputManifest") is not None:
+        return prepare_input_manifest(task_id, bucket, manifest_key, event["InputManifest"], moderated)
+
+    # List images
+    if event.get("UseIndex") == True:
+        keys = list(upload_index.accepted_keys(dynamodb, DYNAMO_UPLOAD_INDEX_TABLE, task_id))
+        print(f"1. Read the upload index of task {task_id}: {len(keys)} images")
+    else:
+        keys = list_keys(bucket, prefix)
+        print(f"1. List s3://{bucket}/{prefix}: {len(keys)} objects")
+    # Unsupported files of a listing never get a result row: left out instead of failing on every resume
+    keys = [k for k in keys if os.path.splitext(k)[1].lower() in SUPPORTED_FILE_TYPES]
+    if moderated is not None and not dedup:
+        resume_stats = {}
+        keys = resume.remaining(keys, bucket, moderated, resume_stats)
+        save_resume_stats(task_id, resume_stats)
+
+    if dedup:
+        # Perceptual hashes, the ones of a previous run reused
+        start_ts = time.time()
+        deadline = start_ts + context.get_remaining_time_in_millis() / 1000 - HASH_RESERVED_S
+        saved = load_hashes(bucket, hashes_key)
+        hashes, unhashed = compute_hashes(bucket, keys, saved, deadline)
+        if len(hashes) > len(saved):
+            save_hashes(bucket, hashes_key, hashes)
+        print(f"2. Computed {len(hashes)} perceptual hashes ({len(saved)} saved) in {round(time.time() - start_ts, 2)}s. Not hashed: {len(unhashed)}")
+
+        # Cluster near-duplicates
+        clusters = cluster(hashes, max_distance)
+        for k in unhashed:
+            clusters[k] = []
+        print(f"3. Clustered {len(keys)} images into {len(clusters)} representatives")
+        if moderated is not None:
+            # Clusters are skipped whole: the rows of the duplicates were written with the representative's
+            resume_stats = {}
+            remaining = set(resume.remaining(list(clusters.keys()), bucket, moderated, resume_stats))
+            clusters = {k: members for k, members in clusters.items() if k in remaining}
+            save_resume_stats(task_id, resume_stats)
+    else:
+        clusters = {k: [] for k in keys}
+
+    # Write manifest
+    write_manifest(bucket, manifest_key, clusters)
+    print(f"4. Wrote manifest: s3://{bucket}/{manifest_key}")
+
+    # Save dedup stats
+    if dedup:
+        dedup_ratio = 0 if len(keys) == 0 else 1 - len(clusters) / len(keys)
+        dynamodb.update_item(
+            TableName=DYNAMO_TASK_TABLE,
+            Key={"id": {"S": task_id}},
+            UpdateExpression="SET dedup_total = :t, dedup_representatives = :r, dedup_ratio = :d",
+            ExpressionAttributeValues={
+                ":t": {"N": str(len(keys))},
+                ":r": {"N": str(len(clusters))},
+                ":d": {"N": str(round(dedup_ratio, 4))},
+            }
+        )
+        print(f"5. Dedup ratio: {round(dedup_ratio, 4)}")
+
+    return {
+        "Bucket": bucket,
+        "Key": manifest_key,
+        "ImageBucket": bucket,
+        "Total": len(keys),
+        "Representatives": len(clusters)
+    }
+
+def prepare_input_manifest(task_id, bucket, manifest_key, source, moderated=None):
+    stats, resume_stats = {}, {}
+    try:
+        rows = input_manifest.entries(s3, source)
+        with S3MultipartWriter(s3, bucket, manifest_key, content_type="text/csv") as f:
+            writer = csv.writer(f)
+            writer.writerow(["Key", "Duplicates"])
+            for key in input_manifest.normalize(rows, SUPPORTED_FILE_TYPES, MAX_IMAGE_BYTES, stats):
+                # The bucket is set by the first accepted row
+                if moderated is None or resume.pending(stats["bucket"], key, moderated, resume_stats):
+                    writer.writerow([key, "[]"])
+        print(f'1. Read the input manifest s3://{source["Bucket"]}/{source["Key"]}: ', stats)
+        if stats["accepted"] == 0:
+            raise input_manifest.ManifestError(f'No valid image in the manifest s3://{source["Bucket"]}/{source["Key"]}: {json.dumps(stats)}')
+    except input_manifest.ManifestError as ex:
+        print("Invalid input manifest: ", ex)
+        dynamodb.update_item(
+            TableName=DYNAMO_TASK_TABLE,
+            Key={"id": {"S": task_id}},
+            UpdateExpression="SET manifest_error = :e",
+            ExpressionAttributeValues={":e": {"S": str(ex)[:1000]}}
+        )
+        raise
+    print(f"2. Wrote manifest: s3://{bucket}/{manifest_key}")
+
+    # Save the counts: the total is known once the manifest is read
+    dynamodb.update_item(
+        TableName=DYNAMO_TASK_TABLE,
+        Key={"id": {"S": task_id}},
+        UpdateExpression="SET total_files = :t, manifest_stats = :s",
+        ExpressionAttributeValues={
+            ":t": {"S": str(stats["accepted"])},
+            ":s": {"S": json.dumps(stats)},
+        }
+    )
+    print("3. Saved manifest counts: ", stats["accepted"])
+    if moderated is not None:
+        save_resume_stats(task_id, resume_stats)
+
+    return {
+        "Bucket": bucket,
+        "Key": manifest_key,
+        "ImageBucket": stats["bucket"],
+        "Total": stats["accepted"],
+    }
+
+def prepare_retry_manifest(task_id, bucket, round):
+    manifest_key = f'{S3_MANIFEST_PREFIX}{task_id}/retry-manifest-{round}.csv'
+    image_bucket, total = bucket, 0
+    with S3MultipartWriter(s3, bucket, manifest_key, content_type="text/csv") as f:
+        writer = csv.writer(f)
+        writer.writerow(["Key", "Duplicates"])
+        entries = [] if DYNAMO_FAILURE_TABLE is None else failure_ledger.entries(dynamodb, DYNAMO_FAILURE_TABLE, task_id, retryable_only=True)
+        for entry in entries:
+            # The images of a task are in one bucket
+            image_bucket = entry["bucket"]["S"]
+            duplicates = [d["S"] for d in entry.get("duplicates", {}).get("L", [])]
+            writer.writerow([entry["s3_key"]["S"], json.dumps(duplicates)])
+            total += 1
+    print(f"1. Retry round {round}: {total} images, s3://{bucket}/{manifest_key}")
+    return {
+        "Bucket": bucket,
+        "Key": manifest_key,
+        "ImageBucket": image_bucket,
+        "Total": total,
+        "Round": round + 1,
+        "WaitSeconds": RETRY_WAIT_S * (2 ** round)
+    }
+
+def save_resume_stats(task_id, resume_stats):
+    dynamodb.update_item(
+        TableName=DYNAMO_TASK_TABLE,
+        Key={"id": {"S": task_id}},
+        UpdateExpression="SET resume_stats = :s",
+        ExpressionAttributeValues={":s": {"S": json.dumps(resume_stats)}}
+    )
+    print("Resume: ", resume_stats)
+
+def list_keys(bucket, prefix):
+    keys = []
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get("Contents", []):
+            keys.append(obj["Key"])
+    return keys
+
+def load_hashes(bucket, hashes_key):
+    '''Perceptual hashes saved by a previous run of the task: {key: hash}.'''
+    try:
+        return json.loads(s3.get_object(Bucket=bucket, Key=hashes_key)["Body"].read())
+    except s3.exceptions.NoSuchKey:
+        return {}
+
+def save_hashes(bucket, hashes_key, hashes):
+    s3.put_object(Bucket=bucket, Key=hashes_key, Body=json.dumps(dict(hashes)).encode('utf-8'))
+
+def compute_hashes(bucket, keys, saved, deadline):
+    '''
+    Perceptual hashes of the images: (hashes [(key, hash)], unhashed keys). The saved hashes ({key: hash}) are reused, the
+    images not read yet when the deadline (epoch seconds) passes are left unhashed.
+    '''
+    def hash_image(key):
+        if key in saved:
+            return key, saved[key]
+        if time.time() >= deadline:
+            return key, None
+        try:
+            body = s3.get_object(Bucket=bucket, Key=key)["Body"]
+            return key, phash(io.BytesIO(body.read()))
+        except Exception as ex:
+            print(f"Failed to hash s3://{bucket}/{key}", ex)
+            return key, None
+
+    hashes, unhashed = [], []
+    # executor.map keeps the listing order and holds at most one image per thread in memory
+    with ThreadPoolExecutor(max_workers=THREAD_POOL_SIZE) as executor:
+        for key, hash_value in executor.map(hash_image, keys):
+            if hash_value is None:
+                unhashed.append(key)
+            else:
+                hashes.append((key, hash_value))
+    return hashes, unhashed
+
+def write_manifest(bucket, manifest_key, clusters):
+    f = io.StringIO()
+    writer = csv.writer(f)
+    writer.writerow(["Key", "Duplicates"])
+    for key, members in clusters.items():
+        writer.writerow([key, json.dumps(members)])
+    s3.put_object(Bucket=bucket, Key=manifest_key, Body=f.getvalue().encode('utf-8'))
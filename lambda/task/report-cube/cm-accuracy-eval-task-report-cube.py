@@ -0,0 +1,52 @@
+'''
+Lambda function triggered by the DynamoDB stream of a moderation result table (event source mapping created when the task
+starts the moderation). Maintains the task's report cube (cm_accuracy_eval.report_cube):
+1. Parse the task id from the stream ARN
+2. Compute the metric key changes of every record: moderation results inserted, review results updated, rows removed
+3. Apply the changes to the cube item, one slice of consecutive records at a time. A slice delivered again is skipped.
+   When a slice fails, or the timeout is near, the records from that slice on are reported as batch item failures: the stream
+   mapping retries them without the slices already applied.
+'''
+import boto3
+import os
+import time
+from cm_accuracy_eval import report_cube
+
+DYNAMODB_TABLE_PREFIX = os.environ["DYNAMODB_TABLE_PREFIX"]
+DYNAMODB_REPORT_CUBE_TABLE = os.environ["DYNAMODB_REPORT_CUBE_TABLE"]
+# Time kept to report the records left before the Lambda timeout
+UPDATE_RESERVED_S = 5
+
+dynamodb = boto3.client('dynamodb')
+
+def lambda_handler(event, context):
+    deadline = time.time() + context.get_remaining_time_in_millis() / 1000 - UPDATE_RESERVED_S
+    records = event["Records"]
+    changes = []
+    for record in records:
+        # arn:aws:dynamodb:region:account:table/<table name>/stream/<label>
+        table_name = record["eventSourceARN"].split("/")[1]
+        task_id = table_name.replace(DYNAMODB_TABLE_PREFIX + '-', '')
+        old_image = record["dynamodb"].get("OldImage")
+        new_image = record["dynamodb"].get("NewImage")
+        changes.append((task_id, record["eventID"], report_cube.diff(report_cube.metric_keys(old_image), report_cube.metric_keys(new_image))))
+    print("1,2. Parse stream records: ", len(records))
+
+    applied, skipped = 0, 0
+    for start, slice_id, deltas in report_cube.slices(changes):
+        failed = time.time() >= deadline
+        if not failed:
+            try:
+                if report_cube.apply(dynamodb, DYNAMODB_REPORT_CUBE_TABLE, changes[start][0], slice_id, deltas):
+                    applied += 1
+                else:
+                    skipped += 1
+            except Exception as ex:
+                print("Failed to update the report cube: ", slice_id, ex)
+                failed = True
+        if failed:
+            print("3. Update report cube: ", applied, "slices applied,", skipped, "skipped, retry from record", start)
+            return {"batchItemFailures": [{"itemIdentifier": records[start]["dynamodb"]["SequenceNumber"]}]}
+    print("3. Update report cube: ", applied, "slices applied,", skipped, "skipped")
+
+    return {"batchItemFailures": []}
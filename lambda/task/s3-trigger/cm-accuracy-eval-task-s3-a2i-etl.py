@@ -1,109 +1,197 @@
 '''
-Lambda function triggered by S3 event: A2I generated new file to the output folder
-1. Parse detail table name from the S3 Key - the A2I store JSON using the workflow name as the folder name. With a prefix defined in the constants (enironment variable)
-2. Read the JSON file generated by A2I; get image S3 URI and human review from the JSON.
-3. Get Rekognition output from the moderation detail table (name from step 1)
-4. Compare A2I human input (step 2) and Rek result (step 3), mark them as FP or TP; And save the result to DB - moderation detail table.
-5. Calculate task status: by counting numbers of images labeled and reviewed
-6,7. Get the task entry from DB, compare if the status changed, if so save the status to DB
+Lambda function processing A2I human review outputs. The S3 event notifications of the A2I output folder are buffered in an
+SQS queue and delivered in batches:
+1. Parse the A2I output files from the messages. The detail table name is parsed from the S3 Key - the A2I store JSON using the
+   workflow name as the folder name. With a prefix defined in the constants (enironment variable)
+2. Read the JSON files generated by A2I concurrently; get image S3 URI and human review from each JSON. A review of a
+   normalized copy (derived prefix, cm_accuracy_eval.normalization) is mapped back to the original image.
+3. Get Rekognition outputs from the moderation detail table (name from step 1) with BatchGetItem
+4. Compare A2I human input (step 2) and Rek result (step 3), mark them as FP or TP. Near-duplicates collapsed into the
+   reviewed image (the "duplicates" attribute) get the same review result. When a batch has several reviews of an image, the
+   last one wins.
+5. Save the rows of each image and add the change of their review flags to the task counters in one transaction
+   (cm_accuracy_eval.task_counters.save_rows): a repeated review adds nothing, and a row changed since it was read (a
+   concurrent delivery) fails the message for a retry. Calculate task status from the counters: no table query per review.
+   The counters of a task started before they existed are rebuilt from the result table first. The rebuild stops before the
+   Lambda timeout and saves its position on the task item: the messages are reported as failed, and the redelivered batch
+   continues the rebuild (the reviews are saved already and don't count twice)
+6. Save the status with a conditional update: the condition re-checks the counters and the current status in DynamoDB, so
+   concurrent batches can't save a stale status
+Failed messages are reported in batchItemFailures: SQS only redelivers those, and moves them to the dead-letter queue after
+the maximum receive count.
 '''
 import json
 import urllib.parse
 import boto3
+import copy
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from botocore.config import Config
+from cm_accuracy_eval.batch_reader import batch_get_items
+from cm_accuracy_eval import task_counters, normalization
 
 DYNAMODB_TABLE_PREFIX = os.environ["DYNAMODB_TABLE_PREFIX"]
 DYNAMO_TASK_TABLE = os.environ["DYNAMODB_TASK_TABLE"]
 DYNAMO_INDEX_NAME = os.environ["DYNAMODB_INDEX_NAME"]
+THREAD_POOL_SIZE = int(os.environ.get("THREAD_POOL_SIZE", "16"))
+S3_DERIVED_PREFIX = os.environ.get("S3_DERIVED_PREFIX", normalization.DERIVED_PREFIX)
+# Time kept to save the reconcile state and respond
+RECONCILE_RESERVED_S = 10
 
-s3 = boto3.client('s3')
+client_config = Config(max_pool_connections=THREAD_POOL_SIZE)
+s3 = boto3.client('s3', config=client_config)
 dynamodb = boto3.client('dynamodb')
 
 def lambda_handler(event, context):
-    # Get the object from the event and show its content type
-    bucket = event['Records'][0]['s3']['bucket']['name']
-    key = urllib.parse.unquote_plus(event['Records'][0]['s3']['object']['key'], encoding='utf-8')
+    deadline = time.time() + context.get_remaining_time_in_millis() / 1000 - RECONCILE_RESERVED_S
+    # Parse A2I output files from the SQS messages (or S3 event records when invoked by S3 directly)
+    reviews = []
+    for record in event.get('Records', []):
+        message_id = record.get('messageId')
+        s3_records = json.loads(record['body']).get('Records', []) if 'body' in record else [record]
+        for r in s3_records:
+            key = urllib.parse.unquote_plus(r['s3']['object']['key'], encoding='utf-8')
+            dynamodb_name = get_table_name(key)
+            if dynamodb_name is None:
+                print("Not an A2I output of a task, skipped:", key)
+                continue
+            reviews.append({"message_id": message_id, "bucket": r['s3']['bucket']['name'], "key": key, "table": dynamodb_name})
+    print("1. parse A2I outputs and dynamoDB detail table names from messages", len(reviews))
 
-    dynamodb_name = ''
+    # Get A2I generated JSON with human review result
+    failed = set()
+    with ThreadPoolExecutor(max_workers=min(THREAD_POOL_SIZE, max(len(reviews), 1))) as executor:
+        for review, a2i in zip(reviews, executor.map(read_a2i_output, reviews)):
+            if a2i is None:
+                failed.add(review["message_id"])
+                continue
+            # Get image s3 path from A2I JSON
+            img_bucket = a2i["inputContent"]["aiServiceRequest"]["image"]["s3Object"]["bucket"]
+            img_key = a2i["inputContent"]["aiServiceRequest"]["image"]["s3Object"]["name"]
+            review["a2i"] = a2i
+            review["file_path"] = normalization.original_path(f's3://{img_bucket}/{img_key}', review["bucket"], S3_DERIVED_PREFIX)
+    print("2. read A2I outputs: ", len(reviews) - len(failed), "failed:", len(failed))
+
+    by_table = {}
+    for review in reviews:
+        if "a2i" in review:
+            by_table.setdefault(review["table"], []).append(review)
+    for dynamodb_name, table_reviews in by_table.items():
+        try:
+            failed.update(process_reviews(dynamodb_name, table_reviews, deadline))
+        except Exception as ex:
+            print(f"Failed to process {len(table_reviews)} reviews of {dynamodb_name}: ", ex)
+            failed.update([r["message_id"] for r in table_reviews])
+
+    if None in failed:
+        # Invoked by S3 directly: no partial batch response
+        raise Exception(f"Failed to process {len(failed)} A2I outputs")
+    print("Processed A2I outputs:", len(reviews), "failed messages:", len(failed))
+    return {"batchItemFailures": [{"itemIdentifier": m} for m in failed]}
+
+def get_table_name(key):
     # Get flow folder name as the DynamoDB name
     for a in key.split('/'):
         if a.startswith(DYNAMODB_TABLE_PREFIX):
-            dynamodb_name = a
-            break
-    print("1. parse dynamoDB detail table name from URL",dynamodb_name)
-    
+            return a
+    return None
+
+def read_a2i_output(review):
     try:
-        # Get A2I generated JSON with human review result
-        response = s3.get_object(Bucket=bucket, Key=key)
-        a2i = json.loads(response["Body"].read().decode('utf-8'))
-        
-        # Get image s3 path from A2I JSON
-        img_bucket = a2i["inputContent"]["aiServiceRequest"]["image"]["s3Object"]["bucket"]
-        img_key = a2i["inputContent"]["aiServiceRequest"]["image"]["s3Object"]["name"]
-        print ("2. get image S3 URL",f's3://{img_bucket}/{img_key}')
-        
-        # Get entry from dynamoDB
-        print(f'!!!!!s3://{img_bucket}/{img_key}', dynamodb_name)
+        response = s3.get_object(Bucket=review["bucket"], Key=review["key"])
+        return json.loads(response["Body"].read().decode('utf-8'))
+    except Exception as ex:
+        print(f'Failed to read A2I output s3://{review["bucket"]}/{review["key"]}', ex)
+        return None
+
+def process_reviews(dynamodb_name, reviews, deadline=None):
+    '''Save the reviews of one task. Returns the ids of the messages that failed.'''
+    id = dynamodb_name.replace(DYNAMODB_TABLE_PREFIX + '-', '')
+    latest = {}
+    for review in reviews:
+        latest[review["file_path"]] = review
+
+    # Get entries from dynamoDB
+    items, unprocessed = batch_get_items(dynamodb, dynamodb_name, [{"file_path": {"S": p}} for p in latest])
+    items_by_path = {i["file_path"]["S"]: i for i in items}
+    print ("3. get moderation detail entries from DB", dynamodb_name, len(items), "unprocessed:", len(unprocessed))
+
+    failed_paths = set()
+    reviewed = {}
+    for file_path, review in latest.items():
+        item = items_by_path.get(file_path)
+        if item is None:
+            # Unprocessed, or the moderation result isn't saved yet: retried by SQS
+            failed_paths.add(file_path)
+            continue
+
+        # Match human review with DB record
+        if item['issue_flag']['N'] != "1":
+            continue
+        item = copy.deepcopy(item)
+        item['reviewed_flag'] = {'N': "1"}
+        for rek in item['rek_results']['L']:
+            review_result = check_a2i(review["a2i"], rek['M']['category']['S'], rek['M']['parent_category']['S'])
+            rek['M']['review_result'] = {'S': review_result}
+
+            # additional attributes for report
+            if review_result == 'true-positive':
+                item['tp_flag'] = {'N': "1"}
+            elif review_result == 'false-positive':
+                item['fp_flag'] = {'N': "1"}
+        reviewed[file_path] = item
+    print ("4. analysis accuracy using both Rek and A2I outputs: ", len(reviewed))
+
+    # The rows of the near-duplicates, as they are before the review: their change is counted too
+    dup_keys = [{"file_path": d} for item in reviewed.values() for d in item.get('duplicates', {}).get('L', [])]
+    dup_items, dup_unprocessed = batch_get_items(dynamodb, dynamodb_name, dup_keys)
+    dups_by_path = {i["file_path"]["S"]: i for i in dup_items}
+    unread = set([k["file_path"]["S"] for k in dup_unprocessed])
+
+    # Save review results back to DynamoDB with the counter changes, one transaction per reviewed image
+    def save_review(file_path):
+        item = reviewed[file_path]
+        rows = [(item, items_by_path[file_path])]
+        for dup in item.get('duplicates', {}).get('L', []):
+            if dup['S'] in unread:
+                return False
+            dup_item = copy.deepcopy(item)
+            del dup_item['duplicates']
+            dup_item['file_path'] = dup
+            dup_item['duplicate_of'] = item['file_path']
+            rows.append((dup_item, dups_by_path.get(dup['S'])))
         try:
-            db_response = dynamodb.get_item(
-                TableName = dynamodb_name,
-                Key = {'file_path': {'S': f's3://{img_bucket}/{img_key}'}} 
-            )       
-            print ("3. get moderation detail entry from DB", db_response)
+            return task_counters.save_rows(dynamodb, DYNAMO_TASK_TABLE, id, dynamodb_name, rows)
         except Exception as ex:
-            print ("3. failed to get moderation detail entry from DB", ex)
+            print(f"Failed to save the review of {file_path}: ", ex)
             return False
-            
-        # Match human review with DB record and update review result to DB
-        if db_response['Item']['issue_flag']['N'] == "1":
-            db_response['Item']['reviewed_flag'] = {'N': "1"}
-            for rek in db_response['Item']['rek_results']['L']:
-                review_result = check_a2i(a2i, rek['M']['category']['S'], rek['M']['parent_category']['S'])
-                rek['M']['review_result'] = {'S': review_result}
-                
-                # additional attributes for report
-                if review_result == 'true-positive':
-                    db_response['Item']['tp_flag'] = {'N': "1"}
-                elif review_result == 'false-positive':
-                    db_response['Item']['fp_flag'] = {'N': "1"}
-        
-            # Save review result back to DynamoDB
-            put_response = dynamodb.put_item(
-                TableName = dynamodb_name,
-                Item = db_response['Item']
-            )
-            print ("4. analysis accuracy using both Rek and A2I outputs: ", put_response)
-
-        # Check task status
-        status = get_task_status(dynamodb_name)
-        print ("5. calculate task status by counting moderation entries: ", status)
-        
-        print("Get task status:", status)
-        if status is not None:
-            # Update DB task table with the new task status
-            # Get task item from DB table
-            id = dynamodb_name.replace(DYNAMODB_TABLE_PREFIX + '-', '')
-            print('item id:', id)
-            d_response = dynamodb.get_item(
-                TableName=DYNAMO_TASK_TABLE,
-                Key={"id" : { "S": id}}
-            )    
-            item = d_response.get("Item")
-            print ("6. Get task entry from DB: ", item)
-            if item is not None and item["status"]["S"] != status:
-                # Update DB
-                item["status"]["S"] = status
-                d_response = dynamodb.put_item(
-                    TableName=DYNAMO_TASK_TABLE,
-                    Item=item,
-                )
-                print ("7. Updated task in DB: ", item)
-   
-    except Exception as e:
-        print(e)
-        raise e
-
-    return True
+
+    with ThreadPoolExecutor(max_workers=min(THREAD_POOL_SIZE, max(len(reviewed), 1))) as executor:
+        for file_path, saved in zip(list(reviewed), executor.map(save_review, list(reviewed))):
+            if not saved:
+                failed_paths.add(file_path)
+    print ("5. save reviews with the task counters: ", len(reviewed), "failed:", len([p for p in reviewed if p in failed_paths]))
+
+    # Check task status
+    task = dynamodb.get_item(TableName=DYNAMO_TASK_TABLE, Key={"id" : { "S": id}}, ConsistentRead=True).get("Item")
+    if task is not None:
+        counters = task_counters.read(task)
+        if counters is None:
+            # Task started before the counters existed
+            counters = task_counters.reconcile(dynamodb, DYNAMO_TASK_TABLE, id, dynamodb_name, task_counters.reconcile_state(task), deadline)
+        if counters is None:
+            # Reconcile saved at the deadline: the redelivered messages continue it and then set the status
+            print ("5. reconcile of the task counters continues in the next delivery: ", id)
+            return [r["message_id"] for r in reviews]
+        status = get_task_status(counters["labeled"], counters["reviewed"])
+        print ("5. calculate task status from the task counters: ", status, counters)
+
+        if status is not None and task["status"]["S"] != status:
+            updated = update_task_status(id, status)
+            print ("6. Updated task status in DB: ", status, updated)
+
+    return [r["message_id"] for r in reviews if r["file_path"] in failed_paths]
 
 def check_a2i(a2i, category_name, parent_category_name):
     found = False
@@ -118,51 +206,36 @@ def check_a2i(a2i, category_name, parent_category_name):
 
     return review_result
 
-def get_task_status(result_table):
+def get_task_status(labeled, reviewed):
     task_status = None
-    labeled, reviewed = get_metrics(result_table)
-    #print("!!! labeled:", labeled, ", reviewed", reviewed)
     if labeled > 0:
-        if reviewed == 1 and labeled > 1:
-            # Set status to "HUMAN_REVIEWING" when reviewed == 0 (this is the first review of the task)
+        if reviewed >= 1 and reviewed < labeled:
+            # Set status to "HUMAN_REVIEWING" from the first review of the task
             task_status = "HUMAN_REVIEWING"
-        elif reviewed == labeled: # Last to review 
+        elif reviewed >= labeled: # Last to review
             task_status = "COMPLETED"
 
     return task_status
-    
-def get_metrics(result_table):
-    # Scan result table: issued images
-    labeled, reviewed, fp, fn, tp, tn = 0, 0, 0, 0, 0, 0
-    d_response = dynamodb.query(
-        TableName=result_table,
-        IndexName=DYNAMO_INDEX_NAME,
-        KeyConditionExpression='issue_flag = :i',
-        ExpressionAttributeValues={
-            ':i': {'N': '1'}
-        }
-    )
-    labeled, reviewed = count_flags(d_response["Items"], labeled, reviewed)
-    last_key = d_response.get("LastEvaluatedKey")
-    if last_key is not None:
-        while last_key is not None:
-            d_response = dynamodb.query(
-                TableName=result_table,
-                IndexName=DYNAMO_INDEX_NAME,
-                KeyConditionExpression='issue_flag = :i',
-                ExpressionAttributeValues={
-                    ':i': {'N': '1'}
-                },
-                ExclusiveStartKey=last_key
-            )
-            last_key = d_response.get("LastEvaluatedKey")
-            labeled, reviewed = count_flags(d_response["Items"], labeled, reviewed)
-
-    return labeled, reviewed
-
-def count_flags(items, labeled, reviewed):
-    labeled += len(items)
-    for i in items:
-        if i["reviewed_flag"]["N"] == "1":
-            reviewed += 1
-    return labeled, reviewed
\ No newline at end of file
+
+def update_task_status(id, status):
+    # The condition is evaluated on the latest counters: a concurrent batch may have changed them since step 5
+    if status == "COMPLETED":
+        condition = "reviewed >= labeled AND #s <> :s"
+        values = {":s": {"S": status}}
+    else:
+        condition = "reviewed < labeled AND NOT #s IN (:s, :completed)"
+        values = {":s": {"S": status}, ":completed": {"S": "COMPLETED"}}
+    try:
+        dynamodb.update_item(
+            TableName=DYNAMO_TASK_TABLE,
+            Key={"id" : { "S": id}},
+            UpdateExpression="SET #s = :s",
+            ConditionExpression=condition,
+            ExpressionAttributeNames={"#s": "status"},
+            ExpressionAttributeValues=values
+        )
+        return True
+    except Exception as ex:
+        if getattr(ex, "response", {}).get("Error", {}).get("Code") == "ConditionalCheckFailedException":
+            return False
+        raise
\ No newline at end of file
@@ -1,26 +1,52 @@
 '''
 1. Read task item from DynamoDB
-2. Check task status - exit flow if status is not 'CREATED'
-3. Count nummbers of files in the S3 bucket path - exit flow if no file uploaded (a temp file in the folder so the number should be greater than 1)
+2. Check task status - exit flow if status is not 'CREATED'.
+   With "resume": true, a run that failed or was aborted (status MODERATING, MODERATION_COMPLETED or FAILED, no running
+   execution) is continued by a new execution that only moderates the images without a result row (cm_accuracy_eval.resume).
+   The task keeps its input, A2I workflow definition, result table and counters: steps 4 to 6 are skipped
+3. Count the images - exit flow if no image uploaded. The upload index counters are read from the task item; tasks created
+   before the upload index are listed, counting the supported file types.
+   With "manifest" ({"format": "csv" | "jsonl" | "s3_inventory", "s3_uri"}), the images listed by the manifest are moderated
+   instead (cm_accuracy_eval.input_manifest): the manifest is checked here, and read, validated and deduplicated by the first
+   state of the execution, which saves the image count
 4. Create dynamodb table keeps moderation result for the task - ignore if exists
 5. Create A2I workflow definition
-6. Start the Step Function execution - bulk moderation images in the S3 bucket
-7. Update the DB item
+6. Connect the moderation result table stream to the report cube Lambda. Failing batches are bisected and retried
+   REPORT_CUBE_MAX_RETRY_ATTEMPTS times, then sent to the on-failure destination so one bad record can't block the stream.
+   A resumed task gets the same failure handling on its existing mapping
+7. Start the Step Function execution - bulk moderation images in the S3 bucket. Indexed tasks moderate the accepted images of
+   the upload index (manifest), unsupported and oversized files are never moderated. Set "dedup" to collapse near-duplicate
+   images before moderation
+8. Update the DB item (a resumed task keeps moderation_started_ts and sets moderation_resumed_ts): set the changed attributes and initialize the task counters. The moderation workers may already be
+   adding to the counters, so the item is updated in place instead of replaced.
 '''
 import json
 import boto3
 import uuid
 from datetime import datetime
 import os
-import subprocess
-from ast import literal_eval
+from cm_accuracy_eval import task_counters, data_access, upload_index, input_manifest
 
 TASK_STATUS = "MODERATING"
+RESUMABLE_STATUS = ["MODERATING", "MODERATION_COMPLETED", "FAILED"]
 DYNAMO_TASK_TABLE = os.environ["DYNAMODB_TASK_TABLE"]
 DYNAMO_RESULT_TABLE_PREFIX = os.environ["DYNAMODB_RESULT_TABLE_PREFIX"]
 WORK_FLOW_NAME_PREFIX = os.environ["WORK_FLOW_NAME_PREFIX"]
 HUMAN_TASK_UI_NAME = os.environ["HUMAN_TASK_UI_NAME"].split('/')[-1]
 STEP_FUNCTION_STATE_MACHINE_ARN = os.environ["STEP_FUNCTION_STATE_MACHINE_ARN"]
+REPORT_CUBE_FUNCTION_NAME = os.environ["REPORT_CUBE_FUNCTION_NAME"]
+SUPPORTED_FILE_TYPES = os.environ["SUPPORTED_FILE_TYPES"].split(',')
+REPORT_CUBE_MAX_RETRY_ATTEMPTS = int(os.environ["REPORT_CUBE_MAX_RETRY_ATTEMPTS"])
+REPORT_CUBE_FAILURE_DESTINATION_ARN = os.environ["REPORT_CUBE_FAILURE_DESTINATION_ARN"]
+
+# Error handling of the report cube stream mappings: the report cube Lambda reports the records it didn't apply, a failing batch
+# is split in two and retried, and the records still failing are sent to the queue instead of blocking the shard
+REPORT_CUBE_MAPPING_CONFIG = {
+    "FunctionResponseTypes": ["ReportBatchItemFailures"],
+    "BisectBatchOnFunctionError": True,
+    "MaximumRetryAttempts": REPORT_CUBE_MAX_RETRY_ATTEMPTS,
+    "DestinationConfig": {"OnFailure": {"Destination": REPORT_CUBE_FAILURE_DESTINATION_ARN}},
+}
 
 s3 = boto3.client("s3")
 sfn = boto3.client("stepfunctions")
@@ -30,11 +56,24 @@ lambda_client = boto3.client('lambda')
 
 def lambda_handler(event, context):
     id = event.get("id")
+    dedup = event.get("dedup") == True
+    manifest = event.get("manifest")
+    resume = event.get("resume") == True
     if id is None:
         return {
             'statusCode': 400,
             'body': 'Missing paramters. Require id.'
         }        
+    if manifest is not None and dedup:
+        return {
+            'statusCode': 400,
+            'body': 'Near-duplicate collapsing is not supported with a manifest.'
+        }
+    if manifest is not None and resume:
+        return {
+            'statusCode': 400,
+            'body': 'A resumed moderation reads the input of the task. Remove the manifest.'
+        }
  
     # Get task item from DB table
     d_response = dynamodb.get_item(
@@ -43,32 +82,74 @@ def lambda_handler(event, context):
     )    
     print("1. Get db item: ", d_response)
 
-    item = unmarshalJson(d_response["Item"])
+    item = data_access.unmarshal(d_response["Item"])
     print("2. Convert db item to normal json: ", item)
-    if item["status"] != "CREATED":
+    if resume:
+        if item["status"] not in RESUMABLE_STATUS:
+            return {
+                'statusCode': 400,
+                'body': f'Only a started moderation can be resumed. Supported status: {", ".join(RESUMABLE_STATUS)}. Task status: {item["status"]}'
+            }
+        if is_running(item.get("step_function_execution_arn")):
+            return {
+                'statusCode': 400,
+                'body': 'The moderation of the task is still running.'
+            }
+    elif item["status"] != "CREATED":
         return {
             'statusCode': 400,
             'body': f'The accuracy evaluation task has already started the moderation. Task status: {item["status"]}'
         }
 
-    # Get numbers of images in the s3 path
-    cli = f'/opt/aws s3api list-objects --bucket {item["s3_bucket"]} --prefix {item["s3_key_prefix"]} --output json --query "[length(Contents[])]"'
-    result = subprocess.Popen(cli,shell=True,stdout=subprocess.PIPE,stderr=subprocess.STDOUT)
-    output = result.communicate()[0].decode('UTF-8')
-    total = literal_eval(output)[0]
-    item["total_files"] = str(total)
-    print(f'3. Count numbers of files in the s3 path: s3://{item["s3_bucket"]}/{item["s3_key_prefix"]}. Total:', item["total_files"])
-    if item["total_files"] == "0":
-        return {
-            'statusCode': 400,
-            'body': f'No image found in the S3 bucket. S3 URI: s3://{item["s3_bucket"]}/{item["s3_key_prefix"]}'
-        }        
+    # Check the input manifest: the images are counted when it is read
+    updated = ["a2i_workflow_arn", "report_cube_mapping_uuid", "step_function_execution_arn",
+        "moderation_resumed_ts" if resume else "moderation_started_ts", "status"]
+    index_counts, source = None, None
+    if resume and "input_manifest" in item:
+        # Checked when the moderation started
+        source = json.loads(item["input_manifest"])
+        print("3. Resume with the input manifest: ", source)
+    elif manifest is not None:
+        try:
+            source = input_manifest.source(manifest.get("format"), manifest.get("s3_uri"))
+            input_manifest.check(s3, source)
+        except input_manifest.ManifestError as ex:
+            return {
+                'statusCode': 400,
+                'body': f'Invalid manifest. {ex}'
+            }
+        item["input_manifest"] = json.dumps(source)
+        updated.append("input_manifest")
+        print("3. Check input manifest: ", source)
+    else:
+        # Get numbers of images in the s3 path
+        index_counts = upload_index.read_counts(d_response["Item"])
+        if index_counts is not None:
+            total = index_counts["accepted"]
+        else:
+            total = upload_index.count_listed(s3, item["s3_bucket"], item["s3_key_prefix"], SUPPORTED_FILE_TYPES)
+        item["total_files"] = str(total)
+        updated.append("total_files")
+        print(f'3. Count numbers of images in the s3 path: s3://{item["s3_bucket"]}/{item["s3_key_prefix"]}. Total:', item["total_files"], "Upload index:", index_counts)
+        if total == 0:
+            rejected = "" if index_counts is None or index_counts["rejected"] == 0 else f' {index_counts["rejected"]} files rejected: unsupported type or format, or too large.'
+            return {
+                'statusCode': 400,
+                'body': f'No image found in the S3 bucket. S3 URI: s3://{item["s3_bucket"]}/{item["s3_key_prefix"]}.{rejected}'
+            }        
     
-    # Create A2I workflow
-    a2i_workflow_arn = createA2iWorkflow(item["id"], item["s3_bucket"], f'{WORK_FLOW_NAME_PREFIX}-{item["id"]}')
-    print("5. Create A2I workflow: ", a2i_workflow_arn )
-    item["a2i_workflow_arn"] = a2i_workflow_arn
+    if not resume:
+        # Create A2I workflow
+        a2i_workflow_arn = createA2iWorkflow(item["id"], item["s3_bucket"], f'{WORK_FLOW_NAME_PREFIX}-{item["id"]}')
+        print("5. Create A2I workflow: ", a2i_workflow_arn )
+        item["a2i_workflow_arn"] = a2i_workflow_arn
 
+    # Feed the report cube from the result table stream: connected before the moderation starts, so no change is missed
+    if not resume or len(item.get("report_cube_mapping_uuid", "")) == 0:
+        item["report_cube_mapping_uuid"] = create_report_cube_mapping(item["moderation_result_table"])
+        print("6. Connect result table stream to the report cube: ", item["report_cube_mapping_uuid"])
+    else:
+        update_report_cube_mapping(item["report_cube_mapping_uuid"])
 
     # Trigger Step function moderation flow
     params = {
@@ -76,68 +157,80 @@ def lambda_handler(event, context):
           "S3Bucket": item["s3_bucket"],
           "S3Prefix": item["s3_key_prefix"],
           "DynamoDBTable": item["moderation_result_table"],
-          "A2IWorkFlowArn": item["a2i_workflow_arn"]
+          "A2IWorkFlowArn": item["a2i_workflow_arn"],
+          "Dedup": dedup,
+          "UseIndex": index_counts is not None,
+          "Resume": resume
         }
+    if source is not None:
+        params["InputManifest"] = source
     sfn_response = sfn.start_execution(
             stateMachineArn = STEP_FUNCTION_STATE_MACHINE_ARN,
             name = WORK_FLOW_NAME_PREFIX+"-" + item["id"] + f"-{str(uuid.uuid4())[0:5]}",
             input = json.dumps(params),
         )
     item["step_function_execution_arn"] = sfn_response["executionArn"]
-    item["moderation_started_ts"] = datetime.now().strftime('%Y/%m/%d %H:%M:%S UTC')
-    print("6. Start step function execution: ", item["step_function_execution_arn"])
+    item["moderation_resumed_ts" if resume else "moderation_started_ts"] = datetime.now().strftime('%Y/%m/%d %H:%M:%S UTC')
+    print("7. Start step function execution: ", item["step_function_execution_arn"])
     
     # Update DB item
     item["status"] = TASK_STATUS
-    d_response = dynamodb.put_item(
+    names = {f"#a{i}": a for i, a in enumerate(updated)}
+    names.update({f"#c{i}": c for i, c in enumerate(task_counters.COUNTERS)})
+    values = {f":a{i}": {"S": item[a]} for i, a in enumerate(updated)}
+    values[":zero"] = {"N": "0"}
+    d_response = dynamodb.update_item(
         TableName=DYNAMO_TASK_TABLE,
-        Item=constructDynamoItem(item),
+        Key={"id": {"S": item["id"]}},
+        UpdateExpression="SET " + ", ".join([f"#a{i} = :a{i}" for i in range(len(updated))]
+            + [f"#c{i} = if_not_exists(#c{i}, :zero)" for i in range(len(task_counters.COUNTERS))]),
+        ExpressionAttributeNames=names,
+        ExpressionAttributeValues=values,
     )
-    print("7. Updated task db: ", item)
+    print("8. Updated task db: ", item)
     
     return {
         'statusCode': 200,
         'body': json.dumps(item)
     }
 
-def constructDynamoItem(item):
-    d_item = {}
-    for key, value in item.items():
-        if value is None:
-            d_item[key] = {'NULL': True}
-        elif type(key) == str:
-            d_item[key] = {'S': value}
-        elif type(key) == datetime:
-            d_item[key] = {'S': value.strftime('%Y/%m/%d %H:%M:%s UTC')}
-        elif type(key) == bool:
-            d_item[key] = {'BOOL': value}
-        elif type(key) == int or type(key) == float:
-            d_item[key] = {'N': value}
+def is_running(execution_arn):
+    if execution_arn is None or len(execution_arn) == 0:
+        return False
+    return sfn.describe_execution(executionArn=execution_arn)["status"] == "RUNNING"
 
-    return d_item
-
-def unmarshalJson(node):
-    data = {}
-    data["M"] = node
-    return unmarshalValue(data, True)
+def create_report_cube_mapping(table_name):
+    try:
+        table = dynamodb.describe_table(TableName=table_name)["Table"]
+        if table.get("StreamSpecification", {}).get("StreamEnabled") == True:
+            stream_arn = table["LatestStreamArn"]
+        else:
+            # Table created before the result tables had a stream
+            stream_arn = dynamodb.update_table(
+                TableName=table_name,
+                StreamSpecification={'StreamEnabled': True, 'StreamViewType': 'NEW_AND_OLD_IMAGES'}
+            )["TableDescription"]["LatestStreamArn"]
+        response = lambda_client.create_event_source_mapping(
+            EventSourceArn=stream_arn,
+            FunctionName=REPORT_CUBE_FUNCTION_NAME,
+            StartingPosition='TRIM_HORIZON',
+            BatchSize=1000,
+            MaximumBatchingWindowInSeconds=5,
+            **REPORT_CUBE_MAPPING_CONFIG
+        )
+        return response["UUID"]
+    except Exception as ex:
+        # The report falls back to reading the result table
+        print("Failed to connect the result table stream to the report cube: ", ex)
+        return ""
 
+def update_report_cube_mapping(mapping_uuid):
+    # Mappings created before the error handling retried a failing batch until its records expired
+    try:
+        lambda_client.update_event_source_mapping(UUID=mapping_uuid, **REPORT_CUBE_MAPPING_CONFIG)
+    except Exception as ex:
+        print("Failed to update the report cube stream mapping: ", ex)
 
-def unmarshalValue(node, mapAsObject):
-    for key, value in node.items():
-        if(key == "S" or key == "N"):
-            return value
-        if(key == "M" or key == "L"):
-            if(key == "M"):
-                if(mapAsObject):
-                    data = {}
-                    for key1, value1 in value.items():
-                        data[key1] = unmarshalValue(value1, mapAsObject)
-                    return data
-            data = []
-            for item in value:
-                data.append(unmarshalValue(item, mapAsObject))
-            return data
-            
 def createA2iWorkflow(task_id, s3_bucket, workflow_name):
     #workflow_name = workflow_name.lower().replace(' ','-')
     print(">>>>> Workflow_name", workflow_name)
@@ -1,13 +1,15 @@
 import json
 import boto3
-import subprocess
-from ast import literal_eval
 from boto3.dynamodb.conditions import Key, Attr
 import os
+import time
+from cm_accuracy_eval import task_counters, data_access, upload_index
 
 DYNAMO_TASK_TABLE = os.environ["DYNAMODB_TASK_TABLE"]
 SUPPORTED_FILE_TYPES = os.environ["SUPPORTED_FILE_TYPES"].split(',')
 DYNAMO_INDEX_NAME = os.environ["DYNAMODB_INDEX_NAME"]
+# Time kept to save the reconcile state and respond
+RECONCILE_RESERVED_S = 5
 
 dynamodb = boto3.client('dynamodb')
 s3 = boto3.client('s3')
@@ -20,9 +22,7 @@ def lambda_handler(event, context):
             'statusCode': 400,
             'body': 'Missing paramters. Require id.'
         }   
-        
-    result ={}
-    
+
     # Get task item from DB table
     d_response = dynamodb.get_item(
         TableName=DYNAMO_TASK_TABLE,
@@ -36,31 +36,40 @@ def lambda_handler(event, context):
             'body': "Task id doesn't exist"
         }   
 
-    # Get S3 file count if status is "CREATED"
+    # Get the upload counts if status is "CREATED": one read of the upload index counters on the task item.
+    # Tasks created before the upload index are listed, counting the supported file types.
+    index_counts = upload_index.read_counts(item)
     if item["status"]["S"] == "CREATED":
-        total = 0
-        try:
-            # Delete the temp file if exisis
-            s3.delete_object(Bucket=item["s3_bucket"]["S"], Key=item["s3_key_prefix"]["S"] + ".temp")
+        if index_counts is not None:
+            item["total_files"] = {"N": str(index_counts["accepted"])}
+            print("2. Get upload index counts: ", index_counts)
+        else:
+            try:
+                # Delete the temp file if exisis: the bulk moderation lists the objects of these tasks
+                s3.delete_object(Bucket=item["s3_bucket"]["S"], Key=item["s3_key_prefix"]["S"] + ".temp")
 
-            # Get S3 object count using AWS CLI (in base layer)
-            cli = f'/opt/aws s3api list-objects --bucket {item["s3_bucket"]["S"]} --prefix {item["s3_key_prefix"]["S"]} --output json --query "[length(Contents[])]"'
-            result = subprocess.Popen(cli,shell=True,stdout=subprocess.PIPE,stderr=subprocess.STDOUT)
-            output = result.communicate()[0].decode('UTF-8')
-            total = literal_eval(output)[0]
-            item["total_files"] = {"N": str(total)}
-            print("2. Get S3 object count: ", total)
-            
-            # Update DB
-            d_response = dynamodb.put_item(
-                TableName=DYNAMO_TASK_TABLE,
-                Item=item,
-            )
-            print("3. Update DB: ", item)
-        except Exception as ex:
-            print("Failed to get S3 object count", ex)        
+                total = upload_index.count_listed(s3, item["s3_bucket"]["S"], item["s3_key_prefix"]["S"], SUPPORTED_FILE_TYPES)
+                item["total_files"] = {"N": str(total)}
+                print("2. Get S3 object count: ", total)
 
-    item = unmarshalJson(item)
+                # Update DB
+                dynamodb.update_item(
+                    TableName=DYNAMO_TASK_TABLE,
+                    Key={"id": {"S": id}},
+                    UpdateExpression="SET total_files = :t",
+                    ExpressionAttributeValues={":t": item["total_files"]}
+                )
+                print("3. Update DB: ", item["total_files"])
+            except Exception as ex:
+                print("Failed to get S3 object count", ex)
+
+    counters = task_counters.read(item)
+    reconcile_state = task_counters.reconcile_state(item)
+    item = data_access.unmarshal(item)
+    item.pop("reconcile_state", None)
+    if index_counts is not None:
+        item["rejected_files"] = index_counts["rejected"]
+        item["total_bytes"] = index_counts["bytes"]
     
     # Get A2I login URL
     a2i_url = None
@@ -74,105 +83,20 @@ def lambda_handler(event, context):
         print("Failed to get A2I portal URL: ", ex)
         
     
-    # Get moderation/review metrics
-    processed, labeled, reviewed, tp, tn, fp, fn = 0, 0, 0, 0, 0, 0, 0
-    if item["status"] != "CREATED":
-        processed, labeled, reviewed, tp, tn, fp, fn = get_metrics(item["moderation_result_table"])
-    item["processed"] = processed
-    item["labeled"] = labeled
-    item["reviewed"] = reviewed
-    item["true_positive"] = tp
-    item["true_negative"] = tn
-    item["false_positive"] = fp
-    item["false_negative"] = fn
+    # Get moderation/review metrics: counters kept on the task item.
+    # Rebuild them from the result table for tasks started before the counters existed, or when "reconcile" is set.
+    # A large table is scanned over several calls: the reconcile stops before the Lambda timeout and continues in the next call.
+    if item["status"] == "CREATED":
+        counters = {c: 0 for c in task_counters.COUNTERS}
+    elif counters is None or reconcile_state is not None or event.get("reconcile") == True:
+        deadline = time.time() + context.get_remaining_time_in_millis() / 1000 - RECONCILE_RESERVED_S
+        reconciled = task_counters.reconcile(dynamodb, DYNAMO_TASK_TABLE, id, item["moderation_result_table"], reconcile_state, deadline)
+        item["reconciling"] = reconciled is None
+        if reconciled is not None:
+            counters = reconciled
+    item.update({c: 0 for c in task_counters.COUNTERS} if counters is None else counters)
         
     return {
         'statusCode': 200,
         'body': json.dumps(item)
     }
-
-def unmarshalJson(node):
-    data = {}
-    data["M"] = node
-    return unmarshalValue(data, True)
-
-
-def unmarshalValue(node, mapAsObject):
-    for key, value in node.items():
-        if(key == "S" or key == "N"):
-            return value
-        if(key == "M" or key == "L"):
-            if(key == "M"):
-                if(mapAsObject):
-                    data = {}
-                    for key1, value1 in value.items():
-                        data[key1] = unmarshalValue(value1, mapAsObject)
-                    return data
-            data = []
-            for item in value:
-                data.append(unmarshalValue(item, mapAsObject))
-            return data
-
-def get_metrics(result_table):
-    # Scan result table with pagination: Total
-    processed = 0
-    d_response = dynamodb.scan(
-        Select="COUNT",
-        TableName=result_table,
-    )
-    processed = d_response["Count"]
-    last_key = d_response.get("LastEvaluatedKey")
-    if last_key is not None:
-        while last_key is not None:
-            d_response = dynamodb.scan(
-                Select="COUNT",
-                TableName=result_table,
-                ExclusiveStartKey=last_key
-            )
-            last_key = d_response.get("LastEvaluatedKey")
-            processed += d_response["Count"]
-    #print("////", processed)
-
-    # Scan result table: issued images
-    labeled, reviewed, fp, fn, tp, tn = 0, 0, 0, 0, 0, 0
-    d_response = dynamodb.query(
-        TableName=result_table,
-        IndexName=DYNAMO_INDEX_NAME,
-        KeyConditionExpression='issue_flag = :i',
-        ExpressionAttributeValues={
-            ':i': {'N': '1'}
-        }
-    )
-    labeled, reviewed, tp, tn, fp, fn = count_flags(d_response["Items"], labeled, reviewed, tp, tn, fp, fn)
-    last_key = d_response.get("LastEvaluatedKey")
-    if last_key is not None:
-        while last_key is not None:
-            d_response = dynamodb.query(
-                TableName=result_table,
-                IndexName=DYNAMO_INDEX_NAME,
-                KeyConditionExpression='issue_flag = :i',
-                ExpressionAttributeValues={
-                    ':i': {'N': '1'}
-                },
-                ExclusiveStartKey=last_key
-            )
-            last_key = d_response.get("LastEvaluatedKey")
-            labeled, reviewed, tp, tn, fp, fn = count_flags(d_response["Items"], labeled, reviewed, tp, tn, fp, fn)
-    #print("////", labeled, reviewed, tp, tn, fp, fn)
-
-    return processed, labeled, reviewed, tp, tn, fp, fn
-
-def count_flags(items, labeled, reviewed, tp, tn, fp, fn):
-    labeled += len(items)
-    for i in items:
-        if i["reviewed_flag"]["N"] == "1":
-            reviewed += 1
-        if i["fp_flag"]["N"] == "1":
-            fp += 1
-        if i["fn_flag"]["N"] == "1":
-            fn += 1
-        if i["tp_flag"]["N"] == "1":
-            tp += 1
-        if i["tn_flag"]["N"] == "1":
-            tn += 1    
-    return labeled, reviewed, tp, tn, fp, fn
\ No newline at end of file
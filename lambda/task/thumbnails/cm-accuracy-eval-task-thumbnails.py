@@ -0,0 +1,157 @@
+'''
+Build the gallery thumbnails of a batch of images, invoked asynchronously by the images APIs for the images of a page that
+don't have one yet (cm_accuracy_eval.thumbnails):
+1. Read the thumbnails already built: concurrent invocations for the same page only build the rest. Count the attempt on
+   the images to build ("thumbnail_attempts")
+2. Download and thumbnail the images on a bounded thread pool, upload the thumbnails under thumbnails/. The originals held
+   and the images decoded at once are bounded by shares of the Lambda memory (thumbnails.MemoryBudget).
+   Images attempted before without a result were in an invocation that ran out of memory or time: they are built one at a
+   time first, with an error saved before each build and cleared after it. The image that fails the invocation again keeps
+   its error, so it isn't requested again and the others are built.
+3. Pack the thumbnails in sprite sheets of up to SPRITE_MAX_IMAGES images, upload them
+4. Save the thumbnail and its box in the sheet on the moderation result items. Images that can't be decoded are saved with
+   an error, so they aren't requested again.
+
+Event: {"TaskId", "ResultTable", "FilePaths": ["s3://bucket/input/<task id>/<path>", ...], "Bucket"}
+"Bucket" (task bucket) receives the thumbnails of images stored in other buckets (input manifest).
+'''
+import boto3
+import os
+import io
+import time
+from concurrent.futures import ThreadPoolExecutor
+from botocore.config import Config
+from cm_accuracy_eval import thumbnails
+
+THREAD_POOL_SIZE = int(os.environ.get("THREAD_POOL_SIZE", "16"))
+MEMORY_M = int(os.environ.get("AWS_LAMBDA_FUNCTION_MEMORY_SIZE", "1024"))
+# Time kept to upload the sprite sheets and save the thumbnails
+SAVE_RESERVED_S = 30
+INTERRUPTED_ERROR = "Thumbnail build interrupted: out of memory or timeout"
+
+client_config = Config(max_pool_connections=THREAD_POOL_SIZE)
+s3 = boto3.client('s3', config=client_config)
+dynamodb = boto3.client('dynamodb', config=client_config)
+originals_budget = thumbnails.MemoryBudget(MEMORY_M * 1024 * 1024 * thumbnails.ORIGINALS_MEMORY_FRACTION)
+decode_budget = thumbnails.MemoryBudget(MEMORY_M * 1024 * 1024 * thumbnails.DECODE_MEMORY_FRACTION)
+
+def lambda_handler(event, context):
+    task_id = event["TaskId"]
+    result_table = event["ResultTable"]
+    file_paths = sorted(set(event["FilePaths"]))
+    task_bucket = event.get("Bucket")
+
+    deadline = time.time() + context.get_remaining_time_in_millis() / 1000 - SAVE_RESERVED_S
+
+    # Skip the images built since the request
+    db_items = {i["file_path"]["S"]: i for i in thumbnails.read(dynamodb, result_table, file_paths)}
+    built = [f for f in file_paths if f in db_items and thumbnails.from_item(db_items[f]) is not None]
+    file_paths = [f for f in file_paths if f not in built]
+    interrupted = [f for f in file_paths if f in db_items and thumbnails.attempts(db_items[f]) > 0]
+    print(f"1. Thumbnails to build: {len(file_paths)}, already built: {len(built)}, interrupted before: {len(interrupted)}")
+    if len(file_paths) == 0:
+        return {"Built": 0, "Failed": 0}
+    with ThreadPoolExecutor(max_workers=THREAD_POOL_SIZE) as executor:
+        list(executor.map(lambda f: update_thumbnail(result_table, f, "ADD #a :one", {":one": {"N": "1"}}), file_paths))
+
+    # Thumbnails: the images of an interrupted invocation one at a time, then the others on the thread pool
+    start_ts = time.time()
+    images, failed = {}, {}
+    for file_path in interrupted:
+        if time.time() >= deadline:
+            break
+        update_thumbnail(result_table, file_path, "SET thumbnail = :t", {":t": thumbnails.error_item(INTERRUPTED_ERROR)})
+        isolated_images, isolated_failed = build_thumbnails([file_path], task_bucket)
+        images.update(isolated_images)
+        failed.update(isolated_failed)
+        if file_path not in isolated_failed:
+            update_thumbnail(result_table, file_path, "REMOVE thumbnail")
+    fresh = [f for f in file_paths if f not in interrupted]
+    fresh_images, fresh_failed = build_thumbnails(fresh, task_bucket)
+    images.update(fresh_images)
+    failed.update(fresh_failed)
+    print(f"2. Built {len(images)} thumbnails in {round(time.time() - start_ts, 2)}s. Failed: {len(failed)}")
+
+    # Sprite sheets
+    items = {}
+    paths = list(images.keys())
+    for n in range(0, len(paths), thumbnails.SPRITE_MAX_IMAGES):
+        sheet_paths = paths[n:n + thumbnails.SPRITE_MAX_IMAGES]
+        bucket = task_bucket or sheet_paths[0][len("s3://"):].split("/", 1)[0]
+        sprite = thumbnails.sprite_uri(bucket, task_id, sheet_paths)
+        body, boxes = thumbnails.make_sprite([images[p] for p in sheet_paths])
+        put_object(sprite, body)
+        for file_path, box in zip(sheet_paths, boxes):
+            items[file_path] = thumbnails.to_item(thumbnails.thumbnail_uri(file_path, bucket=task_bucket), sprite, box)
+    print(f"3. Uploaded {-(-len(paths) // thumbnails.SPRITE_MAX_IMAGES)} sprite sheets")
+
+    # Result items
+    for file_path, error in failed.items():
+        items[file_path] = thumbnails.error_item(error)
+    with ThreadPoolExecutor(max_workers=THREAD_POOL_SIZE) as executor:
+        list(executor.map(lambda i: update_thumbnail(result_table, i[0], "SET thumbnail = :t", {":t": i[1]}), items.items()))
+    print(f"4. Saved {len(items)} thumbnails to {result_table}")
+
+    return {"Built": len(images), "Failed": len(failed)}
+
+def build_thumbnails(file_paths, task_bucket=None):
+    def build(file_path):
+        try:
+            response = get_object(file_path)
+        except Exception as ex:
+            # Missing or unreadable now: may be retried by a later request
+            print(f"Failed to read {file_path}", ex)
+            return file_path, None, None
+        # The original is held until its thumbnail is made
+        with originals_budget.hold(response["ContentLength"]):
+            try:
+                body = response["Body"].read()
+            except Exception as ex:
+                print(f"Failed to read {file_path}", ex)
+                return file_path, None, None
+            try:
+                img, thumbnail = thumbnails.make_thumbnail(io.BytesIO(body), decode_budget)
+            except Exception as ex:
+                print(f"Failed to thumbnail {file_path}", ex)
+                return file_path, None, str(ex)[:200]
+        try:
+            put_object(thumbnails.thumbnail_uri(file_path, bucket=task_bucket), thumbnail)
+            return file_path, img, None
+        except Exception as ex:
+            print(f"Failed to upload the thumbnail of {file_path}", ex)
+            return file_path, None, None
+
+    images, failed = {}, {}
+    if len(file_paths) == 0:
+        return images, failed
+    # Only the thumbnails are kept: the originals and the decoded images are bounded by the memory budgets
+    with ThreadPoolExecutor(max_workers=THREAD_POOL_SIZE) as executor:
+        for file_path, img, error in executor.map(build, file_paths):
+            if img is not None:
+                images[file_path] = img
+            elif error is not None:
+                failed[file_path] = error
+    return images, failed
+
+def update_thumbnail(result_table, file_path, update_expression, values=None):
+    kwargs = {"ExpressionAttributeValues": values} if values is not None else {}
+    if "#a" in update_expression:
+        kwargs["ExpressionAttributeNames"] = {"#a": thumbnails.ATTEMPTS_ATTRIBUTE}
+    try:
+        dynamodb.update_item(
+            TableName=result_table,
+            Key={"file_path": {"S": file_path}},
+            UpdateExpression=update_expression,
+            ConditionExpression="attribute_exists(file_path)",
+            **kwargs
+        )
+    except dynamodb.exceptions.ConditionalCheckFailedException:
+        print(f"No moderation result for {file_path}")
+
+def get_object(s3_uri):
+    bucket, key = s3_uri[len("s3://"):].split("/", 1)
+    return s3.get_object(Bucket=bucket, Key=key)
+
+def put_object(s3_uri, body):
+    bucket, key = s3_uri[len("s3://"):].split("/", 1)
+    s3.put_object(Bucket=bucket, Key=key, Body=body, ContentType="image/jpeg", CacheControl="max-age=86400")
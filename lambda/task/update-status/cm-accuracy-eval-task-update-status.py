@@ -4,6 +4,8 @@ from datetime import datetime
 import os
 
 VALID_STATUS = ["CREATED", "MODERATING", "MODERATION_COMPLETED", "HUMAN_REVIEWING", "COMPLETED", "FAILED"]
+# Set at the end of a moderation run: the reviews may have started (or finished) while it ran, their status is kept
+REVIEW_STATUS = ["HUMAN_REVIEWING", "COMPLETED"]
 DYNAMO_TASK_TABLE = os.environ["DYNAMODB_TASK_TABLE"]
 
 dynamodb = boto3.client('dynamodb')
@@ -33,12 +35,24 @@ def lambda_handler(event, context):
     )        
     item = d_response["Item"]
     
-    # Update DB item
-    item["status"]["S"] = status
-    d_response = dynamodb.put_item(
-        TableName=DYNAMO_TASK_TABLE,
-        Item=item,
-    )
+    # Update DB item: only the status, the task counters are updated concurrently
+    condition = {}
+    values = {":s": {"S": status}}
+    if status == "MODERATION_COMPLETED":
+        condition = {"ConditionExpression": "NOT #s IN (:reviewing, :completed)"}
+        values.update({":reviewing": {"S": REVIEW_STATUS[0]}, ":completed": {"S": REVIEW_STATUS[1]}})
+    try:
+        d_response = dynamodb.update_item(
+            TableName=DYNAMO_TASK_TABLE,
+            Key={"id" : { "S": id}},
+            UpdateExpression="SET #s = :s",
+            ExpressionAttributeNames={"#s": "status"},
+            ExpressionAttributeValues=values,
+            **condition
+        )
+        item["status"]["S"] = status
+    except dynamodb.exceptions.ConditionalCheckFailedException:
+        print(f"Task {id} is in review, status {item['status']['S']} kept instead of {status}")
     
     # TODO implement
     return {
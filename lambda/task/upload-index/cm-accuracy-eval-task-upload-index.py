@@ -0,0 +1,111 @@
+'''
+Lambda function maintaining the upload index of the tasks (cm_accuracy_eval.upload_index). The S3 put and delete notifications
+of the input folder are buffered in an SQS queue and delivered in batches:
+1. Parse the uploads from the messages: task id, key, size, ETag and sequencer. The .temp marker is skipped
+2. Check the extension and the size of the new objects, then read the first bytes of the others concurrently (ranged GET) and
+   sniff the image format
+3. Save the index items (accepted, rejected with the reason, or deleted) and add their changes to the task counters in one
+   transaction per task. Events older than the indexed one, or indexed already, are ignored
+Failed messages are reported in batchItemFailures: SQS only redelivers those, and moves them to the dead-letter queue after
+the maximum receive count.
+'''
+import json
+import urllib.parse
+import boto3
+import os
+from concurrent.futures import ThreadPoolExecutor
+from botocore.config import Config
+from cm_accuracy_eval import upload_index
+
+DYNAMO_TASK_TABLE = os.environ["DYNAMODB_TASK_TABLE"]
+DYNAMO_UPLOAD_INDEX_TABLE = os.environ["DYNAMODB_UPLOAD_INDEX_TABLE"]
+S3_INPUT_PREFIX = os.environ["S3_INPUT_PREFIX"]
+SUPPORTED_FILE_TYPES = os.environ["SUPPORTED_FILE_TYPES"].split(',')
+MAX_IMAGE_BYTES = int(os.environ.get("MAX_IMAGE_BYTES", str(upload_index.MAX_IMAGE_BYTES)))
+SUPPORTED_FORMATS = os.environ.get("SUPPORTED_FORMATS", ",".join(upload_index.SUPPORTED_FORMATS)).split(',')
+THREAD_POOL_SIZE = int(os.environ.get("THREAD_POOL_SIZE", "16"))
+
+client_config = Config(max_pool_connections=THREAD_POOL_SIZE)
+s3 = boto3.client('s3', config=client_config)
+dynamodb = boto3.client('dynamodb', config=client_config)
+
+def lambda_handler(event, context):
+    # Parse uploads from the SQS messages (or S3 event records when invoked by S3 directly)
+    uploads = []
+    for record in event.get('Records', []):
+        message_id = record.get('messageId')
+        # s3:TestEvent messages have no records
+        s3_records = json.loads(record['body']).get('Records', []) if 'body' in record else [record]
+        for r in s3_records:
+            key = urllib.parse.unquote_plus(r['s3']['object']['key'], encoding='utf-8')
+            task_id = upload_index.parse_key(key, S3_INPUT_PREFIX)
+            if task_id is None:
+                continue
+            uploads.append({
+                "message_id": message_id,
+                "task_id": task_id,
+                "bucket": r['s3']['bucket']['name'],
+                "key": key,
+                "deleted": r['eventName'].startswith('ObjectRemoved'),
+                "size": r['s3']['object'].get('size', 0),
+                "etag": r['s3']['object'].get('eTag'),
+                "sequencer": upload_index.sequencer(r['s3']['object']['sequencer']),
+            })
+    print("1. Parse uploads from messages: ", len(uploads))
+
+    # Validate: the format is only sniffed for the objects passing the extension and size checks
+    failed = set()
+    for u in uploads:
+        u["reason"] = None if u["deleted"] else upload_index.check(u["key"], u["size"], SUPPORTED_FILE_TYPES, MAX_IMAGE_BYTES)
+    to_sniff = [u for u in uploads if not u["deleted"] and u["reason"] is None]
+    with ThreadPoolExecutor(max_workers=min(THREAD_POOL_SIZE, max(len(to_sniff), 1))) as executor:
+        for u, header in zip(to_sniff, executor.map(read_header, to_sniff)):
+            if header is False:
+                failed.add(u["message_id"])
+            elif header is None:
+                # Deleted since: indexed by the delete event
+                u["skipped"] = True
+            else:
+                u["format"] = upload_index.sniff_format(header)
+                u["reason"] = upload_index.check_format(u["format"], SUPPORTED_FORMATS)
+    print("2. Sniffed image formats: ", len(to_sniff), "failed:", len(failed))
+
+    # Save index items with the counter changes, per task
+    by_task = {}
+    for u in uploads:
+        if u["message_id"] not in failed and not u.get("skipped"):
+            by_task.setdefault(u["task_id"], []).append(u)
+    deltas = {}
+    with ThreadPoolExecutor(max_workers=min(THREAD_POOL_SIZE, max(len(by_task), 1))) as executor:
+        for (task_id, task_uploads), delta in zip(by_task.items(), executor.map(save, by_task.values())):
+            if delta is None:
+                failed.update([u["message_id"] for u in task_uploads])
+            else:
+                deltas[task_id] = delta
+    print("3. Saved index items and task counters: ", deltas)
+
+    if None in failed:
+        # Invoked by S3 directly: no partial batch response
+        raise Exception(f"Failed to index {len(failed)} uploads")
+    return {"batchItemFailures": [{"itemIdentifier": m} for m in failed]}
+
+def read_header(upload):
+    '''First bytes of an uploaded object. None if the object was deleted since, False on error.'''
+    try:
+        body = s3.get_object(Bucket=upload["bucket"], Key=upload["key"], Range=f"bytes=0-{upload_index.SNIFF_BYTES - 1}")["Body"]
+        return body.read()
+    except s3.exceptions.NoSuchKey:
+        return None
+    except Exception as ex:
+        print(f"Failed to read s3://{upload['bucket']}/{upload['key']}", ex)
+        return False
+
+def save(uploads):
+    '''Save the index items of a task's uploads. Returns the change to the task counters, None on error.'''
+    items = [upload_index.new_item(u["task_id"], u["key"], u["sequencer"], size=u["size"], etag=u["etag"],
+        format=u.get("format"), reason=u["reason"], deleted=u["deleted"]) for u in uploads]
+    try:
+        return upload_index.apply(dynamodb, DYNAMO_UPLOAD_INDEX_TABLE, DYNAMO_TASK_TABLE, uploads[0]["task_id"], items)
+    except Exception as ex:
+        print(f"Failed to index the uploads of task {uploads[0]['task_id']}: ", ex)
+        return None
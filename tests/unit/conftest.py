@@ -0,0 +1,38 @@
+import importlib.util
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(__file__), "..", "..")
+# Shared library of the Lambda functions (common layer)
+sys.path.insert(0, os.path.join(ROOT, "lambda", "layer-common", "python"))
+# Benchmarks print their timings (pytest -s) and are only run with RUN_BENCHMARKS=1
+RUN_BENCHMARKS = os.environ.get("RUN_BENCHMARKS") == "1"
+
+
+def pytest_configure(config):
+    config.addinivalue_line("markers", "benchmark: timing run, skipped unless RUN_BENCHMARKS=1")
+
+
+def pytest_collection_modifyitems(config, items):
+    if RUN_BENCHMARKS:
+        return
+    skip = pytest.mark.skip(reason="benchmark, set RUN_BENCHMARKS=1 to run it")
+    for item in items:
+        if "benchmark" in item.keywords:
+            item.add_marker(skip)
+
+
+@pytest.fixture
+def load_lambda(monkeypatch):
+    '''Load a Lambda handler module from its path under lambda/, with the environment variables given.'''
+    def load(path, **environ):
+        monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+        for k, v in environ.items():
+            monkeypatch.setenv(k, v)
+        spec = importlib.util.spec_from_file_location(os.path.basename(path)[:-len(".py")].replace("-", "_"), os.path.join(ROOT, "lambda", path))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        return module
+    return load
@@ -0,0 +1,152 @@
+'''The A2I ETL saves a review and its counter changes together: a redelivered or concurrent review counts once.'''
+import io
+import json
+import re
+
+import pytest
+from botocore.exceptions import ClientError
+
+from cm_accuracy_eval import task_counters
+
+PREFIX = "cm-accuracy-eval-result"
+TASK_TABLE = "task"
+RESULT_TABLE = f"{PREFIX}-task1"
+A2I_KEY = f"a2i/{RESULT_TABLE}/2024/01/01/00/00/00/review/output.json"
+LABEL = {"name": "Weapons", "parentName": "Violence"}
+
+
+class FakeS3:
+    def __init__(self):
+        self.objects = {}
+
+    def get_object(self, Bucket, Key):
+        return {"Body": io.BytesIO(self.objects[Key])}
+
+
+class FakeDynamoDB:
+    '''Task and result tables. fail_counters: number of transactions failing on the counter update.'''
+    def __init__(self, rows, fail_counters=0):
+        self.rows = {r["file_path"]["S"]: r for r in rows}
+        self.task = {"id": {"S": "task1"}, "status": {"S": "MODERATION_COMPLETED"}}
+        self.task.update({c: {"N": "0"} for c in task_counters.COUNTERS})
+        for r in rows:
+            for c, v in task_counters.item_counts(r).items():
+                self.task[c]["N"] = str(int(self.task[c]["N"]) + v)
+        self.fail_counters = fail_counters
+        # Called between the read of the rows and their transaction
+        self.before_write = None
+
+    def batch_get_item(self, RequestItems):
+        keys = RequestItems[RESULT_TABLE]["Keys"]
+        items = [json.loads(json.dumps(self.rows[k["file_path"]["S"]])) for k in keys if k["file_path"]["S"] in self.rows]
+        return {"Responses": {RESULT_TABLE: items}}
+
+    def get_item(self, TableName, Key, ConsistentRead=False):
+        return {"Item": json.loads(json.dumps(self.task))}
+
+    def update_item(self, TableName, Key, UpdateExpression, ConditionExpression, ExpressionAttributeNames,
+            ExpressionAttributeValues):
+        assert UpdateExpression.startswith("SET #s = :s")
+        self.task["status"] = ExpressionAttributeValues[":s"]
+
+    def unchanged(self, put):
+        row = self.rows.get(put["Item"]["file_path"]["S"])
+        if put["ConditionExpression"] == "attribute_not_exists(file_path)":
+            return row is None
+        for name, flag in put["ExpressionAttributeNames"].items():
+            flagged = row.get(flag, {}).get("N") == "1"
+            if flagged != (re.search(f"{name} = :one", put["ConditionExpression"]) is not None):
+                return False
+        return True
+
+    def transact_write_items(self, TransactItems):
+        if self.before_write is not None:
+            before_write, self.before_write = self.before_write, None
+            before_write()
+        puts = [a["Put"] for a in TransactItems if "Put" in a]
+        # One reason per action: the counter update is last
+        reasons = [{"Code": "None" if self.unchanged(p) else "ConditionalCheckFailed"} for p in puts] + [{"Code": "None"}]
+        if any([r["Code"] != "None" for r in reasons]):
+            raise ClientError({"Error": {"Code": "TransactionCanceledException"}, "CancellationReasons": reasons},
+                "TransactWriteItems")
+        if self.fail_counters > 0:
+            self.fail_counters -= 1
+            raise ClientError({"Error": {"Code": "InternalServerError"}}, "TransactWriteItems")
+        for p in puts:
+            self.rows[p["Item"]["file_path"]["S"]] = p["Item"]
+        for a in TransactItems:
+            if "Update" in a:
+                update = a["Update"]
+                for name, value in zip(update["ExpressionAttributeNames"].values(), update["ExpressionAttributeValues"].values()):
+                    self.task[name] = {"N": str(int(self.task.get(name, {"N": "0"})["N"]) + int(value["N"]))}
+
+
+class Context:
+    def get_remaining_time_in_millis(self):
+        return 60000
+
+
+def row(n, duplicates=()):
+    item = {"file_path": {"S": f"s3://bucket/input/task1/{n}.jpg"}, "issue_flag": {"N": "1"},
+        "rek_results": {"L": [{"M": {"category": {"S": LABEL["name"]}, "parent_category": {"S": LABEL["parentName"]}}}]}}
+    if len(duplicates) > 0:
+        item["duplicates"] = {"L": [{"S": f"s3://bucket/input/task1/{d}.jpg"} for d in duplicates]}
+    return item
+
+
+def duplicate(n, of):
+    item = row(n)
+    item["duplicate_of"] = {"S": f"s3://bucket/input/task1/{of}.jpg"}
+    return item
+
+
+def a2i_output(n, labels):
+    return json.dumps({
+        "inputContent": {"aiServiceRequest": {"image": {"s3Object": {"bucket": "bucket", "name": f"input/task1/{n}.jpg"}}}},
+        "humanAnswers": [{"answerContent": {"AWS/Rekognition/DetectModerationLabels/Image/V3": {"moderationLabels": labels}}}]
+    }).encode()
+
+
+@pytest.fixture
+def handler(load_lambda):
+    return load_lambda("task/s3-trigger/cm-accuracy-eval-task-s3-a2i-etl.py", DYNAMODB_TABLE_PREFIX=PREFIX,
+        DYNAMODB_TASK_TABLE=TASK_TABLE, DYNAMODB_INDEX_NAME="index")
+
+
+def deliver(handler, n, labels):
+    key = A2I_KEY.replace("output", f"output-{n}")
+    handler.s3.objects[key] = a2i_output(n, labels)
+    body = json.dumps({"Records": [{"s3": {"bucket": {"name": "bucket"}, "object": {"key": key}}}]})
+    return handler.lambda_handler({"Records": [{"messageId": f"m{n}", "body": body}]}, Context())["batchItemFailures"]
+
+
+def counters(dynamodb):
+    return task_counters.read(dynamodb.task)
+
+
+def test_failed_counter_update_is_counted_on_redelivery(handler):
+    handler.s3 = FakeS3()
+    handler.dynamodb = dynamodb = FakeDynamoDB([row(0, duplicates=[1]), duplicate(1, of=0), row(2)], fail_counters=1)
+    # Nothing is saved when the counter update fails: the message is redelivered
+    assert deliver(handler, 0, [LABEL]) == [{"itemIdentifier": "m0"}]
+    assert "reviewed_flag" not in dynamodb.rows["s3://bucket/input/task1/0.jpg"]
+    assert deliver(handler, 0, [LABEL]) == []
+    assert counters(dynamodb)["reviewed"] == 2 and counters(dynamodb)["true_positive"] == 2
+    # A repeated delivery adds nothing
+    assert deliver(handler, 0, [LABEL]) == []
+    assert counters(dynamodb)["reviewed"] == 2
+    assert deliver(handler, 2, []) == []
+    assert counters(dynamodb)["reviewed"] == 3 and counters(dynamodb)["false_positive"] == 1
+    assert dynamodb.task["status"]["S"] == "COMPLETED"
+
+
+def test_concurrent_delivery_counts_once(handler):
+    handler.s3 = FakeS3()
+    handler.dynamodb = dynamodb = FakeDynamoDB([row(0), row(1)])
+    # Another delivery of the same review saves it between the read and the write of this one
+    dynamodb.before_write = lambda: deliver(handler, 0, [LABEL])
+    assert deliver(handler, 0, [LABEL]) == [{"itemIdentifier": "m0"}]
+    assert counters(dynamodb)["reviewed"] == 1
+    assert deliver(handler, 0, [LABEL]) == []
+    assert counters(dynamodb)["reviewed"] == 1
+    assert dynamodb.task["status"]["S"] == "HUMAN_REVIEWING"
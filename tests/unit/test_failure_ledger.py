@@ -0,0 +1,95 @@
+'''Failure ledger: classification of the moderation errors, and the entries recorded, retried and summarized.'''
+import pytest
+from botocore.exceptions import ClientError, ReadTimeoutError
+
+from cm_accuracy_eval import failure_ledger
+
+TABLE = "ledger"
+
+
+class Paginator:
+    def __init__(self, method):
+        self.method = method
+
+    def paginate(self, **kwargs):
+        yield self.method(**kwargs)
+
+
+class FakeDynamoDB:
+    def __init__(self):
+        self.items = {}
+
+    def update_item(self, TableName, Key, UpdateExpression, ExpressionAttributeNames, ExpressionAttributeValues):
+        values = ExpressionAttributeValues
+        item = self.items.setdefault((Key["task_id"]["S"], Key["file_path"]["S"]), dict(Key, first_failed_at=values[":now"]))
+        item.update({"bucket": values[":b"], "s3_key": values[":k"], "duplicates": values[":d"], "error_class": values[":c"],
+            "error_code": values[":e"], "error_message": values[":m"], "last_failed_at": values[":now"]})
+        item["attempts"] = {"N": str(int(item.get("attempts", {"N": "0"})["N"]) + 1)}
+
+    def get_paginator(self, name):
+        assert name == "query"
+        return Paginator(self.query)
+
+    def query(self, TableName, KeyConditionExpression, ExpressionAttributeValues, FilterExpression=None):
+        classes = [v["S"] for k, v in ExpressionAttributeValues.items() if k.startswith(":c")]
+        items = [i for (t, p), i in sorted(self.items.items()) if t == ExpressionAttributeValues[":t"]["S"]]
+        if FilterExpression is not None:
+            items = [i for i in items if i["error_class"]["S"] in classes]
+        return {"Items": items}
+
+    def batch_write_item(self, RequestItems):
+        for r in RequestItems[TABLE]:
+            key = r["DeleteRequest"]["Key"]
+            self.items.pop((key["task_id"]["S"], key["file_path"]["S"]), None)
+        return {"UnprocessedItems": {}}
+
+
+def client_error(code):
+    return ClientError({"Error": {"Code": code, "Message": f"{code} message"}}, "DetectModerationLabels")
+
+
+@pytest.mark.parametrize("ex, code, error_class, retryable", [
+    (client_error("ThrottlingException"), "ThrottlingException", failure_ledger.THROTTLE, True),
+    (client_error("ProvisionedThroughputExceededException"), "ProvisionedThroughputExceededException", failure_ledger.THROTTLE, True),
+    (client_error("InvalidImageFormatException"), "InvalidImageFormatException", failure_ledger.INVALID_IMAGE, False),
+    (client_error("ImageTooLargeException"), "ImageTooLargeException", failure_ledger.INVALID_IMAGE, False),
+    (client_error("AccessDenied"), "AccessDenied", failure_ledger.ACCESS, False),
+    (client_error("InvalidS3ObjectException"), "InvalidS3ObjectException", failure_ledger.ACCESS, False),
+    (client_error("InternalServerError"), "InternalServerError", failure_ledger.TRANSIENT, True),
+    (ReadTimeoutError(endpoint_url="https://rekognition"), "ReadTimeoutError", failure_ledger.TRANSIENT, True),
+    (client_error("SomethingNew"), "SomethingNew", failure_ledger.UNKNOWN, True),
+    (ValueError("bad"), "ValueError", failure_ledger.UNKNOWN, True),
+])
+def test_classify(ex, code, error_class, retryable):
+    assert failure_ledger.error_code(ex) == code
+    assert failure_ledger.classify(code) == error_class
+    assert failure_ledger.is_retryable(code) == retryable
+
+
+def test_entries_count_attempts_and_keep_the_last_error():
+    dynamodb = FakeDynamoDB()
+    failure_ledger.record(dynamodb, TABLE, "task1", "bucket", "input/a.jpg", "ThrottlingException", "slow down", now=100)
+    failure_ledger.record(dynamodb, TABLE, "task1", "bucket", "input/a.jpg", "InternalServerError", "", now=200,
+        duplicates=["s3://bucket/input/a2.jpg"])
+    failure_ledger.record(dynamodb, TABLE, "task1", "bucket", "input/b.jpg", "InvalidImageFormatException", "x" * 1000, now=300)
+    failure_ledger.record(dynamodb, TABLE, "task2", "bucket", "input/c.jpg", "ThrottlingException", "slow down", now=300)
+
+    a = dynamodb.items[("task1", "s3://bucket/input/a.jpg")]
+    assert a["attempts"]["N"] == "2" and a["first_failed_at"]["N"] == "100" and a["last_failed_at"]["N"] == "200"
+    assert a["error_class"]["S"] == failure_ledger.TRANSIENT and a["error_message"]["S"] == "InternalServerError"
+    assert a["duplicates"] == {"L": [{"S": "s3://bucket/input/a2.jpg"}]}
+    b = dynamodb.items[("task1", "s3://bucket/input/b.jpg")]
+    assert len(b["error_message"]["S"]) == failure_ledger.MAX_MESSAGE_LENGTH
+
+    retryable = [i["file_path"]["S"] for i in failure_ledger.entries(dynamodb, TABLE, "task1", retryable_only=True)]
+    assert retryable == ["s3://bucket/input/a.jpg"]
+    assert failure_ledger.summary(dynamodb, TABLE, "task1") == {"total": 2, "retryable": 1,
+        "by_class": {failure_ledger.TRANSIENT: 1, failure_ledger.INVALID_IMAGE: 1},
+        "by_error": {"InternalServerError": 1, "InvalidImageFormatException": 1}}
+
+    # Moderated by the retry pass
+    failure_ledger.resolve(dynamodb, TABLE, "task1", ["s3://bucket/input/a.jpg", "s3://bucket/input/missing.jpg"])
+    assert failure_ledger.summary(dynamodb, TABLE, "task1")["total"] == 1
+    assert failure_ledger.clear(dynamodb, TABLE, "task1") == 1
+    assert list(failure_ledger.entries(dynamodb, TABLE, "task1")) == []
+    assert failure_ledger.summary(dynamodb, TABLE, "task2")["total"] == 1
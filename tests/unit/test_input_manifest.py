@@ -0,0 +1,133 @@
+'''Input manifests: parsing of the CSV, JSONL and S3 Inventory formats, validation and deduplication of their rows.'''
+import gzip
+import hashlib
+import io
+import json
+
+import pytest
+
+from cm_accuracy_eval import input_manifest
+from cm_accuracy_eval.input_manifest import ManifestError
+
+TYPES = [".jpg", ".png"]
+
+
+class FakeS3:
+    def __init__(self):
+        self.objects = {}
+
+    def get_object(self, Bucket, Key, Range=None):
+        data = self.objects[(Bucket, Key)]
+        if Range is not None:
+            start, end = [int(v) for v in Range[len("bytes="):].split("-")]
+            data = data[start:end + 1]
+        return {"Body": io.BytesIO(data)}
+
+
+def manifest(s3, format, key, text):
+    data = text.encode("utf-8")
+    s3.objects[("manifests", key)] = gzip.compress(data) if key.endswith(".gz") else data
+    return input_manifest.source(format, f"s3://manifests/{key}")
+
+
+def test_parse_s3_uri():
+    assert input_manifest.parse_s3_uri("s3://bucket/input/a b.jpg") == ("bucket", "input/a b.jpg")
+    for uri in ("s3://bucket", "s3://bucket/", "s3:///key", "https://bucket/key", None):
+        with pytest.raises(ManifestError):
+            input_manifest.parse_s3_uri(uri)
+    with pytest.raises(ManifestError):
+        input_manifest.source("xml", "s3://manifests/m.xml")
+
+
+def test_csv_rows():
+    lines = [
+        "bucket,key\n",
+        "images,input/a.jpg\n",
+        "images,input/with+space%C3%A9.jpg\n",
+        "s3://images/input/b.png\n",
+        "\n",
+        "images\n",
+        "s3://images\n",
+    ]
+    assert list(input_manifest.csv_entries(lines)) == [
+        ("images", "input/a.jpg", None),
+        ("images", "input/with spaceé.jpg", None),
+        ("images", "input/b.png", None),
+        None,
+        None,
+    ]
+
+
+def test_jsonl_rows():
+    lines = [
+        '{"s3_uri": "s3://images/input/a.jpg", "size": 100}\n',
+        '{"file_path": "s3://images/input/b.jpg"}\n',
+        '{"bucket": "images", "key": "input/c.jpg", "size": "300"}\n',
+        "\n",
+        '{"key": "input/d.jpg"}\n',
+        "not json\n",
+    ]
+    assert list(input_manifest.jsonl_entries(lines)) == [
+        ("images", "input/a.jpg", 100),
+        ("images", "input/b.jpg", None),
+        ("images", "input/c.jpg", 300),
+        None,
+        None,
+    ]
+
+
+def test_check_reads_the_first_rows_of_a_gzip_manifest():
+    s3 = FakeS3()
+    # Keys that don't compress: the manifest is larger than the bytes check() reads
+    keys = [hashlib.sha256(str(n).encode()).hexdigest() for n in range(5000)]
+    rows = "".join([json.dumps({"s3_uri": f"s3://images/input/{k}.jpg"}) + "\n" for k in keys])
+    source = manifest(s3, "jsonl", "m.jsonl.gz", rows)
+    assert len(s3.objects[("manifests", "m.jsonl.gz")]) > input_manifest.CHECK_BYTES
+    input_manifest.check(s3, source)
+    assert len(list(input_manifest.entries(s3, source))) == 5000
+    with pytest.raises(ManifestError):
+        input_manifest.check(s3, manifest(s3, "csv", "bad.csv", "not an image\n"))
+    with pytest.raises(ManifestError):
+        input_manifest.check(s3, input_manifest.source("csv", "s3://manifests/missing.csv"))
+
+
+def test_csv_inventory_skips_delete_markers_and_older_versions():
+    s3 = FakeS3()
+    rows = [
+        '"images","input/a.jpg","100","true","false"',
+        '"images","input/b%2Bc.jpg","200","true","false"',
+        '"images","input/a.jpg","50","false","false"',
+        '"images","input/d.jpg","","true","true"',
+    ]
+    s3.objects[("inventory", "data/1.csv.gz")] = gzip.compress("\n".join(rows).encode("utf-8"))
+    s3.objects[("manifests", "manifest.json")] = json.dumps({
+        "destinationBucket": "arn:aws:s3:::inventory",
+        "fileFormat": "CSV",
+        "fileSchema": "Bucket, Key, Size, IsLatest, IsDeleteMarker",
+        "files": [{"key": "data/1.csv.gz"}],
+    }).encode("utf-8")
+    source = input_manifest.source("s3_inventory", "s3://manifests/manifest.json")
+    input_manifest.check(s3, source)
+    assert list(input_manifest.entries(s3, source)) == [("images", "input/a.jpg", 100), ("images", "input/b+c.jpg", 200)]
+    s3.objects[("manifests", "manifest.json")] = json.dumps({"destinationBucket": "arn:aws:s3:::inventory",
+        "fileFormat": "Avro", "files": [{"key": "data/1.avro"}]}).encode("utf-8")
+    with pytest.raises(ManifestError):
+        input_manifest.check(s3, source)
+
+
+def test_normalize_validates_and_deduplicates_in_order():
+    rows = [
+        ("images", "input/b.jpg", None),
+        ("images", "input/a.PNG", 100),
+        None,
+        ("images", "input/c.gif", 100),
+        ("images", "input/d.jpg", 0),
+        ("images", "input/e.jpg", 2000),
+        ("images", "input/b.jpg", 100),
+    ]
+    stats = {}
+    assert list(input_manifest.normalize(rows, TYPES, 1000, stats)) == ["input/b.jpg", "input/a.PNG"]
+    assert stats == {"total": 7, "accepted": 2, "duplicates": 1, "invalid": 2, "unsupported": 1, "too_large": 1,
+        "bucket": "images"}
+    with pytest.raises(ManifestError):
+        list(input_manifest.normalize([("images", "input/a.jpg", None), ("other", "input/b.jpg", None)], TYPES, 1000, {}))
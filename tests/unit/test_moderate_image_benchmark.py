@@ -0,0 +1,98 @@
+'''
+Throughput of a moderation batch against a stubbed Rekognition client with a fixed latency: images per second per
+invocation, printed with RUN_BENCHMARKS=1 pytest -s.
+'''
+import threading
+import time
+
+import pytest
+
+MODERATE_IMAGE = "task/moderate-image/cm-accuracy-eval-task-moderate-image.py"
+LATENCY_S = 0.02
+THREAD_POOL_SIZE = 10
+
+
+class StubRekognition:
+    def __init__(self, latency_s):
+        self.latency_s = latency_s
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def detect_moderation_labels(self, **kwargs):
+        time.sleep(self.latency_s)
+        with self._lock:
+            self.calls += 1
+            labeled = self.calls % 4 == 0
+        labels = [{"Name": "Suggestive", "ParentName": "", "Confidence": 80.0}] if labeled else []
+        return {"ModerationLabels": labels, "ModerationModelVersion": "6.1"}
+
+
+class StubDynamoDB:
+    def __init__(self):
+        self.items = 0
+        self._lock = threading.Lock()
+
+    def batch_write_item(self, RequestItems):
+        with self._lock:
+            self.items += sum([len(r) for r in RequestItems.values()])
+        return {"UnprocessedItems": {}}
+
+
+class Context:
+    def __init__(self, remaining_s):
+        self.deadline = time.time() + remaining_s
+
+    def get_remaining_time_in_millis(self):
+        return int((self.deadline - time.time()) * 1000)
+
+
+def load(load_lambda, monkeypatch):
+    handler = load_lambda(MODERATE_IMAGE, MODERATION_THREAD_POOL_SIZE=str(THREAD_POOL_SIZE))
+    monkeypatch.setattr(handler, "rekognition", StubRekognition(LATENCY_S))
+    monkeypatch.setattr(handler, "dynamodb", StubDynamoDB())
+    monkeypatch.setattr(handler, "print", lambda *args, **kwargs: None, raising=False)
+    return handler
+
+
+def batch(size):
+    return {
+        "Items": [{"S3Key": f"input/task/{n:06}.jpg"} for n in range(size)],
+        "BatchInput": {"S3Bucket": "bucket", "DynamoDBTable": "results", "A2IWorkFlowArn": "arn:flow"},
+        "Attempt": 0,
+    }
+
+
+def test_batch_moderates_every_image(load_lambda, monkeypatch):
+    handler = load(load_lambda, monkeypatch)
+    size = 40
+    response = handler.lambda_handler(batch(size), Context(300))
+    assert len(response["Succeeded"]) == size and response["FailedCount"] == 0
+    assert handler.dynamodb.items == size
+    assert handler.rekognition.calls == size
+
+
+@pytest.mark.benchmark
+def test_batch_throughput(load_lambda, monkeypatch):
+    handler = load(load_lambda, monkeypatch)
+    size = 200
+    start = time.time()
+    response = handler.lambda_handler(batch(size), Context(300))
+    duration = time.time() - start
+    rate = size / duration
+    print(f"\nModeration batch: {size} images in {duration:.2f}s, {rate:.1f} images/s per invocation "
+        f"({THREAD_POOL_SIZE} threads, {LATENCY_S * 1000:.0f} ms Rekognition latency)")
+    assert len(response["Succeeded"]) == size and response["FailedCount"] == 0
+    assert handler.dynamodb.items == size
+
+
+def test_batch_stops_at_the_deadline(load_lambda, monkeypatch):
+    handler = load(load_lambda, monkeypatch)
+    size = 200
+    # About 20 images fit before the deadline
+    context = Context(handler.BATCH_RESERVED_S + 2 * LATENCY_S * (size // THREAD_POOL_SIZE) / 10)
+    response = handler.lambda_handler(batch(size), context)
+    left = [f for f in response["Failed"] if f["Error"] == "DeadlineExceeded"]
+    assert len(left) > 0 and len(response["Succeeded"]) + len(left) == size
+    # Returned for the next attempt
+    assert response["FailedCount"] == len(left)
+    assert set([i["S3Key"] for i in response["Items"]]) == set([f["S3Key"] for f in left])
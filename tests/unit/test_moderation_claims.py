@@ -0,0 +1,79 @@
+'''Moderation claims: an image is moderated by one worker, and a claim is taken over once its lease expired.'''
+from cm_accuracy_eval import result_writer
+from cm_accuracy_eval.moderation_claims import ModerationClaims, CLAIMED, DONE, HELD
+
+TABLE = "claims"
+PATH = "s3://bucket/input/task1/a.jpg"
+
+
+class FakeDynamoDB:
+    '''Claim table. unprocessed: number of BatchWriteItem requests leaving every item unprocessed.'''
+    class exceptions:
+        class ConditionalCheckFailedException(Exception):
+            pass
+
+    def __init__(self, unprocessed=0):
+        self.items = {}
+        self.unprocessed = unprocessed
+
+    def put_item(self, TableName, Item, ConditionExpression, ExpressionAttributeNames, ExpressionAttributeValues):
+        old = self.items.get(Item["claim_id"]["S"])
+        now = int(ExpressionAttributeValues[":now"]["N"])
+        if old is not None and not (old["status"]["S"] == CLAIMED and int(old["expires_at"]["N"]) < now):
+            raise self.exceptions.ConditionalCheckFailedException()
+        self.items[Item["claim_id"]["S"]] = Item
+
+    def get_item(self, TableName, Key, ConsistentRead):
+        item = self.items.get(Key["claim_id"]["S"])
+        return {} if item is None else {"Item": item}
+
+    def batch_write_item(self, RequestItems):
+        requests = RequestItems[TABLE]
+        if self.unprocessed > 0:
+            self.unprocessed -= 1
+            return {"UnprocessedItems": {TABLE: requests}}
+        for r in requests:
+            self.items[r["PutRequest"]["Item"]["claim_id"]["S"]] = r["PutRequest"]["Item"]
+        return {"UnprocessedItems": {}}
+
+
+def claims(dynamodb):
+    return ModerationClaims(dynamodb, TABLE, "task1", lease_s=900)
+
+
+def test_claimed_image_is_held_until_its_lease_expires():
+    dynamodb = FakeDynamoDB()
+    assert claims(dynamodb).claim(PATH, now=1000) == CLAIMED
+    assert claims(dynamodb).claim(PATH, now=1000 + 900) == HELD
+    # The worker died: the claim is taken over
+    assert claims(dynamodb).claim(PATH, now=1000 + 901) == CLAIMED
+    assert dynamodb.items[f"task1#{PATH}"]["expires_at"]["N"] == str(1000 + 901 + 900)
+
+
+def test_done_image_is_skipped():
+    dynamodb = FakeDynamoDB()
+    worker = claims(dynamodb)
+    worker.claim(PATH, now=1000)
+    assert worker.complete([PATH]) == []
+    retried = claims(dynamodb)
+    assert retried.claim(PATH, now=1000) == DONE and retried.skipped == 1
+    # DONE doesn't expire
+    assert retried.claim(PATH, now=10 ** 9) == DONE
+
+
+def test_released_image_is_claimed_again_at_once():
+    dynamodb = FakeDynamoDB()
+    worker = claims(dynamodb)
+    worker.claim(PATH, now=1000)
+    worker.release([PATH])
+    assert claims(dynamodb).claim(PATH, now=1001) == CLAIMED
+
+
+def test_unsaved_claims_are_returned(monkeypatch):
+    # The writer resends the unprocessed items with backoff: no delay in the test
+    monkeypatch.setattr(result_writer.time, "sleep", lambda s: None)
+    other = "s3://bucket/input/task1/b.jpg"
+    dynamodb = FakeDynamoDB(unprocessed=100)
+    worker = claims(dynamodb)
+    worker.claim(PATH, now=1000)
+    assert sorted(worker.complete([PATH, other])) == sorted([PATH, other])
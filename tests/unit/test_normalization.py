@@ -0,0 +1,100 @@
+'''Image normalization: which images are normalized, the derived copies and their mapping back to the originals.'''
+import io
+import random
+
+import pytest
+from PIL import Image
+
+from cm_accuracy_eval import normalization
+from cm_accuracy_eval.normalization import Normalizer, NormalizationError
+
+TASK_BUCKET = "task-bucket"
+KB = 1024
+
+
+class FakeS3:
+    def __init__(self, objects):
+        self.objects = objects
+        self.puts = {}
+        self.heads = 0
+
+    def head_object(self, Bucket, Key):
+        self.heads += 1
+        return {"ContentLength": len(self.objects[(Bucket, Key)])}
+
+    def get_object(self, Bucket, Key):
+        body = self.objects[(Bucket, Key)]
+        return {"ContentLength": len(body), "Body": io.BytesIO(body)}
+
+    def put_object(self, Bucket, Key, Body, ContentType):
+        self.puts[(Bucket, Key)] = Body
+
+
+def image(format, size=(64, 48), mode="RGB", noise=False):
+    out = io.BytesIO()
+    if noise:
+        # Doesn't compress: the file is about as large as its pixels
+        img = Image.frombytes(mode, size, random.Random(1).randbytes(size[0] * size[1] * len(mode)))
+    else:
+        img = Image.new(mode, size, (200, 30, 30, 128) if mode == "RGBA" else (200, 30, 30))
+    img.save(out, format=format)
+    return out.getvalue()
+
+
+@pytest.mark.parametrize("key, size, normalized", [
+    ("input/a.jpg", 100 * KB, False),
+    ("input/a.JPEG", None, False),
+    ("input/a.png", normalization.SIZE_THRESHOLD_BYTES, False),
+    ("input/a.png", normalization.SIZE_THRESHOLD_BYTES + 1, True),
+    ("input/a.webp", 10 * KB, True),
+    ("input/a.HEIC", None, True),
+    ("input/a.gif", None, True),
+])
+def test_needs_normalization(key, size, normalized):
+    assert normalization.needs_normalization(key, size) == normalized
+
+
+def test_original_path_of_a_derived_copy():
+    key = normalization.derived_key("images", "input/task1/a b.webp")
+    assert key == "derived/images/input/task1/a b.webp.jpg"
+    assert normalization.original_path(f"s3://{TASK_BUCKET}/{key}", TASK_BUCKET) == "s3://images/input/task1/a b.webp"
+    # Not a derived copy: unchanged
+    for path in ("s3://images/input/task1/a.jpg", f"s3://other/{key}", f"s3://{TASK_BUCKET}/derived/a.png"):
+        assert normalization.original_path(path, TASK_BUCKET) == path
+
+
+def test_transparent_image_is_downscaled_to_jpeg():
+    body, size = normalization.normalize(io.BytesIO(image("PNG", (400, 100), "RGBA")), max_dimension=100)
+    assert size == (400, 100)
+    with Image.open(io.BytesIO(body)) as img:
+        assert img.format == "JPEG" and img.mode == "RGB" and img.size == (100, 25)
+    with pytest.raises(NormalizationError):
+        normalization.normalize(io.BytesIO(b"not an image"))
+
+
+def test_normalizer_copies_the_images_rekognition_can_not_read():
+    s3 = FakeS3({
+        ("images", "input/small.jpg"): image("JPEG"),
+        ("images", "input/large.png"): image("PNG", (300, 300), noise=True),
+        ("images", "input/a.gif"): image("GIF"),
+        ("images", "input/broken.webp"): b"not an image",
+    })
+    normalizer = Normalizer(s3, TASK_BUCKET, size_threshold=1 * KB, max_dimension=64, concurrency=1)
+    assert normalizer.prepare("images", "input/small.jpg") is None
+    copy = normalizer.prepare("images", "input/large.png")
+    assert copy["Bucket"] == TASK_BUCKET and copy["Key"] == "derived/images/input/large.png.jpg"
+    assert copy["SourceBytes"] == len(s3.objects[("images", "input/large.png")]) and copy["DerivedBytes"] == len(s3.puts[(TASK_BUCKET, copy["Key"])])
+    # Size of the formats Rekognition doesn't read isn't needed
+    heads = s3.heads
+    assert normalizer.prepare("images", "input/a.gif")["Key"] == "derived/images/input/a.gif.jpg"
+    assert s3.heads == heads
+    with pytest.raises(NormalizationError):
+        normalizer.prepare("images", "input/broken.webp")
+    assert normalizer.normalized == 2
+
+
+def test_source_too_large_is_not_read():
+    s3 = FakeS3({("images", "input/a.tiff"): image("TIFF")})
+    with pytest.raises(NormalizationError):
+        normalization.normalize_object(s3, "images", "input/a.tiff", TASK_BUCKET, max_source_bytes=100)
+    assert s3.puts == {}
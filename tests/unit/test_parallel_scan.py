@@ -0,0 +1,52 @@
+'''ParallelScan resumes from its checkpoint without reading a page handed out again.'''
+import pytest
+
+from cm_accuracy_eval.parallel_scan import ParallelScan
+
+
+class FakeDynamoDB:
+    def __init__(self, n, page_size=10):
+        self.rows = [{"file_path": {"S": f"s3://bucket/input/{i}.jpg"}} for i in range(n)]
+        self.page_size = page_size
+
+    def scan(self, TableName, Segment, TotalSegments, ExclusiveStartKey=None):
+        rows = [r for i, r in enumerate(self.rows) if i % TotalSegments == Segment]
+        start = 0 if ExclusiveStartKey is None else int(ExclusiveStartKey["i"]["N"])
+        response = {"Items": rows[start:start + self.page_size]}
+        if start + self.page_size < len(rows):
+            response["LastEvaluatedKey"] = {"i": {"N": str(start + self.page_size)}}
+        return response
+
+
+def read(dynamodb, stop_after_pages):
+    '''Read the table over invocations stopping after a number of pages. Returns the file paths read.'''
+    read, checkpoint = [], None
+    while True:
+        scan = ParallelScan(dynamodb, "table", total_segments=3, checkpoint=checkpoint)
+        for n, page in enumerate(scan.pages()):
+            read += [i["file_path"]["S"] for i in page["Items"]]
+            if n + 1 == stop_after_pages:
+                break
+        checkpoint = scan.checkpoint()
+        if checkpoint is None:
+            return read
+
+
+@pytest.mark.parametrize("stop_after_pages", [1, 2, 5])
+def test_caller_stopping_after_a_page_reads_every_row_once(stop_after_pages):
+    dynamodb = FakeDynamoDB(95)
+    read_paths = read(dynamodb, stop_after_pages)
+    assert sorted(read_paths) == sorted([r["file_path"]["S"] for r in dynamodb.rows])
+
+
+def test_checkpoint_raises_in_the_middle_of_a_page():
+    scan = ParallelScan(FakeDynamoDB(95), "table", total_segments=3)
+    items = scan.items()
+    for _ in range(10):
+        next(items)
+    # The last item of the first page was handed out
+    assert scan.checkpoint() is not None
+    next(items)
+    items.close()
+    with pytest.raises(RuntimeError):
+        scan.checkpoint()
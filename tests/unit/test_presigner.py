@@ -0,0 +1,83 @@
+'''
+Parity of the bulk presigner with botocore (S3 client with signature version s3v4), and its throughput against
+generate_presigned_url, printed with RUN_BENCHMARKS=1 pytest -s.
+'''
+import time
+from datetime import datetime, timezone
+
+import boto3
+import botocore.auth
+import pytest
+from botocore.config import Config
+from botocore.credentials import Credentials
+
+from cm_accuracy_eval.presigner import S3Presigner, PresignedUrlCache
+
+REGION = "us-west-2"
+NOW = datetime(2024, 2, 29, 23, 59, 58, tzinfo=timezone.utc)
+KEYS = [
+    "input/task/image.jpg",
+    "input/task/with space.jpg",
+    "input/task/ünïcödé/画像.png",
+    "input/task/a+b=c&d.jpg",
+    "input/task/(1)!*'.jpg",
+    "input/task/already%20encoded.jpg",
+    "input/task//double//slash.jpg",
+    "input/task/tilde~-_.jpg",
+    "input/task/semi;colon,comma:at@dollar$.jpg",
+]
+
+
+@pytest.fixture(params=[None, "session-token/with+special=chars"], ids=["static", "session"])
+def credentials(request):
+    return Credentials("AKIAEXAMPLE", "secret/key+example", request.param)
+
+
+def botocore_urls(monkeypatch, credentials, uris, expires_in):
+    # The signing time of botocore, fixed
+    monkeypatch.setattr(botocore.auth, "get_current_datetime", lambda: NOW.replace(tzinfo=None), raising=False)
+    s3 = boto3.client("s3", region_name=REGION, endpoint_url=f"https://s3.{REGION}.amazonaws.com",
+        aws_access_key_id=credentials.access_key, aws_secret_access_key=credentials.secret_key, aws_session_token=credentials.token,
+        config=Config(signature_version="s3v4", s3={"addressing_style": "path"}))
+    urls = []
+    for uri in uris:
+        bucket, key = uri[len("s3://"):].split("/", 1)
+        urls.append(s3.generate_presigned_url("get_object", Params={"Bucket": bucket, "Key": key}, ExpiresIn=expires_in))
+    return urls
+
+
+def test_parity_with_botocore(monkeypatch, credentials):
+    uris = [f"s3://cm-accuracy-eval-bucket/{k}" for k in KEYS]
+    expected = botocore_urls(monkeypatch, credentials, uris, 300)
+    assert S3Presigner(credentials, REGION).presign_get_objects(uris, 300, now=NOW) == expected
+
+
+def test_cache_serves_until_min_lifetime():
+    presigner = S3Presigner(Credentials("AKIAEXAMPLE", "secret"), REGION)
+    cache = PresignedUrlCache(presigner, max_size=2, min_lifetime_s=120)
+    now = NOW.timestamp()
+    first = cache.get_urls(["s3://b/1", "s3://b/2", "s3://b/1"], 300, now=now)
+    assert first[0] == first[2]
+    assert cache.get_urls(["s3://b/1"], 300, now=now + 180) == [first[0]]
+    # 120 s left: presigned again
+    assert cache.get_urls(["s3://b/1"], 300, now=now + 181) != [first[0]]
+    cache.get_urls(["s3://b/3"], 300, now=now + 181)
+    stats = cache.pop_stats()
+    assert stats["hits"] == 1 and stats["misses"] == 5 and stats["size"] == 2
+
+
+@pytest.mark.benchmark
+def test_throughput_against_generate_presigned_url(monkeypatch):
+    credentials = Credentials("AKIAEXAMPLE", "secret", "token")
+    uris = [f"s3://cm-accuracy-eval-bucket/input/task/{n:06}.jpg" for n in range(2000)]
+
+    start = time.perf_counter()
+    expected = botocore_urls(monkeypatch, credentials, uris, 300)
+    botocore_s = time.perf_counter() - start
+    start = time.perf_counter()
+    urls = S3Presigner(credentials, REGION).presign_get_objects(uris, 300, now=NOW)
+    bulk_s = time.perf_counter() - start
+
+    print(f"\nPresigning {len(uris)} URLs: generate_presigned_url {len(uris) / botocore_s:.0f} URLs/s, "
+        f"S3Presigner {len(uris) / bulk_s:.0f} URLs/s ({botocore_s / bulk_s:.1f}x)")
+    assert urls == expected
@@ -0,0 +1,175 @@
+'''The token bucket control loop on the in-memory backend, with a simulated clock.'''
+import pytest
+
+from cm_accuracy_eval import rate_limiter
+from cm_accuracy_eval.rate_limiter import TokenBucket, InMemoryBucketBackend
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class CountingBackend(InMemoryBucketBackend):
+    def __init__(self):
+        super().__init__()
+        self.loads = 0
+        self.saves = 0
+
+    def load(self):
+        self.loads += 1
+        return super().load()
+
+    def save(self, state, expected_version):
+        self.saves += 1
+        return super().save(state, expected_version)
+
+
+class ConflictingBackend(InMemoryBucketBackend):
+    '''Another worker updates the bucket between each load and save, the first `conflicts` times.'''
+    def __init__(self, conflicts):
+        super().__init__()
+        self.conflicts = conflicts
+
+    def save(self, state, expected_version):
+        if self.conflicts > 0:
+            self.conflicts -= 1
+            current = self.load()
+            if current is not None:
+                current["version"] += 1
+                super().save(current, current["version"] - 1)
+                return False
+        return super().save(state, expected_version)
+
+
+def bucket(backend, clock, **kwargs):
+    args = dict(initial_rate=10, max_rate=20, min_rate=1, increase_per_s=1, decrease_factor=0.5, decrease_cooldown_s=2,
+        burst_s=1, lease_size=5, clock=clock, sleep=clock.sleep)
+    args.update(kwargs)
+    return TokenBucket(backend, **args)
+
+
+def test_lease_is_consumed_locally():
+    clock, backend = Clock(), CountingBackend()
+    limiter = bucket(backend, clock)
+    for _ in range(5):
+        limiter.acquire()
+    # One backend update for the lease of 5 tokens
+    assert backend.saves == 1
+    assert backend.load()["tokens"] == pytest.approx(5)
+    for _ in range(5):
+        limiter.acquire()
+    assert backend.saves == 2
+    assert clock.sleeps == []
+
+
+def test_waits_for_tokens_at_the_rate():
+    clock = Clock()
+    limiter = bucket(InMemoryBucketBackend(), clock, lease_size=1)
+    for _ in range(10):
+        limiter.acquire()
+    limiter.acquire()
+    # The bucket was empty: one token at 10/s
+    assert sum(clock.sleeps) == pytest.approx(0.1, abs=1e-3)
+    assert limiter.waited_s == pytest.approx(sum(clock.sleeps))
+
+
+def test_additive_increase_up_to_max_rate():
+    clock = Clock()
+    limiter = bucket(InMemoryBucketBackend(), clock, lease_size=1)
+    limiter.acquire()
+    clock.now += 3
+    limiter.acquire()
+    assert limiter.rate() == pytest.approx(13)
+    clock.now += 60
+    limiter.acquire()
+    assert limiter.rate() == pytest.approx(20)
+
+
+def test_multiplicative_decrease_with_cooldown():
+    clock = Clock()
+    limiter = bucket(InMemoryBucketBackend(), clock)
+    limiter.acquire()
+    limiter.on_throttle()
+    assert limiter.rate() == pytest.approx(5)
+    assert limiter.backend.load()["tokens"] == 0
+    # Throttles of the same burst, within the cooldown: no further decrease, and no increase either
+    clock.now += 1
+    limiter.on_throttle()
+    limiter.acquire()
+    assert limiter.rate() == pytest.approx(5)
+    assert limiter.throttled == 2
+    # After the cooldown: increased for the 0.5 s since the cooldown ended, then decreased
+    clock.now += 1.5
+    limiter.on_throttle()
+    assert limiter.rate() == pytest.approx((5 + 0.5) * 0.5)
+    # Not below min_rate
+    for _ in range(10):
+        clock.now += 2
+        limiter.on_throttle()
+    assert limiter.rate() == pytest.approx(1)
+
+
+def test_throttle_drops_the_leased_tokens():
+    clock, backend = Clock(), CountingBackend()
+    limiter = bucket(backend, clock)
+    limiter.acquire()
+    limiter.on_throttle()
+    saves = backend.saves
+    clock.now += 10
+    limiter.acquire()
+    assert backend.saves == saves + 1
+
+
+def test_lease_version_conflicts_back_off():
+    clock = Clock()
+    backend = ConflictingBackend(0)
+    limiter = bucket(backend, clock)
+    limiter.acquire()
+    backend.conflicts = 6
+    clock.sleeps.clear()
+    for _ in range(5):
+        limiter.acquire()
+    assert limiter.conflicts == 6
+    assert len(clock.sleeps) == 6
+    assert all([0 < s <= rate_limiter.CONFLICT_MAX_BACKOFF_S for s in clock.sleeps])
+    # The backoff is reset by a successful lease
+    assert limiter._lease_conflicts == 0
+
+
+def test_decrease_gives_up_after_max_conflicts(monkeypatch):
+    clock = Clock()
+    backend = ConflictingBackend(0)
+    limiter = bucket(backend, clock)
+    limiter.acquire()
+    backend.conflicts = 1000
+    clock.sleeps.clear()
+    limiter.on_throttle()
+    assert limiter.conflicts == rate_limiter.CONFLICT_MAX_RETRIES + 1
+    assert len(clock.sleeps) == rate_limiter.CONFLICT_MAX_RETRIES
+    assert all([s <= rate_limiter.CONFLICT_MAX_BACKOFF_S for s in clock.sleeps])
+
+
+def test_decrease_retries_a_conflict():
+    clock = Clock()
+    backend = ConflictingBackend(0)
+    limiter = bucket(backend, clock)
+    limiter.acquire()
+    backend.conflicts = 2
+    limiter.on_throttle()
+    # Increased during the backoff, then decreased
+    assert limiter.rate() == pytest.approx(5, abs=0.1)
+    assert limiter.conflicts == 2
+
+
+def test_conflict_backoff_is_bounded():
+    for conflicts in range(20):
+        assert 0 <= rate_limiter.conflict_backoff(conflicts) <= rate_limiter.CONFLICT_MAX_BACKOFF_S
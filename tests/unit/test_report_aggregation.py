@@ -0,0 +1,106 @@
+'''
+The NumPy report aggregation against the list based implementation it replaced, and its scaling up to 1M labels (timings
+printed with RUN_BENCHMARKS=1 pytest -s).
+'''
+import math
+import random
+import time
+
+import pytest
+
+from cm_accuracy_eval.report_aggregation import aggregate, TP_STR, FP_STR
+
+TOP_CATEGORIES = ["Explicit Nudity", "Suggestive", "Violence", "Visually Disturbing", "Drugs", "Hate Symbols"]
+SUB_CATEGORIES = ["", "Nudity", "Female Swimwear Or Underwear", "Graphic Violence", "Pills", "Weapons"]
+TYPES = [None, "", TP_STR, FP_STR]
+
+
+def reference(flat_items):
+    '''The aggregation of get-report before NumPy (aggregate_chart_data), with the image lists as counts.'''
+    def add(by_dict, key_name, file_path):
+        if key_name is None or len(key_name) == 0:
+            return
+        if key_name not in by_dict.keys():
+            by_dict[key_name] = [file_path]
+        elif file_path not in by_dict[key_name]:
+            by_dict[key_name].append(file_path)
+
+    by = {k: {} for k in ("by_top_category", "by_sub_category", "by_type", "by_confidence")}
+    by_type = {k: {FP_STR: {}, TP_STR: {}} for k in ("by_top_category_type", "by_sub_category_type", "by_confidence_type")}
+    labeled, reviewed, tp, fp = [], [], [], []
+    for item in flat_items:
+        confidence_bucket = str(int((math.floor(item["confidence"] / 5)) * 5))
+        add(by["by_top_category"], item["top_category"], item["file_path"])
+        add(by["by_sub_category"], item["sub_category"], item["file_path"])
+        add(by["by_type"], item["type"], item["file_path"])
+        add(by["by_confidence"], confidence_bucket, item["file_path"])
+        if item["type"] in (FP_STR, TP_STR):
+            add(by_type["by_top_category_type"][item["type"]], item["top_category"], item["file_path"])
+            add(by_type["by_sub_category_type"][item["type"]], item["sub_category"], item["file_path"])
+            add(by_type["by_confidence_type"][item["type"]], confidence_bucket, item["file_path"])
+        if item["file_path"] not in labeled:
+            labeled.append(item["file_path"])
+        if item["type"] is not None and len(item["type"]) > 0 and item["file_path"] not in reviewed:
+            reviewed.append(item["file_path"])
+        if item["type"] == FP_STR and item["file_path"] not in fp:
+            fp.append(item["file_path"])
+        elif item["type"] == TP_STR and item["file_path"] not in tp:
+            tp.append(item["file_path"])
+
+    def counts(d):
+        return [(k, len(v)) for k, v in d.items()]
+    result = {"labeled": len(labeled), "reviewed": len(reviewed), "tp": len(tp), "fp": len(fp)}
+    result.update({k: counts(v) for k, v in by.items()})
+    result.update({k: {t: counts(v[t]) for t in (FP_STR, TP_STR)} for k, v in by_type.items()})
+    return result
+
+
+def ordered(aggregated):
+    '''Dicts as lists of items: the order of the groups matters (ties keep it when get-report sorts by count).'''
+    result = {}
+    for k, v in aggregated.items():
+        if k in ("by_top_category_type", "by_sub_category_type", "by_confidence_type"):
+            result[k] = {t: list(v[t].items()) for t in v}
+        elif k.startswith("by_"):
+            result[k] = list(v.items())
+        else:
+            result[k] = v
+    return result
+
+
+def random_labels(rng, n_labels, n_images):
+    for _ in range(n_labels):
+        yield {
+            "file_path": f"s3://bucket/input/task/{rng.randrange(n_images):07}.jpg",
+            "top_category": rng.choice(TOP_CATEGORIES),
+            "sub_category": rng.choice(SUB_CATEGORIES),
+            "confidence": rng.uniform(50, 100),
+            "type": rng.choice(TYPES),
+        }
+
+
+def test_matches_the_list_implementation():
+    rng = random.Random(20240229)
+    for _ in range(300):
+        labels = list(random_labels(rng, rng.randrange(0, 400), rng.randrange(1, 120)))
+        assert ordered(aggregate(iter(labels))) == reference(labels)
+
+
+def test_empty():
+    assert ordered(aggregate([])) == reference([])
+
+
+@pytest.mark.benchmark
+def test_linear_scaling_to_1m_labels():
+    rng = random.Random(1)
+    timings = []
+    for n_labels in (125_000, 250_000, 500_000, 1_000_000):
+        labels = list(random_labels(rng, n_labels, n_labels // 3))
+        start = time.perf_counter()
+        result = aggregate(labels)
+        timings.append((n_labels, time.perf_counter() - start))
+        assert result["labeled"] <= n_labels // 3
+        del labels
+    print()
+    for n_labels, seconds in timings:
+        print(f"Report aggregation: {n_labels} labels in {seconds:.2f}s, {seconds / n_labels * 1e6:.2f} us/label")
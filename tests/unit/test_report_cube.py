@@ -0,0 +1,167 @@
+'''The report cube Lambda applies redelivered stream records once, and rebuild() recounts the cube from the result table.'''
+import random
+
+import pytest
+from botocore.exceptions import ClientError
+
+from cm_accuracy_eval import report_cube
+
+PREFIX = "cm-accuracy-eval-result"
+CUBE_TABLE = "cube"
+RESULT_TABLE = f"{PREFIX}-task1"
+STREAM_ARN = f"arn:aws:dynamodb:us-east-1:123456789012:table/{RESULT_TABLE}/stream/2024-01-01T00:00:00.000"
+CATEGORIES = [("Suggestive", "Revealing Clothes"), ("Suggestive", "Partially Exposed Buttocks"), ("Violence", "Weapons"),
+    ("Violence", ""), ("Drugs & Tobacco", "Smoking"), ("Alcohol", "Drinking"), ("Rude Gestures", "Middle Finger")]
+REVIEWS = ["", "true-positive", "false-positive"]
+
+
+class FakeDynamoDB:
+    '''Cube and result tables. fail_transactions: numbers of the transactions that fail, before or "after" their commit.'''
+    def __init__(self, rows=None, fail_transactions=None, fail_after_commit=False):
+        self.cube = {}
+        self.rows = [] if rows is None else rows
+        self.transactions = 0
+        self.fail_transactions = set() if fail_transactions is None else fail_transactions
+        self.fail_after_commit = fail_after_commit
+
+    def transact_write_items(self, TransactItems):
+        self.transactions += 1
+        if self.transactions in self.fail_transactions and not self.fail_after_commit:
+            raise ClientError({"Error": {"Code": "ThrottlingException"}}, "TransactWriteItems")
+        put, update = TransactItems[0]["Put"], TransactItems[1]["Update"]
+        if put["Item"]["task_id"]["S"] in self.cube:
+            raise ClientError({"Error": {"Code": "TransactionCanceledException"},
+                "CancellationReasons": [{"Code": "ConditionalCheckFailed"}, {"Code": "None"}]}, "TransactWriteItems")
+        self.cube[put["Item"]["task_id"]["S"]] = put["Item"]
+        item = self.cube.setdefault(update["Key"]["task_id"]["S"], dict(update["Key"]))
+        for action in update["UpdateExpression"][len("ADD "):].split(", "):
+            name, value = action.split(" ")
+            key = update["ExpressionAttributeNames"][name]
+            total = int(item.get(key, {"N": "0"})["N"]) + int(update["ExpressionAttributeValues"][value]["N"])
+            item[key] = {"N": str(total)}
+        if self.transactions in self.fail_transactions:
+            raise ClientError({"Error": {"Code": "InternalServerError"}}, "TransactWriteItems")
+
+    def update_item(self, TableName, Key, UpdateExpression, ExpressionAttributeValues):
+        assert UpdateExpression == "SET rebuild_state = :s"
+        self.cube.setdefault(Key["task_id"]["S"], dict(Key))["rebuild_state"] = ExpressionAttributeValues[":s"]
+
+    def put_item(self, TableName, Item):
+        self.cube[Item["task_id"]["S"]] = Item
+
+    def describe_table(self, TableName):
+        return {"Table": {"TableSizeBytes": 0}}
+
+    def scan(self, TableName, Segment, TotalSegments, ProjectionExpression, ExclusiveStartKey=None):
+        rows = [r for i, r in enumerate(self.rows) if i % TotalSegments == Segment]
+        start = 0 if ExclusiveStartKey is None else int(ExclusiveStartKey["i"]["N"])
+        response = {"Items": rows[start:start + 10]}
+        if start + 10 < len(rows):
+            response["LastEvaluatedKey"] = {"i": {"N": str(start + 10)}}
+        return response
+
+
+class Context:
+    def get_remaining_time_in_millis(self):
+        return 60000
+
+
+def row(rng, file_path):
+    labels = []
+    for top, sub in rng.sample(CATEGORIES, rng.randint(0, 3)):
+        labels.append({"M": {"parent_category": {"S": top if len(sub) > 0 else ""}, "category": {"S": sub if len(sub) > 0 else top},
+            "confidence": {"N": str(rng.uniform(50, 100))}, "review_result": {"S": rng.choice(REVIEWS)}}})
+    return {"file_path": {"S": file_path}, "rek_results": {"L": labels}}
+
+
+def stream(rng, n):
+    '''Insert records of n rows, then review updates of some of them. Returns (records, final rows).'''
+    rows, records = {}, []
+    for i in range(n):
+        rows[i] = row(rng, f"s3://bucket/input/{i}.jpg")
+        records.append((None, rows[i]))
+    for i in rng.sample(range(n), n // 3):
+        new = row(rng, rows[i]["file_path"]["S"])
+        records.append((rows[i], new))
+        rows[i] = new
+    events = []
+    for seq, (old, new) in enumerate(records):
+        image = {"NewImage": new, "SequenceNumber": str(10**20 + seq)}
+        if old is not None:
+            image["OldImage"] = old
+        events.append({"eventID": f"e{seq:06}", "eventSourceARN": STREAM_ARN, "dynamodb": image})
+    return events, list(rows.values())
+
+
+@pytest.fixture
+def handler(load_lambda):
+    return load_lambda("task/report-cube/cm-accuracy-eval-task-report-cube.py",
+        DYNAMODB_TABLE_PREFIX=PREFIX, DYNAMODB_REPORT_CUBE_TABLE=CUBE_TABLE)
+
+
+def invoke(handler, dynamodb, records):
+    handler.dynamodb = dynamodb
+    return handler.lambda_handler({"Records": records}, Context())["batchItemFailures"]
+
+
+def counts(cube_item):
+    return {k: int(v["N"]) for k, v in cube_item.items() if "N" in v and int(v["N"]) != 0}
+
+
+def expected(rows):
+    '''Metric counts of the result rows.'''
+    total = {}
+    for r in rows:
+        for k in report_cube.metric_keys(r):
+            total[k] = total.get(k, 0) + 1
+    return total
+
+
+def test_slices_are_the_same_for_a_redelivered_batch():
+    rng = random.Random(1)
+    records, _ = stream(rng, 200)
+    changes = [("task1", r["eventID"], report_cube.diff(report_cube.metric_keys(r["dynamodb"].get("OldImage")),
+        report_cube.metric_keys(r["dynamodb"]["NewImage"]))) for r in records]
+    first = list(report_cube.slices(changes, max_keys=20))
+    assert len(first) > 1
+    # A slice only goes over the limit with the keys of a single record
+    ends = [start for start, _, _ in first[1:]] + [len(changes)]
+    assert all([len(d) <= 20 or end - start == 1 for (start, _, d), end in zip(first, ends)])
+    # The records from a slice on are sliced as in the whole batch
+    start = first[2][0]
+    assert list(report_cube.slices(changes[start:], max_keys=20))[0][1] == first[2][1]
+
+
+def test_redelivered_batch_is_counted_once(handler):
+    records, rows = stream(random.Random(2), 300)
+    dynamodb = FakeDynamoDB()
+    assert invoke(handler, dynamodb, records) == []
+    assert invoke(handler, dynamodb, records) == []
+    assert counts(dynamodb.cube["task1"]) == expected(rows)
+
+
+@pytest.mark.parametrize("after_commit", [False, True])
+def test_failed_slice_is_retried_from_its_first_record(handler, monkeypatch, after_commit):
+    monkeypatch.setattr(report_cube, "MAX_KEYS_PER_UPDATE", 20)
+    records, rows = stream(random.Random(3), 300)
+    dynamodb = FakeDynamoDB(fail_transactions={3}, fail_after_commit=after_commit)
+    failures = invoke(handler, dynamodb, records)
+    assert len(failures) == 1
+    start = next(i for i, r in enumerate(records) if r["dynamodb"]["SequenceNumber"] == failures[0]["itemIdentifier"])
+    assert start > 0
+    # The stream mapping retries from the reported record; a crash after the commit redelivers the whole batch
+    assert invoke(handler, dynamodb, records if after_commit else records[start:]) == []
+    assert counts(dynamodb.cube["task1"]) == expected(rows)
+
+
+def test_rebuild_continues_after_the_deadline():
+    records, rows = stream(random.Random(4), 250)
+    dynamodb = FakeDynamoDB(rows)
+    dynamodb.cube["task1"] = {"task_id": {"S": "task1"}, "processed": {"N": "999"}, "by_type#false-positive": {"N": "7"}}
+    assert report_cube.rebuild(dynamodb, CUBE_TABLE, "task1", RESULT_TABLE, deadline=0) is None
+    state = report_cube.rebuild_state(dynamodb.cube["task1"])
+    assert state is not None
+    cube_item = report_cube.rebuild(dynamodb, CUBE_TABLE, "task1", RESULT_TABLE, state)
+    assert report_cube.rebuild_state(cube_item) is None
+    assert counts(cube_item) == expected(rows)
+    assert report_cube.document(cube_item)["processed"] == 250
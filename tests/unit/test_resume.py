@@ -0,0 +1,39 @@
+'''Resume: the images with a result row are skipped, the others are moderated again in the input order.'''
+from cm_accuracy_eval import resume
+
+
+class FakeDynamoDB:
+    def __init__(self, file_paths):
+        self.rows = [{"file_path": {"S": p}} for p in file_paths]
+
+    def describe_table(self, TableName):
+        return {"Table": {"TableSizeBytes": 1}}
+
+    def scan(self, TableName, Segment, TotalSegments, ProjectionExpression, ExclusiveStartKey=None):
+        rows = [r for i, r in enumerate(self.rows) if i % TotalSegments == Segment]
+        start = 0 if ExclusiveStartKey is None else int(ExclusiveStartKey["i"]["N"])
+        response = {"Items": rows[start:start + 10]}
+        if start + 10 < len(rows):
+            response["LastEvaluatedKey"] = {"i": {"N": str(start + 10)}}
+        return response
+
+
+def test_remaining_keys_keep_the_input_order():
+    keys = [f"input/task1/{n:03}.jpg" for n in range(100)]
+    # Moderated: every third image, and an image of another bucket with the same key
+    dynamodb = FakeDynamoDB([f"s3://bucket/{k}" for k in keys[::3]] + [f"s3://other/{keys[1]}"])
+    moderated = resume.moderated(dynamodb, "result")
+    assert len(moderated) == 35
+    stats = {}
+    assert resume.remaining(keys, "bucket", moderated, stats) == [k for n, k in enumerate(keys) if n % 3 != 0]
+    assert stats == {"resume_total": 100, "resume_skipped": 34, "resume_remaining": 66}
+    # Counted across calls
+    resume.remaining(keys[:3], "bucket", moderated, stats)
+    assert stats == {"resume_total": 103, "resume_skipped": 35, "resume_remaining": 68}
+
+
+def test_nothing_moderated():
+    stats = {}
+    assert resume.remaining(["input/task1/a.jpg"], "bucket", resume.moderated(FakeDynamoDB([]), "result"), stats) == \
+        ["input/task1/a.jpg"]
+    assert stats["resume_skipped"] == 0
@@ -0,0 +1,135 @@
+import io
+import itertools
+
+import pytest
+
+from cm_accuracy_eval import s3_multipart
+from cm_accuracy_eval.s3_multipart import S3MultipartWriter, MIN_PART_SIZE
+
+MB = 1024 * 1024
+
+
+class Paginator:
+    def __init__(self, method):
+        self.method = method
+
+    def paginate(self, **kwargs):
+        yield self.method(**kwargs)
+
+
+class FakeS3:
+    '''Objects in memory. Records the bytes read by GetObject and copied by UploadPartCopy.'''
+    def __init__(self):
+        self.objects = {}
+        self.uploads = {}
+        self.bytes_read = 0
+        self.bytes_copied = 0
+        self._ids = itertools.count()
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self.objects[(Bucket, Key)] = bytes(Body)
+
+    def get_object(self, Bucket, Key, Range=None):
+        data = self.objects[(Bucket, Key)]
+        if Range is not None:
+            start, end = [int(v) for v in Range[len("bytes="):].split("-")]
+            data = data[start:end + 1]
+        self.bytes_read += len(data)
+        return {"Body": io.BytesIO(data), "ContentLength": len(data)}
+
+    def create_multipart_upload(self, Bucket, Key, **kwargs):
+        upload_id = str(next(self._ids))
+        self.uploads[upload_id] = {}
+        return {"UploadId": upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        self.uploads[UploadId][PartNumber] = bytes(Body)
+        return {"ETag": f"etag-{PartNumber}"}
+
+    def upload_part_copy(self, Bucket, Key, UploadId, PartNumber, CopySource, CopySourceRange=None):
+        data = self.objects[(CopySource["Bucket"], CopySource["Key"])]
+        if CopySourceRange is not None:
+            start, end = [int(v) for v in CopySourceRange[len("bytes="):].split("-")]
+            data = data[start:end + 1]
+        self.bytes_copied += len(data)
+        self.uploads[UploadId][PartNumber] = data
+        return {"CopyPartResult": {"ETag": f"etag-{PartNumber}"}}
+
+    def list_parts(self, Bucket, Key, UploadId):
+        parts = self.uploads[UploadId]
+        return {"Parts": [{"PartNumber": n, "ETag": f"etag-{n}", "Size": len(parts[n])} for n in sorted(parts)]}
+
+    def get_paginator(self, name):
+        return Paginator(getattr(self, name))
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        parts = self.uploads.pop(UploadId)
+        numbers = [p["PartNumber"] for p in MultipartUpload["Parts"]]
+        assert numbers == sorted(parts)
+        for n in numbers[:-1]:
+            assert len(parts[n]) >= MIN_PART_SIZE, f"part {n} is smaller than {MIN_PART_SIZE} bytes"
+        self.objects[(Bucket, Key)] = b"".join([parts[n] for n in numbers])
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.uploads.pop(UploadId, None)
+
+
+def shard(s3, key, size):
+    data = (key.encode("utf-8") * (size // len(key) + 1))[:size]
+    s3.objects[("bucket", key)] = data
+    return data
+
+
+def test_append_object_copies_large_shards_after_a_header():
+    s3 = FakeS3()
+    sizes = [30 * MB, 12 * MB, 7 * MB, 1 * MB, 20 * MB]
+    shards = [shard(s3, f"shards/{n}", size) for n, size in enumerate(sizes)]
+    with S3MultipartWriter(s3, "bucket", "out") as f:
+        f.write(b"header\n")
+        for n, size in enumerate(sizes):
+            f.append_object("bucket", f"shards/{n}", size)
+    assert s3.objects[("bucket", "out")] == b"header\n" + b"".join(shards)
+    # At most one part of each shard is read, the rest is copied by S3
+    assert s3.bytes_read <= len(sizes) * MIN_PART_SIZE
+    assert s3.bytes_copied >= sum(sizes) - len(sizes) * MIN_PART_SIZE
+    assert f.bytes_written == len(b"header\n") + sum(sizes)
+
+
+def test_append_object_splits_copies_larger_than_max_part(monkeypatch):
+    monkeypatch.setattr(s3_multipart, "MAX_PART_SIZE", 8 * MB)
+    s3 = FakeS3()
+    data = shard(s3, "shards/0", 30 * MB)
+    with S3MultipartWriter(s3, "bucket", "out") as f:
+        f.write(b"h")
+        f.append_object("bucket", "shards/0", len(data))
+    assert s3.objects[("bucket", "out")] == b"h" + data
+    assert s3.bytes_read == MIN_PART_SIZE - 1
+
+
+def test_small_objects_are_buffered():
+    s3 = FakeS3()
+    shards = [shard(s3, f"shards/{n}", 3 * MB) for n in range(5)]
+    with S3MultipartWriter(s3, "bucket", "out") as f:
+        for n in range(5):
+            f.append_object("bucket", f"shards/{n}", 3 * MB)
+    assert s3.objects[("bucket", "out")] == b"".join(shards)
+    assert s3.bytes_copied == 0
+
+
+@pytest.mark.parametrize("suspend_after", [0, 1, 2, 3])
+def test_suspend_and_resume(suspend_after):
+    s3 = FakeS3()
+    sizes = [2 * MB, 9 * MB, 1 * MB, 6 * MB]
+    shards = [shard(s3, f"shards/{n}", size) for n, size in enumerate(sizes)]
+    f = S3MultipartWriter(s3, "bucket", "out")
+    f.write(b"header\n")
+    for n in range(suspend_after):
+        f.append_object("bucket", f"shards/{n}", sizes[n])
+    upload_id, buffered = f.suspend()
+    with S3MultipartWriter.resume(s3, "bucket", "out", upload_id) as f:
+        f.write(buffered)
+        for n in range(suspend_after, len(sizes)):
+            f.append_object("bucket", f"shards/{n}", sizes[n])
+    assert s3.objects[("bucket", "out")] == b"header\n" + b"".join(shards)
+    assert f.bytes_written == len(b"header\n") + sum(sizes)
+    assert len(s3.uploads) == 0
@@ -0,0 +1,82 @@
+'''reconcile() corrects the task counters without losing the changes added while it scans the result table.'''
+from botocore.exceptions import ClientError
+
+from cm_accuracy_eval import task_counters
+
+TASK_TABLE = "task"
+RESULT_TABLE = "result"
+
+
+class FakeDynamoDB:
+    def __init__(self, rows, counters):
+        self.rows = rows
+        self.task = {"id": {"S": "task1"}}
+        self.task.update({c: {"N": str(v)} for c, v in counters.items()})
+        # Called once per scan page
+        self.on_scan = None
+
+    def get_item(self, TableName, Key, ProjectionExpression, ExpressionAttributeNames, ConsistentRead):
+        return {"Item": {k: v for k, v in self.task.items() if k in ExpressionAttributeNames.values()}}
+
+    def describe_table(self, TableName):
+        return {"Table": {"TableSizeBytes": 1}}
+
+    def scan(self, TableName, Segment, TotalSegments, ProjectionExpression, ExclusiveStartKey=None):
+        if self.on_scan is not None:
+            self.on_scan()
+        start = 0 if ExclusiveStartKey is None else int(ExclusiveStartKey["i"]["N"])
+        response = {"Items": self.rows[start:start + 10]}
+        if start + 10 < len(self.rows):
+            response["LastEvaluatedKey"] = {"i": {"N": str(start + 10)}}
+        return response
+
+    def update_item(self, TableName, Key, UpdateExpression, ConditionExpression, ExpressionAttributeValues,
+            ExpressionAttributeNames=None, ReturnValues="NONE"):
+        state = self.task.get("reconcile_state")
+        if ConditionExpression.endswith("attribute_not_exists(reconcile_state)"):
+            holds = state is None
+        elif ConditionExpression == "reconcile_state = :loaded":
+            holds = state == ExpressionAttributeValues[":loaded"]
+        else:
+            holds = ConditionExpression == "attribute_exists(id)"
+        if not holds:
+            raise ClientError({"Error": {"Code": "ConditionalCheckFailedException"}}, "UpdateItem")
+        if UpdateExpression.startswith("SET reconcile_state"):
+            self.task["reconcile_state"] = ExpressionAttributeValues[":s"]
+            return {}
+        for name, value in zip(ExpressionAttributeNames.values(), [ExpressionAttributeValues[f":c{i}"] for i in range(len(ExpressionAttributeNames))]):
+            self.task[name] = {"N": str(int(self.task.get(name, {"N": "0"})["N"]) + int(value["N"]))}
+        if "REMOVE reconcile_state" in UpdateExpression:
+            self.task.pop("reconcile_state", None)
+        return {"Attributes": dict(self.task)}
+
+
+def rows(n, labeled):
+    return [{"issue_flag": {"N": "1" if i < labeled else "0"}} for i in range(n)]
+
+
+def test_changes_added_during_the_scan_are_kept():
+    # Counted twice by a retried batch: 60 processed, 20 labeled for 50 rows with 10 labeled
+    dynamodb = FakeDynamoDB(rows(50, 10), {"processed": 60, "labeled": 20})
+
+    def moderated():
+        # A moderation batch adds its own rows' counts while the table is scanned
+        task_counters.add(dynamodb, TASK_TABLE, "task1", {"processed": 1})
+    dynamodb.on_scan = moderated
+    counters = task_counters.reconcile(dynamodb, TASK_TABLE, "task1", RESULT_TABLE, deadline=None)
+    assert counters["processed"] == 50 + 5 and counters["labeled"] == 10
+
+
+def test_reconcile_continues_from_its_state_once():
+    dynamodb = FakeDynamoDB(rows(50, 10), {})
+    assert task_counters.reconcile(dynamodb, TASK_TABLE, "task1", RESULT_TABLE, deadline=0) is None
+    state = task_counters.reconcile_state(dynamodb.task)
+    # A concurrent first call doesn't take over the saved reconcile
+    assert task_counters.reconcile(dynamodb, TASK_TABLE, "task1", RESULT_TABLE, deadline=0) is None
+    assert task_counters.reconcile_state(dynamodb.task) == state
+    counters = task_counters.reconcile(dynamodb, TASK_TABLE, "task1", RESULT_TABLE, state)
+    assert counters["processed"] == 50 and counters["labeled"] == 10 and counters["reviewed"] == 0
+    assert "reconcile_state" not in dynamodb.task
+    # The call that continued the same state too late doesn't add it again
+    assert task_counters.reconcile(dynamodb, TASK_TABLE, "task1", RESULT_TABLE, state) is None
+    assert task_counters.read(dynamodb.task)["processed"] == 50
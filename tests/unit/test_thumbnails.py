@@ -0,0 +1,161 @@
+'''Memory bounds of the thumbnail builds, and the recovery of the images of an invocation that ran out of memory.'''
+import io
+import threading
+import time
+
+import pytest
+from PIL import Image
+
+from cm_accuracy_eval import thumbnails
+
+RESULT_TABLE = "cm-accuracy-eval-result-task1"
+
+
+class OutOfMemory(BaseException):
+    '''Stands for the Lambda runtime killed while decoding: nothing after it runs.'''
+
+
+class FakeS3:
+    def __init__(self, objects, kills=()):
+        self.objects = objects
+        self.kills = set(kills)
+        self.puts = {}
+
+    def get_object(self, Bucket, Key):
+        if f"s3://{Bucket}/{Key}" in self.kills:
+            raise OutOfMemory()
+        body = self.objects[f"s3://{Bucket}/{Key}"]
+        return {"ContentLength": len(body), "Body": io.BytesIO(body)}
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self.puts[f"s3://{Bucket}/{Key}"] = Body
+
+
+class FakeDynamoDB:
+    class exceptions:
+        class ConditionalCheckFailedException(Exception):
+            pass
+
+    def __init__(self, file_paths, attempts=None):
+        self.items = {f: {"file_path": {"S": f}} for f in file_paths}
+        for f, n in (attempts or {}).items():
+            self.items[f][thumbnails.ATTEMPTS_ATTRIBUTE] = {"N": str(n)}
+        self.updates = []
+        self.throttled = True
+
+    def batch_get_item(self, RequestItems):
+        request = RequestItems[RESULT_TABLE]
+        keys = request["Keys"]
+        # The first request leaves a key unprocessed
+        unprocessed = keys[-1:] if self.throttled else []
+        self.throttled = False
+        items = [dict(self.items[k["file_path"]["S"]]) for k in keys if k not in unprocessed]
+        response = {"Responses": {RESULT_TABLE: items}}
+        if len(unprocessed) > 0:
+            response["UnprocessedKeys"] = {RESULT_TABLE: dict(request, Keys=unprocessed)}
+        return response
+
+    def update_item(self, TableName, Key, UpdateExpression, ConditionExpression, ExpressionAttributeValues=None,
+            ExpressionAttributeNames=None):
+        item = self.items[Key["file_path"]["S"]]
+        self.updates.append((Key["file_path"]["S"], UpdateExpression))
+        if UpdateExpression == "ADD #a :one":
+            item[thumbnails.ATTEMPTS_ATTRIBUTE] = {"N": str(thumbnails.attempts(item) + 1)}
+        elif UpdateExpression == "SET thumbnail = :t":
+            item["thumbnail"] = ExpressionAttributeValues[":t"]
+        elif UpdateExpression == "REMOVE thumbnail":
+            item.pop("thumbnail", None)
+        else:
+            raise AssertionError(UpdateExpression)
+
+
+class Context:
+    def get_remaining_time_in_millis(self):
+        return 300000
+
+
+def image_bytes(format, size=(640, 480)):
+    out = io.BytesIO()
+    Image.new("RGB", size, (200, 30, 30)).save(out, format=format)
+    return out.getvalue()
+
+
+def test_memory_budget_bounds_the_bytes_held():
+    budget = thumbnails.MemoryBudget(100)
+    lock, held, peak = threading.Lock(), [0], [0]
+
+    def task(size):
+        with budget.hold(size):
+            with lock:
+                held[0] += size
+                peak[0] = max(peak[0], held[0])
+            time.sleep(0.01)
+            with lock:
+                held[0] -= size
+
+    threads = [threading.Thread(target=task, args=(s,)) for s in [40] * 10 + [150]]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(timeout=5)
+    assert all([not t.is_alive() for t in threads])
+    # A size over the limit runs alone
+    assert peak[0] == 150 or peak[0] <= 100
+    assert budget.used == 0
+
+
+class RecordingBudget(thumbnails.MemoryBudget):
+    def __init__(self):
+        super().__init__(10 ** 12)
+        self.sizes = []
+
+    def hold(self, size):
+        self.sizes.append(size)
+        return super().hold(size)
+
+
+def test_decode_holds_its_decoded_size():
+    budget = RecordingBudget()
+    thumbnails.make_thumbnail(io.BytesIO(image_bytes("PNG", (2000, 1000))), budget)
+    thumbnails.make_thumbnail(io.BytesIO(image_bytes("JPEG", (2000, 1000))), budget)
+    png, jpeg = budget.sizes
+    assert png == 2000 * 1000 * thumbnails.DECODE_BYTES_PER_PIXEL
+    # Draft mode decodes the JPEG at the smallest scale covering the thumbnail size: 1/4 (1/8 is 125 pixels high)
+    assert jpeg == 500 * 250 * thumbnails.DECODE_BYTES_PER_PIXEL
+
+
+def test_load_resends_unprocessed_keys():
+    paths = [f"s3://bucket/input/task1/{n}.jpg" for n in range(3)]
+    dynamodb = FakeDynamoDB(paths)
+    dynamodb.items[paths[2]]["thumbnail"] = thumbnails.error_item("broken")
+    assert thumbnails.load(dynamodb, RESULT_TABLE, paths) == {paths[2]: {"error": "broken"}}
+
+
+@pytest.fixture
+def handler(load_lambda):
+    return load_lambda("task/thumbnails/cm-accuracy-eval-task-thumbnails.py", THREAD_POOL_SIZE="4")
+
+
+def test_image_killing_the_invocation_gets_an_error_and_the_others_are_built(handler):
+    paths = [f"s3://bucket/input/task1/{n}.png" for n in range(6)]
+    culprit = paths[3]
+    s3 = FakeS3({p: image_bytes("PNG") for p in paths}, kills=[culprit])
+    dynamodb = FakeDynamoDB(paths)
+    handler.s3, handler.dynamodb = s3, dynamodb
+    event = {"TaskId": "task1", "ResultTable": RESULT_TABLE, "FilePaths": paths, "Bucket": "bucket"}
+
+    # The first invocation dies: nothing is saved but the attempts
+    with pytest.raises(OutOfMemory):
+        handler.lambda_handler(event, Context())
+    assert all([thumbnails.attempts(dynamodb.items[p]) == 1 and "thumbnail" not in dynamodb.items[p] for p in paths])
+
+    # The retry builds them one at a time, with an error saved first: the culprit keeps it
+    with pytest.raises(OutOfMemory):
+        handler.lambda_handler(event, Context())
+    assert thumbnails.from_item(dynamodb.items[culprit]) == {"error": handler.INTERRUPTED_ERROR}
+    assert all([thumbnails.from_item(dynamodb.items[p]) is None for p in paths[:3]])
+
+    # The next one skips it
+    assert handler.lambda_handler(event, Context()) == {"Built": 5, "Failed": 0}
+    assert all(["sprite" in thumbnails.from_item(dynamodb.items[p]) for p in paths if p != culprit])
+    assert thumbnails.from_item(dynamodb.items[culprit]) == {"error": handler.INTERRUPTED_ERROR}
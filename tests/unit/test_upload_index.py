@@ -0,0 +1,151 @@
+'''Upload index: validation of the uploads, and index items saved with their counter changes once.'''
+import pytest
+from botocore.exceptions import ClientError
+
+from cm_accuracy_eval import upload_index
+
+INDEX_TABLE = "index"
+TASK_TABLE = "task"
+
+
+class FakeDynamoDB:
+    '''Index and task tables. fail_transactions: number of transactions failing before they are written.'''
+    def __init__(self, fail_transactions=0):
+        self.index = {}
+        self.task = {"id": {"S": "task1"}}
+        self.task.update(upload_index.initial_counts())
+        self.fail_transactions = fail_transactions
+
+    def batch_get_item(self, RequestItems):
+        keys = RequestItems[INDEX_TABLE]["Keys"]
+        return {"Responses": {INDEX_TABLE: [self.index[k["key"]["S"]] for k in keys if k["key"]["S"] in self.index]}}
+
+    def holds(self, put):
+        old = self.index.get(put["Item"]["key"]["S"])
+        if put["ConditionExpression"] == "attribute_not_exists(#k)":
+            return old is None
+        assert put["ConditionExpression"] == "#seq = :seq"
+        return old is not None and old["sequencer"] == put["ExpressionAttributeValues"][":seq"]
+
+    def transact_write_items(self, TransactItems):
+        if self.fail_transactions > 0:
+            self.fail_transactions -= 1
+            raise ClientError({"Error": {"Code": "InternalServerError"}}, "TransactWriteItems")
+        reasons = [{"Code": "None" if "Update" in a or self.holds(a["Put"]) else "ConditionalCheckFailed"} for a in TransactItems]
+        if any([r["Code"] != "None" for r in reasons]):
+            raise ClientError({"Error": {"Code": "TransactionCanceledException"}, "CancellationReasons": reasons},
+                "TransactWriteItems")
+        for a in TransactItems:
+            if "Put" in a:
+                self.index[a["Put"]["Item"]["key"]["S"]] = a["Put"]["Item"]
+            else:
+                update = a["Update"]
+                for name, value in zip(update["ExpressionAttributeNames"].values(), update["ExpressionAttributeValues"].values()):
+                    self.task[name] = {"N": str(int(self.task[name]["N"]) + int(value["N"]))}
+
+
+def item(key, seq, size=100, reason=None, deleted=False):
+    return upload_index.new_item("task1", key, upload_index.sequencer(seq), size=size, reason=reason, deleted=deleted, now=0)
+
+
+def apply(dynamodb, items):
+    return upload_index.apply(dynamodb, INDEX_TABLE, TASK_TABLE, "task1", items)
+
+
+@pytest.mark.parametrize("header, format", [
+    (b"\xff\xd8\xff\xe0\x00\x10JFIF", "jpeg"),
+    (b"\x89PNG\r\n\x1a\n\x00\x00", "png"),
+    (b"GIF89a\x01\x00", "gif"),
+    (b"RIFF\x24\x00\x00\x00WEBPVP8 ", "webp"),
+    (b"\x00\x00\x00\x18ftypheic\x00\x00", "heic"),
+    (b"\x00\x00\x00\x1cftypavif\x00\x00", "avif"),
+    (b"\x00\x00\x00\x18ftypisom\x00\x00", None),
+    (b"RIFF\x24\x00\x00\x00WAVEfmt ", None),
+    (b"", None),
+])
+def test_sniff_format(header, format):
+    assert upload_index.sniff_format(header) == format
+
+
+@pytest.mark.parametrize("key, task_id", [
+    ("input/task1/a.jpg", "task1"),
+    ("input/task1/folder/a.jpg", "task1"),
+    ("input/task1/", None),
+    ("input/task1/.temp", None),
+    ("input/task1", None),
+    ("derived/task1/a.jpg", None),
+])
+def test_parse_key(key, task_id):
+    assert upload_index.parse_key(key, "input/") == task_id
+
+
+def test_check():
+    types = [".jpg", ".png"]
+    assert upload_index.check("input/task1/a.JPG", 100, types) is None
+    assert upload_index.check("input/task1/a.gif", 100, types) == upload_index.REASON_FILE_TYPE
+    assert upload_index.check("input/task1/a.jpg", 0, types) == upload_index.REASON_EMPTY
+    assert upload_index.check("input/task1/a.jpg", upload_index.MAX_IMAGE_BYTES, types) is None
+    assert upload_index.check("input/task1/a.jpg", upload_index.MAX_IMAGE_BYTES + 1, types) == upload_index.REASON_TOO_LARGE
+    assert upload_index.check("input/task1/a.jpg", 200, types, max_bytes=100) == upload_index.REASON_TOO_LARGE
+    assert upload_index.check_format("png") is None
+    assert upload_index.check_format("gif") == upload_index.REASON_FORMAT
+    assert upload_index.check_format("gif", supported_formats=("jpeg", "png", "gif")) is None
+
+
+def test_sequencers_of_different_lengths_compare_in_order():
+    # A longer sequencer is later: compared as strings once padded
+    assert upload_index.sequencer("0A3F") > upload_index.sequencer("FF")
+    assert upload_index.sequencer("00ff") == upload_index.sequencer("FF")
+    assert upload_index.sequencer("0055AB1") < upload_index.sequencer("0055AB2")
+
+
+def test_item_counts():
+    assert upload_index.item_counts(None) == {"index_accepted": 0, "index_rejected": 0, "index_bytes": 0}
+    assert upload_index.item_counts(item("input/task1/a.jpg", "01", size=300)) == \
+        {"index_accepted": 1, "index_rejected": 0, "index_bytes": 300}
+    assert upload_index.item_counts(item("input/task1/a.gif", "01", reason=upload_index.REASON_FILE_TYPE)) == \
+        {"index_accepted": 0, "index_rejected": 1, "index_bytes": 0}
+    deleted = item("input/task1/a.jpg", "02", deleted=True)
+    assert upload_index.item_counts(deleted) == {"index_accepted": 0, "index_rejected": 0, "index_bytes": 0}
+    assert deleted["ttl"]["N"] == str(upload_index.TOMBSTONE_TTL_S)
+    assert upload_index.read_counts({"id": {"S": "task1"}}) is None
+
+
+def test_failed_update_is_applied_on_redelivery():
+    dynamodb = FakeDynamoDB(fail_transactions=1)
+    events = [item("input/task1/a.jpg", "0A", size=100), item("input/task1/b.gif", "0B", reason=upload_index.REASON_FILE_TYPE)]
+    with pytest.raises(ClientError):
+        apply(dynamodb, events)
+    assert dynamodb.index == {}
+    assert apply(dynamodb, events) == {"index_accepted": 1, "index_rejected": 1, "index_bytes": 100}
+    # Redelivered: indexed with the same sequencer, nothing is added
+    assert apply(dynamodb, events) == {}
+    assert upload_index.read_counts(dynamodb.task) == {"accepted": 1, "rejected": 1, "bytes": 100}
+
+
+def test_out_of_order_events_keep_the_latest():
+    dynamodb = FakeDynamoDB()
+    key = "input/task1/a.jpg"
+    # The delete arrives first, then the put it followed
+    apply(dynamodb, [item(key, "0F", deleted=True)])
+    assert apply(dynamodb, [item(key, "0E", size=100)]) == {}
+    assert dynamodb.index[key]["status"]["S"] == upload_index.STATUS_DELETED
+    # Overwritten in one batch: the latest event wins, counted once
+    apply(dynamodb, [item(key, "1A", size=300), item(key, "10", size=200)])
+    assert upload_index.read_counts(dynamodb.task) == {"accepted": 1, "rejected": 0, "bytes": 300}
+
+
+def test_concurrent_event_is_read_again():
+    dynamodb = FakeDynamoDB()
+    key = "input/task1/a.jpg"
+    transact = dynamodb.transact_write_items
+
+    def concurrent(TransactItems):
+        # Another batch indexes the object between the read and the write
+        dynamodb.transact_write_items = transact
+        apply(dynamodb, [item(key, "0A", size=100)])
+        return transact(TransactItems)
+
+    dynamodb.transact_write_items = concurrent
+    assert apply(dynamodb, [item(key, "0B", size=250)]) == {"index_accepted": 0, "index_rejected": 0, "index_bytes": 150}
+    assert upload_index.read_counts(dynamodb.task) == {"accepted": 1, "rejected": 0, "bytes": 250}